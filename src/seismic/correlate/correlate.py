@@ -20,6 +20,7 @@ import warnings
 import yaml
 import glob
 import fnmatch
+import zlib
 
 from mpi4py import MPI
 import numpy as np
@@ -29,7 +30,9 @@ from tqdm import tqdm
 from seismic.correlate.stream import CorrTrace, CorrStream
 from seismic.correlate import preprocessing_td as pptd
 from seismic.correlate import preprocessing_stream as ppst
-from seismic.db.corr_hdf5 import CorrelationDataBase, h5_FMTSTR
+from seismic.db.catalog import CorrelationCatalog
+from seismic.db.corr_hdf5 import (
+    CorrelationDataBase, DBWriteSession, h5_FMTSTR)
 from seismic.trace_data.waveform import Store_Client
 from seismic.utils.fetch_func_from_str import func_from_str
 from seismic.utils import miic_utils as mu
@@ -218,6 +221,8 @@ class Correlator(object):
                 'allow_different_params']
         else:
             self._allow_different_params = False
+        # Write session, only open during pxcorr
+        self._db_session = None
 
     def _filter_by_rcombis(self):
         """
@@ -350,21 +355,39 @@ class Correlator(object):
             inv = None
         inv = self.comm.bcast(inv, root=0)
 
-        for st, write_flag in self._generate_data():
-            cst.extend(self._pxcorr_inner(st, inv))
-            if write_flag:
-                self.logger.debug('Writing Correlations to file.')
-                # Here, we can recombine the correlations for the read_len
-                # size (i.e., stack)
-                # Write correlations to HDF5
-                if cst.count():
-                    self._write(cst)
-                    cst.clear()
-
-        # write the remaining data
-        if cst.count():
-            self._write(cst)
-            cst.clear()
+        # Keep the output files open over all time windows
+        self._db_session = DBWriteSession(
+            self.options, max_open=self.options.get('max_open_files', 64),
+            batch_size=self.options.get('write_batch_size', 512),
+            _force=self._allow_different_params,
+            swmr=self.options.get('swmr', False),
+            merge_threshold=self.options.get('swmr_merge_threshold', 64))
+        try:
+            for st, write_flag in self._generate_data():
+                cst.extend(self._pxcorr_inner(st, inv))
+                if write_flag:
+                    self.logger.debug('Writing Correlations to file.')
+                    # Here, we can recombine the correlations for the
+                    # read_len size (i.e., stack)
+                    # Write correlations to HDF5
+                    if cst.count():
+                        self._write(cst)
+                        cst.clear()
+
+            # write the remaining data
+            if cst.count():
+                self._write(cst)
+                cst.clear()
+        finally:
+            self._db_session.close()
+            self._db_session = None
+
+        if self.options.get('update_catalog', False):
+            # Wait until all cores have finished writing
+            self.comm.Barrier()
+            if self.rank == 0:
+                self.logger.debug('Updating correlation catalog.')
+                CorrelationCatalog(self.corr_dir).update()
 
     def _pxcorr_inner(self, st: Stream, inv: Inventory) -> CorrStream:
         """
@@ -427,8 +450,15 @@ class Correlator(object):
         # Better if the same cores keep writing to the same files
         filelist.sort()
         # Decide which process writes to which station
-        pmap = np.arange(len(filelist))*self.psize/len(filelist)
-        pmap = pmap.astype(np.int32)
+        if self._db_session is None:
+            pmap = np.arange(len(filelist))*self.psize/len(filelist)
+            pmap = pmap.astype(np.int32)
+        else:
+            # Files stay open between calls, so the mapping has to be
+            # independent of the files in this batch
+            pmap = np.array([
+                zlib.crc32(os.path.basename(f).encode()) % self.psize
+                for f in filelist], dtype=np.int32)
         ind = pmap == self.rank
 
         for outf in np.array(filelist)[ind]:
@@ -440,6 +470,13 @@ class Correlator(object):
                 stacktag = 'stack_%s' % str(self.options['read_len'])
             else:
                 stack = None
+            if self._db_session is not None:
+                if cstselect.count():
+                    self._db_session.add_correlation(
+                        outf, cstselect, 'subdivision')
+                if stack is not None:
+                    self._db_session.add_correlation(outf, stack, stacktag)
+                continue
             with CorrelationDataBase(
                 outf, corr_options=self.options,
                     _force=self._allow_different_params) as cdb:
@@ -10,10 +10,153 @@
 Created: Monday, 5th July 2021 02:44:13 pm
 Last Modified: Monday, 30th January 2023 02:26:32 pm
 '''
+from functools import wraps
+from typing import Callable, Iterator, List
+
+import numpy as np
 from obspy.core.util import AttribDict
 from obspy import UTCDateTime
 
 
+# ufuncs whose result is a time again rather than a difference or a mask
+_time_ufuncs = (np.minimum, np.maximum, np.fmin, np.fmax)
+
+
+def _timestamps(times):
+    """
+    Convert :class:`~obspy.UTCDateTime` objects (single ones or sequences
+    of them) to POSIX timestamps, leave anything else untouched.
+    """
+    if isinstance(times, TimeArray):
+        return times.view(np.ndarray)
+    if isinstance(times, UTCDateTime):
+        return times.timestamp
+    if isinstance(times, np.ndarray) and times.ndim == 0:
+        return _timestamps(times.item())
+    if isinstance(times, (list, tuple)) or (
+            isinstance(times, np.ndarray) and times.dtype == object):
+        return np.fromiter((
+            t.timestamp if isinstance(t, UTCDateTime) else float(t)
+            for t in times), dtype=float, count=len(times))
+    return times
+
+
+def _defer_to_arrays(op: Callable) -> Callable:
+    """
+    Wrap a comparison operator of :class:`~obspy.UTCDateTime`, so that it
+    returns ``NotImplemented`` for numpy arrays. Python then calls the
+    reflected operator of the array, which compares elementwise. Otherwise,
+    ``UTCDateTime(1) <= times`` would silently return False.
+    """
+    @wraps(op)
+    def wrapper(self, other):
+        if isinstance(other, np.ndarray):
+            return NotImplemented
+        return op(self, other)
+    wrapper._defers_to_arrays = True
+    return wrapper
+
+
+for _name in ('__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__'):
+    if not getattr(getattr(UTCDateTime, _name), '_defers_to_arrays', False):
+        setattr(
+            UTCDateTime, _name, _defer_to_arrays(getattr(UTCDateTime, _name)))
+
+
+class TimeArray(np.ndarray):
+    """
+    Float64 array of POSIX timestamps that behaves like a list of
+    :class:`~obspy.UTCDateTime` objects wherever single elements are
+    accessed.
+
+    The times of a :class:`~seismic.correlate.stream.CorrBulk` or of a
+    :class:`~seismic.monitor.dv.DV` are stored in this form, so that
+    comparisons, sorting and slicing are vectorised and loading or saving
+    does not create one python object per time window.
+
+    - Indexing with an integer and iterating yield
+      :class:`~obspy.UTCDateTime` objects, ``tolist()`` returns a list of
+      them.
+    - Slicing and boolean or fancy indexing return a :class:`TimeArray`.
+    - Comparisons and arithmetic accept :class:`~obspy.UTCDateTime` objects
+      (and lists of them) and return plain arrays (of bools or seconds).
+      Comparisons are elementwise with the :class:`~obspy.UTCDateTime` on
+      either side.
+      ``min()`` and ``max()`` return :class:`~obspy.UTCDateTime` objects.
+
+    :param times: The times, as a list of :class:`~obspy.UTCDateTime`
+        objects or as timestamps.
+    :type times: List[UTCDateTime] | np.ndarray
+    """
+    def __new__(cls, times: List[UTCDateTime] | np.ndarray):
+        return np.asarray(_timestamps(times), dtype=np.float64).view(cls)
+
+    def __getitem__(self, item):
+        out = super().__getitem__(item)
+        if isinstance(out, TimeArray):
+            return out
+        return UTCDateTime(float(out))
+
+    def __iter__(self) -> Iterator[UTCDateTime]:
+        if self.ndim != 1:
+            return super().__iter__()
+        return (UTCDateTime(t) for t in self.timestamps.tolist())
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(_timestamps(x) for x in inputs)
+        if 'out' in kwargs:
+            kwargs['out'] = tuple(_timestamps(x) for x in kwargs['out'])
+        out = getattr(ufunc, method)(*inputs, **kwargs)
+        if ufunc in _time_ufuncs and method in ('__call__', 'reduce'):
+            return TimeArray(out)[()] if np.ndim(out) == 0 \
+                else TimeArray(out)
+        return out
+
+    def __repr__(self) -> str:
+        return f'TimeArray({np.array2string(self.datetime64)})'
+
+    def __str__(self) -> str:
+        return np.array2string(self.datetime64)
+
+    def argsort(self, *args, **kwargs) -> np.ndarray:
+        return self.timestamps.argsort(*args, **kwargs)
+
+    def argmin(self, *args, **kwargs) -> int:
+        return self.timestamps.argmin(*args, **kwargs)
+
+    def argmax(self, *args, **kwargs) -> int:
+        return self.timestamps.argmax(*args, **kwargs)
+
+    def searchsorted(self, v, *args, **kwargs) -> np.ndarray:
+        return self.timestamps.searchsorted(_timestamps(v), *args, **kwargs)
+
+    def astype(self, *args, **kwargs) -> np.ndarray:
+        return self.timestamps.astype(*args, **kwargs)
+
+    def tolist(self) -> List[UTCDateTime]:
+        """
+        Return the times as list of :class:`~obspy.UTCDateTime` objects.
+        """
+        return list(self)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        """
+        The times as plain float array of POSIX timestamps (a view).
+        """
+        return self.view(np.ndarray)
+
+    @property
+    def datetime64(self) -> np.ndarray:
+        """
+        The times as ``datetime64[ns]`` array, e.g., for plotting.
+        """
+        with np.errstate(invalid='ignore'):
+            ns = np.round(self.timestamps*1e9).astype(np.int64)
+        ns[~np.isfinite(self.timestamps)] = np.iinfo(np.int64).min
+        return ns.view('datetime64[ns]')
+
+
 class CorrStats(AttribDict):
     """
     From Obspy, but with the difference that some items can be lists and that
@@ -69,6 +212,8 @@ class CorrStats(AttribDict):
     ``endtime`` : :class:`~obspy.core.utcdatetime.UTCDateTime`, optional
         Date and time of the last data sample used for correlation in UTC
         (default value is "1970-01-01T00:00:00.0Z").
+        For several correlations, ``corr_start`` and ``corr_end`` are
+        stored as :class:`TimeArray` (lists are converted on assignment).
     ``corr_start``: :class:`~obspy.core.utcdatetime.UTCDateTime`, optional
         Date and time of the first data sample used for correlation in UTC
         (default value is "1970-01-01T00:00:00.0Z").
@@ -196,6 +341,10 @@ class CorrStats(AttribDict):
             elif key == 'npts':
                 if not isinstance(value, int):
                     value = int(value)
+            elif key in ('corr_start', 'corr_end') and isinstance(
+                    value, (list, tuple, np.ndarray)):
+                value = value if isinstance(value, TimeArray) \
+                    else TimeArray(value)
             # set current key
             super(CorrStats, self).__setitem__(key, value)
             # set derived value: delta
@@ -230,6 +379,26 @@ class CorrStats(AttribDict):
 
     __setattr__ = __setitem__
 
+    def __eq__(self, other):
+        """
+        Compare key by key, arrays (e.g., :class:`TimeArray`) element-wise.
+        """
+        if not isinstance(other, AttribDict):
+            return False
+        if self.__dict__.keys() != other.__dict__.keys():
+            return False
+        for k, v in self.__dict__.items():
+            w = other.__dict__[k]
+            if isinstance(v, np.ndarray) or isinstance(w, np.ndarray):
+                if not np.array_equal(v, w):
+                    return False
+            elif v != w:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __getitem__(self, key, default=None):
         """
         """
@@ -12,9 +12,15 @@ Manage objects holding correlations.
 Created: Tuesday, 20th April 2021 04:19:35 pm
 Last Modified: Wednesday, 19th June 2024 04:06:21 pm
 '''
-from typing import Iterator, List, Tuple, Optional
+from typing import Callable, Iterator, List, Tuple, Optional, Union
+from collections.abc import Mapping
 from copy import deepcopy
+import json
+import os
+import struct
+import tempfile
 import warnings
+import weakref
 from matplotlib import pyplot as plt
 import datetime
 
@@ -27,12 +33,21 @@ from obspy.core import Stats
 from seismic.utils import miic_utils as m3ut
 from seismic.plot.plot_correlation import plot_cst, plot_ctr, plot_corr_bulk
 import seismic.monitor.post_corr_process as pcp
-from seismic.monitor.stretch_mod import wfc_multi_reftr
+from seismic.monitor.stretch_mod import mwcs_estimate, wfc_multi_reftr
 from seismic.monitor.dv import DV
 from seismic.monitor.wfc import WFC
-from seismic.correlate.stats import CorrStats
+from seismic.correlate.stats import CorrStats, TimeArray
 from seismic.monitor.trim import corr_mat_trim
 
+# Memory-mapped correlation matrices are processed in blocks of rows of about
+# this size (in bytes)
+ooc_block_bytes = 2**26
+
+# Identifies the uncompressed, memory-mappable CorrBulk format (**.cb**)
+cb_magic = b'\x93SEISMIC-CB'
+# Arrays in **.cb** files start at multiples of this (the page size)
+cb_align = 4096
+
 
 class CorrBulk(object):
     """
@@ -57,6 +72,18 @@ class CorrBulk(object):
         :param statlist: Header of each CorrTrace used to create this object,
             defaults to None
         :type statlist: List[CorrStats], optional
+
+        .. note::
+
+            ``A`` may be a :class:`numpy.memmap` (see
+            :meth:`~seismic.correlate.stream.CorrBulk.to_memmap`). Then,
+            ``normalize``, ``filter``, ``smooth``, ``envelope``, ``taper``,
+            ``taper_center``, ``correct_stretch``, ``correct_shift``, and
+            ``clip`` (along axis 1) work on blocks of correlations and write
+            the results back into the file. ``copy`` creates a new
+            temporary file and ``trim`` returns a view of the file. Hence,
+            the memory required by these operations does not depend on the
+            number of correlations.
         """
         self.data = A
         if stats:
@@ -128,8 +155,8 @@ class CorrBulk(object):
             keep the original data use
             :func:`~seismic.correlate.stream.CorrelationBulk.copy()`.
         """
-        self.data = pcp.corr_mat_normalize(
-            self.data, self.stats, starttime, endtime, normtype)
+        self._map_blocks(lambda data, rows: pcp.corr_mat_normalize(
+            data, self.stats, starttime, endtime, normtype))
         proc_str = f'normalize; normtype: {normtype}'
         if starttime is not None and endtime is not None:
             proc_str += f', starttime: {starttime}, endtime: {endtime}'
@@ -153,18 +180,98 @@ class CorrBulk(object):
                 keep the original data use
                 :func:`~seismic.correlate.stream.CorrelationBulk.copy()`.
         """
-        self.data = pcp.corr_mat_clip(self.data, thres, axis)
+        if axis == 1:
+            # rows are independent
+            self._map_blocks(
+                lambda data, rows: pcp.corr_mat_clip(data, thres, axis))
+        else:
+            self.data = pcp.corr_mat_clip(self.data, thres, axis)
         proc_str = f'Clipped; threshold: {thres}*std, axis={axis}'
         self.stats.processing_bulk += [proc_str]
         return self
 
     def copy(self):
         """
-        Returns a copy of self
+        Returns a copy of self. If the data are memory-mapped, the copy is
+        written into a new temporary file in the same directory.
 
         :return: A copy of self
         """
-        return deepcopy(self)
+        if not self.out_of_core:
+            return deepcopy(self)
+        data = self.data
+        self.data = None
+        try:
+            cb = deepcopy(self)
+        finally:
+            self.data = data
+        cb.data = _to_memmap(data, tmp_dir=os.path.dirname(data.filename))
+        return cb
+
+    @property
+    def out_of_core(self) -> bool:
+        """
+        True if the correlation matrix is memory-mapped.
+        """
+        return isinstance(self.data, np.memmap)
+
+    def to_memmap(
+        self, path: Optional[str] = None,
+            tmp_dir: Optional[str] = None):
+        """
+        Moves the correlation matrix into a memory-mapped **.npy** file.
+        Afterwards, most processing methods work on blocks of correlations
+        and only keep one block in memory at a time.
+
+        :param path: File to write the matrix to. The file can be opened
+            again with ``np.load(path, mmap_mode='r+')``. If None, a temporary
+            file is used that is deleted when the data are no longer needed.
+            Defaults to None.
+        :type path: str, optional
+        :param tmp_dir: Directory for the temporary file, defaults to None
+            (i.e., the default temporary directory).
+        :type tmp_dir: str, optional
+        :return: self
+
+        .. note::
+
+            Copies of memory-mapped CorrBulk objects are saved into
+            temporary files in the same directory.
+        """
+        self.data = _to_memmap(self.data, path, tmp_dir)
+        return self
+
+    def _map_blocks(
+        self, func: Callable[[np.ndarray, slice], np.ndarray],
+            threads: int = 1):
+        """
+        Applies ``func(data, rows)`` to the correlation matrix and stores the
+        result in place. Memory-mapped matrices are processed in blocks of
+        rows, and so are matrices in memory if ``threads`` > 1 (the blocks
+        are then processed in a thread pool). Hence, ``func`` must treat each
+        row independently and may only use ``rows`` to index per-row
+        parameters.
+        """
+        rowbytes = self.data.shape[1]*self.data.itemsize
+        if self.out_of_core:
+            chunks = pcp._row_chunks(
+                self.data.shape[0], rowbytes, ooc_block_bytes)
+            out = self.data
+        elif threads > 1 and self.data.shape[0] > 1:
+            chunks = pcp._row_chunks(self.data.shape[0], rowbytes)
+            first = func(self.data[chunks[0]], chunks[0])
+            out = np.empty(
+                (self.data.shape[0],) + first.shape[1:], first.dtype)
+            out[chunks[0]] = first
+            chunks = chunks[1:]
+        else:
+            self.data = func(self.data, slice(None))
+            return
+
+        def block(rows: slice):
+            out[rows] = func(self.data[rows], rows)
+        pcp._map_chunks(block, chunks, threads)
+        self.data = out
 
     def correct_decay(self):
         """
@@ -185,7 +292,7 @@ class CorrBulk(object):
         self.stats.processing_bulk += ['Corrected for Amplitude Decay']
         return self
 
-    def correct_stretch(self, dv: DV):
+    def correct_stretch(self, dv: DV, threads: int = 1):
         """
         Correct stretching of correlation matrix
 
@@ -196,6 +303,9 @@ class CorrBulk(object):
 
         :param dv: Velocity Change object
         :type dv: DV
+        :param threads: Number of threads to correct blocks of correlations
+            with. Defaults to 1.
+        :type threads: int
 
         ..note:: This action is performed **in-place**. If you would like to
             keep the original data use
@@ -203,12 +313,13 @@ class CorrBulk(object):
         """
         if dv.value_type != 'stretch':
             raise ValueError('DV object does not hold any stretch values.')
-        self.data, self.stats = pcp.apply_stretch(
-            self.data, self.stats, -1.*dv.value)
+        stretches = -1.*np.asarray(dv.value)
+        self._map_blocks(lambda data, rows: pcp.apply_stretch(
+            data, self.stats, _per_row(stretches, rows))[0], threads)
         self.stats.processing_bulk += ['Applied time stretch']
         return self
 
-    def correct_shift(self, dt: DV):
+    def correct_shift(self, dt: DV, threads: int = 1):
         """
         Correct a shift of the traces.
 
@@ -218,10 +329,17 @@ class CorrBulk(object):
         the resulting time shift is passed to this function the shift is
         corrected for, such that if the measurement is done again no shift will
         be detected.
+
+        :param dt: Time shift object
+        :type dt: DV
+        :param threads: Number of threads to correct blocks of correlations
+            with. Defaults to 1.
+        :type threads: int
         """
-        self.data = pcp.apply_shift(
-            data=self.data, stats=self.stats,
-            shifts=-1.*dt.value)
+        shifts = -1.*np.asarray(dt.value)
+        self._map_blocks(lambda data, rows: pcp.apply_shift(
+            data=data, stats=self.stats, shifts=_per_row(shifts, rows)),
+            threads)
         self.stats.processing_bulk += ['Corrected for time shift']
         return self
 
@@ -244,7 +362,7 @@ class CorrBulk(object):
             for ii, li in enumerate(self.data):
                 stats = deepcopy(self.stats)
                 for k in mutables:
-                    if not isinstance(stats[k], list):
+                    if not isinstance(stats[k], (list, np.ndarray)):
                         continue
                     stats[k] = self.stats[k][ii]
                 ctr = CorrTrace(li, _header=stats)
@@ -253,20 +371,23 @@ class CorrBulk(object):
             for ii in ind:
                 stats = deepcopy(self.stats)
                 for k in mutables:
-                    if not isinstance(stats[k], list):
+                    if not isinstance(stats[k], (list, np.ndarray)):
                         continue
                     stats[k] = self.stats[k][ii]
                 ctr = CorrTrace(self.data[ii], _header=stats)
                 cst.append(ctr)
         return cst
 
-    def envelope(self):
+    def envelope(self, threads: int = 1):
         """
         Calculate the envelope of a correlation matrix.
 
         The correlation data of the correlation matrix are replaced by their
         Hilbert envelopes.
 
+        :param threads: Number of threads to compute the envelopes of blocks
+            of correlations with. Defaults to 1.
+        :type threads: int
 
         :return: self with the envelope in data
 
@@ -274,11 +395,14 @@ class CorrBulk(object):
             keep the original data use
             :func:`~seismic.correlate.stream.CorrelationBulk.copy()`.
         """
-        self.data = pcp.corr_mat_envelope(self.data)
+        self._map_blocks(
+            lambda data, rows: pcp.corr_mat_envelope(data), threads)
         self.stats.processing_bulk += ['Computed Envelope']
         return self
 
-    def filter(self, freqs: Tuple[float, float], order: int = 3):
+    def filter(
+            self, freqs: Tuple[float, float], order: int = 3,
+            threads: int = 1):
         """
         Filters the correlation matrix in the frequency band specified in
         freqs using a zero phase filter of twice the order given in order.
@@ -287,6 +411,8 @@ class CorrBulk(object):
         :param freqs: lower and upper limits of the pass band in Hertz
         :type order: int
         :param order: half the order of the Butterworth filter
+        :type threads: int
+        :param threads: Number of threads to filter with. Defaults to 1.
 
         :return: self
 
@@ -294,7 +420,8 @@ class CorrBulk(object):
             keep the original data use
             :func:`~seismic.correlate.stream.CorrelationBulk.copy()`.
         """
-        self.data = pcp.corr_mat_filter(self.data, self.stats, freqs, order)
+        self._map_blocks(lambda data, rows: pcp.corr_mat_filter(
+            data, self.stats, freqs, order, threads=threads))
         proc = [f'filter; freqs: {freqs}, order: {order}']
         self.stats.processing_bulk += proc
         return self
@@ -370,30 +497,50 @@ class CorrBulk(object):
 
         ..note:: the extracted traces will also be saved in self.ref_trc
         """
-        ref_trcs = []
         if isinstance(win_inc, list):
             win_inc = np.array(win_inc)
         elif win_inc == 0:
             return self.extract_trace(method, percentile)
 
         inc_s = win_inc*24*3600
-        start = min(self.stats.corr_start)
+        corr_start = np.atleast_1d(TimeArray(self.stats.corr_start).timestamps)
+        corr_end = np.atleast_1d(TimeArray(self.stats.corr_end).timestamps)
+        # window borders (as timestamps)
+        windows = []
+        start = corr_start.min()
         if isinstance(inc_s, np.ndarray):
             for inc in inc_s:
                 end = start + inc
-                ii = self._find_slice_index(start-inc/2, end+inc/2, True)
+                windows.append((start-inc/2, end+inc/2))
                 start = start + inc
-                ref_trcs.append(pcp.corr_mat_extract_trace(
-                    self.data[ii, :], self.stats, method, percentile))
         else:
-            while start < max(self.stats.corr_end):
+            while start < corr_end.max():
                 end = start + inc_s
-                ii = self._find_slice_index(start-inc_s/2, end+inc_s/2, True)
+                windows.append((start-inc_s/2, end+inc_s/2))
                 start = end
+        windows = np.array(windows).reshape(-1, 2)
+        if method in pcp.extract_methods and np.all(
+                np.diff(corr_start) >= 0) and np.all(np.diff(corr_end) >= 0):
+            # Sorted in time, so each window is a range of rows
+            i0 = np.searchsorted(corr_end, windows[:, 0], 'left')
+            i1 = np.maximum(
+                np.searchsorted(corr_start, windows[:, 1], 'right'), i0)
+            if np.any(i0 == i1):
+                warnings.warn(
+                    'No slices found in the requested time. Returning empty '
+                    'arr.')
+            ref_trcs = pcp.corr_mat_extract_windows(
+                self.data, self.stats, np.column_stack((i0, i1)), method,
+                percentile)
+        else:
+            ref_trcs = []
+            for ws, we in windows:
+                ii = self._find_slice_index(
+                    UTCDateTime(ws), UTCDateTime(we), True)
                 # stats don't need to be altered for this function
                 ref_trcs.append(pcp.corr_mat_extract_trace(
                     self.data[ii, :], self.stats, method, percentile))
-        ref_trcs = np.array(ref_trcs)
+            ref_trcs = np.array(ref_trcs)
         self.ref_trc = ref_trcs
         return ref_trcs
 
@@ -440,7 +587,8 @@ class CorrBulk(object):
         self, ref_trc: Optional[np.ndarray] = None,
         tw: Optional[List[Tuple[float, float]]] = None,
         shift_range: float = 10, shift_steps: int = 101, sides: str = 'both',
-            return_sim_mat: bool = False) -> DV:
+        return_sim_mat: bool = False,
+            method: str = 'shifted_ref') -> DV:
         """
         Time shift estimate through shifting and comparison.
 
@@ -477,15 +625,105 @@ class CorrBulk(object):
             [-end:-start] and [start:end] being used simultaneousy
         :param return_sim_mat: Return simmilarity matrix?, defaults to False
         :type return_sim_mat: bool, optional
+        :param method: ``'shifted_ref'`` compares with ``shift_steps``
+            shifted copies of the reference. ``'fft'`` cross-correlates with
+            the reference in the frequency domain and refines the shift to
+            below the sampling interval, which is much faster for fine shift
+            grids. Defaults to ``'shifted_ref'``.
+        :type method: str, optional
         :return: A DV object holding a shift value.
         :rtype: DV
         """
         dt = pcp.measure_shift(
             self.data, self.stats, ref_trc=ref_trc,
             tw=tw, shift_range=shift_range, shift_steps=shift_steps,
-            sides=sides, return_sim_mat=return_sim_mat)
+            sides=sides, return_sim_mat=return_sim_mat, method=method)
         return dt
 
+    def mwcs(
+        self, freq_min: float, freq_max: float, win_len: float,
+        step: float, ref_trc: Optional[np.ndarray] = None,
+        tw: Optional[Tuple[float, float]] = None, sides: str = 'both',
+        smooth_half_win: int = 5, min_coh: float = 0.65,
+        max_err: float = 0.1, max_dt: float = 0.1,
+        processing: Optional[dict] = None, return_windows: bool = False,
+            threads: int = 1) -> Union[DV, Tuple[DV, dict]]:
+        """
+        Compute the velocity change with the Moving-Window Cross-Spectral
+        method (**MWCS**, see Clarke et al., 2011).
+
+        The time delays between the correlations and the reference are
+        measured in overlapping moving windows from the phase of the
+        cross-spectra. dt/t is the slope of a weighted linear regression of
+        these delays against lag time. No grid of stretched references is
+        tested, which makes this method much cheaper than
+        :meth:`~seismic.correlate.stream.CorrBulk.stretch` for fine
+        resolutions. See :func:`~seismic.monitor.stretch_mod.mwcs_estimate`
+        for details.
+
+        :param freq_min: Lower corner of the frequency band in Hz. Should
+            correspond to the band the CorrBulk was filtered in.
+        :type freq_min: float
+        :param freq_max: Upper corner of the frequency band in Hz
+        :type freq_max: float
+        :param win_len: Length of the moving windows in s
+        :type win_len: float
+        :param step: Step between two moving windows in s
+        :type step: float
+        :param ref_trc: Reference trace, defaults to None. Will extract a
+            single trace if = None.
+        :type ref_trc: np.ndarray, optional
+        :param tw: Start and end of the lapse time window in s (absolute lag
+            time), defaults to None (all lag times)
+        :type tw: Tuple[float, float], optional
+        :param sides: Which sides to use. Can be 'left', 'right' (or
+            'single'), or 'both'. Defaults to 'both'
+        :type sides: str, optional
+        :param smooth_half_win: Half width of the moving average applied to
+            the spectra in frequency bins, defaults to 5
+        :type smooth_half_win: int, optional
+        :param min_coh: Minimum mean coherence of a window to be used for
+            the dt/t regression, defaults to 0.65
+        :type min_coh: float, optional
+        :param max_err: Maximum error of the delay of a window in s,
+            defaults to 0.1
+        :type max_err: float, optional
+        :param max_dt: Maximum absolute delay of a window in s,
+            defaults to 0.1
+        :type max_dt: float, optional
+        :param processing: dictionary holding processing information.
+        :type processing: dict, optional
+        :param return_windows: Also return a dictionary with the delays
+            (``'dt'``), their errors (``'dt_err'``), and the coherences
+            (``'coh'``) of each correlation and moving window as well as the
+            error of dt/t (``'value_err'``). Defaults to False.
+        :type return_windows: bool, optional
+        :param threads: Number of threads. Each one processes a block of
+            correlations. Defaults to 1.
+        :type threads: int, optional
+        :return: The velocity change as :class:`~seismic.monitor.dv.DV`
+            object. Its ``corr`` holds the mean coherence and its
+            ``second_axis`` the lag times of the window centres.
+        :rtype: DV | Tuple[DV, dict]
+        """
+        if ref_trc is None:
+            ref_trc = self.ref_trc
+        if ref_trc is None:
+            ref_trc = self.extract_trace()
+        dv_dict = mwcs_estimate(
+            self.data, ref_trc, self.stats.delta, self.stats.start_lag,
+            freq_min, freq_max, win_len, step, tw=tw, sides=sides,
+            smooth_half_win=smooth_half_win, min_coh=min_coh,
+            max_err=max_err, max_dt=max_dt, threads=threads)
+        windows = {
+            k: dv_dict[k] for k in ['dt', 'dt_err', 'coh', 'value_err']}
+        dv = DV(
+            **{k: v for k, v in dv_dict.items() if k not in windows},
+            stats=deepcopy(self.stats), dv_processing=processing)
+        if return_windows:
+            return dv, windows
+        return dv
+
     def mirror(self):
         """
         Average the causal and acausal (i.e., right and left) parts of the
@@ -513,12 +751,15 @@ class CorrBulk(object):
         averaging is done if more than one correlation function falls in a bin
         between start_times[i] and end_times[i]. If end_time is an empty list
         (default) end_times[i] is set to
-        start_times[i] + (start_times[1] - start_times[0])
+        start_times[i] + (start_times[1] - start_times[0]). The bins may
+        overlap.
 
         :type start_times: list of class:`~obspy.core.UTCDateTime` objects
+            or np.ndarray of timestamps
         :param start_times: list of starting times for the bins of the new
             sampling
         :type end_times: list of class:`~obspy.core.UTCDateTime` objects
+            or np.ndarray of timestamps
         :param end_times: list of end times for the bins of the new
             sampling
 
@@ -554,7 +795,7 @@ class CorrBulk(object):
 
     def smooth(
         self, wsize: int, wtype: str = 'flat',
-            axis: int = 1) -> np.ndarray:
+            axis: int = 1, threads: int = 1) -> np.ndarray:
         """
         Smoothes the correlation matrix with a given window function of the
         given width along the given axis. This method is based on the
@@ -573,6 +814,8 @@ class CorrBulk(object):
         :type axis: int
         :param axis: Axis along with apply the filter. O: smooth along
             correlation lag time axis 1: smooth along time axis
+        :type threads: int
+        :param threads: Number of threads to smooth with. Defaults to 1.
         :rtype: :class:`~numpy.ndarray`
         :return: Filtered matrix
 
@@ -580,7 +823,14 @@ class CorrBulk(object):
             the original data use
             :func:`~seismic.correlate.stream.CorrelationBulk.copy()`
         """
-        self.data = pcp.corr_mat_smooth(self.data, wsize, wtype, axis)
+        if self.out_of_core and axis == 1:
+            _smooth_time_blocks(self.data, wsize, wtype, threads)
+        elif self.out_of_core and axis == 0:
+            self._map_blocks(lambda data, rows: pcp.corr_mat_smooth(
+                data, wsize, wtype, axis, threads=threads))
+        else:
+            self.data = pcp.corr_mat_smooth(
+                self.data, wsize, wtype, axis, threads=threads)
         self.stats.processing_bulk += [
             f'Smoothed. wsize: {wsize}, wtype: {wtype}, axis: {axis}']
         return self
@@ -590,7 +840,9 @@ class CorrBulk(object):
         stretch_range: float = 0.1, stretch_steps: int = 101,
         sides: str = 'both', return_sim_mat: bool = False,
         ref_tr_trim: Optional[Tuple[float, float]] = None,
-            ref_tr_stats=None, processing: Optional[dict] = None) -> DV:
+        ref_tr_stats=None, processing: Optional[dict] = None,
+        search: str = 'grid', coarse_steps: Optional[int] = None,
+            threads: int = 1) -> DV:
         """
         Compute the velocity change with the stretching method
         (see Sens-Schönfelder and Wegler, 2006).
@@ -612,6 +864,19 @@ class CorrBulk(object):
         :type return_sim_mat: bool, optional
         :param processing: dictionary holding processing information.
         :type processing: dict
+        :param search: Search strategy. ``'grid'`` tests all stretch steps,
+            ``'refine'`` runs a coarse search followed by a local search
+            around the maximum and a parabolic sub-grid refinement.
+            ``'fft'`` computes all stretches at once in logarithmic lag
+            time. Defaults to 'grid'.
+        :type search: str, optional
+        :param coarse_steps: Number of stretch values in the coarse search
+            if ``search='refine'``. Defaults to None
+            (``ceil(sqrt(2*stretch_steps))``).
+        :type coarse_steps: int, optional
+        :param threads: Number of threads. Each one estimates the stretch of
+            a block of correlations. Defaults to 1.
+        :type threads: int, optional
         :return: The velocity change as :class:`~seismic.monitor.dv.DV` object.
         :rtype: DV
         """
@@ -619,21 +884,38 @@ class CorrBulk(object):
             ref_trc = self.ref_trc
         dv_dict = pcp.corr_mat_stretch(
             self.data, self.stats, ref_trc, tw, stretch_range, stretch_steps,
-            sides, return_sim_mat, ref_tr_trim, ref_tr_stats)
+            sides, return_sim_mat, ref_tr_trim, ref_tr_stats, search=search,
+            coarse_steps=coarse_steps, threads=threads)
         if not return_sim_mat:
             dv_dict['sim_mat'] = np.array([])
         return DV(**dv_dict, dv_processing=processing)
 
-    def save(self, path: str):
+    def save(self, path: str, format: str = 'npz'):
         """
-        Save the object to a numpy binary format (**.npz**)
+        Save the object to a numpy binary format (**.npz**) or to an
+        uncompressed binary file (**.cb**) that
+        :func:`~seismic.correlate.stream.read_corr_bulk` can memory-map.
 
         :param path: Output path
         :type path: str
-        """
-        kwargs = m3ut.save_header_to_np_array(self.stats)
-        np.savez_compressed(
-            path, data=self.data, **kwargs)
+        :param format: ``'npz'`` for a compressed numpy archive or ``'cb'``
+            for the uncompressed format. The latter consists of a small JSON
+            header followed by the time arrays and the correlation matrix.
+            Loading it is much faster and it does not need to be read
+            completely. Defaults to 'npz'.
+        :type format: str, optional
+        """
+        if format == 'npz':
+            kwargs = m3ut.save_header_to_np_array(self.stats)
+            np.savez_compressed(
+                path, data=self.data, **kwargs)
+        elif format == 'cb':
+            if not path.endswith('.cb'):
+                path += '.cb'
+            _save_cb(path, self.data, self.stats)
+        else:
+            raise ValueError(
+                f'Unknown format {format}. Use either "npz" or "cb".')
 
     def select_corr_time(
         self, starttime: UTCDateTime, endtime: UTCDateTime,
@@ -691,7 +973,8 @@ class CorrBulk(object):
             the original data use
             :func:`~seismic.correlate.stream.CorrelationBulk.copy()`
         """
-        self.data = pcp.corr_mat_taper(self.data, self.stats, width)
+        self._map_blocks(lambda data, rows: pcp.corr_mat_taper(
+            data, self.stats, width))
         proc = [f'tapered: width={width}s']
         self.stats.processing_bulk += proc
         return self
@@ -719,8 +1002,8 @@ class CorrBulk(object):
             the original data use
             :func:`~seismic.correlate.stream.CorrelationBulk.copy()`
         """
-        self.data = pcp.corr_mat_taper_center(
-            self.data, self.stats, width, slope_frac=slope_frac)
+        self._map_blocks(lambda data, rows: pcp.corr_mat_taper_center(
+            data, self.stats, width, slope_frac=slope_frac))
         proc = [f'tapered-centre: width={width}s, slope_frac={slope_frac}']
         self.stats.processing_bulk += proc
         return self
@@ -752,7 +1035,7 @@ class CorrBulk(object):
     def wfc(
         self, ref_trc: np.ndarray, time_window: np.ndarray, sides: str,
         tw_start: float, tw_len: float, freq_min: float, freq_max: float,
-            remove_nans: bool = True) -> WFC:
+            remove_nans: bool = True, threads: int = 1) -> WFC:
         """
         Computes the waveform coherency (**WFC**) between the given reference
         correlation(s) and correlation matrix.
@@ -778,12 +1061,16 @@ class CorrBulk(object):
         :param freq_max: Lowpass frequency used for the computed values. (Hz)
         :type freq_max: float
         :param remove_nans: Remove nans from CorrMatrix, defaults to True
+        :param threads: Number of threads. Each one computes the WFC of a
+            block of correlations. Defaults to 1.
+        :type threads: int, optional
         :return: A dictionary with one correlation array for each reference
             trace. The keys are using the syntax `reftr_%n`.
         :rtype: dict
         """
         wfc_dict = wfc_multi_reftr(
-            self.data, ref_trc, time_window, sides, remove_nans)
+            self.data, ref_trc, time_window, sides, remove_nans,
+            threads=threads)
         wfc_processing = {
             'tw_start': tw_start,
             'tw_len': tw_len,
@@ -810,14 +1097,12 @@ class CorrBulk(object):
         """
         if endtime <= starttime:
             raise ValueError('End has to be after start!')
+        corr_start = TimeArray(self.stats.corr_start)
+        corr_end = TimeArray(self.stats.corr_end)
         if include_partial:
-            ii = np.logical_and(
-                np.array(self.stats.corr_end) >= starttime,
-                np.array(self.stats.corr_start) <= endtime)
+            ii = np.logical_and(corr_end >= starttime, corr_start <= endtime)
         else:
-            ii = np.logical_and(
-                np.array(self.stats.corr_start) >= starttime,
-                np.array(self.stats.corr_end) <= endtime)
+            ii = np.logical_and(corr_start >= starttime, corr_end <= endtime)
         ii = np.squeeze(ii)
         if not len(np.nonzero(ii)[0]):
             warnings.warn(
@@ -825,18 +1110,177 @@ class CorrBulk(object):
         return ii
 
 
-def read_corr_bulk(path: str) -> CorrBulk:
+def _per_row(values: np.ndarray, rows: slice) -> np.ndarray:
+    """
+    Selects the values of ``rows`` if there is one value per row.
+    """
+    return values[rows] if values.ndim else values
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _to_memmap(
+    data: np.ndarray, path: Optional[str] = None,
+        tmp_dir: Optional[str] = None) -> np.memmap:
+    """
+    Copies ``data`` block-wise into a memory-mapped **.npy** file. If
+    ``path`` is None, a temporary file in ``tmp_dir`` is used.
+    """
+    temporary = path is None
+    if temporary:
+        fd, path = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+        os.close(fd)
+    mm = np.lib.format.open_memmap(
+        path, mode='w+', dtype=data.dtype, shape=data.shape)
+    for rows in pcp._row_chunks(
+            data.shape[0], data[:1].nbytes, ooc_block_bytes):
+        mm[rows] = data[rows]
+    if temporary:
+        try:
+            # The mapping stays valid on POSIX systems
+            os.remove(path)
+        except OSError:
+            weakref.finalize(mm, _remove_file, path)
+    return mm
+
+
+def _smooth_time_blocks(
+        data: np.memmap, wsize: int, wtype: str, threads: int):
+    """
+    Smoothes a memory-mapped correlation matrix along the time axis in
+    blocks of rows. Each block is smoothed together with ``wsize`` of the
+    original rows on each side, so that the result equals the one of
+    :func:`~seismic.monitor.post_corr_process.corr_mat_smooth`.
     """
-    Reads a CorrBulk object from an **.npz** file.
+    n = data.shape[0]
+    if n < wsize:
+        raise ValueError("Input vector needs to be bigger than window size.")
+    # original rows before the current block
+    prev = np.array(data[:0])
+    for rows in pcp._row_chunks(n, data[:1].nbytes, ooc_block_bytes):
+        i0, i1 = rows.start, min(rows.stop, n)
+        cur = np.array(data[i0:i1])
+        x = np.concatenate((prev, cur, data[i1:i1 + wsize]))
+        x = pcp.corr_mat_smooth(x, wsize, wtype, 1, threads=threads)
+        data[i0:i1] = x[len(prev):len(prev) + i1 - i0]
+        prev = np.concatenate((prev, cur))[-wsize:]
+
+
+def read_corr_bulk(path: str, mmap_mode: Optional[str] = None) -> CorrBulk:
+    """
+    Reads a CorrBulk object from an **.npz** or a **.cb** file
+    (see :meth:`~seismic.correlate.stream.CorrBulk.save`).
 
-    :param path: Path to file
+    :param path: Path to file, files ending on **.cb** are read as such
     :type path: str
+    :param mmap_mode: Only for **.cb** files. If not None, the correlation
+        matrix is memory-mapped instead of read, so that only the pages that
+        are accessed (e.g., by
+        :meth:`~seismic.correlate.stream.CorrBulk.slice`) are read from disk.
+        Same options as for :class:`numpy.memmap`. With ``'c'``
+        (copy-on-write) processing does not alter the file, with ``'r+'`` the
+        processing results are written back into the file.
+        Defaults to None.
+    :type mmap_mode: str, optional
     :return: the corresponding and converted CorrBulk object
     :rtype: CorrBulk
     """
-    loaded = np.load(path)
-    stats = m3ut.load_header_from_np_array(loaded)
-    return CorrBulk(loaded['data'], stats=stats)
+    if path.endswith('.cb'):
+        data, stats = _read_cb(path, mmap_mode)
+    else:
+        loaded = np.load(path)
+        data = loaded['data']
+        stats = m3ut.load_header_from_np_array(loaded)
+    return CorrBulk(data, stats=CorrStats(stats))
+
+
+def _cb_aligned(n: int) -> int:
+    return -(-n // cb_align)*cb_align
+
+
+def _cb_json(value):
+    """
+    Converts header values that json cannot serialise.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
+
+
+def _save_cb(path: str, data: np.ndarray, stats: CorrStats):
+    """
+    Writes a CorrBulk to the **.cb** format: magic bytes, the length of
+    the JSON header (uint64), the header, and the arrays (times and
+    correlation matrix), each starting at a multiple of ``cb_align``.
+    """
+    arrays = {}
+    header = {}
+    for k, v in stats.items():
+        if k in m3ut.t_keys:
+            arrays[k] = m3ut.convert_utc_to_timestamp(v)
+        else:
+            header[k] = v
+    arrays['data'] = data
+    layout = {}
+    offset = 0
+    for k, a in arrays.items():
+        layout[k] = {'dtype': a.dtype.str, 'shape': a.shape, 'offset': offset}
+        offset = _cb_aligned(offset + a.nbytes)
+    head = json.dumps(
+        {'version': 1, 'stats': header, 'arrays': layout},
+        default=_cb_json).encode()
+    with open(path, 'wb') as f:
+        f.write(cb_magic)
+        f.write(struct.pack('<Q', len(head)))
+        f.write(head)
+        base = _cb_aligned(f.tell())
+        for k, a in arrays.items():
+            f.seek(base + layout[k]['offset'])
+            # blocks, so that memory-mapped matrices are not read at once
+            for rows in pcp._row_chunks(
+                    len(a), a[:1].nbytes, ooc_block_bytes):
+                f.write(np.ascontiguousarray(a[rows]).tobytes())
+        f.truncate(base + offset)
+
+
+def _read_cb(
+        path: str, mmap_mode: Optional[str] = None) -> Tuple[np.ndarray, dict]:
+    """
+    Reads the correlation matrix and the header from a **.cb** file.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(cb_magic)) != cb_magic:
+            raise ValueError(f'{path} is not a CorrBulk file.')
+        n, = struct.unpack('<Q', f.read(8))
+        head = json.loads(f.read(n))
+        base = _cb_aligned(f.tell())
+    stats = head['stats']
+    data = None
+    for k, a in head['arrays'].items():
+        shape = tuple(a['shape'])
+        offset = base + a['offset']
+        if k == 'data' and mmap_mode is not None and np.prod(shape):
+            data = np.memmap(
+                path, dtype=a['dtype'], mode=mmap_mode, offset=offset,
+                shape=shape)
+            continue
+        arr = np.fromfile(
+            path, dtype=a['dtype'], count=int(np.prod(shape)),
+            offset=offset).reshape(shape)
+        if k == 'data':
+            data = arr
+        else:
+            stats[k] = m3ut.convert_timestamp_to_utcdt(arr)
+    return data, stats
 
 
 class CorrStream(Stream):
@@ -1704,11 +2148,10 @@ def convert_statlist_to_bulk_stats(
         mutables += ['channel']
     else:
         immutables += ['channel']
-    for key in mutables:
-        stats[key] = []
+    values = {key: [] for key in mutables}
     for trstat in statlist:
         for key in mutables:
-            stats[key] += [trstat[key]]
+            values[key].append(trstat[key])
         for key in immutables:
             try:
                 if stats[key] != trstat[key]:
@@ -1719,5 +2162,7 @@ def convert_statlist_to_bulk_stats(
                         + f'For station {stats["network"]}.{stats["station"]}')
             except KeyError:
                 warnings.warn(f'No information about {key} in header.')
+    for key in mutables:
+        stats[key] = values[key]
     stats['ntrcs'] = len(statlist)
     return stats
@@ -0,0 +1,464 @@
+'''
+Network-wide index of the correlations in a correlation directory. The index
+allows queries across many station pairs without opening each correlation
+file.
+
+:copyright:
+    The SeisMIC development team (makus@gfz-potsdam.de).
+:license:
+    EUROPEAN UNION PUBLIC LICENCE v. 1.2
+   (https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12)
+:author:
+   Peter Makus (makus@gfz-potsdam.de)
+
+Created: Monday, 19th October 2026 10:12:04 am
+Last Modified: Monday, 19th October 2026 10:12:04 am
+'''
+import fnmatch
+import os
+from glob import glob
+from typing import List, Tuple
+
+import numpy as np
+from obspy import UTCDateTime
+import h5py
+
+from seismic.correlate.stream import CorrStream, CorrTrace
+from seismic.db.corr_hdf5 import (
+    CorrelationDataBase, h5_FMTSTR, list_segments, read_hdf5_data,
+    read_hdf5_header)
+
+
+# Name of the catalog file inside of the correlation directory
+catalog_file = 'catalog.h5'
+
+# Columns of the catalog tables
+index_cols = [
+    'file', 'path', 'tag', 'network', 'station', 'location', 'channel',
+    'corr_start', 'corr_end', 'npts']
+pair_cols = [
+    'file', 'network', 'station', 'location', 'channel', 'stla', 'stlo',
+    'stel', 'evla', 'evlo', 'evel', 'dist', 'az', 'baz']
+file_cols = ['file', 'mtime', 'size', 'segments']
+str_cols = ['file', 'path', 'tag', 'network', 'station', 'location', 'channel']
+coord_keys = [
+    'stla', 'stlo', 'stel', 'evla', 'evlo', 'evel', 'dist', 'az', 'baz']
+
+
+class CorrelationCatalog(object):
+    """
+    Index over all correlation files in one directory. The catalog is saved
+    as a single hdf5 file (``catalog.h5`` in the correlation directory) and
+    holds three tables:
+
+        - ``index``: One row per correlation with the file, the path inside
+          of the file, the tag, the combination codes, the correlation start
+          and end (as timestamps), and the number of samples.
+        - ``pairs``: One row per channel combination with the coordinates of
+          both stations, their distance (in km), azimuth and backazimuth.
+        - ``files``: Latest modification time, total size, and number of
+          committed segments of each indexed file and its segments (see
+          :class:`~seismic.db.corr_hdf5.CorrelationDataBase`). Used to
+          decide which files need to be indexed again on
+          :meth:`~seismic.db.catalog.CorrelationCatalog.update`.
+
+    The whole catalog is held in memory. All queries are vectorised.
+
+    Example::
+
+        >>> cat = CorrelationCatalog('/path/to/corr')
+        >>> cat.update()  # Index new or changed files
+        >>> # all autocorrelations of 2020
+        >>> rows = cat.query(
+        >>>     corr_type='auto', starttime=UTCDateTime(2020, 1, 1),
+        >>>     endtime=UTCDateTime(2021, 1, 1))
+        >>> # Load all correlations recorded on a given day
+        >>> cst = cat.get_data(
+        >>>     starttime=UTCDateTime(2020, 5, 1),
+        >>>     endtime=UTCDateTime(2020, 5, 2))
+    """
+    def __init__(self, corr_dir: str, path: str = None):
+        """
+        Loads the catalog of ``corr_dir``. If no catalog exists yet, an empty
+        catalog is created. Call
+        :meth:`~seismic.db.catalog.CorrelationCatalog.update` to index the
+        files.
+
+        :param corr_dir: Directory that holds the correlation files.
+        :type corr_dir: str
+        :param path: Path to the catalog file. Defaults to ``catalog.h5`` in
+            ``corr_dir``.
+        :type path: str, optional
+        """
+        self.corr_dir = corr_dir
+        self.path = path or os.path.join(corr_dir, catalog_file)
+        self.index = _empty_table(index_cols)
+        self.pairs = _empty_table(pair_cols)
+        self.files = _empty_table(file_cols)
+        if os.path.isfile(self.path):
+            self._read()
+
+    def __len__(self) -> int:
+        return len(self.index['file'])
+
+    def _read(self):
+        with h5py.File(self.path, 'r') as f:
+            for name in ['index', 'pairs', 'files']:
+                table = getattr(self, name)
+                for k in table:
+                    if k in f[name]:
+                        table[k] = np.array(f[name][k])
+                    else:
+                        # Catalog written by an older version, the files
+                        # are indexed again
+                        table[k] = np.full(
+                            len(f[name]['file']), -1, dtype=table[k].dtype)
+
+    def _write(self):
+        # Write to a temporary file first, so readers never see a partially
+        # written catalog
+        tmp = self.path + '.tmp'
+        with h5py.File(tmp, 'w') as f:
+            for name in ['index', 'pairs', 'files']:
+                g = f.create_group(name)
+                for k, v in getattr(self, name).items():
+                    g.create_dataset(k, data=v)
+        os.replace(tmp, self.path)
+
+    def update(self, files: List[str] = None) -> int:
+        """
+        Adds new and changed correlation files to the catalog and removes
+        files that do not exist anymore. Unchanged files are not opened.
+        Correlations in committed segments are indexed as well, a new
+        segment marks the file as changed.
+
+        :param files: Only check these files (have to be located in the
+            correlation directory). Defaults to all correlation files in the
+            correlation directory.
+        :type files: List[str], optional
+        :return: The number of files that were (re-)indexed.
+        :rtype: int
+        """
+        ndropped = 0
+        if files is None:
+            files = glob(h5_FMTSTR.format(
+                dir=self.corr_dir, network='*', station='*', location='*',
+                channel='*'))
+            # remove deleted files
+            names = [os.path.basename(f) for f in files]
+            gone = ~np.isin(self.files['file'], np.array(names, dtype='S'))
+            ndropped = np.count_nonzero(gone)
+            self._drop(self.files['file'][gone])
+        else:
+            names = [os.path.basename(f) for f in files]
+        known = dict(zip(self.files['file'], zip(
+            self.files['mtime'], self.files['size'],
+            self.files['segments'])))
+        changed = []
+        for name in names:
+            stamp = _file_stamp(os.path.join(self.corr_dir, name))
+            if known.get(name.encode()) == stamp:
+                continue
+            changed.append((name, stamp))
+        if not changed:
+            if ndropped:
+                self._write()
+            return 0
+        self._drop(np.array([name for name, _ in changed], dtype='S'))
+        index = {k: [] for k in index_cols}
+        pairs = {k: [] for k in pair_cols}
+        for name, stat in changed:
+            _scan_file(os.path.join(self.corr_dir, name), index, pairs)
+        self._append('index', index)
+        self._append('pairs', pairs)
+        self._append('files', {
+            'file': [name for name, _ in changed],
+            'mtime': [stamp[0] for _, stamp in changed],
+            'size': [stamp[1] for _, stamp in changed],
+            'segments': [stamp[2] for _, stamp in changed]})
+        self._write()
+        return len(changed)
+
+    def _drop(self, names: np.ndarray):
+        """
+        Removes all rows belonging to the files in ``names``.
+        """
+        if not len(names):
+            return
+        for name in ['index', 'pairs', 'files']:
+            table = getattr(self, name)
+            keep = ~np.isin(table['file'], names)
+            for k in table:
+                table[k] = table[k][keep]
+
+    def _append(self, name: str, cols: dict):
+        table = getattr(self, name)
+        for k, v in cols.items():
+            if k in str_cols:
+                v = np.array(v, dtype='S')
+            else:
+                v = np.array(v, dtype=table[k].dtype)
+            table[k] = np.hstack((table[k], v))
+
+    def _select(
+        self, table: dict, network: str, station: str, location: str,
+            channel: str) -> np.ndarray:
+        """
+        Boolean mask of the rows in table that match the codes (wildcards
+        allowed).
+        """
+        mask = np.ones(len(table['file']), dtype=bool)
+        for k, v in zip(
+            ['network', 'station', 'location', 'channel'],
+                [network, station, location, channel]):
+            if v == '*':
+                continue
+            u = np.unique(table[k])
+            match = fnmatch.filter([x.decode() for x in u], v)
+            mask &= np.isin(table[k], np.array(match, dtype='S'))
+        return mask
+
+    def query(
+        self, network: str = '*', station: str = '*', location: str = '*',
+        channel: str = '*', tag: str = 'subdivision',
+        starttime: UTCDateTime = None, endtime: UTCDateTime = None,
+        corr_type: str = None, min_dist: float = None,
+            max_dist: float = None) -> np.ndarray:
+        """
+        Find correlations in the catalog. Wildcards are allowed for all
+        codes.
+
+        :param network: Network combination code, defaults to '*'
+        :type network: str, optional
+        :param station: Station combination code, defaults to '*'
+        :type station: str, optional
+        :param location: Location combination code, defaults to '*'
+        :type location: str, optional
+        :param channel: Channel combination code, defaults to '*'
+        :type channel: str, optional
+        :param tag: Tag, defaults to 'subdivision'
+        :type tag: str, optional
+        :param starttime: Only return correlations that end after this time,
+            defaults to None
+        :type starttime: UTCDateTime, optional
+        :param endtime: Only return correlations that start before this time,
+            defaults to None
+        :type endtime: UTCDateTime, optional
+        :param corr_type: ``'auto'`` for autocorrelations, ``'intra'`` for
+            correlations between different components of the same station,
+            ``'cross'`` for correlations between different stations.
+            Defaults to None (all).
+        :type corr_type: str, optional
+        :param min_dist: Minimum interstation distance in km,
+            defaults to None
+        :type min_dist: float, optional
+        :param max_dist: Maximum interstation distance in km,
+            defaults to None
+        :type max_dist: float, optional
+        :return: A structured array with the columns of the index table (see
+            above) for all matching correlations.
+        :rtype: np.ndarray
+        """
+        mask = self._select(self.index, network, station, location, channel)
+        mask &= self.index['tag'] == tag.encode()
+        if starttime is not None:
+            mask &= self.index['corr_end'] > UTCDateTime(starttime).timestamp
+        if endtime is not None:
+            mask &= self.index['corr_start'] < UTCDateTime(endtime).timestamp
+        if corr_type is not None:
+            mask &= _corr_type_mask(self.index, corr_type)
+        if min_dist is not None or max_dist is not None:
+            pmask = np.ones(len(self.pairs['file']), dtype=bool)
+            if min_dist is not None:
+                pmask &= self.pairs['dist'] >= min_dist
+            if max_dist is not None:
+                pmask &= self.pairs['dist'] <= max_dist
+            mask &= np.isin(
+                _pair_keys(self.index), _pair_keys(self.pairs)[pmask])
+        return np.rec.fromarrays(
+            [self.index[k][mask] for k in index_cols], names=index_cols)
+
+    def get_data(self, **kwargs) -> CorrStream:
+        """
+        Load all correlations matching the query. Each file is only opened
+        once. Takes the same arguments as
+        :meth:`~seismic.db.catalog.CorrelationCatalog.query`.
+
+        :return: The correlations
+        :rtype: CorrStream
+        """
+        rows = self.query(**kwargs)
+        cst = CorrStream()
+        for name in np.unique(rows.file):
+            with CorrelationDataBase(
+                    os.path.join(self.corr_dir, name.decode()),
+                    mode='r') as cdb:
+                for p in rows.path[rows.file == name]:
+                    ds = cdb.get_dataset(p.decode())
+                    cst.append(CorrTrace(
+                        read_hdf5_data(ds), _header=read_hdf5_header(ds)))
+        return cst
+
+    def coordinates(
+        self, network: str = '*', station: str = '*', location: str = '*',
+            channel: str = '*') -> np.ndarray:
+        """
+        Returns the coordinates and distances of all channel combinations
+        that match the given codes (wildcards allowed).
+
+        :return: A structured array with the columns ``file``, ``network``,
+            ``station``, ``location``, ``channel``, ``stla``, ``stlo``,
+            ``stel``, ``evla``, ``evlo``, ``evel``, ``dist`` (km), ``az``,
+            and ``baz``. Coordinates that were not available are NaN.
+        :rtype: np.ndarray
+        """
+        mask = self._select(self.pairs, network, station, location, channel)
+        return np.rec.fromarrays(
+            [self.pairs[k][mask] for k in pair_cols], names=pair_cols)
+
+    def combinations(
+            self, tag: str = 'subdivision') -> List[Tuple[
+                str, str, str, str, str]]:
+        """
+        Returns all channel combinations that hold data with the given tag.
+
+        :param tag: Tag, defaults to 'subdivision'
+        :type tag: str, optional
+        :return: A list of lists holding file path, network, station,
+            location, and channel combination code.
+        :rtype: List[Tuple[str, str, str, str, str]]
+        """
+        mask = self.index['tag'] == tag.encode()
+        combs = np.unique(np.vstack([
+            self.index[k][mask] for k in [
+                'file', 'network', 'station', 'location', 'channel']]).T,
+            axis=0)
+        return [[
+            os.path.join(self.corr_dir, c[0].decode())] + [
+                x.decode() for x in c[1:]] for c in combs]
+
+
+def _empty_table(cols: List[str]) -> dict:
+    table = {}
+    for k in cols:
+        if k in str_cols:
+            table[k] = np.array([], dtype='S1')
+        elif k in ('npts', 'size', 'segments'):
+            table[k] = np.array([], dtype=np.int64)
+        else:
+            table[k] = np.array([], dtype=np.float64)
+    return table
+
+
+def _pair_keys(table: dict) -> np.ndarray:
+    """
+    Unique key of the channel combination of each row
+    """
+    key = table['file']
+    for k in ['station', 'location', 'channel']:
+        key = np.char.add(np.char.add(key, b'/'), table[k])
+    return key
+
+
+def _corr_type_mask(table: dict, corr_type: str) -> np.ndarray:
+    """
+    Boolean mask for autocorrelations (``'auto'``), correlations between
+    different components of the same station (``'intra'``), or correlations
+    between different stations (``'cross'``).
+    """
+    same = np.ones(len(table['file']), dtype=bool)
+    for k in ['network', 'station', 'location']:
+        split = np.char.partition(table[k], b'-')
+        same &= split[:, 0] == split[:, 2]
+    split = np.char.partition(table['channel'], b'-')
+    same_cha = split[:, 0] == split[:, 2]
+    if corr_type == 'auto':
+        return same & same_cha
+    elif corr_type == 'intra':
+        return same & ~same_cha
+    elif corr_type == 'cross':
+        return ~same
+    raise ValueError(
+        f'Unknown corr_type {corr_type}. Use auto, intra, or cross.')
+
+
+def _file_stamp(fpath: str) -> Tuple[float, int, int]:
+    """
+    Latest modification time, total size, and number of committed segments
+    of a correlation file and its segments.
+    """
+    mtime, size, nseg = -1., 0, 0
+    for ii, f in enumerate([fpath] + list_segments(fpath)):
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            if ii == 0:
+                raise
+            # merged in the meantime, the main file has changed as well
+            continue
+        mtime = max(mtime, stat.st_mtime)
+        size += stat.st_size
+        nseg += ii > 0
+    return mtime, size, nseg
+
+
+def _scan_file(fpath: str, index: dict, pairs: dict):
+    """
+    Appends all correlations in ``fpath`` and its committed segments to the
+    column lists of ``index`` and the coordinates of each channel
+    combination to ``pairs``.
+    """
+    name = os.path.basename(fpath)
+    seen = set()
+    with CorrelationDataBase(fpath, mode='r') as cdb:
+        for f in cdb.sources():
+            for tag, gtag in f.items():
+                if not isinstance(gtag, h5py.Group):
+                    # correlation options
+                    continue
+                for net, gnet in gtag.items():
+                    for stat, gstat in gnet.items():
+                        for loc, gloc in gstat.items():
+                            for cha, gcha in gloc.items():
+                                _scan_channel(
+                                    name, tag, net, stat, loc, cha, gcha,
+                                    index, pairs, seen)
+
+
+def _scan_channel(
+    name: str, tag: str, net: str, stat: str, loc: str, cha: str,
+        group: h5py.Group, index: dict, pairs: dict, seen: set):
+    first = None
+    for cst, gcst in group.items():
+        t0 = UTCDateTime(cst).timestamp
+        for cet, ds in gcst.items():
+            if first is None:
+                first = ds
+            # Datasets in the main file take priority over the segments
+            if ds.name in seen:
+                continue
+            seen.add(ds.name)
+            index['file'].append(name)
+            index['path'].append(ds.name)
+            index['tag'].append(tag)
+            index['network'].append(net)
+            index['station'].append(stat)
+            index['location'].append(loc)
+            index['channel'].append(cha)
+            index['corr_start'].append(t0)
+            index['corr_end'].append(UTCDateTime(cet).timestamp)
+            index['npts'].append(ds.shape[0])
+    if first is None:
+        return
+    # Coordinates are only added once per channel combination
+    key = (name, stat, loc, cha)
+    if key in zip(
+            pairs['file'], pairs['station'], pairs['location'],
+            pairs['channel']):
+        return
+    for k, v in zip(
+        ['file', 'network', 'station', 'location', 'channel'],
+            [name, net, stat, loc, cha]):
+        pairs[k].append(v)
+    for k in coord_keys:
+        pairs[k].append(float(first.attrs.get(k, np.nan)))
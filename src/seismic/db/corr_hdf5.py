@@ -13,10 +13,16 @@ Created: Friday, 16th April 2021 03:21:30 pm
 Last Modified: Wednesday, 2nd October 2024 11:28:48 am
 '''
 import ast
+from collections import OrderedDict
 import fnmatch
+from glob import glob
+import hashlib
 import os
 import re
-from typing import List
+import shutil
+import tempfile
+import time
+from typing import List, Optional
 import warnings
 from copy import deepcopy
 
@@ -25,6 +31,11 @@ import numpy as np
 from obspy.core.utcdatetime import UTCDateTime
 from obspy.core import Stats
 import h5py
+try:
+    # Registers bitshuffle / LZ4 filters with HDF5, optional
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 from seismic.correlate.stream import CorrStream, CorrTrace
 import seismic.utils.miic_utils as mu
@@ -34,6 +45,11 @@ hierarchy = '/{tag}/{network}/{station}/{location}/' \
 h5_FMTSTR = os.path.join(
     "{dir}", "{network}.{station}.{location}.{channel}.h5")
 
+# Codecs that can be used to compress the correlations
+codecs = ['gzip', 'lzf', 'bitshuffle', 'lz4']
+# Filters that can be combined with the codecs above
+codec_filters = ['shuffle', 'scaleoffset', 'float16']
+
 
 class DBHandler(h5py.File):
     """
@@ -49,53 +65,89 @@ class DBHandler(h5py.File):
     correlations.
     """
     def __init__(self, path, mode, compression, co, force):
+        # The segments have to be listed before the main file is opened.
+        # Otherwise, segments that are merged in between would be missed.
+        segments = list_segments(path) if mode == 'r' else []
         super(DBHandler, self).__init__(path, mode=mode)
-        if isinstance(compression, str):
-            self.compression = re.findall(r'(\w+?)(\d+)', compression)[0][0]
-            if self.compression != 'gzip':
-                raise ValueError(
-                    'Compression of type %s is not supported.'
-                    % self.compression)
-            self.compression_opts = int(
-                re.findall(r'(\w+?)(\d+)', compression)[0][1])
-            if self.compression_opts not in np.arange(1, 10, 1, dtype=int):
-                ii = np.argmin(abs(
-                    np.arange(1, 10, 1, dtype=int) - self.compression_opts))
-                self.compression_opts = np.arange(1, 10, 1, dtype=int)[ii]
-                warnings.warn(
-                    'Chosen compression level is not available for %s. \
-%s Has been chosen instead (closest)' % (
-                        self.compression, str(self.compression_opts)))
-        else:
-            self.compression = None
-            self.compression_opts = None
+        comp = parse_compression(compression)
+        self.compression = comp['compression']
+        self.compression_opts = comp['compression_opts']
+        self.shuffle = comp['shuffle']
+        self.scaleoffset = comp['scaleoffset']
+        self.dtype = comp['dtype']
 
         # check out the processing that was done on the correlations. Different
         # data will not be allowed
         if co is not None:
             try:
                 co_old = self.get_corr_options()
-                if co_old != co_to_hdf5(co) and not force:
-                    try:
-                        diff = {k: (v, co_old[k]) for k, v in co_to_hdf5(
-                            co).items() if v != co_old[k]}
-                    except KeyError as e:
-                        raise PermissionError(
-                            f'One option is not defined in new dict. {e}'
-                        )
-                    raise PermissionError(
-                        f'The output file {path} already exists and contains'
-                        ' data with'
-                        ' different processing parameters. Differences are:'
-                        '\nFirst: New parameters; Second: Old parameters'
-                        f'\n{diff}'
-                    )
+                if not force:
+                    compare_corr_options(co_old, co, path)
             except KeyError:
                 self.add_corr_options(co)
 
+        # Committed segments of a concurrent writer (see
+        # :class:`~seismic.db.corr_hdf5.CorrelationDataBase`)
+        self._segments = []
+        if segments:
+            self._open_segments(path, segments)
+
     def _close(self):
+        for seg in self._segments:
+            seg.close()
+        self._segments = []
         self.close()
 
+    def _open_segments(self, path: str, segments: List[str]):
+        """
+        Opens the committed segments that belong to this file read-only.
+        ``segments`` must have been listed before the main file was opened.
+        """
+        for seg in segments:
+            try:
+                self._segments.append(h5py.File(seg, 'r'))
+            except FileNotFoundError:
+                # The segments have been merged into the main file since
+                # this file was opened. Read the new main file as well, the
+                # data is deduplicated when read.
+                self._segments.append(h5py.File(path, 'r'))
+                break
+
+    def sources(self) -> List[h5py.File]:
+        """
+        The file itself and its committed segments (only in read mode).
+        """
+        return [self] + self._segments
+
+    def get_dataset(self, path: str) -> h5py.Dataset:
+        """
+        Returns the dataset at ``path`` from the file or, if it is not in
+        the file, from its committed segments.
+
+        :raises KeyError: If the dataset does not exist.
+        """
+        for f in self.sources():
+            if path in f:
+                return f[path]
+        raise KeyError(f'{path} not found in file or segments.')
+
+    def _dataset_kwargs(self) -> dict:
+        """
+        Returns the keyword arguments that are passed to
+        :meth:`h5py.File.create_dataset` to apply the chosen compression.
+        Filters that are switched off are omitted.
+        """
+        kwargs = dict(
+            compression=self.compression,
+            compression_opts=self.compression_opts)
+        if self.shuffle:
+            kwargs['shuffle'] = True
+        if self.scaleoffset is not None:
+            kwargs['scaleoffset'] = self.scaleoffset
+        if self.dtype is not None:
+            kwargs['dtype'] = self.dtype
+        return kwargs
+
     def add_corr_options(self, co: dict):
         sco = str(co_to_hdf5(co))
         ds = self.create_dataset('co', data=np.empty(1))
@@ -127,6 +179,7 @@ class DBHandler(h5py.File):
         if isinstance(data, CorrTrace):
             data = [data]
 
+        kwargs = self._dataset_kwargs()
         for tr in data:
             st = tr.stats
             path = hierarchy.format(
@@ -136,9 +189,7 @@ class DBHandler(h5py.File):
                 corr_st=st.corr_start.format_fissures(),
                 corr_et=st.corr_end.format_fissures())
             try:
-                ds = self.create_dataset(
-                    path, data=tr.data, compression=self.compression,
-                    compression_opts=self.compression_opts)
+                ds = self.create_dataset(path, data=tr.data, **kwargs)
                 convert_header_to_hdf5(ds, st)
             except ValueError as e:
                 print(e)
@@ -277,17 +328,29 @@ omitted." % path, category=UserWarning)
             tag=tag, network=network, station=station, channel=channel,
             location=location,
             corr_st=corr_start, corr_et=corr_end)
-        # Extremely ugly way of changing the path
-        if '*' not in path and '?' not in path:
-            data = np.array(self[path])
-            header = read_hdf5_header(self[path])
-            return CorrStream(CorrTrace(data, _header=header))
-        # Now, we need to differ between the fnmatch pattern and the actually
-        # accessed path
-        path = path.replace('?', '*')
-        pattern = path.replace('/*', '*')
-        path = path.split('*')[0]
-        return all_traces_recursive(self[path], CorrStream(), pattern)
+        if not self._segments:
+            return _get_data_from(self, path)
+        # Merge data from the segments, the main file has priority
+        cst = CorrStream()
+        seen = set()
+        found = False
+        for f in self.sources():
+            try:
+                st = _get_data_from(f, path)
+                found = True
+            except KeyError:
+                continue
+            for tr in st:
+                key = (
+                    tr.stats.network, tr.stats.station, tr.stats.location,
+                    tr.stats.channel, str(tr.stats.corr_start),
+                    str(tr.stats.corr_end))
+                if key not in seen:
+                    seen.add(key)
+                    cst.append(tr)
+        if not found:
+            raise KeyError(f'{path} not found in file or segments.')
+        return cst
 
     def get_available_starttimes(
         self, network: str, station: str, tag: str, location: str,
@@ -322,16 +385,32 @@ omitted." % path, category=UserWarning)
         if isinstance(channel, str):
             if '*' not in channel:
                 path = '/'.join(path.split('/')[:-2])
-                try:
-                    out[channel] = list(self[path].keys())
-                except KeyError:
-                    pass
+                for f in self.sources():
+                    try:
+                        out.setdefault(channel, [])
+                        out[channel].extend(
+                            k for k in f[path].keys()
+                            if k not in out[channel])
+                    except KeyError:
+                        pass
+                if not out[channel]:
+                    del out[channel]
                 return out
             channel = [channel]
         path = '/'.join(path.split('/')[:-3])
-        for ch in channel:
-            for match in fnmatch.filter(self[path].keys(), ch):
-                out[match] = list(self['/'.join([path, match])].keys())
+        for ii, f in enumerate(self.sources()):
+            try:
+                keys = f[path].keys()
+            except KeyError:
+                if ii == 0 and not self._segments:
+                    raise
+                continue
+            for ch in channel:
+                for match in fnmatch.filter(keys, ch):
+                    out.setdefault(match, [])
+                    out[match].extend(
+                        k for k in f['/'.join([path, match])].keys()
+                        if k not in out[match])
         return out
 
     def get_available_channels(
@@ -356,11 +435,14 @@ omitted." % path, category=UserWarning)
             tag=tag, network=network, station=station, location=location,
             channel='*', corr_st='*', corr_et='*')
         path = path.split('*')[0]
-        try:
-            return list(self[path].keys())
-        except KeyError:
-            # No channels available
-            return []
+        out = []
+        for f in self.sources():
+            try:
+                out.extend(k for k in f[path].keys() if k not in out)
+            except KeyError:
+                # No channels available
+                pass
+        return out
 
 
 class CorrelationDataBase(object):
@@ -369,7 +451,8 @@ class CorrelationDataBase(object):
     """
     def __init__(
         self, path: str, corr_options: dict = None, mode: str = 'a',
-            compression: str = 'gzip3', _force: bool = False):
+            compression: str = 'gzip3', _force: bool = False,
+            swmr: bool = False):
         """
         Access an hdf5 file holding correlations. The resulting file can be
         accessed using all functionalities of
@@ -389,10 +472,29 @@ class CorrelationDataBase(object):
             that the arrays should be saved with. 'gzip3' tends to perform
             well, else you could choose 'gzipx' where x is a digit between
             1 and 9 (i.e., 9 is the highest compression) or None for fastest
-            perfomance, defaults to 'gzip3'.
+            perfomance, defaults to 'gzip3'. Further codecs are 'lzf' and,
+            if `hdf5plugin` is installed, 'bitshuffle' (bitshuffle + LZ4)
+            and 'lz4'. Codecs can be combined with filters using '+', e.g.,
+            'shuffle+gzip3'. See
+            :func:`~seismic.db.corr_hdf5.parse_compression` for the
+            available (also lossy) options.
         :type compression: str, optional
         :param _force: allow differnt correlation options, defaults to False
         :type _force: bool, optional
+        :param swmr: Single writer, multiple reader mode. If True and
+            ``mode`` is not ``'r'``, the data are not written into the file
+            itself, but into a new segment file that is committed
+            atomically when the context manager exits. Other processes can
+            read the file at the same time and see all committed segments.
+            Segments are merged into the file with
+            :func:`~seismic.db.corr_hdf5.merge_segments`. In this mode, the
+            returned handler only holds the new data. Defaults to False.
+        :type swmr: bool, optional
+
+        .. note::
+
+            Readers always include committed segments, independent of
+            ``swmr``. Only one process may write to a file at a time.
 
         .. warning::
 
@@ -434,17 +536,364 @@ class CorrelationDataBase(object):
         self.compression = compression
         self.co = corr_options
         self.force = _force
+        self.swmr = swmr and mode != 'r'
+        if self.swmr and mode == 'w':
+            raise ValueError(
+                'Mode w is not possible in swmr mode, data can only be '
+                'appended.')
 
     def __enter__(self) -> DBHandler:
+        if self.swmr:
+            prepare_main_file(self.path, self.co, self.force)
+            self.segment = new_segment_path(self.path)
+            self.db_handler = DBHandler(
+                self.segment + '.tmp', 'w', self.compression, None,
+                self.force)
+            return self.db_handler
         self.db_handler = DBHandler(
             self.path, self.mode, self.compression, self.co, self.force)
         return self.db_handler
 
     def __exit__(self, exc_type, exc_value, tb) -> None or bool:
         self.db_handler._close()
+        if self.swmr:
+            # Commit the segment
+            if exc_type is None:
+                os.replace(self.segment + '.tmp', self.segment)
+            else:
+                os.remove(self.segment + '.tmp')
+        if exc_type is not None:
+            return False
+
+
+class DBWriteSession(object):
+    """
+    Keeps write handles to several correlation databases open, so that
+    correlations can be written over many time windows without opening and
+    closing the files each time. Correlations are buffered and written in
+    batches.
+
+    The correlation options are only validated the first time that a file
+    is opened during a session. If more than ``max_open`` files are used,
+    the least recently used handle is closed.
+
+    If ``swmr`` is True, the files are not kept open. Instead, each batch is
+    committed as a segment (see
+    :class:`~seismic.db.corr_hdf5.CorrelationDataBase`), so that other
+    processes can read the data while the session is running. Merging the
+    segments rewrites the whole file, so they are only merged into a file
+    when the session is closed and at least ``merge_threshold`` segments
+    have been committed.
+
+    .. note::
+
+        Buffered correlations are only written to disk once ``batch_size``
+        traces are buffered, when calling
+        :meth:`~seismic.db.corr_hdf5.DBWriteSession.flush`, or when the
+        session is closed. Use the session as a context manager to ensure
+        that no data are lost.
+
+    Example::
+
+        >>> with DBWriteSession(co) as session:
+        >>>     session.add_correlation(
+        >>>         '/path/to/db/XN-XN.NEP06-NEP06.h5', cst, 'subdivision')
+    """
+    def __init__(
+        self, corr_options: dict, max_open: int = 64, batch_size: int = 512,
+            compression: str = 'gzip3', _force: bool = False,
+            swmr: bool = False, merge_threshold: Optional[int] = 64):
+        """
+        :param corr_options: The dictionary holding the parameters for the
+            correlation.
+        :type corr_options: dict
+        :param max_open: Maximum number of files to keep open at the same
+            time, defaults to 64
+        :type max_open: int, optional
+        :param batch_size: Number of buffered traces after which all buffers
+            are written to disk, defaults to 512
+        :type batch_size: int, optional
+        :param compression: The compression, see
+            :class:`~seismic.db.corr_hdf5.CorrelationDataBase`, defaults to
+            'gzip3'
+        :type compression: str, optional
+        :param _force: allow differnt correlation options, defaults to False
+        :type _force: bool, optional
+        :param swmr: Write committed segments, so that the files can be read
+            during the session, defaults to False
+        :type swmr: bool, optional
+        :param merge_threshold: In swmr mode, the segments of a file are
+            merged into the file on :meth:`close` if there are at least
+            ``merge_threshold`` of them. If None, segments are never merged
+            automatically (see :func:`~seismic.db.corr_hdf5.merge_segments`).
+            Defaults to 64.
+        :type merge_threshold: int, optional
+        """
+        if max_open < 1:
+            raise ValueError('max_open has to be at least 1.')
+        self.co = corr_options
+        self.max_open = max_open
+        self.batch_size = batch_size
+        self.compression = compression
+        self.force = _force
+        self.swmr = swmr
+        self.merge_threshold = merge_threshold
+        self.handles = OrderedDict()
+        self.validated = set()
+        self.buffer = {}
+        self.nbuffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None or bool:
+        self.close()
         if exc_type is not None:
             return False
 
+    def _get_handle(self, path: str) -> DBHandler:
+        """
+        Returns an open handle to ``path`` and closes the least recently used
+        handle if too many files are open.
+        """
+        if path in self.handles:
+            self.handles.move_to_end(path)
+            return self.handles[path]
+        while len(self.handles) >= self.max_open:
+            _, dbh = self.handles.popitem(last=False)
+            dbh._close()
+        # Options only have to be compared once per file
+        co = None if path in self.validated else self.co
+        dbh = DBHandler(path, 'a', self.compression, co, self.force)
+        self.validated.add(path)
+        self.handles[path] = dbh
+        return dbh
+
+    def add_correlation(
+            self, path: str, data: CorrTrace or CorrStream,
+            tag: str = 'subdivision'):
+        """
+        Buffers correlation data to be written into the file ``path``.
+
+        :param path: Full path to the file
+        :type path: str
+        :param data: Data to save.
+        :type data: CorrTrace or CorrStream
+        :param tag: The tag that the data should be saved under, see
+            :meth:`~seismic.db.corr_hdf5.DBHandler.add_correlation`.
+        :type tag: str, optional
+        """
+        if not isinstance(data, CorrTrace) and\
+                not isinstance(data, CorrStream):
+            raise TypeError('Data has to be either a \
+:class:`~seismic.correlate.correlate.CorrTrace` object or a \
+:class:`~seismic.correlate.correlate.CorrStream` object')
+        if isinstance(data, CorrTrace):
+            data = [data]
+        if not path.split('.')[-1] == 'h5':
+            path += '.h5'
+        self.buffer.setdefault(path, {}).setdefault(tag, []).extend(data)
+        self.nbuffered += len(data)
+        if self.nbuffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered correlations to disk.
+        """
+        while self.buffer:
+            path, tags = self.buffer.popitem()
+            if self.swmr:
+                self._write_segment(path, tags)
+                continue
+            dbh = self._get_handle(path)
+            for tag, traces in tags.items():
+                dbh.add_correlation(CorrStream(traces), tag)
+            dbh.flush()
+        self.nbuffered = 0
+
+    def _write_segment(self, path: str, tags: dict):
+        """
+        Writes the buffered data of one file into a new segment.
+        """
+        if path not in self.validated:
+            prepare_main_file(path, self.co, self.force)
+            self.validated.add(path)
+        segment = new_segment_path(path)
+        with DBHandler(
+                segment + '.tmp', 'w', self.compression, None,
+                self.force) as dbh:
+            for tag, traces in tags.items():
+                dbh.add_correlation(CorrStream(traces), tag)
+        os.replace(segment + '.tmp', segment)
+
+    def close(self):
+        """
+        Writes the remaining buffered data and closes all files. In swmr
+        mode, files with at least ``merge_threshold`` segments are merged.
+        """
+        try:
+            self.flush()
+        finally:
+            while self.handles:
+                _, dbh = self.handles.popitem()
+                dbh._close()
+        if self.swmr and self.merge_threshold is not None:
+            for path in self.validated:
+                if len(list_segments(path)) >= self.merge_threshold:
+                    merge_segments(path)
+
+
+def compare_corr_options(co_old: dict, co: dict, path: str):
+    """
+    Compares the correlation options of an existing file to new options.
+
+    :param co_old: The options in the file
+    :type co_old: dict
+    :param co: The new options
+    :type co: dict
+    :param path: Path to the file (used for the error message)
+    :type path: str
+    :raises PermissionError: If the options differ.
+    """
+    if co_old == co_to_hdf5(co):
+        return
+    try:
+        diff = {k: (v, co_old[k]) for k, v in co_to_hdf5(
+            co).items() if v != co_old[k]}
+    except KeyError as e:
+        raise PermissionError(
+            f'One option is not defined in new dict. {e}'
+        )
+    raise PermissionError(
+        f'The output file {path} already exists and contains'
+        ' data with'
+        ' different processing parameters. Differences are:'
+        '\nFirst: New parameters; Second: Old parameters'
+        f'\n{diff}'
+    )
+
+
+def segment_dir(path: str) -> str:
+    """
+    Directory holding the segments of the correlation file ``path``.
+    """
+    return path + '.segments'
+
+
+def list_segments(path: str) -> List[str]:
+    """
+    Returns the committed segments of the correlation file ``path`` in the
+    order that they were written.
+
+    :param path: Path to the correlation file
+    :type path: str
+    :return: Paths to the segment files
+    :rtype: List[str]
+    """
+    return sorted(glob(os.path.join(segment_dir(path), '*.h5')))
+
+
+def new_segment_path(path: str) -> str:
+    """
+    Returns the path to a new segment of ``path``. The segment has to be
+    written to ``<segment>.tmp`` and renamed afterwards to be committed.
+    """
+    os.makedirs(segment_dir(path), exist_ok=True)
+    return os.path.join(
+        segment_dir(path), f'{time.time_ns():020d}-{os.getpid()}.h5')
+
+
+def prepare_main_file(path: str, co: dict, force: bool):
+    """
+    Makes sure that the main file of a segmented database exists and
+    that its correlation options match ``co``. The main file is only read.
+    If it does not exist, it is created atomically, so that readers
+    never see a file that is being written.
+
+    :raises PermissionError: If the options differ.
+    """
+    if not os.path.isfile(path):
+        with DBHandler(path + '.tmp', 'w', None, co, force):
+            pass
+        os.replace(path + '.tmp', path)
+        return
+    if co is None or force:
+        return
+    with h5py.File(path, 'r') as f:
+        try:
+            co_old = co_to_hdf5(ast.literal_eval(str(f['co'].attrs['co'])))
+        except KeyError:
+            # No options in file, will be taken from the segments
+            return
+    compare_corr_options(co_old, co, path)
+
+
+def merge_segments(path: str) -> int:
+    """
+    Merges all committed segments into the correlation file ``path``.
+    The merged file is written as a copy and replaces the original
+    atomically, so processes that are reading the file are not affected.
+    As the whole file is copied, merging is expensive for large files and
+    should not be done after every write. Only the (single) writer should
+    call this function.
+
+    :param path: Path to the correlation file
+    :type path: str
+    :return: The number of merged segments
+    :rtype: int
+    """
+    segments = list_segments(path)
+    if not segments:
+        return 0
+    tmp = path + '.merge'
+    shutil.copyfile(path, tmp)
+    try:
+        with h5py.File(tmp, 'a') as dst:
+            for seg in segments:
+                with h5py.File(seg, 'r') as src:
+                    names = []
+                    src.visititems(
+                        lambda name, obj: names.append(name)
+                        if isinstance(obj, h5py.Dataset) else None)
+                    for name in names:
+                        if name in dst:
+                            continue
+                        parent, base = os.path.split(name)
+                        src.copy(
+                            src[name], dst.require_group(parent or '/'),
+                            name=base)
+    except Exception:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+    for seg in segments:
+        os.remove(seg)
+    try:
+        os.rmdir(segment_dir(path))
+    except OSError:
+        # A new segment has been added in the meantime
+        pass
+    return len(segments)
+
+
+def _get_data_from(f: h5py.File, path: str) -> CorrStream:
+    """
+    Reads all correlations matching ``path`` (may contain wildcards) from
+    ``f``.
+    """
+    # Extremely ugly way of changing the path
+    if '*' not in path and '?' not in path:
+        data = read_hdf5_data(f[path])
+        header = read_hdf5_header(f[path])
+        return CorrStream(CorrTrace(data, _header=header))
+    # Now, we need to differ between the fnmatch pattern and the actually
+    # accessed path
+    path = path.replace('?', '*')
+    pattern = path.replace('/*', '*')
+    path = path.split('*')[0]
+    return all_traces_recursive(f[path], CorrStream(), pattern)
+
 
 def all_traces_recursive(
     group: h5py._hl.group.Group, stream: CorrStream,
@@ -470,10 +919,370 @@ def all_traces_recursive(
             continue
         else:
             stream.append(
-                CorrTrace(np.array(v), _header=read_hdf5_header(v)))
+                CorrTrace(read_hdf5_data(v), _header=read_hdf5_header(v)))
     return stream
 
 
+def parse_compression(compression: str | None) -> dict:
+    """
+    Translates a compression string into the filter settings that are used
+    to write the correlations into the hdf5 file.
+
+    The string consists of one codec and an arbitrary number of filters,
+    separated by a '+' (e.g., ``'shuffle+gzip3'``). Available codecs are:
+
+        - ``'gzipx'``: gzip with compression level x (1-9).
+        - ``'lzf'``: Very fast, but less efficient compression.
+        - ``'bitshuffle'``: Bitshuffle filter combined with LZ4 compression.
+          Requires `hdf5plugin`.
+        - ``'lz4'``: LZ4 compression. Requires `hdf5plugin`.
+
+    Available filters are:
+
+        - ``'shuffle'``: Byte shuffling, improves the compression of
+          floating point data considerably. Lossless.
+        - ``'scaleoffsetx'``: **Lossy.** Keeps x decimal digits of the data.
+          The absolute error is bounded by :math:`10^{-x}`.
+          Hence, only meaningful for data with a known amplitude range
+          (e.g., normalised correlations).
+        - ``'float16'``: **Lossy.** Stores data as half precision floats.
+          The relative error is bounded by :math:`2^{-11} \\approx 4.9
+          \\cdot 10^{-4}` for absolute values between
+          :math:`6.1 \\cdot 10^{-5}` and 65504. Data outside of that range
+          lose precision or overflow, so this should only be used on
+          normalised correlations. Data is returned as float32 when read.
+
+    :param compression: The compression string or None for no compression
+    :type compression: str | None
+    :raises ValueError: For unknown codecs or filters or for invalid
+        combinations.
+    :raises IndexError: If no compression level is provided for gzip.
+    :raises ImportError: If bitshuffle or lz4 are requested, but hdf5plugin
+        is not installed.
+    :return: A dictionary with the keys ``'compression'``,
+        ``'compression_opts'``, ``'shuffle'``, ``'scaleoffset'``, and
+        ``'dtype'``.
+    :rtype: dict
+    """
+    comp = dict(
+        compression=None, compression_opts=None, shuffle=False,
+        scaleoffset=None, dtype=None)
+    if not isinstance(compression, str):
+        return comp
+    codec = None
+    for token in compression.lower().split('+'):
+        if token in ['lzf', 'bitshuffle', 'lz4', 'shuffle', 'float16']:
+            name, level = token, None
+        else:
+            name, level = re.findall(r'([a-z]\w*?)(\d*)$', token)[0]
+            if name in ['gzip', 'scaleoffset'] and not len(level):
+                raise IndexError(
+                    f'{name} requires a level, e.g., {name}3.')
+            level = int(level) if len(level) else None
+        if name not in codecs + codec_filters:
+            raise ValueError(
+                'Compression of type %s is not supported.' % name)
+        if name in codecs:
+            if codec is not None:
+                raise ValueError(
+                    f'Only one codec can be chosen. Got {codec} and {name}.')
+            codec = name
+        if name == 'gzip':
+            if level not in np.arange(1, 10, 1, dtype=int):
+                ii = np.argmin(abs(np.arange(1, 10, 1, dtype=int) - level))
+                level = np.arange(1, 10, 1, dtype=int)[ii]
+                warnings.warn(
+                    'Chosen compression level is not available for %s. \
+%s Has been chosen instead (closest)' % (name, str(level)))
+            comp['compression'] = name
+            comp['compression_opts'] = level
+        elif name == 'lzf':
+            comp['compression'] = name
+        elif name in ['bitshuffle', 'lz4']:
+            if hdf5plugin is None:
+                raise ImportError(
+                    f'Compression of type {name} requires hdf5plugin. '
+                    'Install it using pip install hdf5plugin.')
+            if name == 'bitshuffle':
+                filt = hdf5plugin.Bitshuffle(cname='lz4')
+            else:
+                filt = hdf5plugin.LZ4()
+            comp['compression'] = filt['compression']
+            comp['compression_opts'] = filt['compression_opts']
+        elif name == 'shuffle':
+            comp['shuffle'] = True
+        elif name == 'scaleoffset':
+            comp['scaleoffset'] = level
+        elif name == 'float16':
+            comp['dtype'] = np.float16
+    if comp['scaleoffset'] is not None and comp['dtype'] is not None:
+        raise ValueError(
+            'scaleoffset and float16 cannot be combined.')
+    if comp['shuffle'] and codec is None:
+        warnings.warn(
+            'Shuffle has no effect without compression codec.')
+    return comp
+
+
+def benchmark_compression(
+    path: str, compression: List[str] = [
+        'gzip3', 'shuffle+gzip3', 'lzf', 'shuffle+lzf', 'bitshuffle',
+        'scaleoffset4+shuffle+gzip3', 'float16+shuffle+gzip3'],
+        tag: str = 'subdivision', tmpdir: str = None) -> dict:
+    """
+    Compares the performance of different compression options on a
+    sample correlation file. All correlations with the given tag are
+    rewritten into a temporary file for each compression option
+    and read back afterwards.
+
+    :param path: Path to the sample file.
+    :type path: str
+    :param compression: List of compression strings to test (see
+        :func:`~seismic.db.corr_hdf5.parse_compression`). Options that
+        require `hdf5plugin` are skipped if it is not available.
+    :type compression: List[str], optional
+    :param tag: Tag of the correlations to use, defaults to 'subdivision'
+    :type tag: str, optional
+    :param tmpdir: Directory to write the temporary files to. Defaults to
+        the system's temporary directory.
+    :type tmpdir: str, optional
+    :return: A dictionary with the compression strings as keys. Each value
+        is a dictionary holding the compression ``'ratio'`` (uncompressed
+        size / file size), the ``'write_MBps'`` and ``'read_MBps'``
+        throughput (in MB of uncompressed data per second), and the
+        maximum absolute error ``'max_abs_err'`` introduced by lossy
+        options.
+    :rtype: dict
+    """
+    data = {}
+
+    def _collect(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            data[name] = (np.array(obj), dict(obj.attrs))
+    with h5py.File(path, 'r') as f:
+        f[tag].visititems(_collect)
+    nbytes = sum(d.nbytes for d, _ in data.values())
+    tmpdir = tempfile.mkdtemp(dir=tmpdir)
+    out = {}
+    try:
+        for comp in compression:
+            try:
+                parse_compression(comp)
+            except ImportError as e:
+                warnings.warn(f'{e} Skipping {comp}.')
+                continue
+            outf = os.path.join(tmpdir, 'benchmark.h5')
+            t0 = time.perf_counter()
+            with DBHandler(outf, 'w', comp, None, False) as dbh:
+                kwargs = dbh._dataset_kwargs()
+                for name, (d, attrs) in data.items():
+                    ds = dbh.create_dataset(name, data=d, **kwargs)
+                    ds.attrs.update(attrs)
+            t_write = time.perf_counter() - t0
+            size = os.path.getsize(outf)
+            err = 0.
+            t0 = time.perf_counter()
+            with h5py.File(outf, 'r') as f:
+                for name, (d, _) in data.items():
+                    dr = read_hdf5_data(f[name])
+                    err = max(err, float(np.max(np.abs(dr - d), initial=0)))
+            t_read = time.perf_counter() - t0
+            os.remove(outf)
+            out[comp] = {
+                'ratio': nbytes/size,
+                'write_MBps': nbytes/1e6/t_write,
+                'read_MBps': nbytes/1e6/t_read,
+                'max_abs_err': err}
+    finally:
+        shutil.rmtree(tmpdir)
+    return out
+
+
+def repack(
+    path: str, compression: str = 'gzip3', chunks: int = None,
+        verify: bool = True) -> dict:
+    """
+    Rewrites a correlation file. HDF5 does not reclaim the space of deleted
+    datasets (e.g., after :meth:`~seismic.db.corr_hdf5.DBHandler.remove_data`)
+    and repeated writes fragment the file. Repacking writes all datasets
+    into a new file in sorted order, optionally with a different
+    compression and chunk layout.
+
+    The new file is written next to the original. If ``verify`` is True,
+    the checksums of all datasets and their headers are compared to the
+    original before the original file is replaced. The replacement is
+    atomic, i.e., the file is either the old or the new version.
+
+    Committed segments of the file (see
+    :class:`~seismic.db.corr_hdf5.CorrelationDataBase`) are merged into the
+    file first (see :func:`~seismic.db.corr_hdf5.merge_segments`), so that
+    their data is repacked as well. Like merging, repacking should
+    therefore only be done by the (single) writer or while nothing is
+    written to the file.
+
+    :param path: Path to the correlation file
+    :type path: str
+    :param compression: Compression of the new file, see
+        :func:`~seismic.db.corr_hdf5.parse_compression`, defaults to 'gzip3'
+    :type compression: str, optional
+    :param chunks: Chunk length (in samples) of the datasets. If None, the
+        chunk size is chosen by h5py, defaults to None
+    :type chunks: int, optional
+    :param verify: Verify the data before replacing the file, defaults to
+        True. For lossy compression, only shapes and headers are verified.
+    :type verify: bool, optional
+    :raises ValueError: If the verification fails. The original file is
+        kept in that case.
+    :return: A dictionary holding the ``'path'``, the file size before
+        (including segments) and after (``'size_before'``,
+        ``'size_after'`` in bytes), and the time
+        to read all correlations before and after (``'read_before'``,
+        ``'read_after'`` in seconds).
+    :rtype: dict
+    """
+    comp = parse_compression(compression)
+    lossy = comp['scaleoffset'] is not None or comp['dtype'] is not None
+    tmp = path + '.repack'
+    segments = list_segments(path)
+    size_before = sum(os.path.getsize(f) for f in [path] + segments)
+    # Pending segments would be missing in the repacked file and merging
+    # them afterwards would mix compressions
+    merge_segments(path)
+    checksums = {}
+    t_read = 0.
+    try:
+        with h5py.File(path, 'r') as src, DBHandler(
+                tmp, 'w', compression, None, False) as dst:
+            kwargs = dst._dataset_kwargs()
+            names = []
+            src.visititems(
+                lambda name, obj: names.append(name)
+                if isinstance(obj, h5py.Dataset) else None)
+            for name in sorted(names):
+                t0 = time.perf_counter()
+                data = src[name][()]
+                t_read += time.perf_counter() - t0
+                attrs = dict(src[name].attrs)
+                if name == 'co':
+                    ds = dst.create_dataset(name, data=data)
+                else:
+                    ds_kwargs = dict(kwargs)
+                    # h5py chooses the chunks of empty datasets
+                    if chunks is not None and data.ndim == 1 and len(data):
+                        ds_kwargs['chunks'] = (min(chunks, len(data)),)
+                    ds = dst.create_dataset(name, data=data, **ds_kwargs)
+                ds.attrs.update(attrs)
+                # Lossy data cannot be compared bit by bit
+                checksums[name] = (
+                    None if lossy and name != 'co' else _checksum(data),
+                    data.shape, _checksum_attrs(attrs))
+        if verify:
+            t_read_after = _verify_repack(tmp, checksums)
+        else:
+            t0 = time.perf_counter()
+            with h5py.File(tmp, 'r') as f:
+                for name in checksums:
+                    f[name][()]
+            t_read_after = time.perf_counter() - t0
+    except Exception:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+    return {
+        'path': path, 'size_before': size_before,
+        'size_after': os.path.getsize(path), 'read_before': t_read,
+        'read_after': t_read_after}
+
+
+def repack_bulk(paths: List[str], **kwargs) -> List[dict]:
+    """
+    Repacks many correlation files in parallel using MPI. Each core repacks
+    a subset of the files. Takes the same keyword arguments as
+    :func:`~seismic.db.corr_hdf5.repack`.
+
+    Example::
+
+        >>> # repack.py, execute with mpirun -n 8 python repack.py
+        >>> from glob import glob
+        >>> reports = repack_bulk(
+        >>>     glob('/path/to/corr/*.h5'), compression='shuffle+gzip3')
+
+    :param paths: The files to repack
+    :type paths: List[str]
+    :return: The reports of all files (see
+        :func:`~seismic.db.corr_hdf5.repack`). Files that could not be
+        repacked are reported with an ``'error'`` key.
+    :rtype: List[dict]
+    """
+    # Only import MPI when needed, reading the database does not require it
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    psize = comm.Get_size()
+    rank = comm.Get_rank()
+    paths = sorted(paths)
+    pmap = (np.arange(len(paths))*psize/max(len(paths), 1)).astype(np.int32)
+    reports = []
+    for path in np.array(paths, dtype=object)[pmap == rank]:
+        try:
+            reports.append(repack(path, **kwargs))
+        except Exception as e:
+            warnings.warn(f'File {path} could not be repacked: {e}')
+            reports.append({'path': path, 'error': str(e)})
+    return [r for rr in comm.allgather(reports) for r in rr]
+
+
+def _checksum(data: np.ndarray) -> str:
+    """
+    sha256 of the array's dtype and bytes.
+    """
+    h = hashlib.sha256(str(data.dtype).encode())
+    h.update(np.ascontiguousarray(data).tobytes())
+    return h.hexdigest()
+
+
+def _checksum_attrs(attrs: dict) -> str:
+    return hashlib.sha256(str(sorted(
+        (k, str(v)) for k, v in attrs.items())).encode()).hexdigest()
+
+
+def _verify_repack(path: str, checksums: dict) -> float:
+    """
+    Compares all datasets in ``path`` to the checksums of the original file.
+    Returns the time it took to read the data.
+    """
+    t_read = 0.
+    with h5py.File(path, 'r') as f:
+        for name, (checksum, shape, attr_checksum) in checksums.items():
+            t0 = time.perf_counter()
+            data = f[name][()]
+            t_read += time.perf_counter() - t0
+            if data.shape != shape or (
+                    checksum is not None and _checksum(data) != checksum):
+                raise ValueError(f'Data of {name} differ after repacking.')
+            if _checksum_attrs(dict(f[name].attrs)) != attr_checksum:
+                raise ValueError(
+                    f'Header of {name} differs after repacking.')
+    return t_read
+
+
+def read_hdf5_data(dataset: h5py.Dataset) -> np.ndarray:
+    """
+    Reads the data of a correlation dataset. Data that was saved with
+    half precision (see :func:`~seismic.db.corr_hdf5.parse_compression`) is
+    returned as float32.
+
+    :param dataset: The dataset to be read from
+    :type dataset: h5py.Dataset
+    :return: The correlation data
+    :rtype: np.ndarray
+    """
+    data = np.array(dataset)
+    if data.dtype == np.float16:
+        data = data.astype(np.float32)
+    return data
+
+
 def convert_header_to_hdf5(dataset: h5py.Dataset, header: Stats):
     """
     Convert an :class:`~obspy.core.Stats` object and adds it to the provided
@@ -538,7 +1347,9 @@ def co_to_hdf5(co: dict) -> dict:
     remk = [
         'subdir', 'read_start', 'read_end', 'read_len', 'read_inc',
         'combination_method', 'combinations', 'starttime',
-        'xcombinations', 'preprocess_subdiv', 'allow_different_params']
+        'xcombinations', 'preprocess_subdiv', 'allow_different_params',
+        'max_open_files', 'write_batch_size', 'update_catalog', 'swmr',
+        'swmr_merge_threshold']
     for key in remk:
         coc.pop(key, None)
         coc['corr_args'].pop('combinations', None)
@@ -0,0 +1,411 @@
+'''
+Columnar hdf5 store for velocity change (DV) objects. All DVs of a project
+are kept in one file, one group per DV. The arrays are chunked along the
+time axis and the similarity matrices can be quantised and are only read
+when they are accessed.
+
+:copyright:
+    The SeisMIC development team (makus@gfz-potsdam.de).
+:license:
+    EUROPEAN UNION PUBLIC LICENCE v. 1.2
+   (https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12)
+:author:
+   Peter Makus (makus@gfz-potsdam.de)
+
+Created: Monday, 19th October 2026 02:31:40 pm
+Last Modified: Monday, 19th October 2026 02:31:40 pm
+'''
+import fnmatch
+from functools import partial
+from glob import glob
+import os
+from typing import List
+import warnings
+
+import numpy as np
+import h5py
+
+from seismic.correlate.stats import CorrStats
+from seismic.db.corr_hdf5 import parse_compression
+from seismic.monitor.dv import DV, dv_subdir, read_dv
+import seismic.utils.miic_utils as mu
+
+
+# Frequency band and lapse time window of the DV, saved as attributes
+processing_keys = ['freq_min', 'freq_max', 'tw_start', 'tw_len']
+# Arrays of the DV that have one entry per time and are chunked along time
+time_keys = ['corr', 'value', 'stretches', 'corrs', 'n_stat']
+# Precisions that the similarity matrix can be saved with
+sim_mat_dtypes = ['float64', 'float32', 'float16', 'uint8']
+# Number of times per chunk
+chunk_len = 1024
+# uint8 code for nan in quantised similarity matrices
+_uint8_nan = 255
+
+
+class DVStoreHandler(h5py.File):
+    """
+    The actual file handler of a DV store.
+
+    .. warning::
+
+        **Should not be accessed directly. Access
+        :class:`~seismic.db.dv_hdf5.DVStore` instead.**
+    """
+    def __init__(
+        self, path: str, mode: str, compression: str,
+            sim_mat_dtype: str):
+        super(DVStoreHandler, self).__init__(path, mode=mode)
+        if sim_mat_dtype not in sim_mat_dtypes:
+            raise ValueError(
+                f'sim_mat_dtype has to be one of {sim_mat_dtypes}, not '
+                f'{sim_mat_dtype}.')
+        comp = parse_compression(compression)
+        if comp['dtype'] is not None or comp['scaleoffset'] is not None:
+            raise ValueError(
+                'Lossy filters are not supported for DV stores. Use '
+                'sim_mat_dtype to quantise the similarity matrices.')
+        self.compression = comp['compression']
+        self.compression_opts = comp['compression_opts']
+        self.shuffle = comp['shuffle']
+        self.sim_mat_dtype = sim_mat_dtype
+
+    def _create(
+            self, group: h5py.Group, name: str, data: np.ndarray, nt: int):
+        """
+        Writes one array. Arrays with a time axis of length ``nt`` are
+        chunked along that axis.
+        """
+        data = np.asarray(data)
+        if data.dtype.kind == 'U':
+            group.create_dataset(
+                name, data=data.astype(object),
+                dtype=h5py.string_dtype())
+            return
+        if data.ndim == 0 or not data.size:
+            group.create_dataset(name, data=data)
+            return
+        kwargs = dict(
+            compression=self.compression,
+            compression_opts=self.compression_opts)
+        if self.shuffle:
+            kwargs['shuffle'] = True
+        if nt in data.shape:
+            chunks = list(data.shape)
+            chunks[data.shape.index(nt)] = min(nt, chunk_len)
+            kwargs['chunks'] = tuple(chunks)
+        group.create_dataset(name, data=data, **kwargs)
+
+    def add_dv(self, dv: DV, key: str = None, overwrite: bool = False):
+        """
+        Adds a velocity change to the store.
+
+        :param dv: The velocity change
+        :type dv: DV
+        :param key: Name of the DV inside of the store, may contain
+            slashes to create a hierarchy. If None, the key is determined
+            by :func:`~seismic.db.dv_hdf5.dv_key`. Defaults to None.
+        :type key: str, optional
+        :param overwrite: Overwrite a DV with the same key. Otherwise, a
+            :class:`KeyError` is raised. Defaults to False.
+        :type overwrite: bool, optional
+        """
+        key = dv_key(dv) if key is None else key.strip('/')
+        # Validate before anything is written
+        attrs = {}
+        if dv.dv_processing is not None and len(dv.dv_processing):
+            attrs = {
+                k: float(dv.dv_processing[k]) for k in processing_keys
+                if dv.dv_processing.get(k) is not None}
+            attrs['sides'] = str(dv.dv_processing.get('sides', 'unknown'))
+            attrs['aligned'] = bool(dv.dv_processing.get('aligned', False))
+        if key in self:
+            if not overwrite:
+                raise KeyError(f'DV {key} is already in the store.')
+            del self[key]
+        grp = self.create_group(key)
+        nt = len(np.atleast_1d(dv.corr))
+        for k, v in mu.save_header_to_np_array(dv.stats).items():
+            try:
+                self._create(grp.require_group('stats'), k, v, nt)
+            except TypeError:
+                warnings.warn(
+                    f'Header item {k} of type {type(v)} cannot be written '
+                    'to the DV store.', UserWarning)
+        for k in time_keys + ['second_axis']:
+            if getattr(dv, k) is not None:
+                self._create(grp, k, getattr(dv, k), nt)
+        if dv.sim_mat is not None:
+            self._add_sim_mat(grp, dv.sim_mat, nt)
+        grp.attrs['method'] = str(np.squeeze(dv.method))
+        grp.attrs['value_type'] = str(np.squeeze(dv.value_type))
+        # Missing parameters (e.g., tw_len None for the whole coda) are not
+        # written
+        grp.attrs.update(attrs)
+
+    def _add_sim_mat(self, grp: h5py.Group, sim_mat: np.ndarray, nt: int):
+        """
+        Writes the similarity matrix with the precision of the store.
+        ``'uint8'`` maps the range of the finite values linearly to 0-254.
+        """
+        sim_mat = np.asarray(sim_mat)
+        attrs = {'quantisation': self.sim_mat_dtype}
+        if self.sim_mat_dtype == 'uint8':
+            finite = np.isfinite(sim_mat)
+            lo = float(sim_mat[finite].min()) if finite.any() else 0.
+            hi = float(sim_mat[finite].max()) if finite.any() else 0.
+            scale = (hi - lo)/(_uint8_nan - 1) or 1.
+            q = np.full(sim_mat.shape, _uint8_nan, dtype=np.uint8)
+            q[finite] = np.round((sim_mat[finite] - lo)/scale)
+            sim_mat = q
+            attrs.update(scale=scale, offset=lo)
+        else:
+            sim_mat = sim_mat.astype(self.sim_mat_dtype)
+        self._create(grp, 'sim_mat', sim_mat, nt)
+        grp['sim_mat'].attrs.update(attrs)
+
+    def remove_dv(self, key: str):
+        """
+        Deletes a velocity change from the store.
+
+        :param key: Key of the DV
+        :type key: str
+        """
+        del self[key.strip('/')]
+
+    def get_available_keys(self, pattern: str = '*') -> List[str]:
+        """
+        Returns the keys of all DVs in the store that match ``pattern``.
+
+        :param pattern: Pattern with unix style wildcards, defaults to '*'
+        :type pattern: str, optional
+        :return: Sorted list of keys
+        :rtype: List[str]
+        """
+        keys = []
+
+        def _collect(name, obj):
+            if isinstance(obj, h5py.Group) and 'corr' in obj:
+                keys.append(name)
+        self.visititems(_collect)
+        return sorted(fnmatch.filter(keys, pattern.strip('/')))
+
+    def get_dv(self, key: str, load_sim_mat: bool = False) -> DV:
+        """
+        Reads a velocity change from the store.
+
+        :param key: Key of the DV
+        :type key: str
+        :param load_sim_mat: Read the similarity matrix right away. If False,
+            the similarity matrix is only read when ``DV.sim_mat`` is
+            accessed for the first time. Defaults to False.
+        :type load_sim_mat: bool, optional
+        :return: The velocity change
+        :rtype: DV
+        """
+        grp = self[key.strip('/')]
+        header = {k: _read(ds) for k, ds in grp['stats'].items()}
+        stats = CorrStats(mu.load_header_from_np_array(header))
+        arrays = {
+            k: _read(grp[k]) if k in grp else None
+            for k in time_keys + ['second_axis']}
+        dv_processing = {}
+        if 'sides' in grp.attrs:
+            dv_processing = {
+                k: grp.attrs.get(k) for k in processing_keys}
+            dv_processing['sides'] = grp.attrs['sides']
+            dv_processing['aligned'] = bool(grp.attrs['aligned'])
+        lazy = 'sim_mat' in grp and not load_sim_mat
+        if 'sim_mat' in grp and load_sim_mat:
+            sim_mat = _read_sim_mat(grp['sim_mat'])
+        else:
+            sim_mat = None
+        dv = DV(
+            arrays['corr'], arrays['value'], grp.attrs['value_type'],
+            sim_mat, arrays['second_axis'], grp.attrs['method'], stats,
+            stretches=arrays['stretches'], corrs=arrays['corrs'],
+            n_stat=arrays['n_stat'], dv_processing=dv_processing)
+        if lazy:
+            dv.set_sim_mat_loader(partial(
+                load_sim_mat_from_store, self.filename, grp.name))
+        return dv
+
+    def import_npz(
+        self, path: str, root: str = None,
+            overwrite: bool = False) -> List[str]:
+        """
+        Imports velocity changes that were saved with
+        :meth:`~seismic.monitor.dv.DV.save`.
+
+        :param path: Path to the npz files, wildcards allowed
+        :type path: str
+        :param root: If given, the key of each DV is its path relative to
+            ``root`` without suffix (e.g.,
+            ``'f0.5-1_tw5-20/DV-X9.IR1.HHE'``). Otherwise, the key is
+            determined by :func:`~seismic.db.dv_hdf5.dv_key`.
+            Defaults to None.
+        :type root: str, optional
+        :param overwrite: Overwrite DVs with the same key, defaults to False
+        :type overwrite: bool, optional
+        :return: The keys of the imported DVs
+        :rtype: List[str]
+        """
+        keys = []
+        for f in sorted(glob(path)):
+            dv = read_dv(f)
+            key = None
+            if root is not None:
+                key = os.path.splitext(os.path.relpath(f, root))[0]
+                key = key.replace(os.sep, '/')
+            self.add_dv(dv, key, overwrite=overwrite)
+            keys.append(key or dv_key(dv))
+        return keys
+
+
+class DVStore(object):
+    """
+    hdf5 file that holds many velocity change objects.
+    """
+    def __init__(
+        self, path: str, mode: str = 'a', compression: str = 'gzip3',
+            sim_mat_dtype: str = 'float64'):
+        """
+        Access an hdf5 file holding velocity changes. Compared to one
+        ``npz`` file per DV, all arrays are chunked along the time axis and
+        can be read without decompressing the rest of the file. The
+        similarity matrices (by far the largest arrays) are only read when
+        they are accessed and can be saved with reduced precision.
+
+        :param path: Full path to the file
+        :type path: str
+        :param mode: Mode to access the file. 'a' for all, 'w' for write,
+            'r+' for writing in an already existing file, or 'r' for
+            read-only, defaults to 'a'.
+        :type mode: str, optional
+        :param compression: Compression of the arrays, see
+            :func:`~seismic.db.corr_hdf5.parse_compression`. Only lossless
+            options are allowed. Defaults to 'gzip3'.
+        :type compression: str, optional
+        :param sim_mat_dtype: Precision that new similarity matrices are
+            written with. ``'float16'`` keeps about three significant digits.
+            ``'uint8'`` maps the range of each similarity matrix to 255
+            steps (i.e., an error of up to 0.004 for correlation
+            coefficients between -1 and 1). Similarity matrices are always
+            returned as float. Defaults to 'float64'.
+        :type sim_mat_dtype: str, optional
+
+        .. warning::
+
+            **Access only through a context manager (see below):**
+
+        Example::
+
+            >>> with DVStore('/path/to/dv/dv.h5') as dvs:
+            >>>     dvs.import_npz('/path/to/dv/*.npz')
+            >>>     print(dvs.get_available_keys('*HHZ*'))
+            ['DV-X9-X9.IR1-IR1..HHZ-HHZ']
+            >>>     dv = dvs.get_dv('DV-X9-X9.IR1-IR1..HHZ-HHZ')
+            >>> # the similarity matrix is read on first access
+            >>> dv.sim_mat.shape
+            (365, 1001)
+        """
+        if not path.split('.')[-1] == 'h5':
+            path += '.h5'
+        self.path = path
+        self.mode = mode
+        self.compression = compression
+        self.sim_mat_dtype = sim_mat_dtype
+
+    def __enter__(self) -> DVStoreHandler:
+        self.handler = DVStoreHandler(
+            self.path, self.mode, self.compression, self.sim_mat_dtype)
+        return self.handler
+
+    def __exit__(self, exc_type, exc_value, tb) -> None or bool:
+        self.handler.close()
+        if exc_type is not None:
+            return False
+
+
+def dv_key(dv: DV) -> str:
+    """
+    Default key of a DV inside of a
+    :class:`~seismic.db.dv_hdf5.DVStore`. Corresponds to the file name that
+    :class:`~seismic.monitor.monitor.Monitor` saves the DV as. If the DV
+    holds processing parameters, the frequency band and lapse time window
+    are added as a subgroup, named like the folders of
+    :class:`~seismic.monitor.monitor.Monitor`
+    (see :func:`~seismic.monitor.dv.dv_subdir`). Missing parameters are
+    written as None.
+
+    :param dv: The velocity change
+    :type dv: DV
+    :return: The key
+    :rtype: str
+    """
+    st = dv.stats
+    key = f'DV-{st.network}.{st.station}.{st.location}.{st.channel}'
+    p = dv.dv_processing
+    if p is not None and any(k in p for k in processing_keys):
+        key = dv_subdir(*(p.get(k) for k in processing_keys)) + '/' + key
+    return key
+
+
+def load_sim_mat_from_store(path: str, key: str) -> np.ndarray:
+    """
+    Reads one similarity matrix from a DV store.
+
+    :param path: Path to the store
+    :type path: str
+    :param key: Key of the DV
+    :type key: str
+    :return: The similarity matrix
+    :rtype: np.ndarray
+    """
+    with h5py.File(path, 'r') as f:
+        return _read_sim_mat(f[key]['sim_mat'])
+
+
+def read_dv_store(
+        path: str, pattern: str = '*', load_sim_mat: bool = False) -> List[DV]:
+    """
+    Reads all velocity changes from a DV store whose keys match
+    ``pattern``.
+
+    :param path: Path to the store
+    :type path: str
+    :param pattern: Key pattern with unix style wildcards, defaults to '*'
+    :type pattern: str, optional
+    :param load_sim_mat: Read the similarity matrices right away instead of
+        on first access, defaults to False
+    :type load_sim_mat: bool, optional
+    :return: The velocity changes
+    :rtype: List[DV]
+    """
+    with DVStore(path, mode='r') as dvs:
+        return [
+            dvs.get_dv(k, load_sim_mat)
+            for k in dvs.get_available_keys(pattern)]
+
+
+def _read(ds: h5py.Dataset) -> np.ndarray:
+    """
+    Reads a dataset, strings are returned as numpy unicode arrays.
+    """
+    if h5py.check_string_dtype(ds.dtype) is not None:
+        return np.array(ds.asstr()[()], dtype=str)
+    return ds[()]
+
+
+def _read_sim_mat(ds: h5py.Dataset) -> np.ndarray:
+    """
+    Reads a similarity matrix and reverts the quantisation.
+    """
+    data = ds[()]
+    if ds.attrs.get('quantisation', None) == 'uint8':
+        nans = data == _uint8_nan
+        data = data*ds.attrs['scale'] + ds.attrs['offset']
+        data[nans] = np.nan
+    elif data.dtype == np.float16:
+        data = data.astype(np.float32)
+    return data
@@ -12,10 +12,11 @@ Last Modified: Wednesday, 19th June 2024 04:07:10 pm
 '''
 
 from datetime import datetime
+from functools import partial
 from glob import glob
-from typing import List, Tuple, Optional
+from typing import Callable, Generator, List, Tuple, Optional
 import warnings
-from zipfile import BadZipFile
+from zipfile import BadZipFile, ZipFile
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -65,6 +66,12 @@ class DV(object):
         :param n_stat: Number of stations used for the stack at corr_start t.
             Has the same shape as `value` and `corr`. Defaults to None
         :type n_stat: np.ndarray, optional
+
+        .. note::
+
+            The similarity matrix of DVs read from a
+            :class:`~seismic.db.dv_hdf5.DVStore` is only loaded on first
+            access (see :meth:`~seismic.monitor.dv.DV.set_sim_mat_loader`).
         """
         # Allocate attributes
         self.value_type = value_type
@@ -81,6 +88,30 @@ class DV(object):
         # Available indices
         self.avail = ~np.isnan(self.corr)
 
+    def __getattr__(self, name: str):
+        # Only called if the attribute does not exist, i.e., if the
+        # similarity matrix is to be loaded lazily
+        loader = self.__dict__.get('_sim_mat_loader', None)
+        if name == 'sim_mat' and loader is not None:
+            self.sim_mat = loader()
+            del self._sim_mat_loader
+            return self.sim_mat
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def set_sim_mat_loader(self, loader: Callable[[], np.ndarray]):
+        """
+        Defers loading the similarity matrix. The current similarity matrix
+        is discarded and ``loader`` is called when ``sim_mat`` is accessed
+        for the first time.
+
+        :param loader: Function without arguments that returns the
+            similarity matrix.
+        :type loader: Callable[[], np.ndarray]
+        """
+        self.__dict__.pop('sim_mat', None)
+        self._sim_mat_loader = loader
+
     def __str__(self):
         """
         Print a prettier string.
@@ -222,26 +253,42 @@ class DV(object):
         return self
 
 
-def read_dv(path: str) -> DV:
+def read_dv(path: str, load_sim_mat: bool = True) -> DV:
     """
     Reads a saved velocity change object from an **.npz** file.
 
-    :param path: Path to file, wildcards allowed
+    :param path: Path to file, wildcards allowed. If the path points to a
+        :class:`~seismic.db.dv_hdf5.DVStore` (an **.h5** file), all
+        DVs in the store are read (see
+        :func:`~seismic.db.dv_hdf5.read_dv_store`).
     :type path: str
+    :param load_sim_mat: Decompress the similarity matrix right away. If
+        False, it is only read when ``DV.sim_mat`` is accessed.
+        Defaults to True.
+    :type load_sim_mat: bool, optional
     :return: the corresponding and converted DV object
-    :rtype: DV, List[DV] if path contains wildcards
+    :rtype: DV, List[DV] if path contains wildcards or is a DV store
     """
     if '*' in path or '?' in path:
         dvl = []
         for p in glob(path):
             try:
-                dvl.append(read_dv(p))
+                dv = read_dv(p, load_sim_mat)
             except BadZipFile:
                 warnings.warn(f'File {p} corrupt, skipping..')
+                continue
+            if isinstance(dv, list):
+                dvl.extend(dv)
+            else:
+                dvl.append(dv)
         if not len(dvl):
             raise FileNotFoundError(
                 f'No files that adhere the pattern {path} found.')
         return dvl
+    if path.endswith('.h5'):
+        # Imported here, the store module depends on this one
+        from seismic.db.dv_hdf5 import read_dv_store
+        return read_dv_store(path, load_sim_mat=load_sim_mat)
     loaded = np.load(path)
     stats = CorrStats(mu.load_header_from_np_array(loaded))
     # to check that compatibility works
@@ -261,9 +308,87 @@ def read_dv(path: str) -> DV:
         dv_processing['aligned'] = loaded.get('aligned', False)
     except KeyError:
         dv_processing = {}
-    return DV(
-        loaded['corr'], loaded['value'], vt, loaded['sim_mat'],
+    dv = DV(
+        loaded['corr'], loaded['value'], vt,
+        loaded['sim_mat'] if load_sim_mat else None,
         loaded['second_axis'], method, stats=stats,
         stretches=loaded.get('stretches', None),
         corrs=loaded.get('corrs', None), n_stat=loaded.get('n_stat', None),
         dv_processing=dv_processing)
+    if not load_sim_mat:
+        dv.set_sim_mat_loader(partial(_load_npz_array, path, 'sim_mat'))
+    return dv
+
+
+def dv_subdir(
+    freq_min: float, freq_max: float, tw_start: float,
+        tw_len: float | None) -> str:
+    """
+    Name of the folder that the velocity changes of one frequency band and
+    lapse time window are saved into (e.g., ``'f1-2_tw5-None'``). Integral
+    values are written without decimals, so the name is the same for
+    parameters that were read as int or as float.
+
+    :param freq_min: Lower corner frequency
+    :type freq_min: float
+    :param freq_max: Upper corner frequency
+    :type freq_max: float
+    :param tw_start: Start of the lapse time window
+    :type tw_start: float
+    :param tw_len: Length of the lapse time window, None for the whole coda
+    :type tw_len: float | None
+    :return: The folder name
+    :rtype: str
+    """
+    return 'f%s-%s_tw%s-%s' % tuple(
+        _format_param(v) for v in (freq_min, freq_max, tw_start, tw_len))
+
+
+def _format_param(v: float | None) -> str:
+    if v is None:
+        return 'None'
+    v = float(v)
+    return '%d' % v if v.is_integer() else repr(v)
+
+
+def _load_npz_array(path: str, key: str) -> np.ndarray:
+    with np.load(path) as loaded:
+        return loaded[key]
+
+
+def iter_npz_rows(
+    path: str, key: str = 'sim_mat',
+        chunk_len: int = 1024) -> Generator[np.ndarray, None, None]:
+    """
+    Reads a 2D array from an **.npz** file in blocks of rows, e.g., the
+    similarity matrix of a saved DV. The array is decompressed while it is
+    read, so only one block is held in memory at a time.
+
+    :param path: Path to the npz file
+    :type path: str
+    :param key: Name of the array, defaults to 'sim_mat'
+    :type key: str, optional
+    :param chunk_len: Number of rows per block, defaults to 1024
+    :type chunk_len: int, optional
+    :yield: Blocks of at most ``chunk_len`` rows
+    :rtype: Generator[np.ndarray, None, None]
+    """
+    with ZipFile(path) as zf, zf.open(key + '.npy') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        if fortran_order or dtype.hasobject or len(shape) != 2:
+            # Cannot be read row by row
+            data = np.atleast_2d(_load_npz_array(path, key))
+            for start in range(0, data.shape[0], chunk_len):
+                yield data[start:start + chunk_len]
+            return
+        rowbytes = shape[1]*dtype.itemsize
+        for start in range(0, shape[0], chunk_len):
+            n = min(chunk_len, shape[0] - start)
+            yield np.frombuffer(
+                f.read(n*rowbytes), dtype=dtype).reshape(n, shape[1])
@@ -11,10 +11,12 @@ Created: Thursday, 3rd June 2021 04:15:57 pm
 Last Modified: Tuesday, 9th July 2024 04:48:54 pm
 '''
 from copy import deepcopy
+import hashlib
+from importlib.metadata import PackageNotFoundError, version
 import json
 import logging
 import os
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, List, Optional, Tuple
 import warnings
 import yaml
 import fnmatch
@@ -25,11 +27,22 @@ import numpy as np
 from obspy import UTCDateTime
 from tqdm import tqdm
 
-from seismic.db.corr_hdf5 import CorrelationDataBase, h5_FMTSTR
-from seismic.monitor.dv import DV, read_dv
+from seismic.db.corr_hdf5 import (
+    CorrelationDataBase, h5_FMTSTR, list_segments)
+from seismic.correlate.stats import CorrStats, TimeArray
+from seismic.correlate.stream import CorrBulk, CorrStream
+from seismic.db.catalog import CorrelationCatalog, catalog_file
+from seismic.monitor.dv import DV, dv_subdir, iter_npz_rows, read_dv
+from seismic.monitor import stretch_mod as sm
+from seismic.monitor.trim import corr_mat_trim
 from seismic.monitor.wfc import WFC
 from seismic.utils.miic_utils import log_lvl
 
+try:
+    code_version = version('seismic')
+except PackageNotFoundError:
+    code_version = 'unknown'
+
 
 class Monitor(object):
     def __init__(self, options: dict | str):
@@ -56,6 +69,9 @@ class Monitor(object):
         self.indir = os.path.join(
             options['proj_dir'], options['co']['subdir']
         )
+        # Memory budget for stretched reference traces that are reused
+        sm.ref_cache.resize(
+            int(options['dv'].get('stretch_cache_mb', 256)*2**20))
 
         # init MPI
         self.comm = MPI.COMM_WORLD
@@ -154,6 +170,39 @@ class Monitor(object):
                     netlist, statlist)]))
         return netlist, statlist, infiles
 
+    def _find_channel_combinations(self, tag: str) -> List[
+            Tuple[str, str, str, str, str]]:
+        """
+        Finds all channel combinations with data under ``tag`` in the
+        requested correlation files. If the correlation directory holds a
+        :class:`~seismic.db.catalog.CorrelationCatalog`, the catalog is
+        updated and queried instead of opening every file.
+
+        :param tag: Tag of the correlations
+        :type tag: str
+        :return: A list holding file, network, station, location, and
+            channel combination code for each combination.
+        :rtype: List[Tuple[str, str, str, str, str]]
+        """
+        if os.path.isfile(os.path.join(self.indir, catalog_file)):
+            cat = CorrelationCatalog(self.indir)
+            cat.update()
+            order = {os.path.basename(f): ii for ii, f in enumerate(
+                self.infiles)}
+            plist = [
+                p for p in cat.combinations(tag)
+                if os.path.basename(p[0]) in order]
+            plist.sort(key=lambda p: (order[os.path.basename(p[0])], p[4]))
+            return plist
+        plist = []
+        for f, n, s in zip(self.infiles, self.netlist, self.statlist):
+            locs = os.path.basename(f).split('.')[2]
+            with CorrelationDataBase(f, mode='r') as cdb:
+                ch = cdb.get_available_channels(
+                    tag, n, s, locs)
+                plist.extend([f, n, s, locs, c] for c in ch)
+        return plist
+
     def compute_velocity_change(
         self, corr_file: str, tag: str, network: str, station: str,
             location: str, channel: str, ref_trcs: np.ndarray = None):
@@ -167,6 +216,26 @@ class Monitor(object):
         Data will be written into the defined dv folder and plotted if this
         option was previously set to True.
 
+        ``freq_min``, ``freq_max``, ``tw_start``, and ``tw_len`` in the dv
+        options may be lists. Then, the correlations are only loaded,
+        normalised, and resampled once. One velocity change is computed for
+        each combination of frequency band and time window and saved into a
+        subdirectory of the dv folder named
+        ``f{freq_min}-{freq_max}_tw{tw_start}-{tw_len}``.
+
+        If ``incremental`` is set to True in the dv options, the final
+        reference trace(s) and the processing options are saved into the
+        subdirectory ``incremental`` next to each DV, together with the
+        start of the latest correlation that was processed. On the next run,
+        nothing is done unless the database holds later correlations or
+        there are new time windows. Otherwise, only correlations from the
+        last time window of the existing DV that holds data on (and a few
+        windows before that overlap with it or are needed for the smoothing
+        of pre- and postprocessing) are loaded, stretched against the saved
+        reference, and appended to the existing DV. Earlier time windows are
+        kept as they are. If any option has changed, the velocity change is
+        computed from scratch.
+
         :param corr_file: File to read the correlation data from.
         :type corr_file: str
         :param tag: Tag of the data in the file (almost always `'subdivision'`)
@@ -187,12 +256,44 @@ class Monitor(object):
         self.logger.info(
             f'Computing velocity change for file: {corr_file} and channel: '
             f' {channel}.')
+        bands, windows = self._bands_and_windows()
+        incremental = self.options['dv'].get('incremental', False)
+        states = None
         with CorrelationDataBase(corr_file, mode='r') as cdb:
-            # get the corrstream containing all the corrdata for this combi
-            cst = cdb.get_data(network, station, location, channel, tag)
-            lts = cdb.get_corr_options()['corr_args']['lengthToSave']
-
-        tw_start = self.options['dv']['tw_start']
+            co = cdb.get_corr_options()
+            lts = co['corr_args']['lengthToSave']
+            if incremental:
+                states = self._load_incremental_states(
+                    network, station, location, channel, bands, windows, co)
+                last_corr = latest_corr_start(
+                    cdb, network, station, location, channel, tag)
+            if states is None:
+                # get the corrstream containing all the corrdata for this
+                # combi
+                start = 0
+                cst = cdb.get_data(network, station, location, channel, tag)
+            else:
+                # The overlap is recomputed only if there are new
+                # correlations or time windows
+                if all(
+                    (last_corr is None or st['last_corr'] >= last_corr)
+                    and len(st['dv'].corr) >= len(self.starttimes)
+                        for st in states.values()):
+                    self.logger.info(
+                        f'Velocity change for {network}.{station}.{location}'
+                        f'.{channel} is up to date.')
+                    return
+                start = min(st['start'] for st in states.values())
+                cst = corr_data_since(
+                    cdb, network, station, location, channel, tag,
+                    self.starttimes[start])
+        if states is not None and not cst.count():
+            self.logger.info(
+                f'No new correlations for {network}.{station}.{location}.'
+                f'{channel}.')
+            return
+        tt = 0
+        d = 0
 
         if self.options['dv']['compute_tt']:
             if not hasattr(cst[0].stats, 'dist'):
@@ -207,21 +308,21 @@ class Monitor(object):
                     + ((cst[0].stats.stel-cst[0].stats.evel)/1000)**2)
                 tt = round(
                     d/self.options['dv']['rayleigh_wave_velocity'], 0)
-                tw_start += tt
                 self.logger.info(
                     f'Computed travel time for {network}.{station} is '
                     f'{tt} s. The assumed direct-line distance was {d} km.')
-        if lts < tw_start + self.options['dv']['tw_len']:
-            reqtw = tw_start + self.options[
-                'dv']['tw_len']
-            raise ValueError(
-                'Requested lapse time window (time window start + time window'
-                f' length = {reqtw} contains segments after the Correlation'
-                'Function.'
-                ' When computing the correlations make sure to set an '
-                f'appropriate value for lengthToSave. The value was {lts}.'
-                f' The direct-line distance between the stations is {d} km.'
-            )
+        for tw_start, tw_len in windows:
+            if tw_len is not None and lts < tw_start + tt + tw_len:
+                reqtw = tw_start + tt + tw_len
+                raise ValueError(
+                    'Requested lapse time window (time window start + time '
+                    f'window length = {reqtw} contains segments after the '
+                    'Correlation Function.'
+                    ' When computing the correlations make sure to set an '
+                    'appropriate value for lengthToSave. The value was '
+                    f'{lts}. The direct-line distance between the stations '
+                    f'is {d} km.'
+                )
 
         if 'preprocessing' in self.options['dv']:
             for func in self.options['dv']['preprocessing']:
@@ -229,38 +330,345 @@ class Monitor(object):
                 if func['function'] in ['pop_at_utcs', 'select_time']:
                     f = cst.__getattribute__(func['function'])
                     cst = f(**func['args'])
-        cb = cst.create_corr_bulk(
+        cb_bac = cst.create_corr_bulk(
             network=network, station=station, channel=channel,
             location=location, inplace=True)
 
         # for possible rest bits
         del cst
         # Do the actual processing:
-        cb.normalize(normtype='absmax')
+        cb_bac.normalize(normtype='absmax')
         # That is were the stacking is happening
-        cb.resample(self.starttimes, self.endtimes)
-        cb.filter(
-            (self.options['dv']['freq_min'], self.options['dv']['freq_max']))
+        cb_bac.resample(self.starttimes[start:], self.endtimes[start:])
+        memmap_dir = self.options['dv'].get('memmap_dir')
+        if memmap_dir not in (None, 'None'):
+            # Keep the matrix and its copies for the different bands and the
+            # stretch correction on disk
+            cb_bac.to_memmap(tmp_dir=memmap_dir)
+        threads = int(self.options['dv'].get('threads', 1))
+
+        # Loading, normalisation and resampling are shared by all frequency
+        # bands and time windows
+        for fmin, fmax in bands:
+            cb = cb_bac.copy() if len(bands) > 1 else cb_bac
+            cb.filter((fmin, fmax), threads=threads)
 
-        # Preprocessing on the correlation bulk
-        if 'preprocessing' in self.options['dv']:
-            for func in self.options['dv']['preprocessing']:
-                if func['function'] in ['pop_at_utcs', 'select_time']:
-                    continue
-                f = cb.__getattribute__(func['function'])
-                cb = f(**func['args'])
+            # Preprocessing on the correlation bulk
+            if 'preprocessing' in self.options['dv']:
+                for func in self.options['dv']['preprocessing']:
+                    if func['function'] in ['pop_at_utcs', 'select_time']:
+                        continue
+                    f = cb.__getattribute__(func['function'])
+                    cb = f(**func['args'])
+
+            for tw_start, tw_len in windows:
+                processing = deepcopy(self.options['dv'])
+                processing.update(
+                    freq_min=fmin, freq_max=fmax, tw_start=tw_start,
+                    tw_len=tw_len)
+                state = None
+                if states is not None:
+                    state = states[((fmin, fmax), (tw_start, tw_len))]
+                if incremental:
+                    dv, ref = self._stretch_bulk(
+                        cb, tw_start + tt, tw_len, ref_trcs if state is None
+                        else state['ref_trc'], processing, return_ref=True)
+                else:
+                    dv = self._stretch_bulk(
+                        cb, tw_start + tt, tw_len, ref_trcs, processing)
+
+                # Postprocessing on the dv object
+                if 'postprocessing' in self.options['dv']:
+                    for func in self.options['dv']['postprocessing']:
+                        f = dv.__getattribute__(func['function'])
+                        dv = f(**func['args'])
+                if state is not None:
+                    dv = append_dv(
+                        state['dv'], dv, self.starttimes[state['keep']])
+
+                # One subdirectory per band and time window, so that
+                # each directory can be averaged on its own
+                outdir = self._dv_outdir(
+                    fmin, fmax, tw_start, tw_len,
+                    len(bands) > 1 or len(windows) > 1)
+                os.makedirs(outdir, exist_ok=True)
+                outf = os.path.join(
+                    outdir, f'DV-{network}.{station}.{location}.{channel}')
+                dv.save(outf)
+                if incremental:
+                    os.makedirs(
+                        os.path.join(outdir, 'incremental'), exist_ok=True)
+                    np.savez(
+                        self._incremental_state_file(
+                            outdir, network, station, location, channel),
+                        ref_trc=ref, state=np.array(
+                            self._incremental_state(processing, co)),
+                        last_corr=np.nan if last_corr is None else last_corr)
+                if self.options['dv']['plot_vel_change']:
+                    savedir, fname = os.path.split(self._dv_figure(
+                        outdir, network, station, location, channel))
+                    dv.plot(
+                        save_dir=savedir, figure_file_name=fname,
+                        normalize_simmat=True, sim_mat_Clim=[-1, 1])
+
+    def _cache_file(self, step: str, name: str) -> str:
+        """
+        File that holds the digest of the inputs and the outputs of one task.
+        """
+        return os.path.join(
+            self.options['proj_dir'], '.build_cache', step, name + '.json')
+
+    def _is_up_to_date(
+        self, cachef: str, digest: str,
+            outputs: Optional[List[str]] = None) -> bool:
+        """
+        Checks whether a task was completed with the same digest and all of
+        its recorded outputs and the expected ``outputs`` still exist.
+        """
+        try:
+            with open(cachef) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return entry.get('digest') == digest and all(
+            os.path.isfile(f)
+            for f in entry.get('outputs', []) + (outputs or []))
+
+    def _write_cache(self, cachef: str, digest: str, outputs: List[str]):
+        os.makedirs(os.path.dirname(cachef), exist_ok=True)
+        # Replace atomically, so that an interrupted write does not leave a
+        # corrupt entry
+        tmpf = f'{cachef}.{os.getpid()}.tmp'
+        with open(tmpf, 'w') as f:
+            json.dump({'digest': digest, 'outputs': outputs}, f)
+        os.replace(tmpf, cachef)
+
+    def _dv_outputs(
+        self, network: str, station: str, location: str,
+            channel: str) -> List[str]:
+        """
+        Files that
+        :meth:`~seismic.monitor.monitor.Monitor.compute_velocity_change`
+        writes the velocity changes of one channel combination into.
+        """
+        bands, windows = self._bands_and_windows()
+        multi = len(bands) > 1 or len(windows) > 1
+        outputs = []
+        for fmin, fmax in bands:
+            for tw_start, tw_len in windows:
+                outdir = self._dv_outdir(fmin, fmax, tw_start, tw_len, multi)
+                outputs.append(os.path.join(outdir, (
+                    f'DV-{network}.{station}.{location}.{channel}.npz')))
+                # Missing figures make the task stale as well
+                if self.options['dv']['plot_vel_change']:
+                    outputs.append(self._dv_figure(
+                        outdir, network, station, location, channel))
+        return outputs
+
+    def _dv_figure(
+        self, outdir: str, network: str, station: str, location: str,
+            channel: str) -> str:
+        """
+        Figure that the velocity change saved in ``outdir`` is plotted into.
+        """
+        fname = f'{network}_{station}_{location}_{channel}'
+        if outdir != self.outdir:
+            fname += '_' + os.path.basename(outdir)
+        return os.path.join(
+            self.options['proj_dir'], self.options['fig_subdir'],
+            fname + '.png')
+
+    def _dv_outdir(
+        self, fmin: float, fmax: float, tw_start: float,
+            tw_len: float | None, multi: bool) -> str:
+        """
+        Directory that the velocity change of one frequency band and lapse
+        time window is saved into.
+        """
+        if not multi:
+            return self.outdir
+        return os.path.join(
+            self.outdir, dv_subdir(fmin, fmax, tw_start, tw_len))
+
+    def _incremental_state_file(
+        self, outdir: str, network: str, station: str, location: str,
+            channel: str) -> str:
+        return os.path.join(
+            outdir, 'incremental',
+            f'REF-{network}.{station}.{location}.{channel}.npz')
+
+    def _incremental_state(self, processing: dict, co: dict) -> str:
+        """
+        String representation of all options that influence the velocity
+        change. Options that only define the period to process or the output
+        are excluded.
+        """
+        keys = [
+            'subdir', 'plot_vel_change', 'start_date', 'end_date',
+            'stretch_cache_mb', 'memmap_dir', 'threads']
+        return json.dumps({
+            'dv': {k: v for k, v in processing.items() if k not in keys},
+            'co': co}, sort_keys=True, default=str)
+
+    def _incremental_overlap(self) -> int:
+        """
+        Number of time windows at the end of an existing velocity change
+        that are affected by new correlations: the last window that holds
+        data (it might have been filled only partly), the windows before
+        that overlap with it if ``win_len`` is longer than ``date_inc``, and
+        the windows affected by the smoothing along the time axis in the
+        pre- and postprocessing.
+        """
+        n = int(np.ceil(
+            self.options['dv']['win_len']/self.options['dv']['date_inc']))
+        for func in self.options['dv'].get('preprocessing', []):
+            if func['function'] == 'smooth' and func['args'].get(
+                    'axis', 1) == 1:
+                n += int(func['args']['wsize'])
+        for func in self.options['dv'].get('postprocessing', []):
+            if func['function'] == 'smooth_sim_mat':
+                n += int(func['args']['win_len'])
+        return n
+
+    def _load_incremental_states(
+        self, network: str, station: str, location: str, channel: str,
+        bands: List[Tuple[float, float]],
+        windows: List[Tuple[float, float]], co: dict) -> Dict[
+            tuple, dict] | None:
+        """
+        Loads the existing velocity changes and reference traces for an
+        incremental update.
+
+        :return: For each frequency band and time window a dictionary with
+            the existing DV (``dv``), the reference trace(s) (``ref_trc``),
+            the start of the latest processed correlation as timestamp
+            (``last_corr``), the number of time windows of the DV to keep
+            (``keep``), and the first time window that has to be recomputed
+            (``start``).
+            None if the velocity changes have to be computed from scratch.
+        :rtype: Dict[tuple, dict] | None
+        """
+        multi = len(bands) > 1 or len(windows) > 1
+        overlap = self._incremental_overlap()
+        starts = np.array([UTCDateTime(t).timestamp for t in self.starttimes])
+        states = {}
+        for fmin, fmax in bands:
+            for tw_start, tw_len in windows:
+                outdir = self._dv_outdir(fmin, fmax, tw_start, tw_len, multi)
+                dvf = os.path.join(
+                    outdir, f'DV-{network}.{station}.{location}.{channel}.npz')
+                statef = self._incremental_state_file(
+                    outdir, network, station, location, channel)
+                if not os.path.isfile(dvf) or not os.path.isfile(statef):
+                    return None
+                processing = deepcopy(self.options['dv'])
+                processing.update(
+                    freq_min=fmin, freq_max=fmax, tw_start=tw_start,
+                    tw_len=tw_len)
+                with np.load(statef) as loaded:
+                    if 'last_corr' not in loaded or str(
+                            loaded['state']) != self._incremental_state(
+                                processing, co):
+                        self.logger.info(
+                            f'Options changed since {dvf} was computed.')
+                        return None
+                    ref_trc = loaded['ref_trc']
+                    last_corr = float(loaded['last_corr'])
+                dv = read_dv(dvf)
+                old = TimeArray(dv.stats.corr_start).timestamps
+                if len(old) > len(starts) or not np.allclose(
+                        old, starts[:len(old)]):
+                    self.logger.info(
+                        f'Time windows of {dvf} do not match the options.')
+                    return None
+                # resample creates empty windows up to end_date
+                filled = np.flatnonzero(np.isfinite(dv.corr))
+                n_filled = filled[-1] + 1 if len(filled) else 0
+                keep = max(n_filled - overlap, 0)
+                states[((fmin, fmax), (tw_start, tw_len))] = dict(
+                    dv=dv, ref_trc=ref_trc, last_corr=last_corr, keep=keep,
+                    start=max(keep - overlap, 0))
+        return states
+
+    def _bands_and_windows(self, step: str = 'dv') -> Tuple[
+            List[Tuple[float, float]], List[Tuple[float, float]]]:
+        """
+        Reads the frequency bands and lapse time windows from the dv or wfc
+        options. ``freq_min``, ``freq_max``, ``tw_start``, and ``tw_len`` may
+        be single values or lists. ``tw_len`` may be a single value for all
+        windows.
+
+        :param step: Options section to read from, ``'dv'`` or ``'wfc'``.
+            Defaults to ``'dv'``.
+        :type step: str, optional
+        :raises ValueError: For lists of different length or a freq_min
+            that is not smaller than freq_max.
+        :return: The frequency bands (fmin, fmax) and the time windows
+            (tw_start, tw_len)
+        :rtype: Tuple[List[Tuple[float, float]], List[Tuple[float, float]]]
+        """
+        opt = self.options[step]
+        fmins = opt['freq_min'] if isinstance(
+            opt['freq_min'], list) else [opt['freq_min']]
+        fmaxs = opt['freq_max'] if isinstance(
+            opt['freq_max'], list) else [opt['freq_max']]
+        if len(fmins) != len(fmaxs):
+            raise ValueError(
+                'freq_min and freq_max must be of same length.')
+        for fmin, fmax in zip(fmins, fmaxs):
+            if fmin >= fmax:
+                raise ValueError('freq_min must be smaller than freq_max.')
+        tw_starts = opt['tw_start'] if isinstance(
+            opt['tw_start'], list) else [opt['tw_start']]
+        if not isinstance(opt['tw_len'], list):
+            tw_lens = [opt['tw_len']]*len(tw_starts)
+        elif len(opt['tw_len']) != len(tw_starts):
+            raise ValueError(
+                'tw_start and tw_len must be of same length or tw_len must be'
+                ' a single value.')
+        else:
+            tw_lens = opt['tw_len']
+        return list(zip(fmins, fmaxs)), list(zip(tw_starts, tw_lens))
 
+    def _stretch_bulk(
+        self, cb: CorrBulk, tw_start: float, tw_len: float | None,
+            ref_trcs: np.ndarray | None, processing: dict,
+            return_ref: bool = False) -> DV | Tuple[DV, np.ndarray]:
+        """
+        Estimates the velocity change of a filtered and preprocessed
+        CorrBulk in one lapse time window. The stretch is estimated twice,
+        the second time with a reference trace that is extracted after
+        correcting the first estimate.
+
+        :param cb: The filtered CorrBulk. Will not be altered.
+        :type cb: CorrBulk
+        :param tw_start: Start of the lapse time window in s (including the
+            travel time)
+        :type tw_start: float
+        :param tw_len: Length of the lapse time window in s. If None, the
+            whole coda is used.
+        :type tw_len: float | None
+        :param ref_trcs: Custom reference trace(s) or None
+        :type ref_trcs: np.ndarray | None
+        :param processing: dv options to be saved with the DV
+        :type processing: dict
+        :param return_ref: Also return the final reference trace(s),
+            defaults to False
+        :type return_ref: bool, optional
+        :return: The velocity change (and the reference trace(s))
+        :rtype: DV | Tuple[DV, np.ndarray]
+        """
         # Retain a copy of the stats
         stats_copy = deepcopy(cb.stats)
-        if self.options['dv']['tw_len'] is None:
+        coarse_steps = self.options['dv'].get('coarse_steps')
+        threads = int(self.options['dv'].get('threads', 1))
+        if tw_len is None:
             trim0 = cb.stats.start_lag
             trim1 = cb.stats.end_lag
             cbt = cb
         else:
-            trim0 = -(
-                tw_start+self.options['dv']['tw_len'])
-            trim1 = (
-                tw_start+self.options['dv']['tw_len'])
+            trim0 = -(tw_start+tw_len)
+            trim1 = (tw_start+tw_len)
             cbt = cb.copy().trim(trim0, trim1)
 
         if cbt.data.shape[1] <= 20:
@@ -278,23 +686,24 @@ class Monitor(object):
         tw = [np.arange(
             tw_start*cbt.stats['sampling_rate'],
             trim1*cbt.stats['sampling_rate'], 1)]
-        # 2023/09/29
-        # sim_mat is not required in this operation
-        dv = cbt.stretch(
-            ref_trc=tr, return_sim_mat=False,
-            stretch_steps=self.options['dv']['stretch_steps'],
-            stretch_range=self.options['dv']['stretch_range'],
-            tw=tw, sides=self.options['dv']['sides'],
-            ref_tr_trim=(trim0, trim1), ref_tr_stats=stats_copy,
-            processing=self.options['dv'])
-        ccb = cb.correct_stretch(dv)
-
         # extract the final reference trace (mean excluding very different
         # traces)
         if ref_trcs is None:
+            # 2023/09/29
+            # sim_mat is not required in this operation
+            dv = cbt.stretch(
+                ref_trc=tr, return_sim_mat=False,
+                stretch_steps=self.options['dv']['stretch_steps'],
+                stretch_range=self.options['dv']['stretch_range'],
+                tw=tw, sides=self.options['dv']['sides'],
+                ref_tr_trim=(trim0, trim1), ref_tr_stats=stats_copy,
+                processing=processing,
+                search=self.options['dv'].get('stretch_search', 'grid'),
+                coarse_steps=coarse_steps, threads=threads)
+            # correct_stretch works in-place and cb (or cbt) is still needed
+            ccb = cb.copy().correct_stretch(dv, threads=threads)
             tr = ccb.extract_multi_trace(**self.options['dv']['dt_ref'])
-
-        ccb.trim(trim0, trim1)
+            del ccb
 
         # obtain an improved time shift measurement
         dv = cbt.stretch(
@@ -303,24 +712,12 @@ class Monitor(object):
             stretch_range=self.options['dv']['stretch_range'],
             tw=tw, sides=self.options['dv']['sides'],
             ref_tr_trim=(trim0, trim1), ref_tr_stats=stats_copy,
-            processing=self.options['dv'])
-
-        # Postprocessing on the dv object
-        if 'postprocessing' in self.options['dv']:
-            for func in self.options['dv']['postprocessing']:
-                f = dv.__getattribute__(func['function'])
-                dv = f(**func['args'])
-
-        outf = os.path.join(
-            self.outdir, f'DV-{network}.{station}.{location}.{channel}')
-        dv.save(outf)
-        if self.options['dv']['plot_vel_change']:
-            fname = f'{network}_{station}_{location}_{channel}'
-            savedir = os.path.join(
-                self.options['proj_dir'], self.options['fig_subdir'])
-            dv.plot(
-                save_dir=savedir, figure_file_name=fname,
-                normalize_simmat=True, sim_mat_Clim=[-1, 1])
+            processing=processing,
+            search=self.options['dv'].get('stretch_search', 'grid'),
+            coarse_steps=coarse_steps, threads=threads)
+        if return_ref:
+            return dv, tr
+        return dv
 
     def compute_velocity_change_bulk(self):
         """
@@ -331,17 +728,20 @@ class Monitor(object):
         This function will just call
         :meth:`~seismic.monitor.monitor.Monitor.compute_velocity_change`
         several times.
+
+        If ``skip_unchanged`` is set to True in the dv options, a digest of
+        the dv options, the size and modification time of the correlation
+        file (and its segments), and the SeisMIC version is saved for each
+        channel combination that was processed successfully. Channel
+        combinations with an unchanged digest whose outputs still exist are
+        skipped. Changing ``plot_vel_change`` does not change the digest,
+        but missing figures are recomputed.
+        Interrupted or failed combinations are computed on the next call.
         """
         tag = 'subdivision'
         # get number of available channel combis
         if self.rank == 0:
-            plist = []
-            for f, n, s in zip(self.infiles, self.netlist, self.statlist):
-                locs = os.path.basename(f).split('.')[2]
-                with CorrelationDataBase(f, mode='r') as cdb:
-                    ch = cdb.get_available_channels(
-                        tag, n, s, locs)
-                    plist.extend([f, n, s, locs, c] for c in ch)
+            plist = self._find_channel_combinations(tag)
         else:
             plist = None
         plist = self.comm.bcast(plist, root=0)
@@ -350,9 +750,23 @@ class Monitor(object):
         ind = pmap == self.rank
         ind = np.arange(len(plist), dtype=int)[ind]
 
+        skip_unchanged = self.options['dv'].get('skip_unchanged', False)
+        opt = {
+            k: v for k, v in self.options['dv'].items() if k not in [
+                'plot_vel_change', 'stretch_cache_mb', 'skip_unchanged',
+                'memmap_dir', 'threads']}
+
         # Assign a task to each rank
         for ii in tqdm(ind):
             corr_file, net, stat, loc, cha = plist[ii]
+            if skip_unchanged:
+                cachef = self._cache_file('dv', f'{net}.{stat}.{loc}.{cha}')
+                digest = build_digest(opt, tag, input_stamp(corr_file))
+                if self._is_up_to_date(
+                        cachef, digest, self._dv_outputs(net, stat, loc, cha)):
+                    self.logger.info(
+                        f'Skipping {net}.{stat}.{loc}.{cha}, unchanged.')
+                    continue
             try:
                 self.compute_velocity_change(
                     corr_file, tag, net, stat, loc, cha)
@@ -363,6 +777,11 @@ class Monitor(object):
                 )
             except Exception as e:
                 self.logger.exception(f'{e} for file {corr_file}.')
+            else:
+                if skip_unchanged:
+                    self._write_cache(
+                        cachef, digest,
+                        self._dv_outputs(net, stat, loc, cha))
 
     def compute_components_average(self, method: str = 'AutoComponents'):
         """
@@ -381,103 +800,89 @@ class Monitor(object):
             Defaults to 'AutoComponents'
         :type method: str, optional
         :raises ValueError: For Unknown combination methods.
+
+        .. note::
+
+            The DVs in each dv folder (one per frequency band and lapse time
+            window) are grouped by their file names and the groups are
+            distributed over all MPI ranks. Each average is saved in the
+            folder of its inputs. The names, sizes and modification times
+            of the input files are recorded in the build cache of the
+            project. Groups whose inputs did not change and whose average
+            still exists are skipped. Averages of groups that are left with
+            a single component are removed. The similarity matrices are
+            averaged in chunks of time (see
+            :func:`~seismic.monitor.monitor.average_components_chunked`).
         """
         av_methods = (
             'autocomponents', 'crosscomponents', 'stationwide',
             'crossstations', 'betweenstations', 'betweencomponents')
         if method.lower() not in av_methods:
             raise ValueError('Averaging method not in %s.' % str(av_methods))
-        infiles = glob(os.path.join(self.outdir, '*.npz'))
         if method.lower() == 'autocomponents':
             ch = 'av-auto'
         elif method.lower() in ('betweencomponents', 'crosscomponents'):
             ch = 'av-xc'
         else:
             ch = 'av'
-        while len(infiles):
-            # Find files belonging to same station
-            pat = '.'.join(infiles[0].split('.')[:-2]) + '*'
-            filtfil = fnmatch.filter(infiles, pat)
-            fffil = []  # Second filter
-            for f in filtfil:
-                if ch in f.split('.'):
-                    # Is already computed for this station
-                    # So let's remove all of them from the initial list
-                    for ff in filtfil:
-                        try:
-                            infiles.remove(ff)
-                        except ValueError:
-                            # Has already been removed by one of the other
-                            # check
-                            pass
-                    filtfil.clear()
-                    fffil.clear()
-                    self.logger.debug('Skipping already averaged dv...%s' % f)
-                    break
-                elif 'av' in f:
-                    # computed by another averaging method
-                    infiles.remove(f)
-                    continue
-                components = f.split('.')[-2].split('-')
-                locations = f.split('.')[-3].split('-')
-                stations = f.split('.')[-4].split('-')
-                if method.lower() == 'autocomponents':
-                    # Remove those from combined channels
-                    if any(
-                            components[0] != components[1],
-                            locations[0] != locations[1],
-                            stations[0] != stations[1]):
-                        infiles.remove(f)
-                        continue
-                elif method.lower() in (
-                        'betweencomponents', 'crosscomponents'):
-                    # Remove those from equal channels
-                    components = f.split('.')[-2].split('-')
-                    if components[0] == components[1] \
-                            or stations[0] != stations[1]:
-                        infiles.remove(f)
-                        continue
-                elif method.lower() == 'stationwide':
-                    if stations[0] != stations[1]:
-                        infiles.remove(f)
-                        continue
-                elif method.lower() in ('betweenstations', 'crossstations'):
-                    if stations[0] == stations[1]:
-                        infiles.remove(f)
-                        continue
-                fffil.append(f)
-            dvs = []
-            for f in fffil:
-                try:
-                    dvs.append(read_dv(f))
-                except Exception:
-                    self.logger.exception(
-                        'An unexpected error has ocurred '
-                        + 'while reading file %s.' % f)
-                # Remove so they are not processed again
-                infiles.remove(f)
-            if not len(dvs):
-                continue
-            elif len(dvs) == 1:
+        if self.rank == 0:
+            bands, windows = self._bands_and_windows()
+            multi = len(bands) > 1 or len(windows) > 1
+            plist = []
+            for fmin, fmax in bands:
+                for tw_start, tw_len in windows:
+                    outdir = self._dv_outdir(
+                        fmin, fmax, tw_start, tw_len, multi)
+                    groups = group_dv_files(
+                        glob(os.path.join(outdir, '*.npz')), method)
+                    plist.extend(
+                        (os.path.join(outdir, 'DV-%s.%s.%s.npz' % (
+                            net, stat, ch)), files)
+                        for (net, stat, _), files in sorted(groups.items()))
+        else:
+            plist = None
+        plist = self.comm.bcast(plist, root=0)
+        pmap = np.arange(len(plist))*self.psize/len(plist)
+        pmap = pmap.astype(np.int32)
+        ind = np.arange(len(plist), dtype=int)[pmap == self.rank]
+
+        for ii in ind:
+            outf, files = plist[ii]
+            cachef = self._cache_file('av', os.path.splitext(
+                os.path.relpath(outf, self.outdir))[0])
+            if len(files) == 1:
                 self.logger.warn(
-                    'Only component %s found for station %s.%s... Skipping.'
-                    % (dvs[0].stats.channel, dvs[0].stats.network,
-                        dvs[0].stats.station))
+                    'Only one component found for %s... Skipping.' % files[0])
+                if os.path.isfile(outf):
+                    # Average of components that do not exist anymore
+                    self.logger.warn('Removing outdated average %s.' % outf)
+                    os.remove(outf)
+                continue
+            digest = build_digest(method, [input_stamp(f) for f in files])
+            if self._is_up_to_date(cachef, digest, [outf]):
+                self.logger.debug('Skipping already averaged dv...%s' % outf)
+                continue
+            try:
+                dv_av = average_components_chunked(files)
+            except Exception:
+                self.logger.exception(
+                    'An unexpected error has ocurred '
+                    + 'while averaging files %s.' % files)
                 continue
-            dv_av = average_components(dvs)
-            outf = os.path.join(
-                self.outdir, 'DV-%s.%s.%s' % (
-                    dv_av.stats.network, dv_av.stats.station, ch))
             dv_av.save(outf)
             if self.options['dv']['plot_vel_change']:
                 # plot if desired
                 fname = '%s_%s_%s' % (
                     dv_av.stats.network, dv_av.stats.station, ch)
+                outdir = os.path.dirname(outf)
+                if outdir != self.outdir:
+                    fname += '_' + os.path.basename(outdir)
                 savedir = os.path.join(
                     self.options['proj_dir'], self.options['fig_subdir'])
                 dv_av.plot(
                     save_dir=savedir, figure_file_name=fname,
                     normalize_simmat=True, sim_mat_Clim=[-1, 1])
+            self._write_cache(cachef, digest, [outf])
 
     def compute_waveform_coherence_bulk(self):
         """
@@ -489,69 +894,68 @@ class Monitor(object):
         :meth:`~seismic.monitor.monitor.Monitor.compute_waveform_coherence`
         several times.
         Subsequently, the average of the different component combinations will
-        be computed.
+        be computed. Each rank only keeps the sums of its WFCs for each
+        averaging group. These are reduced on rank 0, which writes the
+        averages.
+
+        If ``skip_unchanged`` is set to True in the wfc options, the
+        computation is skipped if neither the wfc options, the correlation
+        files, nor the SeisMIC version changed since the last successful
+        call and all averages still exist.
         """
         tag = 'subdivision'
         # get number of available channel combis
         if self.rank == 0:
-            plist = []
-            for f, n, s in zip(self.infiles, self.netlist, self.statlist):
-                locs = os.path.basename(f).split('.')[2]
-                with CorrelationDataBase(f, mode='r') as cdb:
-                    ch = cdb.get_available_channels(
-                        tag, n, s, locs)
-                    plist.extend([f, n, s, locs, c] for c in ch)
+            plist = self._find_channel_combinations(tag)
         else:
             plist = None
         plist = self.comm.bcast(plist, root=0)
+        skip_unchanged = self.options['wfc'].get('skip_unchanged', False)
+        if skip_unchanged:
+            # The averages depend on all correlations, so the whole
+            # computation is either skipped or repeated
+            cachef = self._cache_file('wfc', 'wfc')
+            digest = None
+            skip = False
+            if self.rank == 0:
+                digest = build_digest(
+                    {k: v for k, v in self.options['wfc'].items()
+                     if k != 'skip_unchanged'}, plist,
+                    [input_stamp(f) for f in sorted(set(
+                        p[0] for p in plist))])
+                skip = self._is_up_to_date(cachef, digest)
+            if self.comm.bcast(skip, root=0):
+                self.logger.info('Skipping waveform coherence, unchanged.')
+                return
         pmap = np.arange(len(plist))*self.psize/len(plist)
         pmap = pmap.astype(np.int32)
         ind = pmap == self.rank
         ind = np.arange(len(plist), dtype=int)[ind]
 
         # Assign a task to each rank
-        wfcl = []
+        wfc_sums = {}
+        n_failed = 0
         for ii in tqdm(ind):
             corr_file, net, stat, loc, cha = plist[ii]
             for wfc in self.compute_waveform_coherence(
                     corr_file, tag, net, stat, loc, cha):
                 try:
-                    wfcl.append(wfc)
+                    _add_wfc_to_sums(wfc_sums, wfc)
                 except Exception as e:
+                    n_failed += 1
                     self.logger.exception(e)
 
         outdir = os.path.join(
             self.options['proj_dir'], self.options['wfc']['subdir'])
-        # Compute averages and everything
-        wfclu = self.comm.allgather(wfcl)
-        # concatenate
-        wfcl = [j for i in wfclu for j in i]
-        del wfclu
-
-        # Find unique averaging groups
-        wfc_avl = []
-        for wfc in wfcl:
-            wfc_avl.append(
-                (wfc.stats.network, wfc.stats.station,
-                    wfc.wfc_processing['freq_min'],
-                    wfc.wfc_processing['freq_max'],
-                    wfc.wfc_processing['tw_start'],
-                    wfc.wfc_processing['tw_len']))
-        wfc_avl = list(set(wfc_avl))
-        wfcl_sub = []
-        for avl in wfc_avl:
-            net, stat, fmin, fmax, tw_start, tw_len = avl
-            wfcl_sub.append(
-                [wfc for wfc in wfcl if all(
-                    [
-                        wfc.stats.network == net, wfc.stats.station == stat,
-                        wfc.wfc_processing['freq_min'] == fmin,
-                        wfc.wfc_processing['freq_max'] == fmax,
-                        wfc.wfc_processing['tw_start'] == tw_start,
-                        wfc.wfc_processing['tw_len'] == tw_len
-                    ])])
-        for wfc_avl in wfcl_sub:
-            wfc = average_components_wfc(wfc_avl)
+        # Only the sums of each averaging group are sent to rank 0
+        wfc_sums = self.comm.reduce(wfc_sums, op=_merge_wfc_sums, root=0)
+        n_failed = self.comm.reduce(n_failed, op=MPI.SUM, root=0)
+        if self.rank != 0:
+            return
+        os.makedirs(outdir, exist_ok=True)
+        outputs = []
+        for key in wfc_sums:
+            wfc = _average_wfc_sums(*wfc_sums[key])
             # Write files
             outf = os.path.join(outdir, 'WFC-%s.%s.%s.%s.f%a-%a.tw%a-%a' % (
                 wfc.stats.network, wfc.stats.station, wfc.stats.location,
@@ -561,6 +965,9 @@ class Monitor(object):
                 wfc.wfc_processing['tw_start'],
                 wfc.wfc_processing['tw_len']))
             wfc.save(outf)
+            outputs.append(outf + '.npz')
+        if skip_unchanged and not n_failed:
+            self._write_cache(cachef, digest, outputs)
 
     def compute_waveform_coherence(
         self, corr_file: str, tag: str, network: str, station: str, location,
@@ -572,6 +979,12 @@ class Monitor(object):
         The waveform coherence can be used as a measure of stability of
         a certain correlation. See Steinmann, et. al. (2021) for details.
 
+        The correlations are filtered once per frequency band and the
+        coherence of all lapse time windows is computed in one call of
+        :func:`~seismic.monitor.stretch_mod.compute_wfc`. If the reference
+        traces are computed with the ``mean`` or ``median`` method, they are
+        only extracted once per frequency band.
+
         :param corr_file: File to compute the wfc from
         :type corr_file: str
         :param tag: Tag inside of hdf5 file to retrieve corrs from.
@@ -626,95 +1039,135 @@ class Monitor(object):
         cb.resample(starttimes, endtimes)
 
         # Allow lists so the computation does not have to be started x times
-        if not isinstance(self.options['wfc']['freq_min'], list):
-            self.options['wfc']['freq_min'] = [
-                self.options['wfc']['freq_min']]
-        if not isinstance(self.options['wfc']['freq_max'], list):
-            self.options['wfc']['freq_max'] = [
-                self.options['wfc']['freq_max']]
-        if len(self.options['wfc']['freq_min']) != len(
-                self.options['wfc']['freq_max']):
-            raise ValueError(
-                'freq_min and freq_max must be of same length.')
-
-        if not isinstance(self.options['wfc']['tw_start'], list):
-            self.options['wfc']['tw_start'] = [
-                self.options['wfc']['tw_start']]
-        if isinstance(self.options['wfc']['tw_len'], list) and len(
-                self.options['wfc']['tw_len']) != len(
-                self.options['wfc']['tw_start']):
-            raise ValueError(
-                'tw_start and tw_len must be of same length or tw_len must be'
-                ' a single value.')
-        elif not isinstance(self.options['wfc']['tw_len'], list):
-            self.options['wfc']['tw_len'] = [
-                self.options['wfc']['tw_len']] * len(
-                self.options['wfc']['tw_start'])
-
-        cb_bac = cb.copy()
-
-        for fmin, fmax in zip(
-                self.options['wfc']['freq_min'],
-                self.options['wfc']['freq_max']):
-            if fmin >= fmax:
-                raise ValueError('freq_min must be smaller than freq_max.')
-            cb.filter((fmin, fmax))
+        bands, windows = self._bands_and_windows('wfc')
+        dt_ref = self.options['wfc']['dt_ref']
+        # mean and median are computed column by column, so one reference
+        # serves all time windows
+        shared_ref = dt_ref.get('method', 'mean') in ['mean', 'median']
+        tw_max = max(tw_start + tw_len for tw_start, tw_len in windows)
+        threads = int(self.options['dv'].get('threads', 1))
+
+        for fmin, fmax in bands:
+            cb_f = cb.copy() if len(bands) > 1 else cb
+            cb_f.filter((fmin, fmax), threads=threads)
 
             # Preprocessing on the correlation bulk
             if 'preprocessing' in self.options['wfc']:
                 for func in self.options['wfc']['preprocessing']:
                     if func['function'] in ['pop_at_utcs', 'select_time']:
                         continue
-                    f = cb.__getattribute__(func['function'])
-                    cb = f(**func['args'])
+                    f = cb_f.__getattribute__(func['function'])
+                    cb_f = f(**func['args'])
 
             self.logger.debug(
                 f'Preprocessing finished. Computing wfc for fmin: {fmin} '
-                f'and fmax: {fmax} {len(self.options["wfc"]["tw_start"])}'
-                f'time windows.')
+                f'and fmax: {fmax} {len(windows)} time windows.')
 
-            # Now, we loop over the time windows
-            for tw_start, tw_len in zip(
-                self.options['wfc']['tw_start'],
-                    self.options['wfc']['tw_len']):
+            # All windows are computed on the lag times that the longest
+            # window requires
+            cbb, _ = _lag_view(cb_f, tw_max)
+            refs = []
+            if shared_ref:
                 try:
-                    # Now, we make a copy of the cm to be trimmed
-                    cbt = cb.copy().trim(
-                        -(tw_start + tw_len), tw_start + tw_len)
-
+                    refs = np.atleast_2d(cbb.extract_multi_trace(**dt_ref))
+                except Exception as e:
+                    self.logger.error(
+                        'Error extracting the reference for fmin: '
+                        f'{fmin} and fmax: {fmax}. Error: {e}')
+                    continue
+            done = []
+            for tw_start, tw_len in windows:
+                try:
+                    cbt, start = _lag_view(cbb, tw_start + tw_len)
                     if cbt.data.shape[1] <= 20:
                         raise ValueError('CorrBulk extremely short.')
-
-                    tr = cbt.extract_multi_trace(
-                        **self.options['wfc']['dt_ref'])
-                    self.logger.debug(
-                        'Reference trace created.\nComputing WFC...')
-
-                    # Compute time window
-                    tw = [np.arange(
-                        tw_start*cbt.stats['sampling_rate'],
-                        (tw_start+tw_len)*cbt.stats['sampling_rate'], 1)]
-                    wfc = cbt.wfc(
-                        tr, tw, 'both', tw_start, tw_len, fmin, fmax)
-                    self.logger.debug(
-                        'WFC computed.\nAveraging over time axis...')
-                    # Compute the average over the whole time window
-                    wfc.compute_average()
-                    if self.options['wfc']['save_comps']:
-                        outf = os.path.join(
-                            outdir, 'WFC-%s.%s.%s.f%a-%a.tw%a-%a' % (
-                                network, station, channel,
-                                fmin, fmax, tw_start, tw_len))
-                        self.logger.info(f'Writing WFC to {outf}')
-                        wfc.save(outf)
-                    yield wfc
+                    if not shared_ref:
+                        tr = np.atleast_2d(cbt.extract_multi_trace(**dt_ref))
+                        # Place the reference at the same lag times
+                        ref = np.zeros((tr.shape[0], cbb.data.shape[1]))
+                        ref[:, start:start + tr.shape[1]] = tr
+                        refs.append(ref)
+                    done.append((tw_start, tw_len, cbt.stats))
                 except Exception as e:
                     self.logger.error(
                         'Error computing WFC for fmin: '
                         f'{fmin} and fmax: {fmax}'
                         f' and tw_start: {tw_start} and tw_len: {tw_len}. '
                         f'Error: {e}')
-            cb = cb_bac.copy()
+            if not done:
+                continue
+            if not shared_ref:
+                # one reference per time window for each reference trace
+                refs = np.stack(refs, axis=1)
+            self.logger.debug('Reference traces created.\nComputing WFC...')
+            fs = cbb.stats['sampling_rate']
+            tw = [np.arange(
+                tw_start*fs, (tw_start+tw_len)*fs, 1)
+                for tw_start, tw_len, _ in done]
+            try:
+                corr = [
+                    sm.compute_wfc(
+                        cbb.data, tw, np.nan_to_num(ref), 'both',
+                        threads=threads)
+                    for ref in refs]
+            except Exception as e:
+                self.logger.error(
+                    'Error computing WFC for fmin: '
+                    f'{fmin} and fmax: {fmax}. Error: {e}')
+                continue
+            self.logger.debug('WFC computed.\nAveraging over time axis...')
+            for ii, (tw_start, tw_len, stats) in enumerate(done):
+                wfc = WFC(
+                    {'reftr_%d' % jj: c[ii:ii+1] for jj, c in enumerate(
+                        corr)}, stats,
+                    {
+                        'tw_start': tw_start,
+                        'tw_len': tw_len,
+                        'freq_min': fmin,
+                        'freq_max': fmax
+                    })
+                # Compute the average over the whole time window
+                wfc.compute_average()
+                if self.options['wfc']['save_comps']:
+                    outf = os.path.join(
+                        outdir, 'WFC-%s.%s.%s.f%a-%a.tw%a-%a' % (
+                            network, station, channel,
+                            fmin, fmax, tw_start, tw_len))
+                    self.logger.info(f'Writing WFC to {outf}')
+                    wfc.save(outf)
+                yield wfc
+
+
+def input_stamp(path: str) -> List[tuple]:
+    """
+    Name, size, and modification time of a correlation file and its
+    segments. Files that do not exist have a size and modification time of
+    None.
+
+    :param path: Path to the correlation file
+    :type path: str
+    :return: One tuple per file
+    :rtype: List[tuple]
+    """
+    stamp = []
+    for f in [path] + list_segments(path):
+        try:
+            st = os.stat(f)
+            stamp.append((os.path.basename(f), st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            stamp.append((os.path.basename(f), None, None))
+    return stamp
+
+
+def build_digest(*parts) -> str:
+    """
+    Hash of the inputs of a task and the SeisMIC version.
+
+    :return: The hexadecimal SHA-256 digest
+    :rtype: str
+    """
+    parts = json.dumps([code_version, parts], sort_keys=True, default=str)
+    return hashlib.sha256(parts.encode()).hexdigest()
 
 
 def make_time_list(
@@ -820,6 +1273,127 @@ def corr_find_filter(
     return netlist, statlist, infiles
 
 
+def corr_data_since(
+    cdb: CorrelationDataBase, network: str, station: str, location: str,
+        channel: str, tag: str, starttime: UTCDateTime) -> CorrStream:
+    """
+    Reads the correlations of one channel combination that start at or after
+    ``starttime`` from a correlation database.
+
+    :param cdb: The opened database
+    :type cdb: CorrelationDataBase
+    :param network: Network combination code
+    :type network: str
+    :param station: Station combination code
+    :type station: str
+    :param location: Location combination code
+    :type location: str
+    :param channel: Channel combination code
+    :type channel: str
+    :param tag: Tag of the data
+    :type tag: str
+    :param starttime: Earliest start of the correlations
+    :type starttime: UTCDateTime
+    :return: The correlations
+    :rtype: CorrStream
+    """
+    starttime = UTCDateTime(starttime)
+    avail = cdb.get_available_starttimes(
+        network, station, tag, location, channel).get(channel, [])
+    cst = CorrStream()
+    for t in sorted(UTCDateTime(t) for t in avail):
+        if t >= starttime:
+            cst.extend(cdb.get_data(
+                network, station, location, channel, tag, corr_start=t))
+    return cst
+
+
+def latest_corr_start(
+    cdb: CorrelationDataBase, network: str, station: str, location: str,
+        channel: str, tag: str) -> float | None:
+    """
+    Start of the latest correlation of one channel combination in a
+    correlation database.
+
+    :param cdb: The opened database
+    :type cdb: CorrelationDataBase
+    :param network: Network combination code
+    :type network: str
+    :param station: Station combination code
+    :type station: str
+    :param location: Location combination code
+    :type location: str
+    :param channel: Channel combination code
+    :type channel: str
+    :param tag: Tag of the data
+    :type tag: str
+    :return: The start as timestamp, None if there are no correlations
+    :rtype: float | None
+    """
+    avail = cdb.get_available_starttimes(
+        network, station, tag, location, channel).get(channel, [])
+    if not len(avail):
+        return None
+    return max(UTCDateTime(t).timestamp for t in avail)
+
+
+def append_dv(dv: DV, new: DV, starttime: UTCDateTime = None) -> DV:
+    """
+    Appends a velocity change computed for later time windows to an existing
+    one. Time windows of ``dv`` that start at or after ``starttime`` are
+    replaced by the ones of ``new``, earlier time windows of ``new`` are
+    discarded.
+
+    :param dv: The existing velocity change
+    :type dv: DV
+    :param new: Velocity change for the new time windows
+    :type new: DV
+    :param starttime: Start of the first time window to take from ``new``.
+        Defaults to None (i.e., the first time window of ``new``).
+    :type starttime: UTCDateTime, optional
+    :raises ValueError: If the velocity changes have different types or
+        second axes.
+    :return: The combined velocity change
+    :rtype: DV
+    """
+    if dv.value_type != new.value_type or dv.method != new.method \
+            or not np.allclose(dv.second_axis, new.second_axis):
+        raise ValueError(
+            'Velocity changes must be of the same type and have the same '
+            'second axis to be appended.')
+    t_old = TimeArray(dv.stats.corr_start).timestamps
+    t_new = TimeArray(new.stats.corr_start).timestamps
+    t0 = t_new[0] if starttime is None else UTCDateTime(starttime).timestamp
+    i_old = t_old < t0
+    i_new = t_new >= t0
+
+    def _concat(a, b, axis=0):
+        if a is None or b is None:
+            return None
+        a, b = np.asarray(a), np.asarray(b)
+        if not a.ndim or not b.ndim:
+            return None
+        return np.concatenate((
+            np.compress(i_old, a, axis=axis),
+            np.compress(i_new, b, axis=axis)), axis=axis)
+
+    stats = deepcopy(new.stats)
+    stats['corr_start'] = [
+        t for t, i in zip(dv.stats.corr_start, i_old) if i] + [
+        t for t, i in zip(new.stats.corr_start, i_new) if i]
+    stats['corr_end'] = [
+        t for t, i in zip(dv.stats.corr_end, i_old) if i] + [
+        t for t, i in zip(new.stats.corr_end, i_new) if i]
+    return DV(
+        _concat(dv.corr, new.corr), _concat(dv.value, new.value),
+        new.value_type, _concat(dv.sim_mat, new.sim_mat), new.second_axis,
+        new.method, stats, stretches=_concat(
+            dv.stretches, new.stretches, -1),
+        corrs=_concat(dv.corrs, new.corrs, -1),
+        n_stat=_concat(dv.n_stat, new.n_stat),
+        dv_processing=new.dv_processing)
+
+
 def correct_dv_shift(
     dv0: DV, dv1: DV, method: str = 'mean',
         n_overlap: int = 0) -> Tuple[DV, DV]:
@@ -928,9 +1502,8 @@ def correct_time_shift_several(dvs: List[DV], method: str, n_overlap: int):
     # If three different time-series are provided, find the one that
     # spans the middle time
     avl = np.array([
-        np.mean(np.array([
-            t.timestamp for t in dv.stats.corr_start])[
-                dv.avail]) for dv in dvs])
+        np.mean(TimeArray(dv.stats.corr_start).timestamps[dv.avail])
+        for dv in dvs])
     avl_u = np.sort(np.unique(avl))
     # Loop over each unique start and shift and correct them iteratively
     for k, avstart in enumerate(avl_u):
@@ -1034,6 +1607,151 @@ def average_components_mem_save(
     return dvout
 
 
+def group_dv_files(infiles: List[str], method: str) -> Dict[
+        Tuple[str, str, str], List[str]]:
+    """
+    Groups the files of DVs (as saved by
+    :meth:`~seismic.monitor.monitor.Monitor.compute_velocity_change`) for
+    :meth:`~seismic.monitor.monitor.Monitor.compute_components_average`.
+    The network, station, location, and channel codes are parsed from the
+    file names, which have to follow the pattern
+    ``DV-{network}.{station}.{location}.{channel}.npz``. Other files (e.g.,
+    averaged DVs) are ignored.
+
+    :param infiles: The files
+    :type infiles: List[str]
+    :param method: Averaging method, see
+        :meth:`~seismic.monitor.monitor.Monitor.compute_components_average`
+    :type method: str
+    :return: Dictionary with the tuple (network, station, location) as key
+        and the sorted list of files that should be averaged as value.
+    :rtype: Dict[Tuple[str, str, str], List[str]]
+    """
+    method = method.lower()
+    groups = {}
+    for f in infiles:
+        name = os.path.basename(f)
+        if not name.startswith('DV-') or not name.endswith('.npz'):
+            continue
+        codes = name[3:-4].split('.')
+        if len(codes) != 4 or 'av' in codes[3]:
+            continue
+        net, stat, loc, cha = codes
+        stations = stat.split('-')
+        locations = loc.split('-')
+        components = cha.split('-')
+        if method == 'autocomponents':
+            # Remove those from combined channels
+            if any((
+                    components[0] != components[-1],
+                    locations[0] != locations[-1],
+                    stations[0] != stations[-1])):
+                continue
+        elif method in ('betweencomponents', 'crosscomponents'):
+            # Remove those from equal channels
+            if components[0] == components[-1] \
+                    or stations[0] != stations[-1]:
+                continue
+        elif method == 'stationwide':
+            if stations[0] != stations[-1]:
+                continue
+        elif method in ('betweenstations', 'crossstations'):
+            if stations[0] == stations[-1]:
+                continue
+        groups.setdefault((net, stat, loc), []).append(f)
+    return {k: sorted(v) for k, v in groups.items()}
+
+
+def average_components_chunked(
+    files: List[str], save_scatter: bool = True,
+        chunk_len: int = 1024) -> DV:
+    """
+    Averages the similarity matrices of DVs saved in **.npz** files. The
+    result is the same as of :func:`average_components`, but the
+    similarity matrices are decompressed and averaged in chunks of
+    ``chunk_len`` times. Hence, only one chunk of each input is held in
+    memory at the same time.
+
+    :param files: Files of the DVs to compute an average from
+    :type files: List[str]
+    :param save_scatter: Saves the scattering of old values and correlation
+        coefficients to later provide a statistical measure. Defaults to True.
+    :type save_scatter: bool, optional
+    :param chunk_len: Number of times to average at once, defaults to 1024
+    :type chunk_len: int, optional
+    :raises TypeError: for DVs that were computed with different methods
+    :raises ValueError: if none of the DVs can be averaged
+    :return: A single dv with an averaged similarity matrix.
+    :rtype: DV
+    """
+    dvs = [read_dv(f, load_sim_mat=False) for f in files]
+    dv_use = []
+    f_use = []
+    for f, dv in zip(files, dvs):
+        if dv.method != dvs[0].method:
+            raise TypeError('DV has to be computed with the same method.')
+        if 'av' in dv.stats.channel+dv.stats.network+dv.stats.station:
+            warnings.warn('Averaging of averaged dvs not allowed. Skipping dv')
+            continue
+        if len(dv.corr) != len(dvs[0].corr) or len(
+                dv.second_axis) != len(dvs[0].second_axis) or any(
+                dv.second_axis != dvs[0].second_axis):
+            warnings.warn(
+                'The shapes of the similarity matrices of the input DVs '
+                + 'vary. Make sure to compute the dvs with the same parameters'
+                + ' (i.e., start & end dates, date-inc, stretch increment, '
+                + 'and stretch steps.\n\nThis dv will be skipped'
+            )
+            continue
+        dv_use.append(dv)
+        f_use.append(f)
+    if not len(dv_use):
+        raise ValueError('None of the DVs can be averaged.')
+    strvec = dv_use[0].second_axis
+    av_sim_mat = np.empty((len(dv_use[0].corr), len(strvec)))
+    blocks = [iter_npz_rows(f, 'sim_mat', chunk_len) for f in f_use]
+    try:
+        for start in range(0, av_sim_mat.shape[0], chunk_len):
+            total = np.zeros_like(av_sim_mat[start:start + chunk_len])
+            count = np.zeros(total.shape, dtype=np.int32)
+            for it in blocks:
+                block = next(it)
+                finite = ~np.isnan(block)
+                total += np.where(finite, block, 0)
+                count += finite
+            # nan where no DV holds data like np.nanmean
+            with np.errstate(invalid='ignore', divide='ignore'):
+                av_sim_mat[start:start + chunk_len] = total/count
+    finally:
+        for it in blocks:
+            it.close()
+    iimax = np.nanargmax(np.nan_to_num(av_sim_mat), axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        corr = np.nanmax(av_sim_mat, axis=1)
+    dt = strvec[iimax]
+    dt[np.isnan(corr)] = np.nan
+    if save_scatter:
+        stretches = np.array([dv.value for dv in dv_use])
+        corrs = np.array([dv.corr for dv in dv_use])
+    else:
+        stretches = None
+        corrs = None
+    # Number of stations per corr_start
+    n_stat = np.sum([dv.avail for dv in dv_use], axis=0)
+    stats = deepcopy(dv_use[0].stats)
+    if not all(np.array([dv.stats.channel for dv in dv_use]) == stats.channel):
+        stats['channel'] = 'av'
+    if not all(np.array([dv.stats.station for dv in dv_use]) == stats.station):
+        stats['station'] = 'av'
+    if not all(np.array([dv.stats.network for dv in dv_use]) == stats.network):
+        stats['network'] = 'av'
+    return DV(
+        corr, dt, dv_use[0].value_type, av_sim_mat, strvec,
+        dv_use[0].method, stats, stretches=stretches, corrs=corrs,
+        n_stat=n_stat, dv_processing=dv_use[0].dv_processing)
+
+
 def average_components(
     dvs: List[DV], save_scatter: bool = True, correct_shift: bool = False,
     correct_shift_method: str = 'mean',
@@ -1194,3 +1912,85 @@ def average_components_wfc(wfcs: List[WFC]) -> WFC:
         meandict[k] = np.nanmean([wfc[k] for wfc in wfcs], axis=0)
     wfcout = WFC(meandict, stats, wfcp)
     return wfcout
+
+
+def _add_wfc_to_sums(wfc_sums: dict, wfc: WFC) -> dict:
+    """
+    Adds a WFC to the running sums of its averaging group (i.e., network,
+    station, frequency band, and lapse time window).
+
+    :param wfc_sums: Sums as returned by this function. Will be altered.
+    :type wfc_sums: dict
+    :param wfc: The waveform coherence to add
+    :type wfc: WFC
+    :return: The sums. Each value holds the nan-ignoring sum and the number
+        of summands for each key of the WFC, the stats, and the
+        wfc_processing.
+    :rtype: dict
+    """
+    wfcp = wfc.wfc_processing
+    key = (
+        wfc.stats.network, wfc.stats.station, wfcp['freq_min'],
+        wfcp['freq_max'], wfcp['tw_start'], wfcp['tw_len'])
+    total, count, _, _ = wfc_sums.setdefault(key, ({}, {}, wfc.stats, wfcp))
+    for k, v in wfc.items():
+        total[k] = total.get(k, 0) + np.nan_to_num(v)
+        count[k] = count.get(k, 0) + (~np.isnan(v)).astype(int)
+    return wfc_sums
+
+
+def _merge_wfc_sums(a: dict, b: dict) -> dict:
+    """
+    Merges two sums created by :func:`_add_wfc_to_sums`. Used as operator
+    for the MPI reduction.
+    """
+    for key, (total, count, stats, wfcp) in b.items():
+        if key not in a:
+            a[key] = (total, count, stats, wfcp)
+            continue
+        for k in total:
+            a[key][0][k] = a[key][0].get(k, 0) + total[k]
+            a[key][1][k] = a[key][1].get(k, 0) + count[k]
+    return a
+
+
+def _average_wfc_sums(
+        total: dict, count: dict, stats: CorrStats, wfcp: dict) -> WFC:
+    """
+    Computes the averaged WFC of one averaging group from its sums. The
+    result equals :func:`average_components_wfc` of all WFCs in the group.
+    """
+    stats = deepcopy(stats)
+    stats['channel'] = 'av'
+    meandict = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for k in total:
+            meandict[k] = total[k]/count[k]
+    return WFC(meandict, stats, wfcp)
+
+
+def _lag_view(cb: CorrBulk, lag: float) -> Tuple[CorrBulk, int]:
+    """
+    Trims a CorrBulk to the lag times from ``-lag`` to ``lag`` without
+    copying its data.
+
+    :param cb: The CorrBulk. Will not be altered.
+    :type cb: CorrBulk
+    :param lag: Maximal lag time in s
+    :type lag: float
+    :return: A CorrBulk sharing its data with ``cb`` and the index of its
+        first sample in ``cb``. Like :meth:`CorrBulk.trim`, the data are not
+        trimmed if ``cb`` is too short.
+    :rtype: Tuple[CorrBulk, int]
+    """
+    stats = deepcopy(cb.stats)
+    data, stats = corr_mat_trim(cb.data, stats, -lag, lag)
+    start = 0
+    if data.shape != cb.data.shape:
+        start = int(np.floor(
+            (-lag-cb.stats['start_lag'])*cb.stats['sampling_rate']))
+    processing_bulk = stats['processing_bulk']
+    cbt = CorrBulk(data, stats)
+    cbt.stats['processing_bulk'] = processing_bulk + [
+        'trim: %s, %s' % (str(-lag), str(lag))]
+    return cbt, start
@@ -12,11 +12,14 @@ Created: Monday, 14th June 2021 08:50:57 am
 Last Modified: Wednesday, 4th October 2023 09:29:49 am
 '''
 
-from typing import List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Optional
+import warnings
+
 import numpy as np
 from copy import deepcopy
-from scipy.signal import butter, lfilter, hilbert, resample
-from scipy.interpolate import UnivariateSpline, interp1d
+from scipy.ndimage import convolve1d
+from scipy.signal import butter, hilbert, lfilter, resample, sosfilt
 from obspy.core import UTCDateTime
 
 # Obspy imports
@@ -24,8 +27,9 @@ from obspy.signal.invsim import cosine_taper
 
 from seismic.monitor.stretch_mod import multi_ref_vchange_and_align, \
     time_shift_estimate, compare_with_modified_reference, \
-    create_shifted_ref_mat
-from seismic.correlate.stats import CorrStats
+    create_shifted_ref_mat, _interpolate_rows, _gather_tw_indices, \
+    _shift_similarity, _shift_peak
+from seismic.correlate.stats import CorrStats, TimeArray
 from seismic.monitor.dv import DV
 from seismic.monitor.trim import corr_mat_trim
 
@@ -117,9 +121,34 @@ def _smooth(
     return y[window_len - 1:-window_len + 1]
 
 
+def _row_chunks(
+        nrows: int, rowbytes: int, chunk_bytes: int = 2**22) -> List[slice]:
+    """
+    Splits the rows of a matrix into chunks of about ``chunk_bytes``, so that
+    each chunk fits into the cache.
+    """
+    n = max(1, chunk_bytes // max(rowbytes, 1))
+    return [slice(ii, ii + n) for ii in range(0, nrows, n)]
+
+
+def _map_chunks(func: Callable[[slice], None], chunks: List[slice],
+                threads: int = 1):
+    """
+    Calls ``func`` for each chunk. If ``threads`` > 1, the chunks are
+    processed in a thread pool. ``func`` should release the GIL for
+    this to be faster, as scipy's filters do.
+    """
+    if threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(func, chunks))
+    else:
+        for chunk in chunks:
+            func(chunk)
+
+
 def corr_mat_smooth(
     data: np.ndarray, wsize: int, wtype: str = 'flat',
-        axis: int = 1) -> np.ndarray:
+        axis: int = 1, threads: int = 1) -> np.ndarray:
     """ Smoothing of a correlation matrix.
 
     Smoothes the correlation matrix with a given window function of the given
@@ -129,6 +158,10 @@ def corr_mat_smooth(
     window size) in both ends so that transient parts are minimized in the
     beginning and end part of the resulting array.
 
+    The matrix is processed in chunks of rows/cols that are convolved at
+    once. The result equals the one of :func:`_smooth` applied to each
+    row/col.
+
     :type corr_mat: dictionary of the type correlation matrix
     :param corr_mat: correlation matrix to be smoothed
     :type wsize: int
@@ -140,6 +173,9 @@ def corr_mat_smooth(
     :type axis: int
     :param axis: Axis along with apply the filter. O: smooth along correlation
               lag time axis 1: smooth along time axis
+    :type threads: int
+    :param threads: Number of threads to process the chunks with. Defaults
+        to 1.
 
     :rtype: :class:`~numpy.ndarray`
     :return: **X**: Filtered matrix
@@ -148,25 +184,48 @@ def corr_mat_smooth(
     np.nan_to_num(data, copy=False)
 
     # Degenerated corr_mat: single vector
-    try:
-        row, col = data.shape
-    except ValueError:
+    if data.ndim == 1:
         # Single vector not a matrix
         data = _smooth(data, window_len=wsize, window=wtype)
         return data
+    if axis not in [0, 1]:
+        return data
 
-    # Proper 2d matrix. Smooth on the chosen axis
-    if axis == 0:
-        for i in np.arange(row):
-            csig = data[i]
-            scsig = _smooth(csig, window_len=wsize, window=wtype)
-            data[i] = scsig
-    elif axis == 1:
-        for i in np.arange(col):
-            csig = data[:, i]
-            scsig = _smooth(csig, window_len=wsize, window=wtype)
-            data[:, i] = scsig
-
+    # Proper 2d matrix. Smooth on the chosen axis of the array
+    ax = 1 - axis
+    npts = data.shape[ax]
+    if npts < wsize:
+        raise ValueError("Input vector needs to be bigger than window size.")
+    if wsize < 3:
+        return data
+    if wtype not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+        raise ValueError(
+            "Window is not one of 'flat', 'hanning', 'hamming', "
+            "'bartlett', 'blackman'")
+    if wtype == 'flat':  # moving average
+        w = np.ones(wsize, 'd')
+    else:
+        w = getattr(np, wtype)(wsize)
+    w /= w.sum()
+    # first sample of the result in the convolution of the padded signals
+    start = 2*((wsize - 1)//2)
+
+    def ind(s: slice) -> tuple:
+        # index along the smoothed axis
+        return (slice(None), s) if ax == 1 else (s, slice(None))
+
+    def smooth(chunk: slice):
+        x = data[ind(chunk)[::-1]]
+        s = np.concatenate((
+            2*x[ind(slice(0, 1))] - x[ind(slice(wsize, 1, -1))], x,
+            2*x[ind(slice(-1, None))] - x[ind(slice(-1, -wsize, -1))]),
+            axis=ax)
+        data[ind(chunk)[::-1]] = convolve1d(
+            s, w, axis=ax, mode='constant')[ind(slice(start, start + npts))]
+
+    _map_chunks(
+        smooth, _row_chunks(data.shape[1 - ax], npts*data.itemsize),
+        threads)
     return data
 
 
@@ -187,12 +246,17 @@ def unicode_to_string(input):
 
 def corr_mat_filter(
     data: np.ndarray, stats: CorrStats, freqs: Tuple[float, float],
-        order=3) -> np.ndarray:
+        order=3, threads: int = 1) -> np.ndarray:
     """ Filter a correlation matrix.
 
     Filters the correlation matrix corr_mat in the frequency band specified in
     freqs using a zero phase filter of twice the order given in order.
 
+    The Butterworth filter is applied as second-order sections forwards and
+    backwards without padding. The matrix is filtered in cache-sized chunks
+    of rows and the result is written into ``data`` if it is a writeable
+    float array. float32 data are filtered in single precision.
+
     :type data: np.ndarray
     :param data: correlation matrix
     :type stats: :class:`~seismic.correlate.stats.CorrStats`
@@ -201,6 +265,9 @@ def corr_mat_filter(
     :param freqs: lower and upper limits of the pass band in Hertz
     :type order: int
     :param order: half the order of the Butterworth filter
+    :type threads: int
+    :param threads: Number of threads to filter the chunks with. Defaults
+        to 1.
 
     :rtype: np.ndarray
     :return: filtered correlation matrix
@@ -214,15 +281,34 @@ def corr_mat_filter(
 
     fe = float(stats['sampling_rate']) / 2
 
-    (b, a) = butter(
-        order, np.array(freqs, dtype='float') / fe, btype='band')
+    sos = butter(
+        order, np.array(freqs, dtype='float') / fe, btype='band',
+        output='sos')
 
-    data = lfilter(b, a, data, axis=1)
-    data = lfilter(b, a, data[:, ::-1], axis=1)[:, ::-1]
+    if data.dtype != np.float32:
+        data = np.asarray(data, dtype=np.float64)
+    if not data.flags.writeable:
+        data = data.copy()
+    sos = sos.astype(data.dtype)
+
+    def filt(rows: slice):
+        y = sosfilt(sos, data[rows], axis=1)
+        data[rows] = sosfilt(sos, y[:, ::-1], axis=1)[:, ::-1]
 
+    _map_chunks(
+        filt, _row_chunks(data.shape[0], data.shape[1]*data.itemsize),
+        threads)
     return data
 
 
+def _as_timestamps(times: List[UTCDateTime] | np.ndarray) -> np.ndarray:
+    """
+    Converts a list of :class:`~obspy.UTCDateTime` objects or of POSIX
+    timestamps to a float array of timestamps.
+    """
+    return TimeArray(times).timestamps
+
+
 def corr_mat_resample(
     data: np.ndarray, stats: CorrStats, start_times: List[UTCDateTime],
         end_times=[]) -> Tuple[np.ndarray, CorrStats]:
@@ -238,15 +324,22 @@ def corr_mat_resample(
     and end_times[i]. If end_time is an empty list (default) end_times[i] is
     set to start_times[i] + (start_times[1] - start_times[0])
 
+    The bins may overlap. The average ignores nans. The correlations are
+    assigned to the bins with :func:`numpy.searchsorted` and summed with
+    :func:`numpy.add.reduceat`, so that the computational cost grows
+    linearly with the number of correlations and bins.
+
     :type data: np.ndarray
     :param data: 2D matrix holding the correlation data
     :type Stats: :class:`~obspy.core.Stats`
     :param Stats: The stats object belonging to the
         :class:`~seismic.correlate.stream.CorrBulk` object.
-    :type start_times: list of :class:`~obspy.UTCDateTime` objects
+    :type start_times: list of :class:`~obspy.UTCDateTime` objects or
+        np.ndarray of timestamps
     :param start_times: list of starting times for the bins of the new
         sampling
-    :type end_times: list of :class:`~obspy.UTCDateTime` objects
+    :type end_times: list of :class:`~obspy.UTCDateTime` objects or
+        np.ndarray of timestamps
     :param end_times: list of starting times for the bins of the new sampling
 
     :rtype: tuple
@@ -258,47 +351,53 @@ def corr_mat_resample(
             "end_times should be empty or of the same length as start_times.")
 
     # old sampling times
-    otime = np.array([ii.timestamp for ii in stats['corr_start']])
-    if isinstance(start_times[0], UTCDateTime):
-        start_times = [ii.timestamp for ii in start_times]
+    otime = _as_timestamps(stats['corr_start'])
 
     # new sampling times
-    stime = start_times
+    stime = _as_timestamps(start_times)
     if len(end_times):
-        if isinstance(end_times[0], UTCDateTime):
-            end_times = [ii.timestamp for ii in end_times]
-        etime = end_times
+        etime = _as_timestamps(end_times)
+    elif len(stime) == 1:
+        # there is only one start_time given and no end_time => average all
+        etime = np.array([stats['corr_end'][-1].timestamp])
     else:
-        if len(start_times) == 1:
-            # there is only one start_time given and no end_time => average all
-            etime = np.array([stats['corr_end'][-1].timestamp])
-        else:
-            stime = np.array(stime)  # Cannot be a list for this operation
-            etime = stime + (stime[1] - stime[0])
-
-    # create masked array to avoid nans
-    mm = np.ma.masked_array(data, np.isnan(data))
-
-    # new corr_data matrix
-    nmat = np.empty([len(stime), data.shape[1]])
-    nmat.fill(np.nan)
-
-    for ii in range(len(stime)):
-        # index of measurements between start_time[ii] and end_time[ii]
-        ind = np.nonzero((otime >= stime[ii]) * (otime < etime[ii]))
-        # ind is a list(tuple) for dimensions
-        if len(ind[0]) == 1:
-            # one measurement found
-            nmat[ii, :] = data[ind[0], :]
-        elif len(ind[0]) > 1:
-            # more than one measurement in range
-            nmat[ii, :] = np.mean(mm[ind[0], :], axis=0).filled(np.nan)
-
-    # assign new data
-    data = nmat
+        etime = stime + (stime[1] - stime[0])
+
+    # sort the correlations by their start
+    order = None
+    if np.any(np.diff(otime) < 0):
+        order = np.argsort(otime, kind='stable')
+        otime = otime[order]
+    # bin ii holds the rows i0[ii]:i1[ii]
+    i0 = np.searchsorted(otime, stime, side='left')
+    i1 = np.searchsorted(otime, etime, side='left')
+    i1 = np.maximum(i0, i1)
+
+    # nan-free copy with an additional row, so that i1 is a valid index
+    rows = data if order is None else data[order]
+    valid = np.zeros((len(otime) + 1, data.shape[1]), dtype=bool)
+    np.logical_not(np.isnan(rows), out=valid[:-1])
+    filled = np.zeros(valid.shape)
+    np.copyto(filled[:-1], rows, where=valid[:-1])
+    del rows
+
+    # The odd entries of ind are the gaps between the bins
+    ind = np.empty(2*len(stime), dtype=np.intp)
+    ind[0::2] = i0
+    ind[1::2] = i1
+    dsum = np.add.reduceat(filled, ind, axis=0)[0::2]
+    del filled
+    if valid[:-1].all():
+        count = np.broadcast_to((i1 - i0)[:, None], dsum.shape)
+    else:
+        count = np.add.reduceat(valid, ind, axis=0, dtype=np.int32)[0::2]
+        # reduceat returns the row at i0 for empty bins
+        count[i0 == i1] = 0
+    data = np.full(dsum.shape, np.nan)
+    np.divide(dsum, count, out=data, where=count > 0)
 
-    stats['corr_start'] = [UTCDateTime(st) for st in stime]
-    stats['corr_end'] = [UTCDateTime(et) for et in etime]
+    stats['corr_start'] = TimeArray(stime)
+    stats['corr_end'] = TimeArray(etime)
 
     return data, stats
 
@@ -742,49 +841,114 @@ def corr_mat_extract_trace(
     :return **trace**: extracted trace
     """
 
-    ndata = deepcopy(data)
-
     if method == 'mean':
-        mm = np.ma.masked_array(
-            ndata, np.isnan(ndata))
-        out = np.mean(mm, 0).filled(np.nan)
+        out = _nanmean(data)
     elif method == 'median':
-        mm = np.ma.masked_array(
-            ndata, np.isnan(ndata))
-        out = np.median(mm, 0).filled(np.nan)
+        out = _nanmedian(data)
     elif method == 'norm_mean':
         # normalize the matrix
-        ndata = corr_mat_normalize(ndata, stats, normtype='absmax')
-        mm = np.ma.masked_array(
-            ndata, np.isnan(ndata))
-        out = (np.mean(mm, 0).filled(np.nan))
+        ndata = corr_mat_normalize(data.copy(), stats, normtype='absmax')
+        out = _nanmean(ndata)
     elif method == 'similarity_percentile':
         # normalize the matrix
-        ndata = corr_mat_normalize(ndata, stats, normtype='absmax')
-        mm = np.ma.masked_array(
-            ndata, np.isnan(ndata))
-        # calc mean  trace
-        mean_tr = np.mean(mm, 0).filled(np.nan)
-        # calc similarity with mean trace
-        tm_sq = np.sum(mean_tr ** 2)
-        cm_sq = np.sum(ndata ** 2, axis=1)
-        # cm_sq = np.sum(data ** 2, axis=1).filled(np.nan)
-        cor = np.zeros(ndata.shape[0])
-        for ind in range(mm.shape[0]):
-            cor[ind] = (
-                np.dot(ndata[ind, :], mean_tr) / np.sqrt(cm_sq[ind] * tm_sq))
-        # estimate the percentile excluding nans
-        tres = np.percentile(cor[~np.isnan(cor)], percentile)
-        # find the traces that agree with the requested percentile and calc
-        # their mean
-        ind = cor > tres
-        out = np.mean(ndata[ind, :], 0)
+        ndata = corr_mat_normalize(data.copy(), stats, normtype='absmax')
+        out = _similarity_mean(ndata, _nanmean(ndata), percentile)
     else:
         raise ValueError("Method '%s' not defined." % method)
 
     return out
 
 
+# Methods supported by corr_mat_extract_trace and corr_mat_extract_windows
+extract_methods = ('mean', 'median', 'norm_mean', 'similarity_percentile')
+
+
+def corr_mat_extract_windows(
+    data: np.ndarray, stats: CorrStats, bounds: np.ndarray,
+        method: str = 'mean', percentile: float = 50.) -> np.ndarray:
+    """
+    Extract one representative trace for each of several windows of
+    consecutive correlations (rows). The result is the same as calling
+    :func:`corr_mat_extract_trace` for each window, but the matrix is only
+    normalised once and the windows are views of the matrix rather than
+    copies.
+
+    :param data: correlation matrix
+    :type data: np.ndarray
+    :param stats: The stats object from the
+        :class:`~seismic.correlate.stream.CorrBulk` object.
+    :type stats: CorrStats
+    :param bounds: Array of shape (n, 2) holding the first and the last + 1
+        row of each window
+    :type bounds: np.ndarray
+    :param method: method to extract the traces, see
+        :func:`corr_mat_extract_trace`, defaults to 'mean'
+    :type method: str, optional
+    :param percentile: only used for method=='similarity_percentile',
+        defaults to 50.
+    :type percentile: float, optional
+    :return: extracted traces, one row per window
+    :rtype: np.ndarray
+    """
+    if method not in extract_methods:
+        raise ValueError("Method '%s' not defined." % method)
+    bounds = np.asarray(bounds, dtype=int).reshape(-1, 2)
+    if method == 'median':
+        return np.array([_nanmedian(data[a:b]) for a, b in bounds])
+    if method != 'mean':
+        data = corr_mat_normalize(data.copy(), stats, normtype='absmax')
+    # rows without nans can be averaged without copying them
+    nan_rows = np.cumsum(np.r_[0, np.isnan(data).any(axis=1)])
+    means = np.array([
+        _nanmean(data[a:b]) if nan_rows[b] - nan_rows[a] or a == b
+        else data[a:b].mean(axis=0) for a, b in bounds])
+    if method != 'similarity_percentile':
+        return means
+    cm_sq = np.einsum('ij,ij->i', data, data)
+    return np.array([
+        _similarity_mean(data[a:b], mean_tr, percentile, cm_sq[a:b])
+        for (a, b), mean_tr in zip(bounds, means)])
+
+
+def _nanmean(data: np.ndarray) -> np.ndarray:
+    """
+    Mean along the time axis, ignoring nans (nan if all are nan).
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(data, axis=0)
+
+
+def _nanmedian(data: np.ndarray) -> np.ndarray:
+    """
+    Median along the time axis, ignoring nans (nan if all are nan).
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(data, axis=0)
+
+
+def _similarity_mean(
+    ndata: np.ndarray, mean_tr: np.ndarray, percentile: float,
+        cm_sq: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Average of the ``percentile`` % of traces in ``ndata`` that best
+    correlate with ``mean_tr``. Traces containing nans are excluded.
+    ``cm_sq`` are the squared norms of the traces if already known.
+    """
+    tm_sq = np.sum(mean_tr ** 2)
+    if cm_sq is None:
+        cm_sq = np.einsum('ij,ij->i', ndata, ndata)
+    # calc similarity with mean trace
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cor = ndata @ mean_tr / np.sqrt(cm_sq * tm_sq)
+    # estimate the percentile excluding nans
+    tres = np.percentile(cor[~np.isnan(cor)], percentile)
+    # find the traces that agree with the requested percentile and calc
+    # their mean
+    return np.mean(ndata[cor > tres, :], 0)
+
+
 class Error(Exception):
     pass
 
@@ -800,7 +964,8 @@ def corr_mat_stretch(
     stretch_steps: int = 100, sides: str = 'both',
     return_sim_mat: bool = False,
     ref_tr_trim: Optional[Tuple[float, float]] = None,
-        ref_tr_stats: Optional[CorrStats] = None) -> dict:
+    ref_tr_stats: Optional[CorrStats] = None, search: str = 'grid',
+        coarse_steps: Optional[int] = None, threads: int = 1) -> dict:
     """ Time stretch estimate through stretch and comparison.
 
     This function estimates stretching of the time axis of traces as it can
@@ -840,7 +1005,18 @@ def corr_mat_stretch(
         one-sided signals from active sources with zero lag time is on the
         first sample. Other options assume that the zero lag time is in the
         center of the traces.
-
+    :type search: str
+    :param search: ``'grid'`` to test all ``stretch_steps`` stretches,
+        ``'refine'`` for a coarse search, followed by a local search at full
+        resolution and sub-grid refinement of the maximum, or ``'fft'`` for
+        a cross-correlation in logarithmic lag time. See
+        :func:`~seismic.monitor.stretch_mod.time_stretch_estimate`.
+    :type coarse_steps: int, optional
+    :param coarse_steps: Number of stretch values in the coarse search.
+        Only used if ``search='refine'``.
+    :type threads: int
+    :param threads: Number of threads to estimate the stretch with, each
+        one works on a block of correlations. Defaults to 1.
 
     :rtype: Dictionary
     :return: **dv**: Dictionary with the following keys
@@ -892,7 +1068,8 @@ def corr_mat_stretch(
         data, ref_trc, tw=tw, stretch_range=stretch_range,
         stretch_steps=stretch_steps, sides=sides,
         return_sim_mat=return_sim_mat, ref_tr_trim=ref_tr_trim,
-        ref_tr_stats=ref_tr_stats)
+        ref_tr_stats=ref_tr_stats, search=search, coarse_steps=coarse_steps,
+        threads=threads)
 
     # add the keys the can directly be transferred from the correlation matrix
     dv['stats'] = stats
@@ -904,7 +1081,7 @@ def corr_mat_shift(
     data: np.ndarray, stats: CorrStats, ref_trc: np.ndarray = None,
     tw: List[np.ndarray] = None, shift_range: float = 10,
     shift_steps: int = 101, sides: str = 'both',
-        return_sim_mat: bool = False) -> dict:
+        return_sim_mat: bool = False, method: str = 'shifted_ref') -> dict:
     """ Time shift estimate through shifting and comparison.
 
     This function estimates shifting of the time axis of traces as it can
@@ -942,6 +1119,9 @@ def corr_mat_shift(
         one-sided signals from active sources with zero lag time is on the
         first sample. Other options assume that the zero lag time is in the
         center of the traces.
+    :type method: str
+    :param method: ``'shifted_ref'`` or ``'fft'``, see
+        :func:`~seismic.monitor.stretch_mod.time_shift_estimate`.
 
 
     :rtype: Dictionary
@@ -1021,7 +1201,7 @@ def corr_mat_shift(
     dt = time_shift_estimate(
         data, ref_trc=ref_trc, tw=tw, shift_range=shift_range,
         shift_steps=shift_steps, single_sided=ss,
-        return_sim_mat=return_sim_mat)
+        return_sim_mat=return_sim_mat, method=method)
 
     # add the keys the can directly be transferred from the correlation matrix
     dt['stats'] = stats
@@ -1032,7 +1212,8 @@ def measure_shift(
     data: np.ndarray, stats: CorrStats, ref_trc: Optional[np.ndarray] = None,
     tw: Optional[List[List]] = None, shift_range: float = 10,
     shift_steps: int = 101, sides: str = 'both',
-        return_sim_mat: bool = False) -> List[DV]:
+    return_sim_mat: bool = False,
+        method: str = 'shifted_ref') -> List[DV]:
     """ Time shift estimate through shifting and comparison.
 
     This function estimates shifting of the time axis of traces as it can
@@ -1077,6 +1258,14 @@ def measure_shift(
         not be symmetric. For ``both`` the time window will be mirrored about
         zero lag time, e.g. [start,end] will result in time windows
         [-end:-start] and [start:end] being used simultaneousy
+    :type method: str
+    :param method: ``'shifted_ref'`` compares the traces with
+        ``shift_steps`` shifted copies of the reference, so that the
+        estimated shift is one of the tested shifts. ``'fft'``
+        cross-correlates the time windows with the reference in the
+        frequency domain and refines the maximum to below the sampling
+        interval. Here, ``shift_steps`` only determines the sampling of the
+        returned similarity matrix. Defaults to ``'shifted_ref'``.
 
 
     :rtype: List[Dictionary]
@@ -1105,6 +1294,9 @@ def measure_shift(
     if shift_steps % 2 == 0:
         raise ValueError(
             "shift_steps must be an odd number to include zero shift")
+    if method not in ['shifted_ref', 'fft']:
+        raise ValueError(
+            f"'method' must be either 'shifted_ref' or 'fft', not {method}")
     if sides not in ['both', 'single']:
         raise ValueError(
             f"'sides' must be either 'both' or 'single', not {sides}")
@@ -1162,31 +1354,46 @@ def measure_shift(
         data = data[:-1, :]
         stats['corr_start'] = stats['corr_start'][:-1]
 
-    # create matrix with shifted references
     shifts = np.linspace(-shift_range, shift_range, shift_steps)
-    ref_mat = create_shifted_ref_mat(ref_trc, stats, shifts)
-
-    # create space for results
-    # do computation for each time window
-    sim_mats = []
+    # create indices of time windows
+    tw_ind = []
     for twi in tw:
-        # create indices of time windows
         indices = np.arange(
             np.ceil(twi[0]*stats.sampling_rate),
             np.floor(twi[1]*stats.sampling_rate))
         if sides == 'both':
             indices = np.concatenate((np.flipud(-indices), indices))
         indices -= np.round(stats.start_lag * stats.sampling_rate)
-        indices = indices.astype(int)
-        # compare data and shifted reference
-        sim_mats.append(
-            compare_with_modified_reference(data, ref_mat, indices))
-    sim_mat = np.nanmean(sim_mats, axis=0)
-    corr = sim_mat.max(axis=1)
-    value = shifts[sim_mat.argmax(axis=1)]
-    # Set dt to NaN where the correlation is NaN instead of having it equal
-    # to one of the two stretch_range limits
-    value[np.isnan(corr)] = np.nan
+        tw_ind.append(indices.astype(int))
+
+    if method == 'fft':
+        # cross-correlate all windows with the reference at once and
+        # average the similarity of the time windows
+        ctws, nmask = _gather_tw_indices(tw_ind, data.shape[1], 'single')
+        max_lag = int(np.ceil(shift_range*stats.sampling_rate)) + 1
+        sim = np.nanmean(_shift_similarity(
+            data, ref_trc, ctws, nmask, max_lag, remove_nans=False), axis=0)
+        corr, value = _shift_peak(
+            sim, max_lag, -shift_range*stats.sampling_rate,
+            shift_range*stats.sampling_rate)
+        value *= stats.delta
+        if return_sim_mat:
+            sim_mat = _interpolate_rows(
+                sim, shifts*stats.sampling_rate + max_lag)
+    else:
+        # create matrix with shifted references
+        ref_mat = create_shifted_ref_mat(ref_trc, stats, shifts)
+        # compare data and shifted reference for each time window
+        sim_mats = []
+        for indices in tw_ind:
+            sim_mats.append(
+                compare_with_modified_reference(data, ref_mat, indices))
+        sim_mat = np.nanmean(sim_mats, axis=0)
+        corr = sim_mat.max(axis=1)
+        value = shifts[sim_mat.argmax(axis=1)]
+        # Set dt to NaN where the correlation is NaN instead of having it
+        # equal to one of the two stretch_range limits
+        value[np.isnan(corr)] = np.nan
     # assemble results
     dt = {
         'stats': stats,
@@ -1214,15 +1421,18 @@ def apply_shift(
         along rows and number of traces is ``data.shape[0]``.
     :type shifts: :class:`~numpy.ndarray`
     :param shifts: shifts in seconds for each trace in 'data'
+
+    ..note:: All traces are linearly interpolated at once. Values beyond
+        the ends of the traces are extrapolated.
     """
+    data = np.atleast_2d(data)
     times = np.linspace(stats.start_lag, stats.end_lag, stats.npts)
-    # stretch every line
-    for (ii, line) in enumerate(data):
-        # s = UnivariateSpline(times, line, s=0)
-        f = interp1d(
-            times, line, fill_value='extrapolate')
-        data[ii, :] = f(times+shifts[ii])
-
+    # positions in samples
+    shifts = np.asarray(shifts, dtype=float)
+    if shifts.ndim == 1:
+        shifts = shifts[:, None]
+    pos = np.arange(stats.npts) + shifts/(times[1] - times[0])
+    data[...] = _interpolate_rows(data, pos, kind='linear')
     return data
 
 
@@ -1239,16 +1449,19 @@ def apply_stretch(
         along rows and number of traces is ``data.shape[0]``.
     :type stretches: :class:`~numpy.ndarray`
     :param stretches: stretches in relative units for each trace in 'data'
+
+    ..note:: All traces are interpolated at once with cubic splines. Traces
+        that contain nans will be nan.
     """
+    data = np.atleast_2d(data)
     times = np.linspace(stats.start_lag, stats.end_lag, stats.npts)
-
-    # stretch every line
-    for (ii, line) in enumerate(data):
-        # Extrapolating stretches can lead to weird boundary values
-        # So we set the boundary to 0 instead of extrapolating (ext=1)
-        s = UnivariateSpline(times, line, s=0, ext=1)
-        # dv defined as difference
-        # data[ii, :] = s(times * (1 + stretches[ii]))
-        # dv defined as logarithmic change
-        data[ii, :] = s(times * np.exp(-stretches[ii]))
+    # dv defined as logarithmic change
+    stretches = np.asarray(stretches, dtype=float)
+    if stretches.ndim == 1:
+        stretches = stretches[:, None]
+    stretched = times*np.exp(-stretches)
+    pos = (stretched - times[0])/(times[1] - times[0])
+    # Extrapolating stretches can lead to weird boundary values
+    # So we set the boundary to 0 instead of extrapolating
+    data[...] = _interpolate_rows(data, pos, fill_value=0)
     return data, stats
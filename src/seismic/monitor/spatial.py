@@ -26,6 +26,7 @@ from obspy.geodetics.base import locations2degrees as loc2deg
 from obspy.geodetics.base import degrees2kilometers as deg2km
 from obspy import UTCDateTime
 
+from seismic.correlate.stats import TimeArray
 from seismic.monitor.dv import DV
 
 
@@ -749,7 +750,7 @@ class DVGrid(object):
                         f' {dv.stats.id}'
                     )
                 continue
-            ii = np.argmin(abs(np.array(dv.stats.corr_start)-utc))
+            ii = np.argmin(abs(TimeArray(dv.stats.corr_start)-utc))
             val = dv.value[ii]
             corr = dv.corr[ii]
             if np.isnan(val) or np.isnan(corr) or corr <= 1e-3 or corr >= 1:
@@ -1044,7 +1045,7 @@ def align_dv_curves(
     :param value: Value to align the dv/v curve to, defaults to 0.
     :type value: float, optional
     """
-    ii = np.argmin(abs(np.array(dv.stats.corr_start)-utc))
+    ii = np.argmin(abs(TimeArray(dv.stats.corr_start)-utc))
     # to make it more stable we use the mean of the values around the
     # given time
     # this is a problem if ii is close to the beginning or end of the
@@ -1088,7 +1089,7 @@ def dv_starts(dv: DV, utc: UTCDateTime, corr_thres: float) -> bool:
         return False
     if utc < dv.stats.corr_start[0] or utc > dv.stats.corr_end[-1]:
         return False
-    ii = np.argmin(abs(np.array(dv.stats.corr_start)-utc))
+    ii = np.argmin(abs(TimeArray(dv.stats.corr_start)-utc))
     if np.isnan(dv.corr[ii]) or dv.corr[ii] < corr_thres:
         return False
     return True
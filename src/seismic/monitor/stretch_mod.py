@@ -9,16 +9,162 @@
 Created: Tuesday, 15th June 2021 03:42:14 pm
 Last Modified: Friday, 29th September 2023 10:59:17 am
 '''
-from typing import List, Tuple, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple, Optional
 from copy import deepcopy
+import hashlib
+import threading
 
 import numpy as np
 from obspy.signal.invsim import cosine_taper
-from scipy.interpolate import UnivariateSpline, interp1d
+from scipy.fft import irfft, next_fast_len, rfft, rfftfreq
+from scipy.interpolate import (
+    CubicSpline, UnivariateSpline, make_interp_spline)
+from scipy.linalg import solve_banded
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import fftconvolve
 from seismic.correlate.stats import CorrStats
 from seismic.monitor.trim import corr_mat_trim
 
 
+class StretchedReferenceCache(object):
+    """
+    Least recently used cache for matrices of stretched reference traces.
+
+    Building the stretched references (spline evaluation and trimming) is
+    repeated for every stretch estimate. The cache stores the resulting
+    matrices under a hash of the reference trace and all parameters that
+    influence the stretching, so that repeated estimates with the same
+    reference reuse them. The cached matrices are read-only.
+    """
+    def __init__(self, max_bytes: int = 2**28):
+        """
+        :param max_bytes: Memory budget of the cache in bytes. If exceeded,
+            the least recently used matrices are evicted. Defaults to 256 MB.
+        :type max_bytes: int, optional
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Estimates on blocks of rows may share the cache
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def key(ref_trc: np.ndarray, stretches: np.ndarray, *args) -> str:
+        """
+        Hash of the reference trace, the stretch values, and further
+        parameters (their ``repr`` is hashed).
+
+        :rtype: str
+        """
+        h = hashlib.sha1(np.ascontiguousarray(ref_trc, dtype=float))
+        h.update(np.ascontiguousarray(stretches, dtype=float))
+        h.update(repr(args).encode())
+        return h.hexdigest()
+
+    def get(self, key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Return the matrix stored under ``key``. If it is not cached, it is
+        computed by calling ``compute`` and added to the cache.
+
+        :param key: key as returned by :meth:`key`
+        :type key: str
+        :param compute: Function without arguments that returns the matrix
+        :type compute: Callable[[], np.ndarray]
+        :return: The read-only matrix
+        :rtype: np.ndarray
+        """
+        if self.max_bytes <= 0:
+            # The cache is disabled
+            return compute()
+        with self._lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            mat = compute()
+            if mat.base is not None:
+                # Do not keep the memory of a larger array alive
+                mat = mat.copy()
+            mat.setflags(write=False)
+            if mat.nbytes <= self.max_bytes:
+                self.entries[key] = mat
+                self.nbytes += mat.nbytes
+                self.resize(self.max_bytes)
+            return mat
+
+    def resize(self, max_bytes: int):
+        """
+        Set a new memory budget and evict the least recently used matrices
+        until it is met.
+
+        :param max_bytes: Memory budget in bytes
+        :type max_bytes: int
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.nbytes > self.max_bytes:
+                _, mat = self.entries.popitem(last=False)
+                self.nbytes -= mat.nbytes
+
+    def clear(self):
+        """
+        Remove all matrices from the cache.
+        """
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+#: Cache used by :func:`time_stretch_estimate`. It is disabled (i.e., has a
+#: memory budget of 0) unless it is enabled with
+#: :meth:`StretchedReferenceCache.resize`, which the
+#: :class:`~seismic.monitor.monitor.Monitor` does.
+ref_cache = StretchedReferenceCache(max_bytes=0)
+
+
+def _map_row_blocks(
+    func: Callable[[slice], Any], nrows: int,
+        threads: int = 1) -> List[Any]:
+    """
+    Calls ``func(rows)`` for ``threads`` consecutive blocks of rows in a
+    thread pool and returns the results in the order of the blocks. NumPy
+    and SciPy release the GIL in the heavy computations, so that the blocks
+    are computed in parallel. With ``threads`` <= 1, ``func`` is called once
+    for all rows.
+    """
+    if threads <= 1 or nrows < 2:
+        return [func(slice(None))]
+    bounds = np.linspace(0, nrows, min(threads, nrows) + 1).astype(int)
+    blocks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(func, blocks))
+
+
+def _concatenate_dvs(dvs: List[dict], ntw: int, nstr: int) -> dict:
+    """
+    Joins the results of velocity change estimates on consecutive blocks
+    of rows (as returned by :func:`velocity_change_estimate` and co.).
+    """
+    if len(dvs) == 1:
+        return dvs[0]
+    dv = dict(dvs[0])
+    for key in ['corr', 'value']:
+        dv[key] = np.squeeze(np.concatenate(
+            [np.reshape(d[key], (ntw, -1)) for d in dvs], axis=1))
+    if 'sim_mat' in dv:
+        dv['sim_mat'] = np.squeeze(np.concatenate(
+            [np.reshape(d['sim_mat'], (-1, nstr, ntw)) for d in dvs]))
+    return dv
+
+
 def time_windows_creation(
         starting_list: list, t_width: List[int] or int) -> np.ndarray:
     """ Time windows creation.
@@ -67,7 +213,7 @@ def time_windows_creation(
 
 def compute_wfc(
     mat: np.ndarray, tw: np.ndarray, refcorr: np.ndarray, sides: str,
-        remove_nans: bool = True) -> np.ndarray:
+        remove_nans: bool = True, threads: int = 1) -> np.ndarray:
     """
     Computes the waveform coherency (**WFC**) between the given reference
     correlation and correlationmatrix.
@@ -76,78 +222,60 @@ def compute_wfc(
 
     :param mat: 2D Correlation Matrix (function of corrstart and time lag)
     :type mat: np.ndarray
-    :param tw: Lag time window to use for the computation
+    :param tw: Lag time windows to use for the computation
     :type tw: np.ndarray
     :param refcorr: 1D reference Correlation Trace extracted from `mat`.
+        If 2D, it will be interpreted as one reference trace for each
+        time window in ``tw``.
     :type refcorr: np.ndarray
     :param sides: Which sides to use. Can be `both`, `right`, `left`,
         or `single`.
     :type sides: str
     :param remove_nans: Remove nans from CorrMatrix, defaults to True
     :type remove_nans: bool, optional
+    :param threads: Number of threads. Each one computes the WFC for a
+        block of rows of ``mat``. Defaults to 1.
+    :type threads: int, optional
     :raises ValueError: unknown option in sides
-    :return: A 1D array with len=N(time windows)
+    :return: A 2D array with shape (N(time windows), N(correlations))
     :rtype: np.ndarray
+
+    .. note::
+        All time windows are computed at once. The samples of each window
+        are gathered into one array, so that the memory requirement is
+        about the number of samples in all windows times the number of
+        rows of ``mat``.
     """
     # Mat must be a 2d vector in every case so
     mat = np.atleast_2d(mat)
+    refcorr = np.asarray(refcorr)
 
-    assert len(refcorr) == mat.shape[1]
-
-    if remove_nans:
-        mat = np.nan_to_num(mat)
-
-    center_p = np.floor((mat.shape[1] - 1.) / 2.)
-
-    corr = np.zeros((len(tw), mat.shape[0]))
-
-    for (ii, ctw) in enumerate(tw):
-
-        if sides == 'both':
-            if ctw[0] == 0:
-                ctw = np.hstack((
-                    center_p - ctw[::-1],
-                    center_p + ctw[1:])).astype(np.int32)
-            else:
-                ctw = np.hstack((
-                    center_p - ctw[::-1],
-                    center_p + ctw)).astype(np.int32)
-        elif sides == 'left':
-            ctw = (center_p - ctw[::-1]).astype(np.int32)
-        elif sides == 'right':
-            ctw = (center_p + ctw).astype(np.int32)
-        elif sides == 'single':
-            ctw = ctw.astype(np.int32)
-        else:
-            raise ValueError(
-                'sides = %s not a valid option.' % sides)
-
-        mask = np.zeros((mat.shape[1],))
-        mask[ctw] = 1
-
-        ref_mask_mat = mask
-        mat_mask_mat = np.tile(mask, (mat.shape[0], 1))
-
-        first = mat * mat_mask_mat
-        second = refcorr * ref_mask_mat
-
-        dprod = np.dot(first, second.T)
-
-        # Normalization
-        f_sq = np.sum(first ** 2, axis=1)
-        s_sq = np.sum(second ** 2)
+    assert refcorr.shape[-1] == mat.shape[1]
+    if refcorr.ndim == 2 and refcorr.shape[0] != len(tw):
+        raise ValueError(
+            'refcorr has to contain one reference trace per time window.')
 
-        f_sq = f_sq.reshape(1, len(f_sq))
+    ctws, nmask = _gather_tw_indices(tw, mat.shape[1], sides)
+    if refcorr.ndim == 2:
+        second = np.take_along_axis(refcorr, ctws, axis=1) * nmask
+    else:
+        second = refcorr[ctws] * nmask
 
-        den = np.sqrt(np.dot(f_sq, s_sq))
+    # Normalization
+    s_norm = np.sqrt(np.sum(second ** 2, axis=1))
 
-        corr[ii] = dprod/den
-    return corr
+    def wfc_rows(rows: slice) -> np.ndarray:
+        first, f_norm = _gather_tw_samples(
+            mat[rows], ctws, nmask, remove_nans, np.float64)
+        dprod = np.einsum('ijk,ik->ij', first, second)
+        return dprod/(f_norm*s_norm[:, None])
+    return np.concatenate(
+        _map_row_blocks(wfc_rows, mat.shape[0], threads), axis=1)
 
 
 def wfc_multi_reftr(
     corr_data: np.ndarray, ref_trs: np.ndarray, tw: np.ndarray, sides: str,
-        remove_nans: bool = True) -> dict:
+        remove_nans: bool = True, threads: int = 1) -> dict:
     """
     Computes the waveform coherency (**WFC**) between the given reference
     correlation(s) and correlation matrix.
@@ -168,6 +296,10 @@ def wfc_multi_reftr(
         or `single`.
     :type sides: str
     :param remove_nans: Remove nans from CorrMatrix, defaults to True
+    :type remove_nans: bool, optional
+    :param threads: Number of threads, see :func:`compute_wfc`.
+        Defaults to 1.
+    :type threads: int, optional
     :return: A dictionary with one correlation array for each reference trace.
     :rtype: dict
     """
@@ -189,21 +321,89 @@ def wfc_multi_reftr(
     if reftr_count == 1:
         key = "reftr_0"
         value = compute_wfc(
-            corr_data, tw, ref_trs, sides, remove_nans=remove_nans)
+            corr_data, tw, ref_trs, sides, remove_nans=remove_nans,
+            threads=threads)
         multi_ref_panel.update({key: value})
     else:  # For multiple-traces loops
         for i, rftr in enumerate(ref_trs):
             key = "reftr_%d" % i
             value = value = compute_wfc(
-                corr_data, tw, rftr, sides, remove_nans=remove_nans)
+                corr_data, tw, rftr, sides, remove_nans=remove_nans,
+                threads=threads)
             multi_ref_panel.update({key: value})
     return multi_ref_panel
 
 
+def _gather_tw_indices(
+    tw: np.ndarray, npts: int, sides: str) -> Tuple[
+        np.ndarray, np.ndarray]:
+    """
+    Translates the time windows to sample indices of a correlation function
+    with ``npts`` samples. All windows are padded to the same length.
+
+    :return: The indices of each window (shape (len(tw), n)) and a mask that
+        is zero for padded or repeated samples.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    center_p = np.floor((npts - 1.) / 2.)
+    ctws = []
+    for ctw in tw:
+        ctw = np.asarray(ctw)
+        if sides == 'both':
+            if ctw[0] == 0:
+                ctw = np.hstack((
+                    center_p - ctw[::-1],
+                    center_p + ctw[1:])).astype(np.int32)
+            else:
+                ctw = np.hstack((
+                    center_p - ctw[::-1],
+                    center_p + ctw)).astype(np.int32)
+        elif sides == 'left':
+            ctw = (center_p - ctw[::-1]).astype(np.int32)
+        elif sides == 'right':
+            ctw = (center_p + ctw).astype(np.int32)
+        elif sides == 'single':
+            ctw = ctw.astype(np.int32)
+        else:
+            raise ValueError(
+                'sides = %s not a valid option.' % sides)
+        if np.any(ctw >= npts) or np.any(ctw < -npts):
+            raise IndexError(
+                f'Time window exceeds the length of the correlation ({npts}).')
+        # Every sample is only used once
+        ctws.append(np.unique(ctw % npts))
+    nidx = max(len(ctw) for ctw in ctws)
+    ind = np.zeros((len(ctws), nidx), dtype=np.intp)
+    nmask = np.zeros((len(ctws), nidx), dtype=np.int8)
+    for ii, ctw in enumerate(ctws):
+        ind[ii, :len(ctw)] = ctw
+        nmask[ii, :len(ctw)] = 1
+    return ind, nmask
+
+
+def _gather_tw_samples(
+    mat: np.ndarray, ctws: np.ndarray, nmask: np.ndarray, remove_nans: bool,
+        dtype: type) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gathers the samples of all time windows from the rows of ``mat``.
+
+    :return: Contiguous array of shape (len(ctws), mat.shape[0], n) and the
+        norm of each row in each time window.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    gathered = np.ascontiguousarray(
+        mat[:, ctws].transpose(1, 0, 2), dtype=dtype)
+    if remove_nans:
+        gathered = np.nan_to_num(gathered)
+    gathered *= nmask[:, None, :]
+    norm = np.sqrt(np.einsum('ijk,ijk->ij', gathered, gathered))
+    return gathered, norm
+
+
 def velocity_change_estimate(
     mat: np.ndarray, tw: np.ndarray, strrefmat: np.ndarray, strvec: np.ndarray,
     sides: str = 'both', return_sim_mat: bool = False,
-        remove_nans: bool = True) -> dict:
+        remove_nans: bool = True, dtype: type = np.float64) -> dict:
     """ Velocity change estimate through stretching and comparison.
 
     Velocity changes are estimated comparing each correlation function stored
@@ -232,6 +432,18 @@ def velocity_change_estimate(
     :type remove_nans: bool
     :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
         given correlation matrix before any other operation.
+    :type dtype: type
+    :param dtype: Floating point precision of the computation and of the
+        returned similarity matrix. ``np.float32`` halves memory and
+        computation time, but rounding errors can decide between stretch
+        values with (almost) identical correlation. Defaults to
+        ``np.float64``.
+
+    .. note::
+
+        Only the samples inside of the time windows are gathered and
+        compared. All time windows are computed in one batched matrix
+        product, processed in chunks of rows of ``mat``.
 
     :rtype: Dictionary
     :return: **dv**: Dictionary with the following keys
@@ -264,70 +476,328 @@ def velocity_change_estimate(
             f"samples corrmat has shape {mat.shape} "
             f'and stretched reference matrix has {strrefmat.shape}')
 
-    if remove_nans:
-        mat = np.nan_to_num(mat)
+    strvec = np.asarray(strvec)
+    ctws, nmask = _gather_tw_indices(tw, mat.shape[1], sides)
 
-    center_p = np.floor((mat.shape[1] - 1.) / 2.)
+    # Only the samples inside of the time windows are used
+    # shape (ntw, ntimes, nsamples) and (ntw, nstr, nsamples)
+    first, f_norm = _gather_tw_samples(mat, ctws, nmask, remove_nans, dtype)
+    second, s_norm = _gather_tw_samples(
+        strrefmat, ctws, nmask, False, dtype)
+    second_t = np.ascontiguousarray(second.transpose(0, 2, 1))
 
-    nstr = strrefmat.shape[0]
+    ntimes = mat.shape[0]
+    corr = np.zeros((len(tw), ntimes))
+    dt = np.zeros((len(tw), ntimes))
+    if return_sim_mat:
+        sim_mat = np.zeros([ntimes, len(strvec), len(tw)], dtype=dtype)
+    # Process in chunks of rows to limit the memory footprint
+    chunk = max(1, 2**24 // max(1, len(strvec)*len(tw)))
+    for ii in range(0, ntimes, chunk):
+        sl = slice(ii, ii + chunk)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tmp = np.matmul(first[:, sl], second_t)
+            tmp /= f_norm[:, sl, None]*s_norm[:, None, :]
+        if return_sim_mat:
+            sim_mat[sl] = tmp.transpose(1, 2, 0)
+        corr[:, sl] = tmp.max(axis=2)
+        dt[:, sl] = strvec[tmp.argmax(axis=2)]
 
-    corr = np.zeros((len(tw), mat.shape[0]))
-    dt = np.zeros((len(tw), mat.shape[0]))
-    sim_mat = np.zeros([mat.shape[0], len(strvec), len(tw)])
+    # Set dt to NaN where the correlation is NaN instead of having it equal
+    # to one of the two stretch_range limits
+    dt[np.isnan(corr)] = np.nan
 
-    for (ii, ctw) in enumerate(tw):
+    dv = {'corr': np.squeeze(corr),
+          'value': np.squeeze(dt),
+          'second_axis': strvec,
+          'value_type': 'stretch',
+          'method': 'single_ref'}
 
-        if sides == 'both':
-            # ctw = np.hstack((center_p - ctw[::-1],
-            #                  center_p + ctw)).astype(np.int32)
-            if ctw[0] == 0:
-                ctw = np.hstack((
-                    center_p - ctw[::-1],
-                    center_p + ctw[1:])).astype(np.int32)
-            else:
-                ctw = np.hstack((
-                    center_p - ctw[::-1],
-                    center_p + ctw)).astype(np.int32)
-        elif sides == 'left':
-            ctw = (center_p - ctw[::-1]).astype(np.int32)
-        elif sides == 'right':
-            ctw = (center_p + ctw).astype(np.int32)
-        elif sides == 'single':
-            ctw = ctw.astype(np.int32)
-        else:
-            raise ValueError(
-                'sides = %s not a valid option.' % sides)
+    if return_sim_mat:
+        dv.update({'sim_mat': np.squeeze(sim_mat)})
 
-        mask = np.zeros((mat.shape[1],))
-        mask[ctw] = 1
+    return dv
 
-        ref_mask_mat = np.tile(mask, (nstr, 1))
-        mat_mask_mat = np.tile(mask, (mat.shape[0], 1))
 
-        first = mat * mat_mask_mat
-        second = strrefmat * ref_mask_mat
+def refined_velocity_change_estimate(
+    mat: np.ndarray, tw: np.ndarray,
+    stretch_ref: Callable[[np.ndarray], np.ndarray], strvec: np.ndarray,
+    coarse_steps: Optional[int] = None, sides: str = 'both',
+    return_sim_mat: bool = False, remove_nans: bool = True,
+    dtype: type = np.float64,
+        fine_ref: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> dict:
+    """ Velocity change estimate through a coarse-to-fine stretching search.
+
+    Instead of comparing each row of ``mat`` with all stretched versions of
+    the reference, the similarity is first computed on a coarse subset of
+    ``strvec`` with ``coarse_steps`` values. Afterwards, the similarity is
+    evaluated at full resolution, but only in the vicinity (half a coarse
+    increment to each side) of the coarse maximum of each row and time
+    window. Finally, the position of the maximum is refined to below the
+    increment of ``strvec`` by fitting a parabola through the maximum and
+    its two neighbours.
 
-        dprod = np.dot(first, second.T)
+    :type mat: :class:`~numpy.ndarray`
+    :param mat: 2d ndarray containing the correlation functions.
+        One for each row.
+    :type tw: :class:`~numpy.ndarray` of int
+    :param tw: 2d ndarray of time windows to be use in the velocity change
+         estimate.
+    :type stretch_ref: Callable
+    :param stretch_ref: Function that takes a 1D array of stretch values and
+        returns the correspondingly stretched references as 2D array (one
+        row for each stretch value and with as many columns as ``mat``).
+    :type strvec: :class:`~numpy.ndarray`
+    :param strvec: Equally spaced, full resolution stretch vector.
+    :type coarse_steps: int, optional
+    :param coarse_steps: Number of stretch values in the coarse search.
+        Defaults to ``ceil(sqrt(2*len(strvec)))``, which requires computing
+        about 10 % of the similarities for ``len(strvec) = 1001``. The coarse
+        grid has to be fine enough to sample the main maximum of the
+        similarity function, otherwise side maxima can be picked.
+    :type sides: string
+    :param sides: Side of the reference matrix to be used for the velocity
+        change estimate ('both' | 'left' | 'right' | 'single')
+    :type return_sim_mat: bool
+    :param return_sim_mat: If `True`, the returned dictionary contains a
+        similarity matrix with the full resolution of ``strvec``. The values
+        in the vicinity of the maximum are computed at full resolution, the
+        remaining values are linearly interpolated from the coarse search.
+    :type remove_nans: bool
+    :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
+        given correlation matrix before any other operation.
+    :type dtype: type
+    :param dtype: Floating point precision of the computation and of the
+        returned similarity matrix.
+    :type fine_ref: Callable, optional
+    :param fine_ref: Function like ``stretch_ref`` that is used for the
+        stretched references at full resolution, e.g., to avoid caching
+        them. Defaults to None (``stretch_ref``).
 
-        # Normalization
-        f_sq = np.sum(first ** 2, axis=1)
-        s_sq = np.sum(second ** 2, axis=1)
+    :rtype: Dictionary
+    :return: **dv**: Dictionary with the same keys as returned by
+        :func:`velocity_change_estimate`. *value* holds the refined stretch
+        and *corr* the interpolated maximum of the similarity.
+    """
+    mat = np.atleast_2d(mat)
+    strvec = np.asarray(strvec)
+    nstr = len(strvec)
+    if coarse_steps is None:
+        coarse_steps = int(np.ceil(np.sqrt(2*nstr)))
+    if coarse_steps < 3:
+        raise ValueError('coarse_steps has to be at least 3.')
+
+    # Coarse grid as subset of the full grid
+    step = max(1, int(np.ceil((nstr - 1) / (coarse_steps - 1))))
+    cidx = np.arange(0, nstr, step)
+    if cidx[-1] != nstr - 1:
+        cidx = np.append(cidx, nstr - 1)
+
+    ctws, nmask = _gather_tw_indices(tw, mat.shape[1], sides)
+    first, f_norm = _gather_tw_samples(mat, ctws, nmask, remove_nans, dtype)
+    ntw, ntimes = f_norm.shape
+
+    # Coarse search
+    coarse, c_norm = _gather_tw_samples(
+        stretch_ref(strvec[cidx]), ctws, nmask, False, dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        csim = np.matmul(first, coarse.transpose(0, 2, 1))
+        csim /= f_norm[..., None]*c_norm[:, None, :]
+    peak = cidx[np.argmax(np.nan_to_num(csim, nan=-np.inf), axis=2)]
+
+    # Full resolution in the vicinity of each coarse maximum
+    hw = step // 2 + 1
+    fidx = np.clip(peak[..., None] + np.arange(-hw, hw + 1), 0, nstr - 1)
+    # Rows are sorted by their maximum, so that chunks of rows can be
+    # compared to a short contiguous range of stretched references
+    chunk = 128
+    order = np.argsort(peak, axis=1)
+    ranges = []
+    for ii in range(ntw):
+        for jj in range(0, ntimes, chunk):
+            rows = order[ii, jj:jj + chunk]
+            ranges.append((
+                ii, rows, fidx[ii, rows].min(), fidx[ii, rows].max() + 1))
+    needed = np.unique(np.hstack([np.arange(lo, hi) for *_, lo, hi in ranges]))
+    fine_ref = fine_ref or stretch_ref
+    fine, fi_norm = _gather_tw_samples(
+        fine_ref(strvec[needed]), ctws, nmask, False, dtype)
+    sim = np.empty(fidx.shape, dtype=dtype)
+    for ii, rows, lo, hi in ranges:
+        lo, hi = np.searchsorted(needed, [lo, hi])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tmp = np.matmul(first[ii, rows], fine[ii, lo:hi].T)
+            tmp /= f_norm[ii, rows, None]*fi_norm[ii, None, lo:hi]
+        sim[ii, rows] = np.take_along_axis(
+            tmp, np.searchsorted(needed, fidx[ii, rows]) - lo, axis=1)
+
+    # Sub-grid refinement with a parabola through the maximum
+    jmax = np.argmax(np.nan_to_num(sim, nan=-np.inf), axis=2)[..., None]
+    y1 = np.take_along_axis(sim, jmax, axis=2)[..., 0]
+    y0 = np.take_along_axis(sim, np.maximum(jmax - 1, 0), axis=2)[..., 0]
+    y2 = np.take_along_axis(
+        sim, np.minimum(jmax + 1, fidx.shape[2] - 1), axis=2)[..., 0]
+    best = np.take_along_axis(fidx, jmax, axis=2)[..., 0]
+    denom = y0 - 2*y1 + y2
+    # Only if both neighbours have been evaluated and form a maximum
+    inner = (jmax[..., 0] > 0) & (jmax[..., 0] < fidx.shape[2] - 1) & (
+        best > 0) & (best < nstr - 1) & (denom < 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(inner, .5*(y0 - y2)/denom, 0)
+    delta = np.clip(np.nan_to_num(delta), -.5, .5)
+    corr = y1 - .25*(y0 - y2)*delta
+    dt = np.interp(best + delta, np.arange(nstr), strvec)
+    dt[np.isnan(corr)] = np.nan
 
-        f_sq = f_sq.reshape(1, len(f_sq))
-        s_sq = s_sq.reshape(1, len(s_sq))
+    dv = {'corr': np.squeeze(corr),
+          'value': np.squeeze(dt),
+          'second_axis': strvec,
+          'value_type': 'stretch',
+          'method': 'single_ref'}
+
+    if return_sim_mat:
+        # Linearly interpolate the coarse similarity to the full grid
+        grid = np.arange(nstr)
+        right = np.clip(np.searchsorted(cidx, grid), 1, len(cidx) - 1)
+        left = right - 1
+        w = ((grid - cidx[left]) / (cidx[right] - cidx[left])).astype(dtype)
+        sim_mat = csim[..., left]*(1 - w) + csim[..., right]*w
+        np.put_along_axis(sim_mat, fidx, sim, axis=2)
+        dv.update({'sim_mat': np.squeeze(sim_mat.transpose(1, 2, 0))})
+
+    return dv
+
+
+def log_stretch_estimate(
+    mat: np.ndarray, tw: List[np.ndarray], ref_trc: np.ndarray,
+    strvec: np.ndarray, sides: str = 'both', return_sim_mat: bool = False,
+        remove_nans: bool = True) -> dict:
+    """ Velocity change estimate through stretching in logarithmic lag time.
+
+    Stretching the lag time axis by :math:`e^{-\\varepsilon}` corresponds to a
+    shift by :math:`\\varepsilon` on a logarithmic lag time axis
+    :math:`u = \\ln|t|`. Therefore, the reference trace and the correlation
+    functions are resampled (cubic splines) on an equally spaced grid in
+    :math:`u`, covering the time window. The similarity with all stretched
+    references is then computed at once as cross-correlation along the
+    :math:`u` axis with FFTs. The samples are weighted with :math:`e^u`, so
+    that the result approximates the correlation coefficient of the time
+    window in linear time. For ``sides='both'``, the two sides are resampled
+    separately and their contributions summed up.
+
+    The spacing of the :math:`u` grid is chosen, so that the latest sample of
+    the time window is not undersampled. If the increment of ``strvec`` is
+    not a multiple of this spacing, the similarity is interpolated with a
+    cubic spline.
+
+    :type mat: :class:`~numpy.ndarray`
+    :param mat: 2d ndarray containing the correlation functions.
+        One for each row.
+    :type tw: list of :class:`~numpy.ndarray` of int
+    :param tw: list of 1D ndarrays holding the indices of samples in the time
+        windows counted from zero lag time. Only the first and the last
+        sample of each window are used. Lags of less than one sample are
+        excluded.
+    :type ref_trc: :class:`~numpy.ndarray`
+    :param ref_trc: 1D array containing the reference trace. Its zero lag
+        time has to be in the center (on the first sample for
+        ``sides='single'``). It may be longer than the rows of ``mat``.
+    :type strvec: :class:`~numpy.ndarray`
+    :param strvec: Equally spaced stretch values to be tested.
+    :type sides: str
+    :param sides: Side of the reference matrix to be used for the stretching
+        estimate ('both' | 'left' | 'right' | 'single')
+    :type return_sim_mat: bool
+    :param return_sim_mat: If `True` the returning dictionary contains also
+        the similarity matrix `sim_mat`.
+    :type remove_nans: bool
+    :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
+        given correlation matrix before any other operation.
 
-        den = np.sqrt(np.dot(f_sq.T, s_sq))
+    :rtype: Dictionary
+    :return: **dv**: Dictionary with the same keys as returned by
+        :func:`velocity_change_estimate`.
+    """
+    mat = np.atleast_2d(mat)
+    if remove_nans:
+        mat = np.nan_to_num(mat)
+    ref_trc = np.squeeze(ref_trc)
+    strvec = np.asarray(strvec)
+    nstr = len(strvec)
+    dstr = strvec[1] - strvec[0] if nstr > 1 else 1.
+
+    # time axes in samples
+    if sides == 'single':
+        t_mat = np.arange(mat.shape[1], dtype=float)
+        t_ref = np.arange(len(ref_trc), dtype=float)
+        signs = [1]
+    elif sides in ('both', 'left', 'right'):
+        t_mat = np.arange(mat.shape[1]) - (mat.shape[1] - 1.) / 2.
+        t_ref = np.arange(len(ref_trc)) - (len(ref_trc) - 1.) / 2.
+        signs = {'both': [1, -1], 'left': [-1], 'right': [1]}[sides]
+    else:
+        raise ValueError('sides = %s not a valid option.' % sides)
+    mat_spline = make_interp_spline(t_mat, mat, k=3, axis=1)
+    ref_spline = make_interp_spline(t_ref, ref_trc, k=3)
 
-        tmp = dprod / den
-        sim_mat[:, :, ii] = tmp
+    def ref_at(t: np.ndarray) -> np.ndarray:
+        # no extrapolation
+        return np.where(
+            (t >= t_ref[0]) & (t <= t_ref[-1]), ref_spline(t), 0)
 
-        tmp_corr_vect = tmp.max(axis=1)
-        corr[ii, :] = tmp_corr_vect
-        dt[ii, :] = strvec[tmp.argmax(axis=1)]
+    corr = np.zeros((len(tw), mat.shape[0]))
+    dt = np.zeros((len(tw), mat.shape[0]))
+    if return_sim_mat:
+        sim_mat = np.zeros((mat.shape[0], nstr, len(tw)))
+    for ii, ctw in enumerate(tw):
+        t0 = max(np.min(ctw), 1)
+        t1 = np.max(ctw)
+        if t1 > t_mat[-1]:
+            raise IndexError(
+                'Time window exceeds the length of the correlation '
+                f'({mat.shape[1]}).')
+        if t1 <= t0:
+            raise ValueError('Time window has to be longer than one sample.')
+        # spacing of the log lag grid
+        if dstr * t1 > 1:
+            du = dstr / np.ceil(dstr * t1)
+        else:
+            du = dstr * np.floor(1 / (dstr * t1))
+        u = np.log(t0) + np.arange(int(np.log(t1 / t0) / du) + 1) * du
+        w = np.exp(u)
+        # Number of shifts covering all stretches
+        nshift = int(np.ceil((strvec[-1] - strvec[0]) / du - 1e-9)) + 1
+        u_ref = np.log(t0) + np.arange(1 - nshift, len(u)) * du - strvec[0]
+        sim = 0
+        f_norm = 0
+        r_norm = 0
+        for sign in signs:
+            f = mat_spline(sign*w)
+            r = ref_at(sign*np.exp(u_ref))
+            # cross-correlation along the log lag axis
+            sim = sim + fftconvolve(
+                (f*w)[:, ::-1], r[None], mode='valid', axes=1)[:, ::-1]
+            r_norm = r_norm + fftconvolve(
+                w[::-1], r**2, mode='valid')[::-1]
+            f_norm = f_norm + np.sum(f**2*w, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sim /= np.sqrt(np.outer(f_norm, np.maximum(r_norm, 0)))
+        # similarity at the stretch values
+        pos = (strvec - strvec[0]) / du
+        nearest = np.round(pos).astype(int)
+        if np.allclose(pos, nearest):
+            sim = sim[:, nearest]
+        else:
+            invalid = np.isnan(sim[:, nearest])
+            sim = CubicSpline(
+                np.arange(nshift), np.nan_to_num(sim), axis=1)(pos)
+            sim[invalid] = np.nan
+        if return_sim_mat:
+            sim_mat[..., ii] = sim
+        corr[ii] = np.max(sim, axis=1)
+        dt[ii] = strvec[np.argmax(sim, axis=1)]
 
-        # Set dt to NaN where the correlation is NaN instead of having it equal
-        # to one of the two stretch_range limits
-        dt[ii, np.isnan(tmp_corr_vect)] = np.nan
+    dt[np.isnan(corr)] = np.nan
 
     dv = {'corr': np.squeeze(corr),
           'value': np.squeeze(dt),
@@ -346,7 +816,10 @@ def time_stretch_estimate(
     stretch_range: float = 0.1, stretch_steps: int = 100, sides: str = 'both',
     remove_nans: bool = True,
     ref_tr_trim: Optional[Tuple[float, float]] = None,
-        ref_tr_stats=None) -> dict:
+    ref_tr_stats=None, search: str = 'grid',
+    coarse_steps: Optional[int] = None,
+    return_sim_mat: bool = True, use_cache: bool = True,
+        threads: int = 1) -> dict:
     """ Time stretch estimate through stretch and comparison.
 
     This function estimates stretching of the time axis of traces as it can
@@ -388,6 +861,33 @@ def time_stretch_estimate(
     :type remove_nans: bool
     :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
         given correlation matrix before any other operation.
+    :type search: str
+    :param search: Search strategy for the best fitting stretch. ``'grid'``
+        compares with all ``stretch_steps`` stretched references.
+        ``'refine'`` computes a coarse search followed by a local search at
+        full resolution and a sub-grid refinement of the maximum (see
+        :func:`refined_velocity_change_estimate`). ``'fft'`` computes the
+        similarity for all stretches at once as cross-correlation in
+        logarithmic lag time (see :func:`log_stretch_estimate`).
+        Defaults to ``'grid'``.
+    :type coarse_steps: int, optional
+    :param coarse_steps: Number of stretch values in the coarse search.
+        Only used if ``search='refine'``.
+    :type return_sim_mat: bool
+    :param return_sim_mat: Return the similarity matrix. For
+        ``search='refine'``, values far from the maximum are interpolated.
+        Defaults to True.
+    :type use_cache: bool
+    :param use_cache: Take the stretched references from
+        :data:`ref_cache` if they have been computed for the same
+        reference and parameters before. Only has an effect if the cache
+        has been enabled with :meth:`StretchedReferenceCache.resize`.
+        The references at full resolution of ``search='refine'`` depend on
+        the data and are never cached. Defaults to True.
+    :type threads: int
+    :param threads: Number of threads. Each one estimates the stretch for
+        a block of rows of ``corr_data``. The result does not depend on the
+        number of threads. Defaults to 1.
 
     :rtype: Dictionary
     :return: **dv**: Dictionary with the following keys
@@ -443,10 +943,6 @@ def time_stretch_estimate(
 
     # different values of shifting to be tested
     stretches = np.linspace(-stretch_range, stretch_range, stretch_steps)
-    # dv defined as difference
-    # time_facs = 1/(1 + stretchs)
-    # dv defined as logarithmic stretch
-    time_facs = np.exp(-stretches)
 
     # time axis
     if sides != 'single':
@@ -454,30 +950,67 @@ def time_stretch_estimate(
     else:
         time_idx = np.arange(len(ref_trc))
 
-    # create the array to hold the shifted traces
-    ref_stretch = np.zeros((len(stretches), len(ref_trc)))
-
-    # create a spline object for the reference trace
-    # :NOTE: This change can give very different results and should
-    # **definitely** be discussed!
-    # 01.07.21 No extrapolation
-    # 15.11.22 set extrapolation to 0 / ext=1
-    ref_tr_spline = UnivariateSpline(time_idx, ref_trc, s=0, ext='zeros')
-
-    # evaluate the spline object at different points and put in the prepared
-    # array
-    for (k, this_fac) in enumerate(time_facs):
-        ref_stretch[k, :] = ref_tr_spline(time_idx * this_fac)
-
-    if ref_tr_trim is not None:
-        ref_stretch, _ = corr_mat_trim(
-            ref_stretch, deepcopy(ref_tr_stats), ref_tr_trim[0],
-            ref_tr_trim[1])
+    def stretch_ref(stretches: np.ndarray) -> np.ndarray:
+        if not use_cache:
+            return compute_stretch_ref(stretches)
+        key = ref_cache.key(
+            ref_trc, stretches, sides == 'single', ref_tr_trim,
+            None if ref_tr_trim is None else (
+                ref_tr_stats['start_lag'], ref_tr_stats['sampling_rate'],
+                ref_tr_stats['npts']))
+        return ref_cache.get(key, lambda: compute_stretch_ref(stretches))
+
+    def compute_stretch_ref(stretches: np.ndarray) -> np.ndarray:
+        # create a spline object for the reference trace
+        # :NOTE: This change can give very different results and should
+        # **definitely** be discussed!
+        # 01.07.21 No extrapolation
+        # 15.11.22 set extrapolation to 0 / ext=1
+        ref_tr_spline = UnivariateSpline(
+            time_idx, ref_trc, s=0, ext='zeros')
+        # create the array to hold the shifted traces
+        ref_stretch = np.zeros((len(stretches), len(ref_trc)))
+        # dv defined as difference
+        # time_facs = 1/(1 + stretchs)
+        # dv defined as logarithmic stretch
+        time_facs = np.exp(-stretches)
+        # evaluate the spline object at different points and put in the
+        # prepared array
+        for (k, this_fac) in enumerate(time_facs):
+            ref_stretch[k, :] = ref_tr_spline(time_idx * this_fac)
+        if ref_tr_trim is not None:
+            ref_stretch, _ = corr_mat_trim(
+                ref_stretch, deepcopy(ref_tr_stats), ref_tr_trim[0],
+                ref_tr_trim[1])
+        return ref_stretch
 
     # search best fit of the crosscorrs to one of the stretched ref_traces
-    dv = velocity_change_estimate(
-        mat, tw, ref_stretch, stretches, sides=sides, return_sim_mat=True,
-        remove_nans=remove_nans)
+    if search == 'grid':
+        ref_stretch = stretch_ref(stretches)
+
+        def estimate(rows: slice) -> dict:
+            return velocity_change_estimate(
+                mat[rows], tw, ref_stretch, stretches, sides=sides,
+                return_sim_mat=return_sim_mat, remove_nans=remove_nans)
+    elif search == 'refine':
+        def estimate(rows: slice) -> dict:
+            return refined_velocity_change_estimate(
+                mat[rows], tw, stretch_ref, stretches,
+                coarse_steps=coarse_steps, sides=sides,
+                return_sim_mat=return_sim_mat, remove_nans=remove_nans,
+                fine_ref=compute_stretch_ref)
+    elif search == 'fft':
+        def estimate(rows: slice) -> dict:
+            return log_stretch_estimate(
+                mat[rows], tw, ref_trc, stretches, sides=sides,
+                return_sim_mat=return_sim_mat, remove_nans=remove_nans)
+    else:
+        raise ValueError(
+            f'Unknown search {search}. Use \'grid\', \'refine\', or '
+            '\'fft\'.')
+    dv = _concatenate_dvs(
+        _map_row_blocks(estimate, mat.shape[0], threads), len(tw),
+        len(stretches))
 
     # TODO: It is not really clear why it it necessary to transpose here so
     # this is the fist point where to look in case of errors.
@@ -488,12 +1021,233 @@ def time_stretch_estimate(
     return dv
 
 
+def _mwcs_windows(
+    npts: int, delta: float, start_lag: float,
+    tw: Optional[Tuple[float, float]], win_len: float, step: float,
+        sides: str) -> np.ndarray:
+    """
+    Index of the first sample of each moving window for
+    :func:`mwcs_estimate`. Windows on the left side are mirrored about zero
+    lag time.
+    """
+    if sides not in ['both', 'left', 'right', 'single']:
+        raise ValueError(
+            "sides has to be one of 'both', 'left', 'right', or 'single'.")
+    wl = int(round(win_len/delta))
+    nstep = int(round(step/delta))
+    if wl < 4 or nstep < 1:
+        raise ValueError(
+            'win_len has to span at least 4 samples and step at least one.')
+    if tw is None:
+        tw = (0, max(-start_lag, start_lag + (npts - 1)*delta))
+    if tw[0] < 0 or tw[1] <= tw[0]:
+        raise ValueError(
+            'tw must hold start and end of the lapse time window with '
+            '0 <= start < end.')
+    # sample of zero lag time
+    zero = -start_lag/delta
+    right = np.arange(
+        int(np.ceil(zero + tw[0]/delta - 1e-6)),
+        int(np.floor(zero + tw[1]/delta + 1e-6)) - wl + 2, nstep)
+    starts = []
+    if sides != 'left':
+        starts.append(right)
+    if sides in ['both', 'left']:
+        starts.append(np.round(2*zero - right - wl + 1).astype(int))
+    starts = np.hstack(starts)
+    starts = np.unique(starts[(starts >= 0) & (starts <= npts - wl)])
+    if not len(starts):
+        raise ValueError(
+            'No moving window fits into the lapse time window. Choose a '
+            'shorter win_len or a longer tw.')
+    return starts
+
+
+def _mwcs_spectra(
+    data: np.ndarray, starts: np.ndarray, wl: int, nfft: int,
+        taper: np.ndarray) -> np.ndarray:
+    """
+    Spectra of the demeaned and tapered moving windows of each row of
+    ``data``. Returns an array of shape (nrows, nwindows, nfft//2 + 1).
+    """
+    seg = data[:, starts[:, None] + np.arange(wl)]
+    seg = seg - seg.mean(axis=-1, keepdims=True)
+    return rfft(seg*taper, n=nfft, axis=-1)
+
+
+def _smooth_spectrum(x: np.ndarray, half_win: int) -> np.ndarray:
+    """
+    Moving average of a (complex) spectrum along the frequency axis.
+    """
+    if half_win < 1:
+        return x
+    size = 2*half_win + 1
+    if np.iscomplexobj(x):
+        return uniform_filter1d(x.real, size, axis=-1, mode='nearest') \
+            + 1j*uniform_filter1d(x.imag, size, axis=-1, mode='nearest')
+    return uniform_filter1d(x, size, axis=-1, mode='nearest')
+
+
+def mwcs_estimate(
+    mat: np.ndarray, ref_trc: np.ndarray, delta: float, start_lag: float,
+    freq_min: float, freq_max: float, win_len: float, step: float,
+    tw: Optional[Tuple[float, float]] = None, sides: str = 'both',
+    smooth_half_win: int = 5, min_coh: float = 0.65, max_err: float = 0.1,
+        max_dt: float = 0.1, threads: int = 1) -> dict:
+    """
+    Velocity change estimate with the Moving-Window Cross-Spectral method
+    (**MWCS**, see Clarke et al., 2011).
+
+    The lapse time window is split into overlapping moving windows. In each
+    of them, the time delay between the rows of ``mat`` and the reference
+    trace is estimated from the phase of the smoothed cross-spectrum, using
+    a weighted linear regression through the origin in the frequency band
+    [``freq_min``, ``freq_max``]. The weights depend on the coherence. The
+    relative time delay dt/t is then obtained from a weighted linear
+    regression of the delays against the lag times of the window centres.
+    Windows with a low coherence, a large error, or a large delay are
+    excluded from this regression.
+
+    In contrast to the stretching, no grid of stretched references is
+    tested. The spectra of all windows and rows are computed with one
+    batched FFT, so that the cost only grows with the number of windows.
+
+    :param mat: 2D correlation matrix. One correlation function per row.
+    :type mat: np.ndarray
+    :param ref_trc: Reference trace with the same number of samples.
+    :type ref_trc: np.ndarray
+    :param delta: Sampling interval in s
+    :type delta: float
+    :param start_lag: Lag time of the first sample in s
+    :type start_lag: float
+    :param freq_min: Lower corner of the frequency band in Hz
+    :type freq_min: float
+    :param freq_max: Upper corner of the frequency band in Hz
+    :type freq_max: float
+    :param win_len: Length of the moving windows in s
+    :type win_len: float
+    :param step: Step between two moving windows in s
+    :type step: float
+    :param tw: Start and end of the lapse time window in s (absolute lag
+        time). Defaults to None (all lag times).
+    :type tw: Tuple[float, float], optional
+    :param sides: Which sides to use. Can be 'left', 'right' (or 'single'),
+        or 'both'. For 'both', the lapse time window is mirrored about zero
+        lag time. Defaults to 'both'.
+    :type sides: str, optional
+    :param smooth_half_win: Half width of the moving average applied to the
+        spectra in frequency bins. Defaults to 5.
+    :type smooth_half_win: int, optional
+    :param min_coh: Minimum mean coherence of a window to be used for the
+        dt/t regression. Defaults to 0.65.
+    :type min_coh: float, optional
+    :param max_err: Maximum error of the delay of a window in s to be used
+        for the dt/t regression. Defaults to 0.1.
+    :type max_err: float, optional
+    :param max_dt: Maximum absolute delay of a window in s to be used for
+        the dt/t regression. Defaults to 0.1.
+    :type max_dt: float, optional
+    :param threads: Number of threads. Each one processes a block of rows
+        of ``mat``. Defaults to 1.
+    :type threads: int, optional
+    :raises ValueError: For invalid windows or a frequency band that
+        contains less than two frequencies.
+    :return: **dv**: Dictionary with the following keys
+
+        *corr*: 1d ndarray holding the mean coherence of the used windows.
+        *value*: 1d ndarray holding dt/t. Like the stretch, it corresponds
+            to the negative relative velocity change -dv/v.
+        *value_err*: 1d ndarray with the standard error of dt/t.
+        *dt*: 2d ndarray with the delay of each row and window in s.
+            Its dimension is: :func:(mat.shape[0],len(second_axis))
+        *dt_err*: 2d ndarray with the error of each delay in s.
+        *coh*: 2d ndarray with the mean coherence of each row and window.
+        *second_axis*: Lag times of the window centres in s.
+        *sim_mat*: Empty array. MWCS does not compute a similarity matrix.
+        *value_type*: It is equal to 'stretch'.
+        *method*: It is equal to 'mwcs'.
+    :rtype: dict
+    """
+    mat = np.atleast_2d(mat)
+    ref_trc = np.asarray(ref_trc)
+    if ref_trc.shape != mat.shape[1:]:
+        raise ValueError(
+            'ref_trc must be a single trace with as many samples as the '
+            f'rows of mat. Shapes are {ref_trc.shape} and {mat.shape}.')
+    starts = _mwcs_windows(
+        mat.shape[1], delta, start_lag, tw, win_len, step, sides)
+    wl = int(round(win_len/delta))
+    nfft = next_fast_len(2*wl)
+    freqs = rfftfreq(nfft, delta)
+    band = (freqs >= freq_min) & (freqs <= freq_max)
+    if band.sum() < 2:
+        raise ValueError(
+            'The frequency band has to contain at least two frequencies. '
+            'Choose a wider band or a longer win_len.')
+    taper = np.hanning(wl)
+    centres = start_lag + (starts + (wl - 1)/2)*delta
+    omega = 2*np.pi*freqs[band]
+
+    ref_spec = _mwcs_spectra(ref_trc[None], starts, wl, nfft, taper)
+    ref_pow = _smooth_spectrum(np.abs(ref_spec)**2, smooth_half_win)
+
+    def estimate(rows: slice) -> Tuple[np.ndarray, ...]:
+        spec = _mwcs_spectra(mat[rows], starts, wl, nfft, taper)
+        # A delay of the row produces a phase of omega*dt
+        cross = _smooth_spectrum(ref_spec*spec.conj(), smooth_half_win)
+        cur_pow = _smooth_spectrum(np.abs(spec)**2, smooth_half_win)
+        cross = cross[..., band]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            coh = np.clip(np.abs(cross)/np.sqrt(
+                ref_pow[..., band]*cur_pow[..., band]), 0, 1)
+            # weights of the phase regression
+            cc = np.minimum(coh, .99)**2
+            w = np.sqrt(cc/(1 - cc)*np.sqrt(np.abs(cross)))
+            phi = np.unwrap(np.angle(cross), axis=-1)
+            sx2 = np.sum(w*omega**2, axis=-1)
+            dt = np.sum(w*omega*phi, axis=-1)/sx2
+            res = np.sum((phi - dt[..., None]*omega)**2, axis=-1)/(
+                len(omega) - 1)
+            dt_err = np.sqrt(res*np.sum(w**2*omega**2, axis=-1))/sx2
+        return dt, dt_err, coh.mean(axis=-1)
+
+    dt, dt_err, coh = (
+        np.concatenate(x) for x in zip(*_map_row_blocks(
+            estimate, mat.shape[0], threads)))
+
+    # weighted regression of the delays through the origin
+    with np.errstate(invalid='ignore', divide='ignore'):
+        use = (coh >= min_coh) & (dt_err <= max_err) & (np.abs(dt) <= max_dt)
+        w = np.where(use, 1/np.maximum(dt_err, 1e-12)**2, 0)
+        stt = np.sum(w*centres**2, axis=1)
+        value = np.sum(w*centres*np.where(use, dt, 0), axis=1)/stt
+        value_err = 1/np.sqrt(stt)
+        corr = np.sum(np.where(use, coh, 0), axis=1)/use.sum(axis=1)
+    nouse = use.sum(axis=1) < 2
+    for x in [value, value_err, corr]:
+        x[nouse] = np.nan
+
+    return {
+        'corr': corr,
+        'value': value,
+        'value_err': value_err,
+        'dt': dt,
+        'dt_err': dt_err,
+        'coh': coh,
+        'second_axis': centres,
+        'sim_mat': np.array([]),
+        'value_type': 'stretch',
+        'method': 'mwcs'}
+
+
 def multi_ref_vchange(
     corr_data: np.ndarray, ref_trs: np.ndarray, tw: np.ndarray = None,
     stretch_range: float = 0.1, stretch_steps: int = 100, sides: str = 'both',
     remove_nans: bool = True,
     ref_tr_trim: Optional[Tuple[float, float]] = None,
-        ref_tr_stats=None) -> dict:
+    ref_tr_stats=None, search: str = 'grid',
+    coarse_steps: Optional[int] = None,
+        return_sim_mat: bool = True, threads: int = 1) -> dict:
     """ Velocity change estimate with single or multiple reference traces.
 
     This function estimates the velocity change corresponding to each row of
@@ -543,6 +1297,17 @@ def multi_ref_vchange(
     :type remove_nans: bool
     :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
         given correlation matrix before any other operation.
+    :type search: str
+    :param search: Search strategy ``'grid'``, ``'refine'``, or ``'fft'``,
+        see :func:`time_stretch_estimate`.
+    :type coarse_steps: int, optional
+    :param coarse_steps: Number of stretch values in the coarse search.
+        Only used if ``search='refine'``.
+    :type return_sim_mat: bool
+    :param return_sim_mat: Return the similarity matrices. They are always
+        computed if several reference traces are given.
+    :type threads: int
+    :param threads: Number of threads, see :func:`time_stretch_estimate`.
 
     :rtype: dictionary
     :return: **multi_ref_panel**: It is a dictionary that contains as much
@@ -567,6 +1332,9 @@ def multi_ref_vchange(
     except ValueError:  # An array is passed
         reftr_count = 1
 
+    # The alignment of several references requires the similarity matrices
+    return_sim_mat = return_sim_mat or reftr_count > 1
+
     # Dictionary that will hold all the results
     multi_ref_panel = {}
 
@@ -576,7 +1344,9 @@ def multi_ref_vchange(
         value = time_stretch_estimate(
             corr_data, ref_trc=ref_trs, tw=tw, stretch_range=stretch_range,
             stretch_steps=stretch_steps, sides=sides, remove_nans=remove_nans,
-            ref_tr_trim=ref_tr_trim, ref_tr_stats=ref_tr_stats)
+            ref_tr_trim=ref_tr_trim, ref_tr_stats=ref_tr_stats,
+            search=search, coarse_steps=coarse_steps,
+            return_sim_mat=return_sim_mat, threads=threads)
         multi_ref_panel.update({key: value})
     else:  # For multiple-traces loops
         for i in range(reftr_count):
@@ -586,7 +1356,9 @@ def multi_ref_vchange(
                 corr_data, ref_trc=ref_trc, tw=tw, stretch_range=stretch_range,
                 stretch_steps=stretch_steps, sides=sides,
                 remove_nans=remove_nans,
-                ref_tr_trim=ref_tr_trim, ref_tr_stats=ref_tr_stats)
+                ref_tr_trim=ref_tr_trim, ref_tr_stats=ref_tr_stats,
+                search=search, coarse_steps=coarse_steps,
+                return_sim_mat=return_sim_mat, threads=threads)
             multi_ref_panel.update({key: value})
     return multi_ref_panel
 
@@ -862,7 +1634,8 @@ def multi_ref_vchange_and_align(
     sides: str = 'both', return_sim_mat: bool = False,
     remove_nans: bool = True,
     ref_tr_trim: Optional[Tuple[float, float]] = None,
-        ref_tr_stats=None) -> dict:
+    ref_tr_stats=None, search: str = 'grid',
+        coarse_steps: Optional[int] = None, threads: int = 1) -> dict:
     """ Multi-reference dv estimate and alignment
 
     :type corr_data: :class:`~numpy.ndarray`
@@ -898,6 +1671,14 @@ def multi_ref_vchange_and_align(
     :type remove_nans: bool
     :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
         given correlation matrix before any other operation.
+    :type search: str
+    :param search: Search strategy ``'grid'``, ``'refine'``, or ``'fft'``,
+        see :func:`time_stretch_estimate`.
+    :type coarse_steps: int, optional
+    :param coarse_steps: Number of stretch values in the coarse search.
+        Only used if ``search='refine'``.
+    :type threads: int
+    :param threads: Number of threads, see :func:`time_stretch_estimate`.
 
     :rtype: Dictionary
     :return: **dv**: Dictionary with the following keys
@@ -938,7 +1719,9 @@ def multi_ref_vchange_and_align(
     multi_ref_panel = multi_ref_vchange(
         corr_data, ref_trs, tw=tw, stretch_range=stretch_range,
         stretch_steps=stretch_steps, sides=sides, remove_nans=remove_nans,
-        ref_tr_trim=ref_tr_trim, ref_tr_stats=ref_tr_stats)
+        ref_tr_trim=ref_tr_trim, ref_tr_stats=ref_tr_stats, search=search,
+        coarse_steps=coarse_steps, return_sim_mat=return_sim_mat,
+        threads=threads)
 
     n_ref = len(list(multi_ref_panel.keys()))
 
@@ -956,7 +1739,8 @@ def time_shift_estimate(
     corr_data: np.ndarray, ref_trc: np.ndarray = None,
     tw: List[np.ndarray] = None, shift_range: float = 10,
     shift_steps: int = 100, single_sided: bool = False,
-        return_sim_mat: bool = True, remove_nans: bool = True) -> dict:
+    return_sim_mat: bool = True, remove_nans: bool = True,
+        method: str = 'shifted_ref') -> dict:
     """ Time shift estimate through shifting and comparison.
 
     This function is intended to estimate shift of traces as they can occur
@@ -999,6 +1783,13 @@ def time_shift_estimate(
     :type remove_nans: bool
     :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
         given correlation matrix before any other operation.
+    :type method: str
+    :param method: ``'shifted_ref'`` compares with ``shift_steps`` shifted
+        copies of the reference and returns the best shift on this grid.
+        ``'fft'`` cross-correlates with the reference in the frequency
+        domain and refines the maximum to below the sampling interval
+        (see :func:`fft_shift_estimate`). The latter is considerably faster
+        for fine shift grids. Defaults to ``'shifted_ref'``.
 
     :rtype: Dictionary
     :return: **dt**: Dictionary with the following keys
@@ -1056,6 +1847,21 @@ def time_shift_estimate(
     # different values of shifting to be tested
     shifts = np.linspace(-shift_range, shift_range, shift_steps)
 
+    if method == 'fft':
+        # The shifted references below are ref(t - shift)
+        dt = fft_shift_estimate(
+            mat, ref_trc, tw, -shifts,
+            sides='single' if single_sided else 'both',
+            return_sim_mat=return_sim_mat, remove_nans=remove_nans)
+        dt.update({
+            'value': -dt['value'],
+            'second_axis': shifts,
+            'value_type': np.array(['shift']),
+            'method': np.array(['time_shift'])})
+        return dt
+    elif method != 'shifted_ref':
+        raise ValueError(f'Unknown method {method}.')
+
     # time axis
     if single_sided:
         time_idx = np.arange(len(ref_trc)) - (len(ref_trc) - 1.) / 2.
@@ -1103,12 +1909,102 @@ def time_shift_estimate(
     return dt
 
 
+def _not_a_knot_band(npts: int) -> np.ndarray:
+    """
+    Banded matrix (as used by :func:`scipy.linalg.solve_banded` with
+    ``(2, 2)``) of the equations for the second derivatives of a cubic
+    not-a-knot spline through ``npts`` samples with unit spacing.
+    """
+    ab = np.zeros((5, npts))
+    ab[2] = 4
+    ab[1, 1:] = 1
+    ab[3, :-1] = 1
+    # continuous third derivative at the second and second to last sample
+    ab[2, 0] = ab[2, -1] = 1
+    ab[1, 1] = ab[3, -2] = -2
+    ab[0, 2] = ab[4, -3] = 1
+    return ab
+
+
+def _interpolate_rows(
+    mat: np.ndarray, pos: np.ndarray, kind: str = 'cubic',
+        fill_value: Optional[float] = None,
+        chunk_rows: int = 32) -> np.ndarray:
+    """
+    Interpolates all rows of a matrix at once. The rows are processed in
+    chunks that fit into the cache.
+
+    :param mat: 2D matrix with one trace per row
+    :type mat: np.ndarray
+    :param pos: Positions in samples to evaluate each row at. Has to be
+        broadcastable to ``(mat.shape[0], n)``.
+    :type pos: np.ndarray
+    :param kind: ``'linear'`` or ``'cubic'``. The cubic interpolant is the
+        not-a-knot spline, i.e., the same as
+        :class:`~scipy.interpolate.UnivariateSpline` with ``s=0``.
+        Defaults to ``'cubic'``.
+    :type kind: str, optional
+    :param fill_value: Value for positions outside of the trace. If None,
+        the first and last interval are extrapolated. Defaults to None.
+    :type fill_value: float, optional
+    :param chunk_rows: Number of rows to interpolate at once, defaults to 32
+    :type chunk_rows: int, optional
+    :raises ValueError: For an unknown ``kind`` or too short traces
+    :return: The interpolated matrix with shape ``(mat.shape[0], n)``.
+        float32 if ``mat`` is float32, otherwise float64. For
+        ``kind='cubic'``, rows that contain nans are nan.
+    :rtype: np.ndarray
+    """
+    mat = np.atleast_2d(mat)
+    nrows, npts = mat.shape
+    if kind not in ['linear', 'cubic']:
+        raise ValueError(f'Unknown kind of interpolation {kind}.')
+    if npts < 2 or (kind == 'cubic' and npts < 4):
+        raise ValueError('Traces are too short for the interpolation.')
+    dtype = np.float32 if mat.dtype == np.float32 else np.float64
+    pos = np.broadcast_to(pos, (nrows, np.shape(pos)[-1]))
+    out = np.empty(pos.shape, dtype=dtype)
+    if kind == 'cubic':
+        ab = _not_a_knot_band(npts)
+    for start in range(0, nrows, chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        y = np.array(mat[rows], dtype=np.float64)
+        p = np.array(pos[rows], dtype=np.float64)
+        outside = (p < -1e-9) | (p > npts - 1 + 1e-9)
+        if fill_value is not None:
+            np.clip(p, 0, npts - 1, out=p)
+        ind = np.clip(np.floor(p).astype(np.intp), 0, npts - 2)
+        t = p - ind
+        u = 1 - t
+        ind += np.arange(y.shape[0])[:, None]*npts
+        y0 = np.take(y, ind)
+        y1 = np.take(y, ind + 1)
+        res = u*y0 + t*y1
+        if kind == 'cubic':
+            nans = ~np.all(np.isfinite(y), axis=1)
+            y[nans] = 0
+            # second derivatives
+            rhs = np.zeros((npts, y.shape[0]))
+            rhs[1:-1] = 6*np.diff(y, 2, axis=1).T
+            m = np.ascontiguousarray(solve_banded(
+                (2, 2), ab, rhs, overwrite_b=True, check_finite=False).T)
+            res += ((u*u*u - u)*np.take(m, ind)
+                    + (t*t*t - t)*np.take(m, ind + 1))/6
+            res[nans] = np.nan
+        if fill_value is not None:
+            res[outside] = fill_value
+        out[rows] = res
+    return out
+
+
 def time_shift_apply(
     corr_data: np.ndarray, shift: np.ndarray,
         single_sided: bool = False) -> np.ndarray:
     """
     Correct for clock drifts that are given in shifts.
 
+    All traces are linearly interpolated at once.
+
     :param corr_data: Matrix with one correlation trace per row
     :type corr_data: np.ndarray
     :param shift: 1 or 2D array holding shifts in number of samples compared to
@@ -1139,22 +2035,11 @@ def time_shift_apply(
     if shift.shape[1] > 1 and shift.shape[1] != mat.shape[1]:
         raise ValueError('shift.shape[1] must be equal corr_data.shape[1]')
 
-    # time axis
-    if single_sided:
-        time_idx = np.arange(mat.shape[1])
-    else:
-        time_idx = np.arange(mat.shape[1]) - (mat.shape[1] - 1.) / 2.
-
-    # allocate space for the result
-    shifted_mat = np.zeros_like(mat)
-
-    # stretch every line
-    for ii, (ctr, delta) in enumerate(zip(mat, shift)):
-        s = interp1d(
-            time_idx, ctr, kind='linear', bounds_error=False, fill_value=0)
-        shifted_mat[ii, :] = s(time_idx - delta)
-
-    return shifted_mat
+    # The time axis does not matter for a shift. The sample positions are
+    # the same for single and double sided correlations.
+    pos = np.arange(mat.shape[1]) - shift
+    shifted_mat = _interpolate_rows(mat, pos, kind='linear', fill_value=0)
+    return shifted_mat.astype(mat.dtype, copy=False)
 
 
 def time_stretch_apply(
@@ -1169,6 +2054,8 @@ def time_stretch_apply(
     estimated with :func:`~seismic.monitor.stretch_mod.time_stretch_estimate`
     you need to apply negative stretching.
 
+    All traces are interpolated at once with cubic splines.
+
     :type corr_data: :class:`~numpy.ndarray`
     :param corr_data: 2d ndarray containing the correlation functions that are
         to be shifted.
@@ -1204,20 +2091,14 @@ def time_stretch_apply(
 
     # time axis
     if single_sided:
-        time_idx = np.arange(mat.shape[1])
+        center = 0
     else:
-        time_idx = np.arange(mat.shape[1]) - (mat.shape[1] - 1.) / 2.
-
-    # allocate space for the result
-    stretched_mat = np.zeros_like(mat)
+        center = (mat.shape[1] - 1.) / 2.
+    time_idx = np.arange(mat.shape[1]) - center
 
-    # stretch every line
-    for (ii, line) in enumerate(mat):
-        s = UnivariateSpline(time_idx, line, s=0)
-        stretched_mat[ii, :] = s(time_idx * (1 + stretch[ii]))
-        stretched_mat[ii, :] = s(time_idx * np.exp(stretch[ii]))
-
-    return stretched_mat
+    stretched_mat = _interpolate_rows(
+        mat, time_idx * np.exp(stretch) + center)
+    return stretched_mat.astype(mat.dtype, copy=False)
 
 
 def create_shifted_ref_mat(
@@ -1268,3 +2149,165 @@ def compare_with_modified_reference(
     sim_mat = dprod / den
 
     return sim_mat
+
+
+def _shift_similarity(
+    mat: np.ndarray, ref_trc: np.ndarray, ctws: np.ndarray,
+    nmask: np.ndarray, max_lag: int, remove_nans: bool = True,
+        chunk_rows: int = 256) -> np.ndarray:
+    """
+    Correlation coefficient between the time windows of each row of ``mat``
+    and the reference trace shifted by all integer lags from ``-max_lag`` to
+    ``max_lag``, i.e., with ``ref_trc[indices + lag]``. The lags are
+    evaluated at once by cross-correlation in the frequency domain.
+    Samples of the reference outside of the trace are zero.
+
+    :return: Similarity with shape ``(len(ctws), mat.shape[0], 2*max_lag+1)``
+    :rtype: np.ndarray
+    """
+    mat = np.atleast_2d(mat)
+    ref_trc = np.squeeze(ref_trc).astype(np.float64)
+    nrows, npts = mat.shape
+    nlags = 2*max_lag + 1
+    sim = np.empty((len(ctws), nrows, nlags))
+    for ii, (ind, m) in enumerate(zip(ctws, nmask)):
+        ind = ind[m.astype(bool)]
+        lo = ind.min()
+        width = ind.max() + 1 - lo
+        nfft = next_fast_len(width + 2*max_lag, real=True)
+        mask = np.zeros(width, dtype=bool)
+        mask[ind - lo] = True
+        # reference segment from lo - max_lag to hi + max_lag
+        ref = np.zeros(width + 2*max_lag)
+        start = lo - max_lag
+        ref[max(0, -start):min(len(ref), npts - start)] = ref_trc[
+            max(0, start):min(npts, start + len(ref))]
+        ref_f = rfft(ref, nfft)
+        # energy of the shifted reference inside of the window
+        s_norm = np.sqrt(np.maximum(irfft(
+            np.conj(rfft(mask.astype(float), nfft))*rfft(ref**2, nfft),
+            nfft)[:nlags], 0))
+        for jj in range(0, nrows, chunk_rows):
+            first = np.where(mask, mat[jj:jj + chunk_rows, lo:lo + width], 0.)
+            if remove_nans:
+                first = np.nan_to_num(first)
+            nans = np.isnan(first).any(axis=1)
+            first[nans] = 0
+            f_norm = np.sqrt(np.sum(first**2, axis=1))
+            dprod = irfft(
+                np.conj(rfft(first, nfft, axis=1))*ref_f, nfft,
+                axis=1)[:, :nlags]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                dprod /= f_norm[:, None]*s_norm[None, :]
+            dprod[nans] = np.nan
+            sim[ii, jj:jj + chunk_rows] = dprod
+    return sim
+
+
+def _shift_peak(
+    sim: np.ndarray, max_lag: int, smin: float, smax: float) -> Tuple[
+        np.ndarray, np.ndarray]:
+    """
+    Picks the maximum of the similarity from :func:`_shift_similarity` in
+    the lag range from ``smin`` to ``smax`` and refines it to below one
+    sample by fitting a parabola through the maximum and its neighbours.
+
+    :return: The correlation at the maximum and the lag of the maximum in
+        samples.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    lags = np.arange(-max_lag, max_lag + 1)
+    valid = (lags >= np.ceil(smin - 1e-9)) & (lags <= np.floor(smax + 1e-9))
+    if not valid.any():
+        valid = lags == np.round((smin + smax)/2)
+    search = np.where(valid, np.nan_to_num(sim, nan=-np.inf), -np.inf)
+    jmax = np.argmax(search, axis=-1)[..., None]
+    y1 = np.take_along_axis(sim, jmax, axis=-1)[..., 0]
+    y0 = np.take_along_axis(sim, np.maximum(jmax - 1, 0), axis=-1)[..., 0]
+    y2 = np.take_along_axis(
+        sim, np.minimum(jmax + 1, len(lags) - 1), axis=-1)[..., 0]
+    denom = y0 - 2*y1 + y2
+    inner = (jmax[..., 0] > 0) & (jmax[..., 0] < len(lags) - 1) & (
+        denom < 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(inner, .5*(y0 - y2)/denom, 0)
+    delta = np.clip(np.nan_to_num(delta), -.5, .5)
+    corr = y1 - .25*(y0 - y2)*delta
+    value = np.clip(lags[jmax[..., 0]] + delta, smin, smax)
+    value[np.isnan(corr)] = np.nan
+    return corr, value
+
+
+def fft_shift_estimate(
+    mat: np.ndarray, ref_trc: np.ndarray, tw: List[np.ndarray],
+    shifts: np.ndarray, sides: str = 'both', return_sim_mat: bool = False,
+        remove_nans: bool = True, average_tw: bool = False) -> dict:
+    """ Time shift estimate through cross-correlation with the reference.
+
+    Instead of comparing each row of ``mat`` with a matrix of shifted
+    references (see :func:`compare_with_modified_reference`), the time
+    windows of each row are cross-correlated with the reference in the
+    frequency domain. This yields the correlation coefficient for all
+    integer sample lags at once. The best shift is refined to below one
+    sample by fitting a parabola through the maximum and its neighbours.
+
+    :type mat: :class:`~numpy.ndarray`
+    :param mat: 2d ndarray containing the correlation functions.
+        One for each row.
+    :type ref_trc: :class:`~numpy.ndarray`
+    :param ref_trc: 1D reference trace with the same length as the rows of
+        ``mat``.
+    :type tw: list of :class:`~numpy.ndarray` of int
+    :param tw: Time windows in samples as for
+        :func:`velocity_change_estimate`.
+    :type shifts: :class:`~numpy.ndarray`
+    :param shifts: Shifts in samples to return the similarity matrix for.
+        The estimated shift is limited to the range of ``shifts``. A shift
+        ``s`` compares ``mat[:, indices]`` with ``ref_trc[indices + s]``.
+    :type sides: str
+    :param sides: Side of the traces to be used ('both' | 'left' | 'right' |
+        'single')
+    :type return_sim_mat: bool
+    :param return_sim_mat: Return the similarity matrix sampled at
+        ``shifts``. The similarity between the integer lags is interpolated
+        with a cubic spline.
+    :type remove_nans: bool
+    :param remove_nans: If `True` applay :func:`~numpy.nan_to_num` to the
+        given correlation matrix. Otherwise, rows with nans inside of a time
+        window result in nan.
+    :type average_tw: bool
+    :param average_tw: Average the similarity of all time windows before
+        picking the maximum, so that only one shift per row is returned.
+
+    :rtype: Dictionary
+    :return: **dt**: Dictionary with the same keys as returned by
+        :func:`velocity_change_estimate`. *value* holds the shift in samples.
+    """
+    mat = np.atleast_2d(mat)
+    if len(np.squeeze(ref_trc)) != mat.shape[1]:
+        raise ValueError(
+            'ref_trc and mat must have the same number of samples. '
+            f'mat has shape {mat.shape} and ref_trc has length '
+            f'{len(np.squeeze(ref_trc))}.')
+    shifts = np.asarray(shifts, dtype=float)
+    ctws, nmask = _gather_tw_indices(tw, mat.shape[1], sides)
+    # One lag more to both sides for the parabola and the spline
+    max_lag = int(np.ceil(np.abs(shifts).max())) + 1
+    sim = _shift_similarity(mat, ref_trc, ctws, nmask, max_lag, remove_nans)
+    if average_tw:
+        sim = np.nanmean(sim, axis=0, keepdims=True)
+    corr, dt = _shift_peak(sim, max_lag, shifts.min(), shifts.max())
+
+    dv = {'corr': np.squeeze(corr),
+          'value': np.squeeze(dt),
+          'second_axis': shifts,
+          'value_type': 'shift',
+          'method': 'time_shift'}
+
+    if return_sim_mat:
+        ntw, nrows, nlags = sim.shape
+        sim_mat = _interpolate_rows(
+            sim.reshape(-1, nlags), shifts + max_lag).reshape(ntw, nrows, -1)
+        dv.update({'sim_mat': np.squeeze(sim_mat.transpose(1, 2, 0))})
+
+    return dv
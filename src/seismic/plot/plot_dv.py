@@ -22,6 +22,7 @@ from matplotlib import dates as mdates
 import numpy as np
 from obspy import UTCDateTime
 
+from seismic.correlate.stats import TimeArray
 from seismic.plot.plot_utils import set_mpl_params
 
 
@@ -38,7 +39,7 @@ def plot_fancy_dv(
         fig = ax.get_figure()
 
     val = -dv.value[~np.isnan(dv.corr)]*100
-    corr_starts = np.array(dv.stats.corr_start)
+    corr_starts = TimeArray(dv.stats.corr_start)
     t_real = [t.datetime for t in corr_starts[~np.isnan(dv.corr)]]
 
     ax = ax or plt.gca()
@@ -181,6 +182,14 @@ def plot_technical_dv(
         dv_tick_delta = round(stretch_vect.max()/5, oom)
         dv_y_label = "dv/v"
         # plotting velocity requires to flip the stretching axis
+    elif (value_type == 'stretch') and (method == 'mwcs'):
+
+        # The second axis holds the lag times of the moving windows
+        tit = "MWCS dv/v"
+        stretching_amount = np.nanmax(np.abs(dt))
+        oom = -int(np.floor(np.log10(stretching_amount/5)))
+        dv_tick_delta = round(stretching_amount/5, oom)
+        dv_y_label = "dv/v"
     elif (value_type == 'shift') and (method == 'time_shift'):
 
         tit = "Time shift"
@@ -254,7 +263,7 @@ def plot_technical_dv(
     ax2 = f.add_subplot(gs[1])
     if plot_scatter:
         # reshape so we can plot a histogram
-        histt = np.array([t.timestamp for t in stats['corr_start']])
+        histt = TimeArray(stats['corr_start']).timestamps
         histt = np.tile(histt, dv.stretches.shape[0])
         histcorrs = np.reshape(dv.corrs, -1)
         histstretches = np.reshape(-dv.stretches, -1)
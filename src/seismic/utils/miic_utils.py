@@ -20,6 +20,7 @@ from obspy import Inventory, Stream, Trace, UTCDateTime
 from obspy.core import Stats, AttribDict
 
 from seismic.correlate.preprocessing_stream import cos_taper_st
+from seismic.correlate.stats import TimeArray
 
 
 log_lvl = {
@@ -245,7 +246,9 @@ no_stats = [
     'data', 'tw_len', 'tw_start', 'freq_min', 'freq_max', 'aligned', 'subdir',
     'plot_vel_change', 'start_date', 'end_date', 'win_len', 'date_inc',
     'sides', 'compute_tt', 'rayleigh_wave_velocity', 'stretch_range',
-    'stretch_steps', 'dt_ref', 'preprocessing', 'postprocessing']
+    'stretch_steps', 'dt_ref', 'preprocessing', 'postprocessing',
+    'stretch_search', 'coarse_steps', 'stretch_cache_mb', 'incremental',
+    'skip_unchanged', 'memmap_dir', 'threads']
 
 
 def save_header_to_np_array(stats: Stats) -> dict:
@@ -306,25 +309,24 @@ def convert_utc_to_timestamp(
     """
     if isinstance(utcdt, UTCDateTime):
         utcdt = [utcdt]
-    timestamp = np.array([t.timestamp for t in utcdt])
-    return timestamp
+    return np.array(TimeArray(utcdt).timestamps)
 
 
-def convert_timestamp_to_utcdt(timestamp: np.ndarray) -> List[UTCDateTime]:
+def convert_timestamp_to_utcdt(
+        timestamp: np.ndarray) -> TimeArray | UTCDateTime:
     """
-    Converts a numpy array holding timestamps (i.e., floats) to a list of
-    UTCDateTime objects
+    Converts a numpy array holding timestamps (i.e., floats) to a
+    :class:`~seismic.correlate.stats.TimeArray`, which yields UTCDateTime
+    objects on element access.
 
     :param timestamp: numpy array holding timestamps
     :type timestamp: np.ndarray
-    :return: a list of UTCDateTime objects
-    :rtype: List[UTCDateTime]
+    :return: the times, a single UTCDateTime if only one timestamp was given
+    :rtype: TimeArray | UTCDateTime
     """
-    timestamp = list(timestamp)
-    for ii, t in enumerate(timestamp):
-        timestamp[ii] = UTCDateTime(t)
+    timestamp = TimeArray(np.ravel(timestamp))
     if len(timestamp) == 1:
-        timestamp = timestamp[0]
+        return timestamp[0]
     return timestamp
 
 
@@ -0,0 +1,187 @@
+'''
+:copyright:
+    The SeisMIC development team (makus@gfz-potsdam.de).
+:license:
+    EUROPEAN UNION PUBLIC LICENCE v. 1.2
+   (https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12)
+:author:
+   Peter Makus (makus@gfz-potsdam.de)
+
+Created: Monday, 19th October 2026 11:02:41 am
+Last Modified: Monday, 19th October 2026 11:02:41 am
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from obspy import read, UTCDateTime
+import h5py
+import numpy as np
+import yaml
+
+from seismic.db import catalog
+from seismic.db.corr_hdf5 import (
+    CorrelationDataBase, co_to_hdf5, h5_FMTSTR, list_segments,
+    merge_segments)
+from seismic.correlate.stream import CorrStream, CorrTrace
+
+
+with open('params_example.yaml') as file:
+    co = co_to_hdf5(yaml.load(file, Loader=yaml.FullLoader)['co'])
+    co['corr_args']['combinations'] = []
+
+
+def write_corrs(
+    corr_dir: str, net: str, stat: str, cha: str, dist: float,
+        n: int = 3, start: int = 0, swmr: bool = False):
+    tr = read()[0]
+    cst = CorrStream()
+    for ii in range(start, n):
+        ctr = CorrTrace(tr.data.copy())
+        ctr.stats.network = net
+        ctr.stats.station = stat
+        ctr.stats.location = '-'
+        ctr.stats.channel = cha
+        ctr.stats.corr_start = UTCDateTime(2020, 1, 1) + ii*86400
+        ctr.stats.corr_end = ctr.stats.corr_start + 3600
+        ctr.stats.dist = dist
+        ctr.stats.stla = 10.
+        cst.append(ctr)
+    outf = h5_FMTSTR.format(
+        dir=corr_dir, network=net, station=stat, location='-', channel=cha)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with CorrelationDataBase(outf, co, swmr=swmr) as cdb:
+            cdb.add_correlation(cst, 'subdivision')
+    return outf
+
+
+class TestCorrelationCatalog(unittest.TestCase):
+    def setUp(self):
+        self.corr_dir = tempfile.mkdtemp()
+        self.files = [
+            write_corrs(self.corr_dir, 'X-X', 'A-A', 'HHZ-HHZ', 0),
+            write_corrs(self.corr_dir, 'X-X', 'A-A', 'HHE-HHZ', 0),
+            write_corrs(self.corr_dir, 'X-X', 'A-B', 'HHZ-HHZ', 12.5)]
+        self.cat = catalog.CorrelationCatalog(self.corr_dir)
+        self.cat.update()
+
+    def tearDown(self):
+        shutil.rmtree(self.corr_dir)
+
+    def test_index(self):
+        self.assertEqual(len(self.cat), 9)
+        self.assertEqual(len(self.cat.coordinates()), 3)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.corr_dir, catalog.catalog_file)))
+
+    def test_reload(self):
+        cat = catalog.CorrelationCatalog(self.corr_dir)
+        self.assertEqual(len(cat), 9)
+        np.testing.assert_array_equal(
+            cat.index['corr_start'], self.cat.index['corr_start'])
+
+    def test_update_unchanged(self):
+        self.assertEqual(self.cat.update(), 0)
+
+    def test_update_changed(self):
+        f = write_corrs(self.corr_dir, 'X-X', 'A-B', 'HHZ-HHZ', 12.5, 5)
+        self.assertEqual(self.cat.update(), 1)
+        self.assertEqual(len(self.cat), 11)
+        self.assertEqual(
+            np.count_nonzero(self.cat.files['file'] == os.path.basename(
+                f).encode()), 1)
+
+    def test_update_segment(self):
+        # New correlations in an unmerged segment
+        f = write_corrs(
+            self.corr_dir, 'X-X', 'A-B', 'HHZ-HHZ', 12.5, 5, 3, swmr=True)
+        self.assertEqual(len(list_segments(f)), 1)
+        self.assertEqual(self.cat.update(), 1)
+        self.assertEqual(len(self.cat), 11)
+        self.assertEqual(len(self.cat.coordinates()), 3)
+        cst = self.cat.get_data(
+            station='A-B', starttime=UTCDateTime(2020, 1, 3, 12))
+        self.assertEqual(
+            sorted(tr.stats.corr_start for tr in cst),
+            [UTCDateTime(2020, 1, 4), UTCDateTime(2020, 1, 5)])
+        self.assertEqual(self.cat.update(), 0)
+        # Another segment
+        write_corrs(
+            self.corr_dir, 'X-X', 'A-B', 'HHZ-HHZ', 12.5, 6, 5, swmr=True)
+        self.assertEqual(self.cat.update(), 1)
+        self.assertEqual(len(self.cat), 12)
+        # Merged, nothing is indexed twice
+        merge_segments(f)
+        self.assertEqual(self.cat.update(), 1)
+        self.assertEqual(len(self.cat), 12)
+        self.assertEqual(
+            self.cat.get_data(station='A-B').count(), 6)
+
+    def test_reload_old_catalog(self):
+        with h5py.File(self.cat.path, 'a') as f:
+            del f['files']['segments']
+        cat = catalog.CorrelationCatalog(self.corr_dir)
+        self.assertEqual(cat.update(), 3)
+        self.assertEqual(len(cat), 9)
+
+    def test_update_removed(self):
+        os.remove(self.files[0])
+        self.cat.update()
+        self.assertEqual(len(self.cat), 6)
+        self.assertEqual(len(self.cat.coordinates()), 2)
+
+    def test_query_time(self):
+        rows = self.cat.query(
+            starttime=UTCDateTime(2020, 1, 2),
+            endtime=UTCDateTime(2020, 1, 2, 12))
+        self.assertEqual(len(rows), 3)
+        np.testing.assert_array_equal(
+            rows.corr_start, UTCDateTime(2020, 1, 2).timestamp)
+
+    def test_query_wildcard(self):
+        rows = self.cat.query(channel='*-HHZ', station='A-?')
+        self.assertEqual(len(rows), 9)
+        rows = self.cat.query(channel='HHE*')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len(self.cat.query(tag='stack_86398')), 0)
+
+    def test_query_corr_type(self):
+        self.assertEqual(len(self.cat.query(corr_type='auto')), 3)
+        self.assertEqual(len(self.cat.query(corr_type='intra')), 3)
+        self.assertEqual(len(self.cat.query(corr_type='cross')), 3)
+        with self.assertRaises(ValueError):
+            self.cat.query(corr_type='bla')
+
+    def test_query_dist(self):
+        rows = self.cat.query(min_dist=10)
+        self.assertEqual(len(rows), 3)
+        np.testing.assert_array_equal(rows.station, b'A-B')
+        self.assertEqual(len(self.cat.query(max_dist=10)), 6)
+
+    def test_coordinates(self):
+        coords = self.cat.coordinates(station='A-B')
+        self.assertEqual(len(coords), 1)
+        self.assertEqual(coords.dist[0], 12.5)
+        self.assertEqual(coords.stla[0], 10.)
+        self.assertTrue(np.isnan(coords.evla[0]))
+
+    def test_get_data(self):
+        cst = self.cat.get_data(
+            corr_type='auto', starttime=UTCDateTime(2020, 1, 2))
+        self.assertEqual(cst.count(), 2)
+        for ctr in cst:
+            self.assertEqual(ctr.stats.station, 'A-A')
+            self.assertEqual(ctr.stats.channel, 'HHZ-HHZ')
+
+    def test_combinations(self):
+        combs = self.cat.combinations()
+        self.assertEqual(len(combs), 3)
+        self.assertIn(
+            [self.files[2], 'X-X', 'A-B', '-', 'HHZ-HHZ'], combs)
+
+
+if __name__ == "__main__":
+    unittest.main()
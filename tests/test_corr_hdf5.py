@@ -13,6 +13,9 @@ Last Modified: Monday, 17th June 2024 05:09:04 pm
 
 '''
 from copy import deepcopy
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 from unittest import mock
@@ -587,6 +590,459 @@ class TestDBHandler(unittest.TestCase):
             d, {x: 'x' for x in act_paths[-2:]})
 
 
+class TestParseCompression(unittest.TestCase):
+    def test_none(self):
+        comp = corr_hdf5.parse_compression(None)
+        self.assertIsNone(comp['compression'])
+        self.assertIsNone(comp['compression_opts'])
+        self.assertFalse(comp['shuffle'])
+
+    def test_gzip(self):
+        comp = corr_hdf5.parse_compression('gzip5')
+        self.assertEqual(comp['compression'], 'gzip')
+        self.assertEqual(comp['compression_opts'], 5)
+        self.assertFalse(comp['shuffle'])
+
+    def test_shuffle_gzip(self):
+        comp = corr_hdf5.parse_compression('shuffle+gzip3')
+        self.assertEqual(comp['compression'], 'gzip')
+        self.assertEqual(comp['compression_opts'], 3)
+        self.assertTrue(comp['shuffle'])
+
+    def test_lzf(self):
+        comp = corr_hdf5.parse_compression('lzf')
+        self.assertEqual(comp['compression'], 'lzf')
+        self.assertIsNone(comp['compression_opts'])
+
+    def test_lossy(self):
+        comp = corr_hdf5.parse_compression('scaleoffset4+lzf')
+        self.assertEqual(comp['scaleoffset'], 4)
+        comp = corr_hdf5.parse_compression('float16+gzip3')
+        self.assertEqual(comp['dtype'], np.float16)
+
+    def test_two_codecs(self):
+        with self.assertRaises(ValueError):
+            corr_hdf5.parse_compression('lzf+gzip3')
+
+    def test_scaleoffset_float16(self):
+        with self.assertRaises(ValueError):
+            corr_hdf5.parse_compression('scaleoffset3+float16')
+
+    def test_scaleoffset_no_level(self):
+        with self.assertRaises(IndexError):
+            corr_hdf5.parse_compression('scaleoffset+gzip3')
+
+    @patch('seismic.db.corr_hdf5.hdf5plugin', None)
+    def test_no_hdf5plugin(self):
+        with self.assertRaises(ImportError):
+            corr_hdf5.parse_compression('bitshuffle')
+
+    def test_hdf5plugin(self):
+        plugin_mock = MagicMock()
+        plugin_mock.Bitshuffle.return_value = {
+            'compression': 32008, 'compression_opts': (0, 2)}
+        with patch('seismic.db.corr_hdf5.hdf5plugin', plugin_mock):
+            comp = corr_hdf5.parse_compression('bitshuffle')
+        self.assertEqual(comp['compression'], 32008)
+        self.assertEqual(comp['compression_opts'], (0, 2))
+
+
+class TestCompressionRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.h5')
+        tr = read()[0]
+        tr.data = (tr.data/np.abs(tr.data).max()).astype(np.float32)
+        tr.stats.network = 'BW-BW'
+        tr.stats.station = 'RJOB-RJOB'
+        tr.stats.channel = 'EHZ-EHZ'
+        tr.stats.location = '-'
+        tr.stats['corr_start'] = tr.stats.starttime
+        tr.stats['corr_end'] = tr.stats.endtime
+        self.ctr = CorrTrace(tr.data, _header=tr.stats)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _round_trip(self, compression):
+        with corr_hdf5.CorrelationDataBase(
+                self.path, co, 'w', compression) as cdb:
+            cdb.add_correlation(self.ctr)
+        with corr_hdf5.CorrelationDataBase(self.path, mode='r') as cdb:
+            st = self.ctr.stats
+            return cdb.get_data(
+                st.network, st.station, st.location, st.channel,
+                'subdivision')[0].data
+
+    def test_lossless(self):
+        for comp in ['lzf', 'shuffle+gzip3', 'shuffle+lzf']:
+            np.testing.assert_array_equal(
+                self._round_trip(comp), self.ctr.data)
+
+    def test_scaleoffset(self):
+        data = self._round_trip('scaleoffset3+gzip3')
+        self.assertLessEqual(np.abs(data - self.ctr.data).max(), 1e-3)
+
+    def test_float16(self):
+        data = self._round_trip('float16+shuffle+gzip3')
+        self.assertEqual(data.dtype, np.float32)
+        np.testing.assert_allclose(data, self.ctr.data, atol=5e-4)
+
+    def test_benchmark(self):
+        with corr_hdf5.CorrelationDataBase(self.path, co, 'w') as cdb:
+            cdb.add_correlation(self.ctr)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            out = corr_hdf5.benchmark_compression(
+                self.path, ['gzip3', 'float16+lzf'], tmpdir=self.tmpdir)
+        self.assertEqual(list(out.keys()), ['gzip3', 'float16+lzf'])
+        self.assertEqual(out['gzip3']['max_abs_err'], 0)
+        self.assertGreater(out['float16+lzf']['max_abs_err'], 0)
+        for v in out.values():
+            self.assertGreater(v['ratio'], 0)
+
+
+class TestDBWriteSession(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        tr = read()[0]
+        tr.stats.network = 'BW-BW'
+        tr.stats.station = 'RJOB-RJOB'
+        tr.stats.channel = 'EHZ-EHZ'
+        tr.stats.location = '-'
+        tr.stats['corr_start'] = tr.stats.starttime
+        tr.stats['corr_end'] = tr.stats.endtime
+        self.cst = CorrStream()
+        for ii in range(4):
+            ctr = CorrTrace(tr.data.copy(), _header=tr.stats.copy())
+            ctr.stats.corr_start += ii*3600
+            ctr.stats.corr_end += ii*3600
+            self.cst.append(ctr)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _count(self, path):
+        with corr_hdf5.CorrelationDataBase(path, mode='r') as cdb:
+            return cdb.get_data(
+                'BW-BW', 'RJOB-RJOB', '-', 'EHZ-EHZ', 'subdivision').count()
+
+    def test_max_open(self):
+        with self.assertRaises(ValueError):
+            corr_hdf5.DBWriteSession(co, max_open=0)
+
+    def test_buffer_and_flush(self):
+        path = os.path.join(self.tmpdir, 'a.h5')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with corr_hdf5.DBWriteSession(co, batch_size=3) as session:
+                session.add_correlation(path, self.cst[:2])
+                self.assertEqual(session.nbuffered, 2)
+                self.assertEqual(len(session.handles), 0)
+                session.add_correlation(path, self.cst[2:])
+                self.assertEqual(session.nbuffered, 0)
+                self.assertEqual(len(session.handles), 1)
+            self.assertEqual(len(session.handles), 0)
+            self.assertEqual(self._count(path), 4)
+
+    def test_lru(self):
+        paths = [os.path.join(self.tmpdir, f'{ii}.h5') for ii in range(3)]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with corr_hdf5.DBWriteSession(
+                    co, max_open=2, batch_size=1) as session:
+                for p, tr in zip(paths, self.cst):
+                    session.add_correlation(p, tr)
+                self.assertListEqual(list(session.handles), paths[1:])
+                self.assertSetEqual(session.validated, set(paths))
+                with patch.object(corr_hdf5, 'DBHandler') as dbh_mock:
+                    session.add_correlation(paths[0], self.cst[3])
+                    # Options are not compared again
+                    dbh_mock.assert_called_once_with(
+                        paths[0], 'a', 'gzip3', None, False)
+                    session.handles.pop(paths[0])
+            for p in paths:
+                self.assertEqual(self._count(p), 1)
+
+    def test_different_co(self):
+        path = os.path.join(self.tmpdir, 'a.h5')
+        co2 = deepcopy(co)
+        co2['sampling_rate'] = 1234
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with corr_hdf5.DBWriteSession(co) as session:
+                session.add_correlation(path, self.cst)
+            with self.assertRaises(PermissionError):
+                with corr_hdf5.DBWriteSession(co2) as session:
+                    session.add_correlation(path, self.cst)
+
+
+class TestRepack(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.h5')
+        tr = read()[0]
+        tr.stats.network = 'BW-BW'
+        tr.stats.station = 'RJOB-RJOB'
+        tr.stats.channel = 'EHZ-EHZ'
+        tr.stats.location = '-'
+        tr.stats['corr_start'] = tr.stats.starttime
+        tr.stats['corr_end'] = tr.stats.endtime
+        self.cst = CorrStream()
+        for ii in range(10):
+            ctr = CorrTrace(
+                tr.data.astype(np.float32), _header=tr.stats.copy())
+            ctr.stats.corr_start += ii*3600
+            ctr.stats.corr_end += ii*3600
+            self.cst.append(ctr)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with corr_hdf5.CorrelationDataBase(self.path, co, 'w') as cdb:
+                cdb.add_correlation(self.cst)
+                cdb.remove_data(
+                    'BW-BW', 'RJOB-RJOB', '-', 'EHZ-EHZ', 'subdivision',
+                    '*')
+                cdb.add_correlation(self.cst[:2])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with corr_hdf5.CorrelationDataBase(self.path, mode='r') as cdb:
+            return cdb.get_data(
+                'BW-BW', 'RJOB-RJOB', '-', 'EHZ-EHZ', 'subdivision')
+
+    def test_repack(self):
+        report = corr_hdf5.repack(self.path, 'shuffle+gzip3', chunks=1000)
+        self.assertLess(report['size_after'], report['size_before'])
+        self.assertEqual(report['path'], self.path)
+        self.assertFalse(os.path.isfile(self.path + '.repack'))
+        st = self._read()
+        self.assertEqual(st.count(), 2)
+        for tr, tr_org in zip(st, self.cst[:2]):
+            np.testing.assert_array_equal(tr.data, tr_org.data)
+            self.assertEqual(tr.stats.corr_start, tr_org.stats.corr_start)
+        with corr_hdf5.CorrelationDataBase(self.path, mode='r') as cdb:
+            self.assertDictEqual(
+                cdb.get_corr_options(), corr_hdf5.co_to_hdf5(co))
+            ds = cdb[corr_hdf5.hierarchy.format(
+                tag='subdivision', network='BW-BW', station='RJOB-RJOB',
+                location='-', channel='EHZ-EHZ',
+                corr_st=self.cst[0].stats.corr_start.format_fissures(),
+                corr_et=self.cst[0].stats.corr_end.format_fissures())]
+            self.assertEqual(ds.chunks, (1000,))
+            self.assertTrue(ds.shuffle)
+
+    def test_repack_empty(self):
+        with h5py.File(self.path, 'a') as f:
+            f.create_dataset('empty', data=np.array([], dtype=np.float32))
+        corr_hdf5.repack(self.path, 'gzip3', chunks=1000)
+        with h5py.File(self.path, 'r') as f:
+            self.assertEqual(f['empty'].shape, (0,))
+        self.assertEqual(self._read().count(), 2)
+
+    def test_repack_segments(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with corr_hdf5.CorrelationDataBase(
+                    self.path, co, swmr=True) as cdb:
+                cdb.add_correlation(self.cst[2:4])
+        self.assertEqual(len(corr_hdf5.list_segments(self.path)), 1)
+        report = corr_hdf5.repack(self.path, 'shuffle+gzip3')
+        self.assertEqual(corr_hdf5.list_segments(self.path), [])
+        with h5py.File(self.path, 'r') as f:
+            # The data of the segment is in the repacked file
+            st = corr_hdf5._get_data_from(f, corr_hdf5.hierarchy.format(
+                tag='subdivision', network='BW-BW', station='RJOB-RJOB',
+                location='-', channel='EHZ-EHZ', corr_st='*', corr_et='*'))
+            self.assertEqual(st.count(), 4)
+            ds = f[corr_hdf5.hierarchy.format(
+                tag='subdivision', network='BW-BW', station='RJOB-RJOB',
+                location='-', channel='EHZ-EHZ',
+                corr_st=self.cst[3].stats.corr_start.format_fissures(),
+                corr_et=self.cst[3].stats.corr_end.format_fissures())]
+            self.assertTrue(ds.shuffle)
+        self.assertGreater(
+            report['size_before'], report['size_after'])
+
+    def test_repack_lossy(self):
+        corr_hdf5.repack(self.path, 'float16+gzip3')
+        st = self._read()
+        self.assertEqual(st.count(), 2)
+        self.assertEqual(st[0].data.dtype, np.float32)
+
+    @patch('seismic.db.corr_hdf5._checksum')
+    def test_verification_fails(self, checksum_mock):
+        checksum_mock.side_effect = ['a', 'b', 'c', 'd', 'e', 'f']
+        size = os.path.getsize(self.path)
+        with self.assertRaises(ValueError):
+            corr_hdf5.repack(self.path)
+        self.assertFalse(os.path.isfile(self.path + '.repack'))
+        self.assertEqual(size, os.path.getsize(self.path))
+
+    def test_repack_bulk(self):
+        path2 = os.path.join(self.tmpdir, 'test2.h5')
+        shutil.copy(self.path, path2)
+        with warnings.catch_warnings(record=True) as w:
+            reports = corr_hdf5.repack_bulk(
+                [path2, self.path, os.path.join(self.tmpdir, 'no.h5')])
+            self.assertEqual(len(w), 1)
+        self.assertEqual(len(reports), 3)
+        self.assertIn('error', reports[0])
+        self.assertEqual(reports[1]['path'], self.path)
+
+
+class TestSWMR(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.h5')
+        tr = read()[0]
+        tr.stats.network = 'BW-BW'
+        tr.stats.station = 'RJOB-RJOB'
+        tr.stats.channel = 'EHZ-EHZ'
+        tr.stats.location = '-'
+        tr.stats['corr_start'] = tr.stats.starttime
+        tr.stats['corr_end'] = tr.stats.endtime
+        self.cst = CorrStream()
+        for ii in range(4):
+            ctr = CorrTrace(tr.data.copy(), _header=tr.stats.copy())
+            ctr.stats.corr_start += ii*3600
+            ctr.stats.corr_end += ii*3600
+            self.cst.append(ctr)
+        warnings.simplefilter('ignore')
+
+    def tearDown(self):
+        warnings.resetwarnings()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, cst):
+        with corr_hdf5.CorrelationDataBase(
+                self.path, co, swmr=True) as cdb:
+            cdb.add_correlation(cst)
+
+    def _read(self):
+        with corr_hdf5.CorrelationDataBase(self.path, mode='r') as cdb:
+            cst = cdb.get_data(
+                'BW-BW', 'RJOB-RJOB', '-', 'EHZ-EHZ', 'subdivision')
+            starts = cdb.get_available_starttimes(
+                'BW-BW', 'RJOB-RJOB', 'subdivision', '-', 'EHZ-EHZ')
+            chans = cdb.get_available_channels(
+                'subdivision', 'BW-BW', 'RJOB-RJOB', '-')
+        return cst, starts, chans
+
+    def test_write_segments(self):
+        self._write(self.cst[:2])
+        # Reader while the writer is still writing
+        with corr_hdf5.CorrelationDataBase(
+                self.path, co, swmr=True) as cdb:
+            cdb.add_correlation(self.cst[2:])
+            cst, starts, chans = self._read()
+            self.assertEqual(cst.count(), 2)
+        self.assertEqual(len(corr_hdf5.list_segments(self.path)), 2)
+        cst, starts, chans = self._read()
+        self.assertEqual(cst.count(), 4)
+        self.assertEqual(len(starts['EHZ-EHZ']), 4)
+        self.assertListEqual(chans, ['EHZ-EHZ'])
+        with corr_hdf5.CorrelationDataBase(self.path, mode='r') as cdb:
+            self.assertDictEqual(
+                cdb.get_corr_options(), corr_hdf5.co_to_hdf5(co))
+
+    def test_failed_write_not_committed(self):
+        with self.assertRaises(ValueError):
+            with corr_hdf5.CorrelationDataBase(
+                    self.path, co, swmr=True) as cdb:
+                cdb.add_correlation(self.cst)
+                raise ValueError('test')
+        self.assertEqual(len(corr_hdf5.list_segments(self.path)), 0)
+        self.assertListEqual(
+            os.listdir(corr_hdf5.segment_dir(self.path)), [])
+
+    def test_wrong_co(self):
+        self._write(self.cst[:1])
+        co2 = deepcopy(co)
+        co2['sampling_rate'] = 1234
+        with self.assertRaises(PermissionError):
+            with corr_hdf5.CorrelationDataBase(
+                    self.path, co2, swmr=True):
+                pass
+
+    def test_mode_w(self):
+        with self.assertRaises(ValueError):
+            corr_hdf5.CorrelationDataBase(self.path, co, 'w', swmr=True)
+
+    def test_merge(self):
+        self._write(self.cst[:2])
+        self._write(self.cst[1:])
+        self.assertEqual(corr_hdf5.merge_segments(self.path), 2)
+        self.assertFalse(os.path.isdir(corr_hdf5.segment_dir(self.path)))
+        cst, _, _ = self._read()
+        self.assertEqual(cst.count(), 4)
+        self.assertEqual(corr_hdf5.merge_segments(self.path), 0)
+
+    def test_merged_while_reading(self):
+        self._write(self.cst[:2])
+        self._write(self.cst[2:])
+        segments = corr_hdf5.list_segments(self.path)
+        list_segments = corr_hdf5.list_segments
+
+        def merge_on_open(*args, **kwargs):
+            # Segments are merged after the reader listed them
+            with patch.object(
+                    corr_hdf5, 'list_segments', side_effect=list_segments):
+                corr_hdf5.merge_segments(self.path)
+            return segments
+        with patch.object(
+                corr_hdf5, 'list_segments', side_effect=merge_on_open):
+            cst, _, _ = self._read()
+        self.assertEqual(cst.count(), 4)
+
+    def test_merged_before_listing(self):
+        # The main file is opened, then the segments are merged and a new
+        # segment is committed before the reader lists the segments
+        self._write(self.cst[:1])
+        self._write(self.cst[1:2])
+        init = h5py.File.__init__
+        state = {'merged': False}
+
+        def merge_after_open(f, name, *args, **kwargs):
+            init(f, name, *args, **kwargs)
+            if name == self.path and not state['merged']:
+                state['merged'] = True
+                corr_hdf5.merge_segments(self.path)
+                self._write(self.cst[2:])
+        with patch.object(h5py.File, '__init__', merge_after_open):
+            cst, _, _ = self._read()
+        # The data of the merged segments is not lost
+        self.assertTrue(state['merged'])
+        starts = [tr.stats.corr_start for tr in cst]
+        for tr in self.cst[:2]:
+            self.assertIn(tr.stats.corr_start, starts)
+        self.assertEqual(self._read()[0].count(), 4)
+
+    def test_session(self):
+        with corr_hdf5.DBWriteSession(
+                co, batch_size=2, swmr=True, merge_threshold=2) as s:
+            s.add_correlation(self.path, self.cst[:3])
+            self.assertEqual(len(corr_hdf5.list_segments(self.path)), 1)
+            self.assertEqual(len(s.handles), 0)
+            self.assertEqual(self._read()[0].count(), 3)
+            s.add_correlation(self.path, self.cst[3:])
+        self.assertEqual(len(corr_hdf5.list_segments(self.path)), 0)
+        self.assertEqual(self._read()[0].count(), 4)
+
+    def test_session_merge_threshold(self):
+        for threshold in [3, None]:
+            with corr_hdf5.DBWriteSession(
+                    co, batch_size=2, swmr=True,
+                    merge_threshold=threshold) as s:
+                s.add_correlation(self.path, self.cst[:2])
+                s.add_correlation(self.path, self.cst[2:])
+            # Two segments are not merged
+            self.assertEqual(len(corr_hdf5.list_segments(self.path)), 2)
+            self.assertEqual(self._read()[0].count(), 4)
+            corr_hdf5.merge_segments(self.path)
+
+
 class TestCorrelationDataBase(unittest.TestCase):
     @patch('seismic.db.corr_hdf5.DBHandler')
     def test_no_corr_options(self, dbh_mock):
@@ -439,6 +439,33 @@ class TestCorrrelator(unittest.TestCase):
             mock.call(mock.ANY, 'stack_86398')]
         dbh_mock().add_correlation.assert_has_calls(add_cst_calls)
 
+    @mock.patch('builtins.open')
+    @mock.patch('seismic.correlate.correlate.logging')
+    @mock.patch('seismic.correlate.correlate.os.makedirs')
+    def test_write_session(
+            self, makedirs_mock, logging_mock, open_mock):
+        options = deepcopy(self.options)
+        options['co']['combinations'] = [(0, 0), (0, 1), (0, 2)]
+        options['co']['subdivision']['recombine_subdivision'] = False
+        sc_mock = mock.Mock(Store_Client)
+        sc_mock.get_available_stations.return_value = [
+            ['lala', 'lolo'], ['lala', 'lili']]
+        sc_mock._translate_wildcards.return_value = [
+            ['lala', 'lolo', 'E'], ['lala', 'lili', 'Z']]
+        c = correlate.Correlator(sc_mock, options)
+        cst_mock = mock.Mock(CorrStream)
+        cst_mock2 = mock.Mock(CorrStream)
+        cst_mock.select.return_value = cst_mock2
+        cst_mock.__iter__ = mock.Mock(return_value=iter(self.st))
+        c._db_session = mock.MagicMock()
+        with mock.patch(
+                'seismic.correlate.correlate.CorrelationDataBase') as cdb_mock:
+            c._write(cst_mock)
+            cdb_mock.assert_not_called()
+        self.assertEqual(c._db_session.add_correlation.call_count, 3)
+        c._db_session.add_correlation.assert_any_call(
+            mock.ANY, cst_mock2, 'subdivision')
+
     @mock.patch('seismic.utils.miic_utils.resample_or_decimate')
     @mock.patch('seismic.correlate.correlate.calc_cross_combis')
     @mock.patch('seismic.correlate.correlate.preprocess_stream')
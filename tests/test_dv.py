@@ -11,6 +11,9 @@ Created: Wednesday, 27th October 2021 12:58:15 pm
 Last Modified: Tuesday, 5th March 2024 03:01:56 pm
 '''
 
+import os
+import shutil
+import tempfile
 import unittest
 from unittest import mock
 from unittest.mock import patch
@@ -19,6 +22,7 @@ import warnings
 from zipfile import BadZipFile
 
 import numpy as np
+from obspy import UTCDateTime
 
 from seismic.monitor import dv
 from seismic.correlate.stats import CorrStats
@@ -244,5 +248,49 @@ class TestReadDV(unittest.TestCase):
         self.assertEqual(len(dvout), 1)
 
 
+class TestDVSubdir(unittest.TestCase):
+    def test_int_and_float(self):
+        self.assertEqual(dv.dv_subdir(1, 2., 5, 10), 'f1-2_tw5-10')
+        self.assertEqual(
+            dv.dv_subdir(np.float64(.5), 1.25, 0, None),
+            'f0.5-1.25_tw0-None')
+
+
+class TestLazyNpz(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'DV-X.npz')
+        stats = CorrStats({
+            'corr_start': [UTCDateTime(ii) for ii in range(50)],
+            'corr_end': [UTCDateTime(ii + 1) for ii in range(50)]})
+        self.sim_mat = np.random.rand(50, 7)
+        self.dv = dv.DV(
+            np.ones(50), np.zeros(50), 'stretch', self.sim_mat,
+            np.arange(7), 'single_ref', stats)
+        self.dv.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_lazy(self):
+        dvout = dv.read_dv(self.path, load_sim_mat=False)
+        self.assertNotIn('sim_mat', dvout.__dict__)
+        np.testing.assert_array_equal(dvout.sim_mat, self.sim_mat)
+        self.assertIn('sim_mat', dvout.__dict__)
+
+    def test_iter_npz_rows(self):
+        for chunk_len in [1, 7, 50, 100]:
+            chunks = list(dv.iter_npz_rows(self.path, chunk_len=chunk_len))
+            self.assertEqual(len(chunks), -(-50//chunk_len))
+            np.testing.assert_array_equal(
+                np.vstack(chunks), self.sim_mat)
+
+    def test_iter_npz_rows_fortran(self):
+        np.savez(self.path, sim_mat=np.asfortranarray(self.sim_mat))
+        np.testing.assert_array_equal(
+            np.vstack(list(dv.iter_npz_rows(self.path, chunk_len=8))),
+            self.sim_mat)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,190 @@
+'''
+:copyright:
+    The SeisMIC development team (makus@gfz-potsdam.de).
+:license:
+    EUROPEAN UNION PUBLIC LICENCE v. 1.2
+   (https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12)
+:author:
+   Peter Makus (makus@gfz-potsdam.de)
+
+Created: Monday, 19th October 2026 03:05:12 pm
+Last Modified: Monday, 19th October 2026 03:05:12 pm
+'''
+from copy import deepcopy
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from obspy import UTCDateTime
+import numpy as np
+
+from seismic.correlate.stats import CorrStats
+from seismic.db import dv_hdf5
+from seismic.monitor.dv import DV, read_dv
+
+
+def create_dv(nt: int = 20, nstr: int = 31, channel: str = 'HHE-HHZ') -> DV:
+    rng = np.random.default_rng(0)
+    sim_mat = np.clip(rng.standard_normal((nt, nstr))*.3 + .2, -1, 1)
+    sim_mat[3] = np.nan
+    second_axis = np.linspace(-.01, .01, nstr)
+    stats = CorrStats({
+        'network': 'X9-X9', 'station': 'IR1-IR1', 'location': '-',
+        'channel': channel, 'npts': 101, 'sampling_rate': 10.,
+        'start_lag': -5.,
+        'corr_start': [UTCDateTime(2020, 1, 1) + ii*86400 for ii in range(nt)],
+        'corr_end': [UTCDateTime(2020, 1, 2) + ii*86400 for ii in range(nt)]})
+    corr = np.nanmax(sim_mat, axis=1)
+    value = second_axis[np.argmax(np.nan_to_num(sim_mat), axis=1)]
+    return DV(
+        corr, value, 'stretch', sim_mat, second_axis, 'single_ref', stats,
+        n_stat=np.ones(nt), dv_processing=dict(
+            freq_min=1, freq_max=2, tw_start=3, tw_len=10, sides='both',
+            aligned=False))
+
+
+class TestDVStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dv.h5')
+        self.dv = create_dv()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertDVEqual(self, dv, exp):
+        for k in ['corr', 'value', 'second_axis', 'n_stat']:
+            np.testing.assert_array_equal(getattr(dv, k), getattr(exp, k))
+        self.assertEqual(dv.method, exp.method)
+        self.assertEqual(dv.value_type, exp.value_type)
+        self.assertEqual(dv.stats.channel, exp.stats.channel)
+        self.assertEqual(dv.stats.npts, exp.stats.npts)
+        np.testing.assert_array_equal(
+            dv.stats.corr_start, exp.stats.corr_start)
+        self.assertDictEqual(dv.dv_processing, {
+            k: v for k, v in exp.dv_processing.items()})
+
+    def test_round_trip(self):
+        with dv_hdf5.DVStore(self.path) as dvs:
+            dvs.add_dv(self.dv)
+            key = dvs.get_available_keys()[0]
+            dv = dvs.get_dv(key)
+        self.assertEqual(key, dv_hdf5.dv_key(self.dv))
+        self.assertEqual(
+            key, 'f1-2_tw3-10/DV-X9-X9.IR1-IR1.-.HHE-HHZ')
+        self.assertDVEqual(dv, self.dv)
+        np.testing.assert_array_equal(dv.sim_mat, self.dv.sim_mat)
+        # Same key after the round trip
+        self.assertEqual(dv_hdf5.dv_key(dv), key)
+
+    def test_tw_len_none(self):
+        self.dv.dv_processing['tw_len'] = None
+        with dv_hdf5.DVStore(self.path) as dvs:
+            dvs.add_dv(self.dv)
+            key = dvs.get_available_keys()[0]
+            dv = dvs.get_dv(key)
+        self.assertEqual(key, 'f1-2_tw3-None/DV-X9-X9.IR1-IR1.-.HHE-HHZ')
+        self.assertDVEqual(dv, self.dv)
+
+    def test_missing_processing_keys(self):
+        self.dv.dv_processing = {'freq_min': .5, 'sides': 'both'}
+        self.assertEqual(
+            dv_hdf5.dv_key(self.dv),
+            'f0.5-None_twNone-None/DV-X9-X9.IR1-IR1.-.HHE-HHZ')
+        self.dv.dv_processing = {'sides': 'both'}
+        self.assertEqual(
+            dv_hdf5.dv_key(self.dv), 'DV-X9-X9.IR1-IR1.-.HHE-HHZ')
+        with dv_hdf5.DVStore(self.path) as dvs:
+            dvs.add_dv(self.dv)
+            dv = dvs.get_dv('DV-X9-X9.IR1-IR1.-.HHE-HHZ')
+        self.assertEqual(dv.dv_processing['sides'], 'both')
+        self.assertIsNone(dv.dv_processing['freq_min'])
+
+    def test_invalid_processing_not_written(self):
+        self.dv.dv_processing['tw_len'] = 'bla'
+        with dv_hdf5.DVStore(self.path) as dvs:
+            with self.assertRaises(ValueError):
+                dvs.add_dv(self.dv, 'mykey')
+            self.assertNotIn('mykey', dvs)
+
+    def test_lazy_sim_mat(self):
+        with dv_hdf5.DVStore(self.path) as dvs:
+            dvs.add_dv(self.dv, 'mykey')
+        dv = dv_hdf5.read_dv_store(self.path)[0]
+        self.assertNotIn('sim_mat', dv.__dict__)
+        # copies and pickles load the matrix as well
+        np.testing.assert_array_equal(
+            deepcopy(dv).sim_mat, self.dv.sim_mat)
+        np.testing.assert_array_equal(
+            pickle.loads(pickle.dumps(dv)).sim_mat, self.dv.sim_mat)
+        np.testing.assert_array_equal(dv.sim_mat, self.dv.sim_mat)
+        self.assertIn('sim_mat', dv.__dict__)
+        self.assertNotIn('_sim_mat_loader', dv.__dict__)
+        dv = dv_hdf5.read_dv_store(self.path, load_sim_mat=True)[0]
+        self.assertIn('sim_mat', dv.__dict__)
+
+    def test_quantised(self):
+        for dtype, atol in [('float16', 1e-3), ('uint8', 5e-3)]:
+            with dv_hdf5.DVStore(
+                    self.path, mode='w', sim_mat_dtype=dtype) as dvs:
+                dvs.add_dv(self.dv, 'dv')
+                self.assertEqual(dvs['dv/sim_mat'].dtype, np.dtype(dtype))
+            dv = dv_hdf5.read_dv_store(self.path)[0]
+            np.testing.assert_allclose(
+                dv.sim_mat, self.dv.sim_mat, atol=atol)
+            self.assertTrue(np.all(np.isnan(dv.sim_mat[3])))
+            np.testing.assert_array_equal(dv.corr, self.dv.corr)
+
+    def test_chunked_along_time(self):
+        dv = create_dv(nt=3000)
+        with dv_hdf5.DVStore(self.path) as dvs:
+            dvs.add_dv(dv, 'dv')
+            self.assertEqual(
+                dvs['dv/sim_mat'].chunks, (dv_hdf5.chunk_len, 31))
+            self.assertEqual(dvs['dv/corr'].chunks, (dv_hdf5.chunk_len,))
+
+    def test_overwrite(self):
+        with dv_hdf5.DVStore(self.path) as dvs:
+            dvs.add_dv(self.dv, 'dv')
+            with self.assertRaises(KeyError):
+                dvs.add_dv(self.dv, 'dv')
+            dvs.add_dv(create_dv(nt=5), 'dv', overwrite=True)
+            self.assertEqual(len(dvs.get_dv('dv').corr), 5)
+            dvs.remove_dv('dv')
+            self.assertEqual(dvs.get_available_keys(), [])
+
+    def test_pattern(self):
+        with dv_hdf5.DVStore(self.path) as dvs:
+            for cha in ['HHE-HHE', 'HHE-HHZ', 'HHZ-HHZ']:
+                dvs.add_dv(create_dv(channel=cha))
+            self.assertEqual(len(dvs.get_available_keys()), 3)
+            self.assertEqual(len(dvs.get_available_keys('*HHE-*')), 2)
+        self.assertEqual(
+            len(dv_hdf5.read_dv_store(self.path, '*HHZ-HHZ')), 1)
+
+    def test_import_npz(self):
+        os.makedirs(os.path.join(self.dir, 'sub'))
+        self.dv.save(os.path.join(self.dir, 'sub', 'DV-a'))
+        self.dv.save(os.path.join(self.dir, 'sub', 'DV-b'))
+        with dv_hdf5.DVStore(self.path) as dvs:
+            keys = dvs.import_npz(
+                os.path.join(self.dir, 'sub', '*.npz'), root=self.dir)
+            self.assertEqual(keys, ['sub/DV-a', 'sub/DV-b'])
+        dvs = read_dv(self.path)
+        self.assertEqual(len(dvs), 2)
+        self.assertDVEqual(dvs[0], self.dv)
+        np.testing.assert_array_equal(dvs[1].sim_mat, self.dv.sim_mat)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            with dv_hdf5.DVStore(self.path, sim_mat_dtype='int4'):
+                pass
+        with self.assertRaises(ValueError):
+            with dv_hdf5.DVStore(self.path, compression='float16+gzip3'):
+                pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -211,7 +211,7 @@ class TestLoadHeaderFromNPArray(unittest.TestCase):
             'other': 'blub'})
         d = mu.save_header_to_np_array(st)
         st2 = mu.load_header_from_np_array(d)
-        self.assertDictEqual(st2, dict(st))
+        self.assertEqual(CorrStats(st2), st)
 
 
 class ConvertUTCToTimeStamp(unittest.TestCase):
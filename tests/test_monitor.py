@@ -11,7 +11,10 @@ Created: Tuesday, 6th July 2021 09:18:14 am
 Last Modified: Wednesday, 19th June 2024 10:39:35 am
 '''
 
+from glob import glob
 import os
+import shutil
+import tempfile
 import unittest
 from unittest import mock
 from unittest.mock import patch
@@ -19,11 +22,13 @@ import warnings
 from copy import deepcopy
 
 import numpy as np
-from obspy import UTCDateTime
+from obspy import read, UTCDateTime
+import yaml
 
 from seismic.monitor import monitor
-from seismic.monitor.dv import DV
+from seismic.monitor.dv import DV, read_dv
 from seismic.correlate.stats import CorrStats
+from seismic.correlate.stream import CorrStream, CorrTrace
 from seismic.db.corr_hdf5 import h5_FMTSTR
 
 
@@ -349,6 +354,648 @@ class TestAverageDVbyCoords(unittest.TestCase):
         self.assertIsNone(av_dv.corrs)
 
 
+class TestComputeVelocityChange(unittest.TestCase):
+    def setUp(self):
+        with open('params_example.yaml') as file:
+            self.options = yaml.load(file, Loader=yaml.FullLoader)
+        self.outdir = tempfile.mkdtemp()
+        self.options['dv'].update(
+            freq_min=[1, 2], freq_max=[2, 4], tw_start=[5, 10], tw_len=5,
+            compute_tt=False, plot_vel_change=False, preprocessing=[],
+            postprocessing=[])
+        self.m = monitor.Monitor.__new__(monitor.Monitor)
+        self.m.options = self.options
+        self.m.outdir = self.outdir
+        self.m.logger = mock.MagicMock()
+        self.m.starttimes = [UTCDateTime(0) + ii*3600 for ii in range(3)]
+        self.m.endtimes = [t + 3600 for t in self.m.starttimes]
+        tr = read()[0]
+        self.cst = CorrStream()
+        for t in self.m.starttimes:
+            ctr = CorrTrace(tr.data.astype(float))
+            ctr.stats.sampling_rate = 20
+            ctr.stats.start_lag = -15
+            ctr.stats.corr_start = t
+            ctr.stats.corr_end = t + 3600
+            ctr.stats.network = 'X-X'
+            ctr.stats.station = 'A-A'
+            ctr.stats.location = '-'
+            ctr.stats.channel = 'HHZ-HHZ'
+            self.cst.append(ctr)
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_bands_and_windows(self):
+        bands, windows = self.m._bands_and_windows()
+        self.assertEqual(bands, [(1, 2), (2, 4)])
+        self.assertEqual(windows, [(5, 5), (10, 5)])
+
+    def test_bands_and_windows_single(self):
+        self.options['dv'].update(
+            freq_min=1, freq_max=2, tw_start=5, tw_len=None)
+        bands, windows = self.m._bands_and_windows()
+        self.assertEqual(bands, [(1, 2)])
+        self.assertEqual(windows, [(5, None)])
+
+    def test_bands_and_windows_wrong_len(self):
+        self.options['dv']['freq_max'] = [2]
+        with self.assertRaises(ValueError):
+            self.m._bands_and_windows()
+        self.options['dv']['freq_max'] = [2, 4]
+        self.options['dv']['tw_len'] = [1, 2, 3]
+        with self.assertRaises(ValueError):
+            self.m._bands_and_windows()
+
+    def test_bands_and_windows_fmin_fmax(self):
+        self.options['dv']['freq_max'] = [2, 1]
+        with self.assertRaises(ValueError):
+            self.m._bands_and_windows()
+
+    @mock.patch.object(monitor.Monitor, '_stretch_bulk')
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_one_load(self, cdb_mock, stretch_mock):
+        cdb = cdb_mock.return_value.__enter__.return_value
+        cdb.get_data.return_value = self.cst
+        cdb.get_corr_options.return_value = {
+            'corr_args': {'lengthToSave': 15}}
+        self.m.compute_velocity_change(
+            'file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        cdb.get_data.assert_called_once()
+        self.assertEqual(stretch_mock.call_count, 4)
+        processing = [c.args[4] for c in stretch_mock.call_args_list]
+        self.assertEqual(
+            [(p['freq_min'], p['tw_start']) for p in processing],
+            [(1, 5), (1, 10), (2, 5), (2, 10)])
+        # each band filtered once from the same resampled bulk
+        cbs = [c.args[0] for c in stretch_mock.call_args_list]
+        self.assertIs(cbs[0], cbs[1])
+        self.assertIsNot(cbs[0], cbs[2])
+        self.assertFalse(np.allclose(cbs[0].data, cbs[2].data))
+        dv = stretch_mock.return_value
+        self.assertEqual(dv.save.call_count, 4)
+        self.assertEqual(
+            dv.save.call_args_list[1].args[0], os.path.join(
+                self.outdir, 'f1-2_tw10-5', 'DV-X-X.A-A.-.HHZ-HHZ'))
+        self.assertTrue(
+            os.path.isdir(os.path.join(self.outdir, 'f2-4_tw5-5')))
+
+    @mock.patch.object(monitor.Monitor, '_stretch_bulk')
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_single(self, cdb_mock, stretch_mock):
+        self.options['dv'].update(
+            freq_min=1, freq_max=2, tw_start=5, tw_len=5)
+        cdb = cdb_mock.return_value.__enter__.return_value
+        cdb.get_data.return_value = self.cst
+        cdb.get_corr_options.return_value = {
+            'corr_args': {'lengthToSave': 15}}
+        self.m.compute_velocity_change(
+            'file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        stretch_mock.return_value.save.assert_called_once_with(
+            os.path.join(self.outdir, 'DV-X-X.A-A.-.HHZ-HHZ'))
+
+    def test_stretch_bulk(self):
+        self.options['dv'].update(stretch_steps=11, return_sim_mat=True)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cb = self.cst.create_corr_bulk(inplace=False)
+        # symmetric lag times
+        cb.stats.start_lag = -(cb.stats.npts - 1)/2*cb.stats.delta
+        cb.filter((1, 4))
+        data = cb.data.copy()
+        for tw_len in (5, None):
+            dv = self.m._stretch_bulk(cb, 5, tw_len, None, {'a': 1})
+            self.assertEqual(dv.sim_mat.shape, (3, 11))
+            self.assertEqual(dv.dv_processing, {'a': 1})
+            np.testing.assert_array_equal(cb.data, data)
+
+    def _incremental_setup(
+        self, cdb_mock: mock.MagicMock, n: int, n_corr: int = None,
+            per_win: int = 1, win_len: int = 3600):
+        # n time windows, n_corr correlations (per_win in each hour)
+        self.options['dv'].update(
+            freq_min=1, freq_max=4, tw_start=5, tw_len=5, stretch_steps=11,
+            return_sim_mat=True, incremental=True, date_inc=3600,
+            win_len=win_len)
+        self.m.starttimes = [UTCDateTime(0) + ii*3600 for ii in range(n)]
+        self.m.endtimes = [t + win_len for t in self.m.starttimes]
+        n_corr = n*per_win if n_corr is None else n_corr
+        rng = np.random.default_rng(0)
+        tr = read()[0]
+        cst = CorrStream()
+        for ii in range(n_corr):
+            t = UTCDateTime(0) + ii*3600/per_win
+            ctr = CorrTrace(
+                tr.data.astype(float) + rng.normal(0, 100, tr.stats.npts))
+            ctr.stats.sampling_rate = 20
+            ctr.stats.start_lag = -(tr.stats.npts - 1)/40
+            ctr.stats.corr_start = t
+            ctr.stats.corr_end = t + 3600/per_win
+            ctr.stats.network = 'X-X'
+            ctr.stats.station = 'A-A'
+            ctr.stats.location = '-'
+            ctr.stats.channel = 'HHZ-HHZ'
+            cst.append(ctr)
+        cdb = cdb_mock.return_value.__enter__.return_value
+        cdb.get_corr_options.return_value = {
+            'corr_args': {'lengthToSave': 15}}
+        cdb.get_data.reset_mock()
+        cdb.get_data.side_effect = lambda *args, corr_start=None: \
+            cst.copy() if corr_start is None else CorrStream(
+                [tr.copy() for tr in cst if tr.stats.corr_start == corr_start])
+        cdb.get_available_starttimes.return_value = {'HHZ-HHZ': [
+            tr.stats.corr_start.format_fissures() for tr in cst]}
+        return cdb
+
+    def _incremental_check(
+            self, cdb_mock: mock.MagicMock, first: dict, second: dict):
+        """
+        Updates a DV computed with the setup ``first`` incrementally with
+        ``second`` and compares it to a computation from scratch with the
+        same reference trace.
+        """
+        args = ('file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        outf = os.path.join(self.outdir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')
+        statef = os.path.join(
+            self.outdir, 'incremental', 'REF-X-X.A-A.-.HHZ-HHZ.npz')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self._incremental_setup(cdb_mock, **first)
+            self.m.compute_velocity_change(*args)
+            with np.load(statef) as loaded:
+                ref = loaded['ref_trc']
+            cdb = self._incremental_setup(cdb_mock, **second)
+            self.m.compute_velocity_change(*args)
+            cdb.get_data.assert_called()
+            dv = read_dv(outf)
+            self.options['dv']['incremental'] = False
+            self.m.compute_velocity_change(*args, ref_trcs=ref)
+            exp = read_dv(outf)
+        np.testing.assert_allclose(dv.sim_mat, exp.sim_mat)
+        np.testing.assert_allclose(dv.corr, exp.corr)
+        return dv
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_incremental(self, cdb_mock):
+        args = ('file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        outf = os.path.join(self.outdir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')
+        statef = os.path.join(
+            self.outdir, 'incremental', 'REF-X-X.A-A.-.HHZ-HHZ.npz')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self._incremental_setup(cdb_mock, 6)
+            self.m.compute_velocity_change(*args)
+            dv0 = read_dv(outf)
+            with np.load(statef) as loaded:
+                ref = loaded['ref_trc']
+            # three new time windows
+            cdb = self._incremental_setup(cdb_mock, 9)
+            self.m.compute_velocity_change(*args)
+            # The last old time window is recomputed
+            self.assertEqual(
+                [c.kwargs['corr_start'] for c in cdb.get_data.call_args_list],
+                self.m.starttimes[4:])
+            dv = read_dv(outf)
+            # reference computation with the same reference trace
+            self.options['dv']['incremental'] = False
+            self.m.compute_velocity_change(*args, ref_trcs=ref)
+            exp = read_dv(outf)
+        self.assertEqual(len(dv.corr), 9)
+        np.testing.assert_array_equal(dv.corr[:5], dv0.corr[:5])
+        np.testing.assert_array_equal(dv.sim_mat[:5], dv0.sim_mat[:5])
+        np.testing.assert_allclose(dv.sim_mat[5:], exp.sim_mat[5:])
+        np.testing.assert_allclose(dv.value[5:], exp.value[5:])
+        np.testing.assert_array_equal(
+            dv.stats.corr_start, exp.stats.corr_start)
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_incremental_up_to_date_and_changed(self, cdb_mock):
+        args = ('file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cdb = self._incremental_setup(cdb_mock, 4)
+            self.m.compute_velocity_change(*args)
+            cdb.get_data.reset_mock()
+            self.m.compute_velocity_change(*args)
+            cdb.get_data.assert_not_called()
+            # Different options, everything is recomputed
+            self.options['dv']['stretch_steps'] = 13
+            self.m.compute_velocity_change(*args)
+            cdb.get_data.assert_called_once_with(*args[2:], args[1])
+        dv = read_dv(os.path.join(self.outdir, 'DV-X-X.A-A.-.HHZ-HHZ.npz'))
+        self.assertEqual(dv.sim_mat.shape, (4, 13))
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_incremental_up_to_date_smoothing(self, cdb_mock):
+        args = ('file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        outf = os.path.join(self.outdir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cdb = self._incremental_setup(cdb_mock, 6)
+            self.options['dv']['postprocessing'] = [
+                {'function': 'smooth_sim_mat', 'args': {'win_len': 3}}]
+            self.assertGreater(self.m._incremental_overlap(), 0)
+            self.m.compute_velocity_change(*args)
+            mtime = os.path.getmtime(outf)
+            cdb.get_data.reset_mock()
+            self.m.compute_velocity_change(*args)
+        cdb.get_data.assert_not_called()
+        self.assertEqual(os.path.getmtime(outf), mtime)
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_incremental_long_win_len(self, cdb_mock):
+        # Each time window stacks the correlations of two hours, so the new
+        # correlations also fall into the last old window
+        self._incremental_setup(cdb_mock, 6, win_len=7200)
+        self.assertEqual(self.m._incremental_overlap(), 2)
+        dv = self._incremental_check(
+            cdb_mock, dict(n=6, win_len=7200), dict(n=9, win_len=7200))
+        self.assertEqual(len(dv.corr), 9)
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_incremental_new_data_in_window(self, cdb_mock):
+        # end_date does not change, a correlation is added to the last
+        # time window that holds data and the empty windows are filled
+        dv = self._incremental_check(
+            cdb_mock, dict(n=4, n_corr=5, per_win=2),
+            dict(n=4, per_win=2))
+        self.assertTrue(np.all(np.isfinite(dv.corr)))
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_incremental_new_data_in_last_window(self, cdb_mock):
+        dv = self._incremental_check(
+            cdb_mock, dict(n=4, n_corr=7, per_win=2),
+            dict(n=4, per_win=2))
+        self.assertEqual(len(dv.corr), 4)
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_memmap(self, cdb_mock):
+        args = ('file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+        outf = os.path.join(self.outdir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')
+        tmpdir = os.path.join(self.outdir, 'tmp')
+        os.makedirs(tmpdir)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self._incremental_setup(cdb_mock, 6)
+            self.options['dv'].update(incremental=False, memmap_dir=tmpdir)
+            self.m.compute_velocity_change(*args)
+            dv = read_dv(outf)
+            self.options['dv']['memmap_dir'] = 'None'
+            self.m.compute_velocity_change(*args)
+            exp = read_dv(outf)
+        np.testing.assert_allclose(dv.sim_mat, exp.sim_mat)
+        np.testing.assert_array_equal(dv.value, exp.value)
+        self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_incremental_overlap(self):
+        self.options['dv'].update(
+            preprocessing=[
+                {'function': 'smooth', 'args': {'wsize': 4, 'axis': 1}},
+                {'function': 'smooth', 'args': {'wsize': 40, 'axis': 0}}],
+            postprocessing=[
+                {'function': 'smooth_sim_mat', 'args': {'win_len': 3}}],
+            win_len=86400, date_inc=86400)
+        self.assertEqual(self.m._incremental_overlap(), 8)
+        self.options['dv'].update(win_len=86400*5, date_inc=86400*2)
+        self.assertEqual(self.m._incremental_overlap(), 10)
+
+    def test_stretch_bulk_refine_yaml_null(self):
+        # coarse_steps : null in the yaml file
+        self.assertIsNone(self.options['dv']['coarse_steps'])
+        self.options['dv'].update(stretch_steps=101, stretch_search='refine')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cb = self.cst.create_corr_bulk(inplace=False)
+        cb.stats.start_lag = -(cb.stats.npts - 1)/2*cb.stats.delta
+        cb.filter((1, 4))
+        dv = self.m._stretch_bulk(cb, 5, 5, None, {})
+        self.assertEqual(len(dv.value), 3)
+
+    @mock.patch('seismic.monitor.monitor.CorrelationDataBase')
+    def test_tw_too_long(self, cdb_mock):
+        cdb = cdb_mock.return_value.__enter__.return_value
+        cdb.get_data.return_value = self.cst
+        cdb.get_corr_options.return_value = {
+            'corr_args': {'lengthToSave': 12}}
+        with self.assertRaises(ValueError):
+            self.m.compute_velocity_change(
+                'file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ')
+
+
+class TestSkipUnchanged(unittest.TestCase):
+    def setUp(self):
+        with open('params_example.yaml') as file:
+            self.options = yaml.load(file, Loader=yaml.FullLoader)
+        self.dir = tempfile.mkdtemp()
+        self.options['proj_dir'] = self.dir
+        self.options['dv'].update(
+            freq_min=1, freq_max=2, tw_start=5, tw_len=5,
+            skip_unchanged=True)
+        self.m = monitor.Monitor.__new__(monitor.Monitor)
+        self.m.options = self.options
+        self.m.outdir = os.path.join(self.dir, 'vel_change')
+        self.m.logger = mock.MagicMock()
+        self.m.comm = monitor.MPI.COMM_WORLD
+        self.m.rank = 0
+        self.m.psize = 1
+        self.corr_file = os.path.join(self.dir, 'X-X.A-A.-.HHZ-HHZ.h5')
+        with open(self.corr_file, 'w') as f:
+            f.write('a')
+        self.outf = os.path.join(self.m.outdir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')
+        self.figf = os.path.join(
+            self.dir, self.options['fig_subdir'], 'X-X_A-A_-_HHZ-HHZ.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_output(self, *args):
+        os.makedirs(self.m.outdir, exist_ok=True)
+        with open(self.outf, 'w') as f:
+            f.write('dv')
+        if self.options['dv']['plot_vel_change']:
+            os.makedirs(os.path.dirname(self.figf), exist_ok=True)
+            with open(self.figf, 'w') as f:
+                f.write('fig')
+
+    def test_input_stamp(self):
+        stamp = monitor.input_stamp(self.corr_file)
+        self.assertEqual(stamp[0][:2], ('X-X.A-A.-.HHZ-HHZ.h5', 1))
+        self.assertEqual(
+            monitor.input_stamp(os.path.join(self.dir, 'bla.h5')),
+            [('bla.h5', None, None)])
+
+    def test_build_digest(self):
+        d = monitor.build_digest({'a': 1, 'b': [2, 3]}, 'x')
+        self.assertEqual(d, monitor.build_digest({'b': [2, 3], 'a': 1}, 'x'))
+        self.assertNotEqual(d, monitor.build_digest({'a': 1, 'b': [2]}, 'x'))
+
+    @mock.patch.object(monitor.Monitor, '_find_channel_combinations')
+    @mock.patch.object(monitor.Monitor, 'compute_velocity_change')
+    def test_dv(self, cvc_mock, fcc_mock):
+        fcc_mock.return_value = [
+            (self.corr_file, 'X-X', 'A-A', '-', 'HHZ-HHZ')]
+        cvc_mock.side_effect = self.write_output
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 1)
+        # Unchanged or only plotting changed
+        self.m.compute_velocity_change_bulk()
+        self.options['dv']['plot_vel_change'] = False
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 1)
+        # Options changed
+        self.options['dv']['stretch_steps'] = 5
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 2)
+        # Input changed
+        os.utime(self.corr_file, ns=(0, 10**9))
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 3)
+        # Output missing
+        os.remove(self.outf)
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 4)
+
+    @mock.patch.object(monitor.Monitor, '_find_channel_combinations')
+    @mock.patch.object(monitor.Monitor, 'compute_velocity_change')
+    def test_dv_figure_missing(self, cvc_mock, fcc_mock):
+        fcc_mock.return_value = [
+            (self.corr_file, 'X-X', 'A-A', '-', 'HHZ-HHZ')]
+        cvc_mock.side_effect = self.write_output
+        self.options['dv']['plot_vel_change'] = False
+        self.m.compute_velocity_change_bulk()
+        # Plotting enabled, but the figure does not exist
+        self.options['dv']['plot_vel_change'] = True
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 2)
+        self.assertTrue(os.path.isfile(self.figf))
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 2)
+        os.remove(self.figf)
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 3)
+
+    def test_dv_figure(self):
+        self.assertEqual(self.m._dv_figure(
+            self.m.outdir, 'X-X', 'A-A', '-', 'HHZ-HHZ'), self.figf)
+        self.assertEqual(
+            self.m._dv_figure(
+                os.path.join(self.m.outdir, 'f1-2_tw5-5'), 'X-X', 'A-A', '-',
+                'HHZ-HHZ'),
+            self.figf[:-4] + '_f1-2_tw5-5.png')
+
+    @mock.patch.object(monitor.Monitor, '_find_channel_combinations')
+    @mock.patch.object(monitor.Monitor, 'compute_velocity_change')
+    def test_dv_failed(self, cvc_mock, fcc_mock):
+        fcc_mock.return_value = [
+            (self.corr_file, 'X-X', 'A-A', '-', 'HHZ-HHZ')]
+        cvc_mock.side_effect = ValueError
+        self.m.compute_velocity_change_bulk()
+        cvc_mock.side_effect = self.write_output
+        self.m.compute_velocity_change_bulk()
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 2)
+
+    @mock.patch.object(monitor.Monitor, '_find_channel_combinations')
+    @mock.patch.object(monitor.Monitor, 'compute_velocity_change')
+    def test_dv_disabled(self, cvc_mock, fcc_mock):
+        fcc_mock.return_value = [
+            (self.corr_file, 'X-X', 'A-A', '-', 'HHZ-HHZ')]
+        cvc_mock.side_effect = self.write_output
+        self.options['dv']['skip_unchanged'] = False
+        self.m.compute_velocity_change_bulk()
+        self.m.compute_velocity_change_bulk()
+        self.assertEqual(cvc_mock.call_count, 2)
+        self.assertFalse(
+            os.path.isdir(os.path.join(self.dir, '.build_cache')))
+
+
+class TestComputeWaveformCoherence(unittest.TestCase):
+    def setUp(self):
+        with open('params_example.yaml') as file:
+            self.options = yaml.load(file, Loader=yaml.FullLoader)
+        self.outdir = tempfile.mkdtemp()
+        starttimes = [UTCDateTime(0) + ii*86400 for ii in range(4)]
+        self.options['proj_dir'] = self.outdir
+        self.options['wfc'].update(
+            freq_min=[1, 2], freq_max=[2, 4], tw_start=[2, 5, 8], tw_len=2,
+            preprocessing=[], save_comps=False,
+            start_date=str(starttimes[0]), end_date=str(starttimes[-1]),
+            date_inc=86400, win_len=86400,
+            dt_ref={'win_inc': 0, 'method': 'mean', 'percentile': 50})
+        self.m = monitor.Monitor.__new__(monitor.Monitor)
+        self.m.options = self.options
+        self.m.logger = mock.MagicMock()
+        self.m.rank = 0
+        tr = read()[0]
+        self.cst = CorrStream()
+        rng = np.random.default_rng(0)
+        for t in starttimes:
+            ctr = CorrTrace(
+                tr.data[:601].astype(float) + rng.normal(size=601)*100)
+            ctr.stats.sampling_rate = 20
+            ctr.stats.start_lag = -15
+            ctr.stats.corr_start = t
+            ctr.stats.corr_end = t + 86400
+            ctr.stats.network = 'X-X'
+            ctr.stats.station = 'A-A'
+            ctr.stats.location = '-'
+            ctr.stats.channel = 'HHZ-HHZ'
+            self.cst.append(ctr)
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def compute(self):
+        with mock.patch(
+                'seismic.monitor.monitor.CorrelationDataBase') as cdb_mock:
+            cdb = cdb_mock.return_value.__enter__.return_value
+            cdb.get_data.return_value = self.cst.copy()
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                return list(self.m.compute_waveform_coherence(
+                    'file', 'subdivision', 'X-X', 'A-A', '-', 'HHZ-HHZ'))
+
+    def per_window(self, wfc):
+        # Compute the same wfc on a trimmed copy of the filtered bulk
+        p = wfc.wfc_processing
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cb = self.cst.create_corr_bulk(inplace=False)
+            cb.normalize(normtype='absmax')
+            cb.resample(*monitor.make_time_list(
+                self.options['wfc']['start_date'],
+                self.options['wfc']['end_date'], 86400, 86400))
+        cb.filter((p['freq_min'], p['freq_max']))
+        cb.trim(-(p['tw_start'] + p['tw_len']), p['tw_start'] + p['tw_len'])
+        tr = cb.extract_multi_trace(**self.options['wfc']['dt_ref'])
+        tw = [np.arange(
+            p['tw_start']*20, (p['tw_start'] + p['tw_len'])*20, 1)]
+        return cb.wfc(
+            tr, tw, 'both', p['tw_start'], p['tw_len'], p['freq_min'],
+            p['freq_max'])
+
+    def test_all_bands_and_windows(self):
+        wfcs = self.compute()
+        self.assertEqual(len(wfcs), 6)
+        self.assertEqual(
+            [(wfc.wfc_processing['freq_min'], wfc.wfc_processing['tw_start'])
+                for wfc in wfcs],
+            [(1, 2), (1, 5), (1, 8), (2, 2), (2, 5), (2, 8)])
+        for wfc in wfcs:
+            exp = self.per_window(wfc)
+            np.testing.assert_allclose(wfc['reftr_0'], exp['reftr_0'])
+            self.assertEqual(wfc.stats.npts, exp.stats.npts)
+            self.assertTrue(wfc.mean.size)
+
+    def test_window_dependent_reference(self):
+        self.options['wfc']['dt_ref'].update(method='norm_mean', win_inc=2)
+        wfcs = self.compute()
+        self.assertEqual(len(wfcs), 6)
+        for wfc in wfcs:
+            exp = self.per_window(wfc)
+            self.assertEqual(list(wfc.keys()), list(exp.keys()))
+            for k in wfc:
+                np.testing.assert_allclose(wfc[k], exp[k])
+
+    def test_reference_extracted_once(self):
+        with mock.patch.object(
+                monitor.CorrBulk, 'extract_multi_trace',
+                return_value=np.ones(401)) as emt_mock:
+            wfcs = self.compute()
+        self.assertEqual(emt_mock.call_count, 2)
+        self.assertEqual(len(wfcs), 6)
+
+    def test_short_window(self):
+        self.options['wfc']['tw_start'] = [0, 5]
+        self.options['wfc']['tw_len'] = [0.2, 2]
+        wfcs = self.compute()
+        self.assertEqual(len(wfcs), 2)
+        self.assertEqual(self.m.logger.error.call_count, 2)
+
+    @mock.patch.object(monitor.Monitor, '_find_channel_combinations')
+    def test_bulk(self, fcc_mock):
+        fcc_mock.return_value = [
+            ('file', 'X-X', 'A-A', '-', 'HHZ-HHZ'),
+            ('file', 'X-X', 'A-A', '-', 'HHE-HHE')]
+        self.m.comm = monitor.MPI.COMM_WORLD
+        self.m.psize = 1
+        wfcs = self.compute()
+        with mock.patch.object(
+                monitor.Monitor, 'compute_waveform_coherence',
+                side_effect=[iter(wfcs), iter(wfcs)]):
+            self.m.compute_waveform_coherence_bulk()
+        outdir = os.path.join(self.outdir, self.options['wfc']['subdir'])
+        self.assertEqual(len(os.listdir(outdir)), 6)
+        wfc = np.load(os.path.join(
+            outdir, 'WFC-X-X.A-A.-.av.f1-2.tw2-2.npz'))
+        np.testing.assert_allclose(wfc['reftr_0'], wfcs[0]['reftr_0'])
+
+    @mock.patch.object(monitor.Monitor, '_find_channel_combinations')
+    def test_bulk_skip_unchanged(self, fcc_mock):
+        fcc_mock.return_value = [
+            ('file', 'X-X', 'A-A', '-', 'HHZ-HHZ')]
+        self.m.comm = monitor.MPI.COMM_WORLD
+        self.m.psize = 1
+        self.options['wfc']['skip_unchanged'] = True
+        wfcs = self.compute()
+        with mock.patch.object(
+                monitor.Monitor, 'compute_waveform_coherence',
+                side_effect=lambda *args: iter(wfcs)) as cwfc_mock:
+            self.m.compute_waveform_coherence_bulk()
+            self.m.compute_waveform_coherence_bulk()
+            self.assertEqual(cwfc_mock.call_count, 1)
+            self.options['wfc']['tw_len'] = 3
+            self.m.compute_waveform_coherence_bulk()
+            self.assertEqual(cwfc_mock.call_count, 2)
+
+
+class TestWFCSums(unittest.TestCase):
+    def setUp(self):
+        stats = CorrStats()
+        stats.network = 'X-X'
+        stats.station = 'A-A'
+        wfcp = {'freq_min': 1, 'freq_max': 2, 'tw_start': 0, 'tw_len': 5}
+        self.wfcs = []
+        for ii in range(5):
+            data = np.random.rand(1, 10)
+            data[0, ii] = np.nan
+            self.wfcs.append(monitor.WFC(
+                {'reftr_0': data, 'reftr_1': data*2}, deepcopy(stats), wfcp))
+        self.wfcs[0]['reftr_0'][0, 1] = np.nan
+
+    def test_average(self):
+        a = {}
+        for wfc in self.wfcs[:2]:
+            monitor._add_wfc_to_sums(a, wfc)
+        b = {}
+        for wfc in self.wfcs[2:]:
+            monitor._add_wfc_to_sums(b, wfc)
+        sums = monitor._merge_wfc_sums(a, b)
+        self.assertEqual(len(sums), 1)
+        av = monitor._average_wfc_sums(*sums[('X-X', 'A-A', 1, 2, 0, 5)])
+        exp = monitor.average_components_wfc(self.wfcs)
+        self.assertEqual(av.stats.channel, 'av')
+        for k in exp:
+            np.testing.assert_allclose(av[k], exp[k])
+
+    def test_groups(self):
+        self.wfcs[1].wfc_processing = dict(
+            self.wfcs[1].wfc_processing, tw_start=5)
+        sums = {}
+        for wfc in self.wfcs:
+            monitor._add_wfc_to_sums(sums, wfc)
+        self.assertEqual(len(sums), 2)
+        av = monitor._average_wfc_sums(*sums[('X-X', 'A-A', 1, 2, 5, 5)])
+        np.testing.assert_array_equal(av['reftr_0'], self.wfcs[1]['reftr_0'])
+
+    def test_all_nan(self):
+        self.wfcs = self.wfcs[:1]
+        self.wfcs[0]['reftr_0'][:] = np.nan
+        sums = monitor._add_wfc_to_sums({}, self.wfcs[0])
+        av = monitor._average_wfc_sums(*sums[('X-X', 'A-A', 1, 2, 0, 5)])
+        self.assertTrue(np.all(np.isnan(av['reftr_0'])))
+
+
 class TestCorrectDVShift(unittest.TestCase):
     def setUp(self):
         self.dv = DV(
@@ -613,5 +1260,179 @@ class TestAverageComponentsMemSave(unittest.TestCase):
         self.assertEqual(dv_av.stats.channel, 'A')
 
 
+def save_dv(path: str, channel: str, nt: int = 30, shift: float = 0) -> DV:
+    rng = np.random.default_rng(len(path))
+    sim_mat = rng.random((nt, 11)) + shift
+    sim_mat[int(shift*10)] = np.nan
+    stats = CorrStats({
+        'network': 'X-X', 'station': 'A-A', 'location': '-',
+        'channel': channel,
+        'corr_start': [UTCDateTime(ii*3600) for ii in range(nt)],
+        'corr_end': [UTCDateTime(ii*3600 + 3600) for ii in range(nt)]})
+    corr = np.nanmax(sim_mat, axis=1)
+    dv = DV(
+        corr, np.zeros(nt), 'stretch', sim_mat, np.linspace(-.1, .1, 11),
+        'single_ref', stats)
+    dv.save(path)
+    return dv
+
+
+class TestGroupDVFiles(unittest.TestCase):
+    def setUp(self):
+        self.files = [
+            '/d/DV-X-X.A-A.-.HHZ-HHZ.npz', '/d/DV-X-X.A-A.-.HHE-HHE.npz',
+            '/d/DV-X-X.A-A.-.HHE-HHZ.npz', '/d/DV-X-X.A-B.-.HHZ-HHZ.npz',
+            '/d/DV-X-X.A-B.-.HHE-HHZ.npz', '/d/DV-X-X.A-A.av-auto.npz',
+            '/d/DV-X-X.A-A.00-00.HHZ-HHZ.npz', '/d/other.npz']
+
+    def test_auto(self):
+        groups = monitor.group_dv_files(self.files, 'AutoComponents')
+        self.assertDictEqual(groups, {
+            ('X-X', 'A-A', '-'): [
+                '/d/DV-X-X.A-A.-.HHE-HHE.npz', '/d/DV-X-X.A-A.-.HHZ-HHZ.npz'],
+            ('X-X', 'A-A', '00-00'): ['/d/DV-X-X.A-A.00-00.HHZ-HHZ.npz']})
+
+    def test_cross(self):
+        groups = monitor.group_dv_files(self.files, 'CrossComponents')
+        self.assertDictEqual(groups, {
+            ('X-X', 'A-A', '-'): ['/d/DV-X-X.A-A.-.HHE-HHZ.npz']})
+
+    def test_stations(self):
+        groups = monitor.group_dv_files(self.files, 'CrossStations')
+        self.assertDictEqual(groups, {
+            ('X-X', 'A-B', '-'): [
+                '/d/DV-X-X.A-B.-.HHE-HHZ.npz', '/d/DV-X-X.A-B.-.HHZ-HHZ.npz']})
+        groups = monitor.group_dv_files(self.files, 'StationWide')
+        self.assertEqual(len(groups[('X-X', 'A-A', '-')]), 3)
+
+
+class TestAverageComponentsChunked(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = [
+            os.path.join(self.dir, f'DV-X-X.A-A.-.{c}.npz')
+            for c in ['HHE-HHE', 'HHN-HHN', 'HHZ-HHZ']]
+        self.dvs = [
+            save_dv(f[:-4], f.split('.')[-2], shift=ii*.5)
+            for ii, f in enumerate(self.files)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_same_as_average_components(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            exp = monitor.average_components(self.dvs)
+        for chunk_len in [1, 7, 1000]:
+            dv_av = monitor.average_components_chunked(
+                self.files, chunk_len=chunk_len)
+            np.testing.assert_allclose(dv_av.sim_mat, exp.sim_mat)
+            np.testing.assert_array_equal(dv_av.value, exp.value)
+            np.testing.assert_array_equal(dv_av.corr, exp.corr)
+            np.testing.assert_array_equal(dv_av.n_stat, exp.n_stat)
+            np.testing.assert_array_equal(dv_av.stretches, exp.stretches)
+            self.assertEqual(dv_av.stats.channel, 'av')
+
+    def test_differing_shape(self):
+        save_dv(self.files[1][:-4], 'HHN-HHN', nt=10)
+        with self.assertWarns(UserWarning):
+            dv_av = monitor.average_components_chunked(self.files)
+        np.testing.assert_array_equal(dv_av.n_stat[1:5], 2)
+
+    def test_nothing_to_average(self):
+        with self.assertRaises(ValueError):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.dvs[0].stats.channel = 'av'
+                self.dvs[0].save(self.files[0][:-4])
+                monitor.average_components_chunked(self.files[:1])
+
+
+class TestComputeComponentsAverage(unittest.TestCase):
+    def setUp(self):
+        with open('params_example.yaml') as file:
+            options = yaml.load(file, Loader=yaml.FullLoader)
+        options['dv']['plot_vel_change'] = False
+        self.dir = tempfile.mkdtemp()
+        options['proj_dir'] = self.dir
+        self.m = monitor.Monitor.__new__(monitor.Monitor)
+        self.m.options = options
+        self.m.outdir = self.dir
+        self.m.logger = mock.MagicMock()
+        self.m.comm = monitor.MPI.COMM_WORLD
+        self.m.rank = 0
+        self.m.psize = 1
+        for c in ['HHE-HHE', 'HHZ-HHZ', 'HHE-HHZ']:
+            save_dv(os.path.join(self.dir, f'DV-X-X.A-A.-.{c}'), c)
+        self.outf = os.path.join(self.dir, 'DV-X-X.A-A.av-auto.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            self.m.compute_components_average('bla')
+
+    @mock.patch('seismic.monitor.monitor.average_components_chunked',
+                wraps=monitor.average_components_chunked)
+    def test_skip_unchanged(self, acc_mock: mock.MagicMock):
+        self.m.compute_components_average()
+        acc_mock.assert_called_once_with([
+            os.path.join(self.dir, 'DV-X-X.A-A.-.HHE-HHE.npz'),
+            os.path.join(self.dir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')])
+        self.assertTrue(os.path.isfile(self.outf))
+        # Nothing changed
+        self.m.compute_components_average()
+        acc_mock.assert_called_once()
+        # Changed input
+        infile = os.path.join(self.dir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')
+        mtime = os.path.getmtime(self.outf) + 10
+        os.utime(infile, (mtime, mtime))
+        self.m.compute_components_average()
+        self.assertEqual(acc_mock.call_count, 2)
+
+    @mock.patch('seismic.monitor.monitor.average_components_chunked',
+                wraps=monitor.average_components_chunked)
+    def test_group_changed(self, acc_mock: mock.MagicMock):
+        save_dv(os.path.join(self.dir, 'DV-X-X.A-A.-.HHN-HHN'), 'HHN-HHN')
+        self.m.compute_components_average()
+        self.assertEqual(len(acc_mock.call_args.args[0]), 3)
+        # A component was removed, the average is newer than the inputs
+        os.remove(os.path.join(self.dir, 'DV-X-X.A-A.-.HHN-HHN.npz'))
+        self.m.compute_components_average()
+        self.assertEqual(acc_mock.call_count, 2)
+        acc_mock.assert_called_with([
+            os.path.join(self.dir, 'DV-X-X.A-A.-.HHE-HHE.npz'),
+            os.path.join(self.dir, 'DV-X-X.A-A.-.HHZ-HHZ.npz')])
+        # Only one component left
+        os.remove(os.path.join(self.dir, 'DV-X-X.A-A.-.HHE-HHE.npz'))
+        self.m.compute_components_average()
+        self.assertEqual(acc_mock.call_count, 2)
+        self.assertFalse(os.path.isfile(self.outf))
+
+    def test_bands(self):
+        self.m.options['dv'].update(
+            freq_min=[1, 2], freq_max=[2, 4], tw_start=5, tw_len=5)
+        dirs = [
+            os.path.join(self.dir, d) for d in ['f1-2_tw5-5', 'f2-4_tw5-5']]
+        for ii, d in enumerate(dirs):
+            os.makedirs(d)
+            for c in ['HHE-HHE', 'HHZ-HHZ']:
+                save_dv(
+                    os.path.join(d, f'DV-X-X.A-A.-.{c}'), c, shift=ii*.5)
+        self.m.compute_components_average()
+        # The top level DVs do not belong to any band
+        self.assertFalse(os.path.isfile(self.outf))
+        avs = [
+            read_dv(os.path.join(d, 'DV-X-X.A-A.av-auto.npz')) for d in dirs]
+        for d, av in zip(dirs, avs):
+            np.testing.assert_allclose(
+                av.sim_mat,
+                monitor.average_components_chunked(
+                    sorted(glob(os.path.join(d, 'DV-X-X.A-A.-.*.npz')))
+                ).sim_mat)
+        self.assertFalse(np.allclose(avs[0].corr, avs[1].corr))
+
+
 if __name__ == "__main__":
     unittest.main()
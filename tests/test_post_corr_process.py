@@ -17,6 +17,7 @@ from copy import deepcopy
 
 import numpy as np
 from obspy import UTCDateTime
+from scipy.signal import butter, lfilter
 
 from seismic.monitor import post_corr_process as pcp
 from seismic.correlate.stats import CorrStats
@@ -127,6 +128,73 @@ class TestCorrMatFilter(unittest.TestCase):
         self.assertTrue(
             np.allclose(datafiltft[:, unch], self.dataft[:, unch], rtol=0.001))
 
+    def test_zero_phase(self):
+        b, a = butter(3, np.array((2, 4))/8, btype='band')
+        exp = lfilter(b, a, self.data, axis=1)
+        exp = lfilter(b, a, exp[:, ::-1], axis=1)[:, ::-1]
+        datafilt = pcp.corr_mat_filter(self.data.copy(), self.stats, (2, 4))
+        np.testing.assert_allclose(datafilt, exp, atol=1e-10)
+
+    def test_in_place_float32(self):
+        data = self.data.astype(np.float32)
+        datafilt = pcp.corr_mat_filter(data, self.stats, (2, 4))
+        self.assertIs(datafilt, data)
+        self.assertEqual(datafilt.dtype, np.float32)
+        exp = pcp.corr_mat_filter(self.data.copy(), self.stats, (2, 4))
+        np.testing.assert_allclose(datafilt, exp, atol=1e-4)
+
+    def test_threads(self):
+        data = np.random.rand(100, 512)
+        with mock.patch.object(pcp, '_row_chunks', return_value=[
+                slice(ii, ii + 7) for ii in range(0, 100, 7)]):
+            datafilt = pcp.corr_mat_filter(
+                data.copy(), self.stats, (2, 4), threads=4)
+        exp = pcp.corr_mat_filter(data.copy(), self.stats, (2, 4))
+        np.testing.assert_allclose(datafilt, exp)
+
+
+class TestCorrMatSmooth(unittest.TestCase):
+    def setUp(self):
+        self.data = np.random.rand(30, 40)
+
+    def test_rows(self):
+        for wtype in ['flat', 'hanning', 'blackman']:
+            for wsize in [3, 4, 11]:
+                out = pcp.corr_mat_smooth(
+                    self.data.copy(), wsize, wtype, axis=0)
+                exp = [pcp._smooth(row, wsize, wtype) for row in self.data]
+                np.testing.assert_allclose(out, exp)
+
+    def test_cols(self):
+        for wtype in ['flat', 'hamming']:
+            for wsize in [3, 6, 10]:
+                out = pcp.corr_mat_smooth(
+                    self.data.copy(), wsize, wtype, axis=1)
+                exp = [pcp._smooth(col, wsize, wtype) for col in self.data.T]
+                np.testing.assert_allclose(out, np.array(exp).T)
+
+    def test_threads(self):
+        with mock.patch.object(pcp, '_row_chunks', return_value=[
+                slice(ii, ii + 4) for ii in range(0, 40, 4)]):
+            out = pcp.corr_mat_smooth(self.data.copy(), 5, axis=1, threads=3)
+        exp = pcp.corr_mat_smooth(self.data.copy(), 5, axis=1)
+        np.testing.assert_allclose(out, exp)
+
+    def test_nans(self):
+        self.data[3, 5] = np.nan
+        out = pcp.corr_mat_smooth(self.data, 3, axis=0)
+        self.assertFalse(np.any(np.isnan(out)))
+
+    def test_small_window(self):
+        out = pcp.corr_mat_smooth(self.data.copy(), 2)
+        np.testing.assert_array_equal(out, self.data)
+
+    def test_wrong_window(self):
+        with self.assertRaises(ValueError):
+            pcp.corr_mat_smooth(self.data, 5, 'blabla')
+        with self.assertRaises(ValueError):
+            pcp.corr_mat_smooth(self.data, 35, axis=1)
+
 
 class TestCorrMatTrim(unittest.TestCase):
     def setUp(self):
@@ -204,6 +272,45 @@ class TestCorrMatResample(unittest.TestCase):
         self.assertTrue(np.all(np.isnan(outdata[4, :])))
         self.assertTrue(np.all(outstats['corr_start'] == nstarts))
 
+    def test_overlapping(self):
+        corr_data = np.random.rand(11, 50)
+        starts = [UTCDateTime(ii) for ii in np.arange(0, 101, 10)]
+        stats = {'corr_start': starts}
+        nstarts = np.arange(0, 101, 10.)
+        outdata, outstats = pcp.corr_mat_resample(
+            corr_data, stats, nstarts, nstarts + 30)
+        self.assertEqual(outdata.shape, (11, 50))
+        np.testing.assert_allclose(
+            outdata[:9], (corr_data[:-2] + corr_data[1:-1]
+                          + corr_data[2:])/3)
+        np.testing.assert_allclose(outdata[-1], corr_data[-1])
+        self.assertEqual(outstats['corr_end'][0], UTCDateTime(30))
+
+    def test_unsorted_and_nans(self):
+        corr_data = np.random.rand(4, 50)
+        corr_data[0, :10] = np.nan
+        corr_data[2, :5] = np.nan
+        starts = [UTCDateTime(ii) for ii in (30, 0, 10, 20)]
+        stats = {'corr_start': starts}
+        outdata, _ = pcp.corr_mat_resample(
+            corr_data, stats, [UTCDateTime(0), UTCDateTime(20)])
+        np.testing.assert_allclose(
+            outdata[0], np.nanmean(corr_data[1:3], axis=0))
+        np.testing.assert_allclose(
+            outdata[1, 10:], np.mean(corr_data[[0, 3], 10:], axis=0))
+        np.testing.assert_array_equal(outdata[1, :10], corr_data[3, :10])
+
+    def test_all_nan_and_empty(self):
+        corr_data = np.random.rand(3, 50)
+        corr_data[1, :10] = np.nan
+        starts = [UTCDateTime(ii) for ii in (0, 10, 40)]
+        stats = {'corr_start': starts}
+        outdata, _ = pcp.corr_mat_resample(
+            corr_data, stats, np.array([10., 20., 30.]))
+        self.assertTrue(np.all(np.isnan(outdata[0, :10])))
+        np.testing.assert_array_equal(outdata[0, 10:], corr_data[1, 10:])
+        self.assertTrue(np.all(np.isnan(outdata[1:])))
+
 
 # class CorrMatCorrectDecay(unittest.TestCase):
 #     def setUp(self):
@@ -485,6 +592,51 @@ class TestCorrMatExtractTrace(unittest.TestCase):
         exp = np.ones(21)
         self.assertTrue(np.allclose(out, exp))
 
+    def test_nan(self):
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((50, 21))
+        data[3] = np.nan
+        data[5, 2] = np.nan
+        data[:, 7] = np.nan
+        mm = np.ma.masked_array(data, np.isnan(data))
+        np.testing.assert_allclose(
+            pcp.corr_mat_extract_trace(data, self.stats, 'mean'),
+            np.mean(mm, 0).filled(np.nan))
+        np.testing.assert_allclose(
+            pcp.corr_mat_extract_trace(data, self.stats, 'median'),
+            np.ma.median(mm, 0).filled(np.nan))
+        # the input is not altered
+        self.assertTrue(np.all(np.isnan(data[3])))
+
+    def test_sim_perc_loop(self):
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((50, 21)) + np.sin(np.arange(21))
+        data[3] = np.nan
+        out = pcp.corr_mat_extract_trace(
+            data, self.stats, 'similarity_percentile', 70)
+        # straightforward implementation
+        ndata = data/np.nanmax(np.abs(data), axis=1)[:, None]
+        mean_tr = np.nanmean(ndata, 0)
+        cor = np.array([
+            np.dot(tr, mean_tr)/np.sqrt(np.sum(tr**2)*np.sum(mean_tr**2))
+            for tr in ndata])
+        ind = cor > np.percentile(cor[~np.isnan(cor)], 70)
+        np.testing.assert_allclose(out, np.mean(ndata[ind], 0))
+
+    def test_windows(self):
+        rng = np.random.default_rng(1)
+        data = rng.standard_normal((40, 21))
+        data[4, 5] = np.nan
+        bounds = np.array([[0, 10], [5, 20], [18, 40], [3, 4]])
+        for method in pcp.extract_methods:
+            out = pcp.corr_mat_extract_windows(
+                data, self.stats, bounds, method, 40)
+            exp = [pcp.corr_mat_extract_trace(
+                data[a:b], self.stats, method, 40) for a, b in bounds]
+            np.testing.assert_allclose(out, exp)
+        with self.assertRaises(ValueError):
+            pcp.corr_mat_extract_windows(data, self.stats, bounds, 'bla')
+
     # def test_sim_perc1(self):
     #     # Let's chevck back at some point
     #     indata = np.ones_like(self.data)
@@ -717,6 +869,27 @@ class TestMeasureShift(unittest.TestCase):
         np.testing.assert_array_equal(
             np.linspace(-10, 10, 101), dt.second_axis)
 
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            pcp.measure_shift(self.data, self.stats, method='bla')
+
+    def test_fft_like_shifted_ref(self):
+        rng = np.random.default_rng(2)
+        ref = np.convolve(
+            rng.standard_normal(141), np.hanning(9), 'same')[20:-20]
+        data = np.vstack([np.roll(ref, s) for s in [-3, 0, 4]])
+        data[1, 0] = np.nan
+        kwargs = dict(
+            ref_trc=ref, tw=[[5, 30], [10, 35]], shift_range=8,
+            shift_steps=33, return_sim_mat=True)
+        exp = pcp.measure_shift(data, self.stats, **kwargs)
+        dt = pcp.measure_shift(data, self.stats, method='fft', **kwargs)
+        np.testing.assert_allclose(dt.value, exp.value, atol=.1)
+        np.testing.assert_allclose(dt.corr, exp.corr, atol=1e-3)
+        np.testing.assert_allclose(dt.sim_mat, exp.sim_mat, atol=1e-2)
+        np.testing.assert_array_equal(exp.second_axis, dt.second_axis)
+        np.testing.assert_array_equal(['absolute_shift'], dt.method[0])
+
 
 class TestApplyShift(unittest.TestCase):
     def setUp(self):
@@ -776,6 +949,26 @@ class TestApplyStretch(unittest.TestCase):
         np.testing.assert_array_almost_equal(
             self.data[:, :93], correctdata[:, :93], decimal=3)
 
+    def test_keeps_dtype_and_nan_rows(self):
+        data = deepcopy(self.data)
+        data[1, 5] = np.nan
+        outdata = pcp.apply_stretch(data, self.stats, [.01, .02])[0]
+        self.assertEqual(outdata.dtype, np.float32)
+        self.assertTrue(np.all(np.isnan(outdata[1])))
+        self.assertTrue(np.all(np.isfinite(outdata[0])))
+
+    def test_matches_spline(self):
+        from scipy.interpolate import UnivariateSpline
+        data = np.random.default_rng(1).standard_normal((3, 101))
+        stretches = np.array([-.03, 0, .04])
+        outdata = pcp.apply_stretch(deepcopy(data), self.stats, stretches)[0]
+        times = np.arange(101, dtype=float)
+        for row, out, s in zip(data, outdata, stretches):
+            t = times*np.exp(-s)
+            exp = UnivariateSpline(times, row, s=0)(t)
+            exp[t > times[-1]] = 0
+            np.testing.assert_allclose(out, exp, atol=1e-8)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,105 @@
+'''
+:copyright:
+    The SeisMIC development team (makus@gfz-potsdam.de).
+:license:
+    EUROPEAN UNION PUBLIC LICENCE v. 1.2
+   (https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12)
+:author:
+   Peter Makus (makus@gfz-potsdam.de)
+
+Created: Monday, 19th October 2026 05:12:40 pm
+Last Modified: Monday, 19th October 2026 05:12:40 pm
+'''
+from copy import deepcopy
+import pickle
+import unittest
+
+import numpy as np
+from obspy import UTCDateTime
+
+from seismic.correlate.stats import CorrStats, TimeArray
+
+
+class TestTimeArray(unittest.TestCase):
+    def setUp(self):
+        self.utc = [UTCDateTime(2020, 1, 1) + ii*3600 for ii in range(5)]
+        self.t = TimeArray(self.utc)
+
+    def test_storage(self):
+        self.assertEqual(self.t.dtype, np.float64)
+        np.testing.assert_array_equal(
+            self.t.timestamps, [u.timestamp for u in self.utc])
+        np.testing.assert_array_equal(
+            TimeArray(self.t.timestamps).timestamps, self.t.timestamps)
+
+    def test_element_access(self):
+        self.assertIsInstance(self.t[0], UTCDateTime)
+        self.assertEqual(self.t[-1], self.utc[-1])
+        self.assertEqual(list(self.t), self.utc)
+        self.assertEqual(self.t.tolist(), self.utc)
+        self.assertEqual(min(self.t), self.utc[0])
+        self.assertEqual(self.t.max(), self.utc[-1])
+
+    def test_slicing(self):
+        self.assertIsInstance(self.t[1:3], TimeArray)
+        self.assertEqual(self.t[1:3].tolist(), self.utc[1:3])
+        ii = np.array([True, False, True, False, False])
+        self.assertEqual(self.t[ii].tolist(), [self.utc[0], self.utc[2]])
+        np.testing.assert_array_equal(self.t[::-1].argsort(), range(5)[::-1])
+
+    def test_compare_both_sides(self):
+        exp = np.array([False, False, True, True, True])
+        for res in (
+                self.t >= self.utc[2], self.utc[2] <= self.t,
+                ~(self.t < self.utc[2]), ~(self.utc[2] > self.t)):
+            self.assertIsInstance(res, np.ndarray)
+            np.testing.assert_array_equal(res, exp)
+        np.testing.assert_array_equal(
+            self.utc[2] == self.t, self.t == self.utc[2])
+        np.testing.assert_array_equal(
+            self.utc[2] != self.t, self.t != self.utc[2])
+        # Plain object arrays are compared elementwise as well
+        np.testing.assert_array_equal(
+            self.utc[2] <= np.array(self.utc, dtype=object), exp)
+        # Scalars are not affected
+        self.assertTrue(self.utc[2] <= self.utc[3])
+        self.assertFalse(self.utc[2] == 'bla')
+
+    def test_vectorised(self):
+        np.testing.assert_array_equal(
+            self.t >= self.utc[2], [False, False, True, True, True])
+        np.testing.assert_array_equal(self.t == self.utc, np.ones(5, bool))
+        np.testing.assert_array_equal(
+            self.t - self.utc[0], np.arange(5)*3600.)
+        np.testing.assert_array_equal(np.diff(self.t), np.full(4, 3600.))
+        self.assertEqual(self.t.searchsorted(self.utc[3]), 3)
+
+    def test_datetime64(self):
+        np.testing.assert_array_equal(
+            self.t.datetime64,
+            np.array([u.datetime for u in self.utc], dtype='datetime64[ns]'))
+
+    def test_copy_pickle(self):
+        for t in [deepcopy(self.t), pickle.loads(pickle.dumps(self.t))]:
+            self.assertIsInstance(t, TimeArray)
+            self.assertEqual(t.tolist(), self.utc)
+
+
+class TestCorrStats(unittest.TestCase):
+    def test_list_to_time_array(self):
+        st = CorrStats({'corr_start': [UTCDateTime(ii) for ii in range(3)]})
+        self.assertIsInstance(st.corr_start, TimeArray)
+        self.assertIsInstance(st.starttime, TimeArray)
+        st.corr_end = UTCDateTime(10)
+        self.assertIsInstance(st.corr_end, UTCDateTime)
+
+    def test_eq(self):
+        st = CorrStats({'corr_start': [UTCDateTime(ii) for ii in range(3)]})
+        st2 = deepcopy(st)
+        self.assertEqual(st, st2)
+        st2.corr_start = [UTCDateTime(ii) for ii in range(1, 4)]
+        self.assertNotEqual(st, st2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,10 @@ Created: Monday, 31st May 2021 01:50:04 pm
 Last Modified: Wednesday, 19th June 2024 04:24:46 pm
 '''
 
+import os
+import shutil
+import tempfile
+import tracemalloc
 import unittest
 from unittest import mock
 import warnings
@@ -52,8 +56,7 @@ class TestCorrBulk(unittest.TestCase):
 
     def test_setup_ex_stats(self):
         cb = stream.CorrBulk(np.zeros((5, 5)), stats=deepcopy(self.cb.stats))
-        for v0, v1 in zip(cb.stats.values(), self.cb.stats.values()):
-            self.assertEqual(v0, v1)
+        self.assertEqual(cb.stats, self.cb.stats)
         np.testing.assert_array_equal(cb.data, np.zeros((5, 5)))
 
     def test_get_item(self):
@@ -216,12 +219,27 @@ class TestCorrBulk(unittest.TestCase):
         np.testing.assert_array_equal(np.zeros((25, 25)), cb.data)
         self.assertIn('Computed Envelope', cb.stats.processing_bulk)
 
+    def test_threads(self):
+        # small blocks, so that the matrix is split between the threads
+        def row_chunks(nrows, rowbytes, chunk_bytes=None):
+            return row_chunks_orig(nrows, rowbytes, 2*rowbytes)
+        row_chunks_orig = stream.pcp._row_chunks
+        dv = mock.MagicMock()
+        dv.value = np.array([.01, -.02, .005])
+        dv.value_type = 'stretch'
+        exp = self.cb.copy().envelope().correct_stretch(dv)
+        with mock.patch.object(stream.pcp, '_row_chunks', row_chunks):
+            cb = self.cb.copy().envelope(threads=4)
+            cb.correct_stretch(dv, threads=4)
+        np.testing.assert_array_equal(cb.data, exp.data)
+
     @mock.patch('seismic.correlate.stream.pcp.corr_mat_filter')
     def test_filter(self, filter_mock):
         filter_mock.return_value = np.zeros((25, 25))
         cb = self.cb.copy()
         cb.filter((1, 2), 17)
-        filter_mock.assert_called_once_with(mock.ANY, cb.stats, (1, 2), 17)
+        filter_mock.assert_called_once_with(
+            mock.ANY, cb.stats, (1, 2), 17, threads=1)
         np.testing.assert_array_equal(
             filter_mock.call_args[0][0], self.cb.data)
         self.assertIn(
@@ -265,6 +283,31 @@ class TestCorrBulk(unittest.TestCase):
         calls = [mock.call(mock.ANY, self.cb.stats, 'bla', 25)]*5
         extract_mock.assert_has_calls(calls)
 
+    def test_extract_multi_trace_windows(self):
+        # one pass over all windows gives the same as one call per window
+        rng = np.random.default_rng(0)
+        n = 60
+        stats = stream.CorrStats({
+            'npts': 101, 'sampling_rate': 10., 'start_lag': -5.,
+            'ntrcs': n,
+            'corr_start': [UTCDateTime(ii*3600) for ii in range(n)],
+            'corr_end': [UTCDateTime((ii+1)*3600) for ii in range(n)]})
+        A = rng.standard_normal((n, 101))
+        A[5] = np.nan
+        A[7, 3] = np.nan
+        cb = stream.CorrBulk(A, stats=stats)
+        for method in stream.pcp.extract_methods:
+            for wi in [.25, [.1, .3, .2]]:
+                with mock.patch.object(
+                        stream.pcp, 'corr_mat_extract_trace',
+                        wraps=stream.pcp.corr_mat_extract_trace) as emock:
+                    out = cb.extract_multi_trace(wi, method, 30)
+                emock.assert_not_called()
+                # unsorted times take the slow path
+                ii = np.arange(n)[::-1]
+                exp = cb[ii].extract_multi_trace(wi, method, 30)
+                np.testing.assert_allclose(out, exp)
+
     @mock.patch('seismic.monitor.post_corr_process.measure_shift')
     def test_measure_shift(self, mshift_mock: mock.MagicMock):
         tw = [[0, 1]]
@@ -272,8 +315,8 @@ class TestCorrBulk(unittest.TestCase):
         x = self.cb.measure_shift(tw=tw)
         mshift_mock.assert_called_once_with(
             mock.ANY, self.cb.stats, ref_trc=None, tw=tw,
-            shift_range=10, shift_steps=101, sides='both', return_sim_mat=False
-        )
+            shift_range=10, shift_steps=101, sides='both',
+            return_sim_mat=False, method='shifted_ref')
         np.testing.assert_array_equal(
             mshift_mock.call_args[0][0], self.cb.data)
         self.assertEqual(x, 'bla')
@@ -322,7 +365,8 @@ class TestCorrBulk(unittest.TestCase):
         cb = self.cb.copy()
         smooth_mock.return_value = np.zeros((25, 25))
         cb.smooth(1, 'blub', 125)
-        smooth_mock.assert_called_once_with(mock.ANY, 1, 'blub', 125)
+        smooth_mock.assert_called_once_with(
+            mock.ANY, 1, 'blub', 125, threads=1)
         np.testing.assert_array_equal(
             smooth_mock.call_args[0][0], self.cb.data)
         np.testing.assert_array_equal(cb.data, np.zeros((25, 25)))
@@ -363,7 +407,8 @@ class TestCorrBulk(unittest.TestCase):
         self.cb.stretch(np.zeros((25,)), [1, 2, 3], 0.5, 105, 'bla', True)
         stretch_mock.assert_called_once_with(
             mock.ANY, self.cb.stats, mock.ANY, [1, 2, 3], 0.5, 105, 'bla',
-            True, None, None)
+            True, None, None, search='grid',
+            coarse_steps=None, threads=1)
         np.testing.assert_array_equal(
             stretch_mock.call_args[0][2], np.zeros((25,)))
         dv_mock.assert_called_once_with(test=0, dv_processing=None)
@@ -376,7 +421,8 @@ class TestCorrBulk(unittest.TestCase):
         self.cb.stretch()
         stretch_mock.assert_called_once_with(
             mock.ANY, self.cb.stats, 'ha_funny!', None, 0.1, 101, 'both',
-            False, None, None)
+            False, None, None, search='grid',
+            coarse_steps=None, threads=1)
         np.testing.assert_array_equal(
             stretch_mock.call_args[0][0], self.cb.data)
         dv_mock.assert_called_once_with(
@@ -449,7 +495,7 @@ class TestCorrBulk(unittest.TestCase):
         wfc_func_mock.return_value = {'test': 0}
         self.cb.wfc('myreftr', 'lala', 'both', 0, 15, 1, 2, False)
         wfc_func_mock.assert_called_once_with(
-            mock.ANY, 'myreftr', 'lala', 'both', False)
+            mock.ANY, 'myreftr', 'lala', 'both', False, threads=1)
         statsexp = deepcopy(self.cb.stats)
         wfc_processing = {
             'tw_start': 0,
@@ -459,6 +505,30 @@ class TestCorrBulk(unittest.TestCase):
         }
         wfc_mock.assert_called_once_with({'test': 0}, statsexp, wfc_processing)
 
+    @mock.patch('seismic.correlate.stream.mwcs_estimate')
+    def test_mwcs(self, mwcs_mock):
+        ntr = self.cb.data.shape[0]
+        mwcs_mock.return_value = {
+            'corr': np.ones(ntr), 'value': np.zeros(ntr),
+            'value_err': np.zeros(ntr), 'dt': np.zeros((ntr, 2)),
+            'dt_err': np.zeros((ntr, 2)), 'coh': np.ones((ntr, 2)),
+            'second_axis': np.array([1., 2.]), 'sim_mat': np.array([]),
+            'value_type': 'stretch', 'method': 'mwcs'}
+        dv, windows = self.cb.mwcs(
+            1, 2, 5, 2.5, ref_trc='myreftr', tw=(5, 20),
+            processing={'a': 1}, return_windows=True)
+        mwcs_mock.assert_called_once_with(
+            mock.ANY, 'myreftr', self.cb.stats.delta,
+            self.cb.stats.start_lag, 1, 2, 5, 2.5, tw=(5, 20), sides='both',
+            smooth_half_win=5, min_coh=.65, max_err=.1, max_dt=.1,
+            threads=1)
+        self.assertEqual(dv.method, 'mwcs')
+        self.assertEqual(dv.dv_processing, {'a': 1})
+        np.testing.assert_array_equal(dv.second_axis, [1, 2])
+        self.assertEqual(
+            sorted(windows), ['coh', 'dt', 'dt_err', 'value_err'])
+        self.assertIsInstance(self.cb.mwcs(1, 2, 5, 2.5), stream.DV)
+
     def test_find_index_partial(self):
         start = self.cb.stats.corr_start[0] + 1
         end = self.cb.stats.corr_end[-1] - 1
@@ -492,6 +562,87 @@ class TestCorrBulk(unittest.TestCase):
         self.assertEqual(len(np.nonzero(out)[0]), 0)
 
 
+class TestCorrBulkMemmap(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.A = rng.standard_normal((300, 201))
+        self.A[7] = np.nan
+        self.stats = stream.CorrStats()
+        self.stats['ntrcs'], self.stats['npts'] = self.A.shape
+        self.stats['sampling_rate'] = 10
+        self.stats['start_lag'] = -10.
+        self.dir = tempfile.mkdtemp()
+        # Several blocks of an uneven number of rows
+        self.block_bytes = stream.ooc_block_bytes
+        stream.ooc_block_bytes = 37*self.A[0].nbytes
+
+    def tearDown(self):
+        stream.ooc_block_bytes = self.block_bytes
+        shutil.rmtree(self.dir)
+
+    def cb(self) -> stream.CorrBulk:
+        return stream.CorrBulk(self.A.copy(), stats=deepcopy(self.stats))
+
+    def test_same_as_in_memory(self):
+        dv = mock.MagicMock()
+        dv.value = np.linspace(-.01, .01, 300)
+        dv.value_type = 'stretch'
+        ops = [
+            lambda cb: cb.normalize(normtype='absmax'),
+            lambda cb: cb.filter((.5, 2)),
+            lambda cb: cb.smooth(9, 'hanning', axis=1),
+            lambda cb: cb.smooth(5, 'flat', axis=0),
+            lambda cb: cb.envelope(),
+            lambda cb: cb.taper(2),
+            lambda cb: cb.taper_center(2),
+            lambda cb: cb.correct_stretch(dv),
+            lambda cb: cb.correct_shift(dv),
+            lambda cb: cb.clip(1.),
+            lambda cb: cb.trim(-5, 5)]
+        cbm = self.cb().to_memmap(tmp_dir=self.dir)
+        for op in ops:
+            exp = op(self.cb())
+            cb = op(cbm.copy())
+            self.assertTrue(cb.out_of_core)
+            np.testing.assert_allclose(cb.data, exp.data)
+            self.assertEqual(cb.stats.npts, exp.stats.npts)
+        # the original was not altered
+        np.testing.assert_array_equal(cbm.data, self.A)
+
+    def test_temporary_files_removed(self):
+        cb = self.cb().to_memmap(tmp_dir=self.dir)
+        cb.copy().filter((.5, 2))
+        self.assertTrue(cb.out_of_core)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_to_file(self):
+        path = os.path.join(self.dir, 'data.npy')
+        cb = self.cb().to_memmap(path)
+        cb.normalize(normtype='absmax')
+        cb.data.flush()
+        np.testing.assert_allclose(
+            np.load(path), self.cb().normalize(normtype='absmax').data)
+
+    def test_bounded_memory(self):
+        A = np.ones((2000, 1000))
+        cb = stream.CorrBulk(A, stats=deepcopy(self.stats)).to_memmap(
+            tmp_dir=self.dir)
+        del A
+        stream.ooc_block_bytes = 2**20
+        tracemalloc.start()
+        try:
+            cb = cb.copy()
+            cb.filter((.5, 2))
+            cb.smooth(5, axis=1)
+            cb.normalize()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(cb.out_of_core)
+        # The matrix holds 16 MB
+        self.assertLess(peak, 2**23)
+
+
 class TestReadCorrBulk(unittest.TestCase):
     @mock.patch('seismic.correlate.stream.np.load')
     @mock.patch('seismic.correlate.stream.m3ut.load_header_from_np_array')
@@ -503,7 +654,35 @@ class TestReadCorrBulk(unittest.TestCase):
         np.load.assert_called_once_with('/path/to/file')
         load_header_mock.assert_called_once_with(
             {'something': 0, 'data': 'ishere'})
-        cb_mock.assert_called_once_with('ishere', stats={'stats': 'arehere'})
+        cb_mock.assert_called_once_with(
+            'ishere', stats=stream.CorrStats({'stats': 'arehere'}))
+
+    def test_cb_format(self):
+        rng = np.random.default_rng(0)
+        stats = stream.CorrStats({
+            'network': 'A-B', 'station': 'X-Y', 'channel': 'HHZ-HHZ',
+            'npts': 51, 'sampling_rate': 10., 'start_lag': -2.5,
+            'ntrcs': 40,
+            'corr_start': [UTCDateTime(ii*3600) for ii in range(40)],
+            'corr_end': [UTCDateTime((ii+1)*3600) for ii in range(40)]})
+        cb = stream.CorrBulk(rng.standard_normal((40, 51)), stats=stats)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bulk')
+            cb.save(path, format='cb')
+            path += '.cb'
+            for mmap_mode in [None, 'r', 'c']:
+                cb2 = stream.read_corr_bulk(path, mmap_mode=mmap_mode)
+                self.assertEqual(cb2.out_of_core, mmap_mode is not None)
+                np.testing.assert_array_equal(cb2.data, cb.data)
+                self.assertEqual(cb2.stats, cb.stats)
+                sl = cb2.slice(UTCDateTime(3600*10), UTCDateTime(3600*20))
+                np.testing.assert_array_equal(sl.data, cb.data[9:21])
+            # copy-on-write does not alter the file
+            cb2.normalize()
+            np.testing.assert_array_equal(
+                stream.read_corr_bulk(path).data, cb.data)
+            with self.assertRaises(ValueError):
+                cb.save(path, format='hdf5')
 
 
 class TestCorrStats(unittest.TestCase):
@@ -12,15 +12,102 @@ Last Modified: Monday, 16th January 2023 11:14:10 am
 '''
 
 import unittest
+from unittest import mock
 from copy import deepcopy
 
 import numpy as np
+from scipy.interpolate import UnivariateSpline
 
 from seismic.monitor import stretch_mod as sm
 from seismic.correlate.stats import CorrStats
 from seismic.monitor.post_corr_process import apply_stretch
 
 
+class TestStretchedReferenceCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = sm.StretchedReferenceCache(max_bytes=2000)
+
+    def test_get(self):
+        compute = mock.MagicMock(return_value=np.ones(100))
+        for _ in range(3):
+            out = self.cache.get('a', compute)
+        compute.assert_called_once_with()
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.nbytes, 800)
+        with self.assertRaises(ValueError):
+            out[0] = 2
+
+    def test_lru(self):
+        self.cache.get('a', lambda: np.ones(100))
+        self.cache.get('b', lambda: np.ones(100))
+        self.cache.get('a', lambda: np.ones(100))
+        self.cache.get('c', lambda: np.ones(100))
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+        self.assertLessEqual(self.cache.nbytes, 2000)
+        self.cache.resize(1000)
+        self.assertEqual(list(self.cache.entries), ['c'])
+
+    def test_too_large(self):
+        out = self.cache.get('a', lambda: np.ones(1000))
+        self.assertEqual(len(out), 1000)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.nbytes, 0)
+
+    def test_view_copied(self):
+        base = np.ones((10, 100))
+        out = self.cache.get('a', lambda: base[:, :10])
+        self.assertIsNone(out.base)
+        self.assertEqual(self.cache.nbytes, 800)
+
+    def test_key(self):
+        ref = np.arange(10.)
+        strvec = np.linspace(-.1, .1, 11)
+        key = self.cache.key(ref, strvec, True, None)
+        self.assertEqual(key, self.cache.key(ref.copy(), strvec, True, None))
+        self.assertNotEqual(key, self.cache.key(ref + 1, strvec, True, None))
+        self.assertNotEqual(key, self.cache.key(ref, strvec*2, True, None))
+        self.assertNotEqual(key, self.cache.key(ref, strvec, False, None))
+
+    def test_disabled(self):
+        cache = sm.StretchedReferenceCache(max_bytes=0)
+        compute = mock.MagicMock(return_value=np.ones(10))
+        cache.get('a', compute)
+        cache.get('a', compute)
+        self.assertEqual(compute.call_count, 2)
+        self.assertEqual(len(cache), 0)
+        # disabled unless enabled by the Monitor
+        self.assertEqual(sm.ref_cache.max_bytes, 0)
+
+    @mock.patch.object(sm, 'ref_cache', sm.StretchedReferenceCache())
+    def test_time_stretch_estimate(self):
+        ref = np.sin(np.arange(101)*.3)
+        data = np.tile(ref, (3, 1))
+        dv0 = sm.time_stretch_estimate(data, ref, stretch_steps=11)
+        self.assertEqual(len(sm.ref_cache), 1)
+        hits = sm.ref_cache.hits
+        dv1 = sm.time_stretch_estimate(data, ref, stretch_steps=11)
+        self.assertEqual(sm.ref_cache.hits, hits + 1)
+        np.testing.assert_array_equal(dv0['sim_mat'], dv1['sim_mat'])
+        sm.time_stretch_estimate(data, ref, stretch_steps=11, sides='single')
+        self.assertEqual(len(sm.ref_cache), 2)
+        dv2 = sm.time_stretch_estimate(
+            data, ref, stretch_steps=11, use_cache=False)
+        self.assertEqual(sm.ref_cache.hits, hits + 1)
+        np.testing.assert_array_equal(dv0['sim_mat'], dv2['sim_mat'])
+
+    @mock.patch.object(sm, 'ref_cache', sm.StretchedReferenceCache())
+    def test_refine_fine_not_cached(self):
+        ref = np.sin(np.arange(101)*.3)
+        data = np.tile(ref, (3, 1))
+        sm.time_stretch_estimate(
+            data, ref, stretch_steps=101, search='refine')
+        # only the coarse grid is cached
+        self.assertEqual(len(sm.ref_cache), 1)
+        coarse = next(iter(sm.ref_cache.entries.values()))
+        self.assertLess(len(coarse), 101)
+
+
 class TestTimeWindowsCreation(unittest.TestCase):
     def test_wrong_leng(self):
         with self.assertRaises(ValueError):
@@ -39,6 +126,57 @@ class TestTimeWindowsCreation(unittest.TestCase):
         self.assertEqual(out[0][0], st)
 
 
+class TestComputeWFC(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.mat = rng.normal(size=(10, 201))
+        self.mat[2, 50:60] = np.nan
+        self.ref = rng.normal(size=201)
+        self.tw = [np.arange(0, 20), np.arange(10, 40), np.arange(50, 100)]
+
+    def reference_wfc(self, ref, ctw):
+        # Straightforward implementation for a single window
+        center = 100
+        ind = np.hstack((center - ctw[::-1], center + ctw))
+        ind = np.unique(ind)
+        mat = np.nan_to_num(self.mat)[:, ind]
+        ref = ref[ind]
+        return mat @ ref / np.sqrt(np.sum(mat**2, axis=1)*np.sum(ref**2))
+
+    def test_all_windows(self):
+        corr = sm.compute_wfc(self.mat, self.tw, self.ref, 'both')
+        self.assertEqual(corr.shape, (3, 10))
+        for ii, ctw in enumerate(self.tw):
+            np.testing.assert_allclose(
+                corr[ii], self.reference_wfc(self.ref, ctw))
+
+    def test_identical(self):
+        corr = sm.compute_wfc(
+            np.tile(self.ref, (3, 1)), self.tw, self.ref, 'right')
+        np.testing.assert_allclose(corr, 1)
+
+    def test_ref_per_window(self):
+        refs = np.vstack((self.ref, -self.ref, 2*self.ref))
+        corr = sm.compute_wfc(self.mat, self.tw, refs, 'both')
+        single = sm.compute_wfc(self.mat, self.tw, self.ref, 'both')
+        np.testing.assert_allclose(corr, single*np.array([[1], [-1], [1]]))
+
+    def test_threads(self):
+        corr = sm.compute_wfc(self.mat, self.tw, self.ref, 'both')
+        np.testing.assert_allclose(
+            sm.compute_wfc(self.mat, self.tw, self.ref, 'both', threads=4),
+            corr, atol=1e-12)
+
+    def test_wrong_number_of_refs(self):
+        with self.assertRaises(ValueError):
+            sm.compute_wfc(
+                self.mat, self.tw, np.vstack((self.ref, self.ref)), 'both')
+
+    def test_wrong_sides(self):
+        with self.assertRaises(ValueError):
+            sm.compute_wfc(self.mat, self.tw, self.ref, 'bla')
+
+
 # pretty complex to test
 # This is a little more like an integral test
 class TestTimeStretchEstimate(unittest.TestCase):
@@ -104,6 +242,335 @@ class TestTimeStretchEstimate(unittest.TestCase):
         np.testing.assert_array_almost_equal(dv['value'], np.array(stretches))
 
 
+class TestVelocityChangeEstimate(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.mat = rng.normal(size=(20, 101))
+        self.ref = rng.normal(size=(11, 101))
+        self.strvec = np.linspace(-.1, .1, 11)
+        self.tw = [np.arange(5, 15), np.arange(20, 45)]
+
+    def masked_sim_mat(self, ctw):
+        # Straightforward computation with the full traces
+        mask = np.zeros(101)
+        mask[ctw] = 1
+        first = self.mat*mask
+        second = self.ref*mask
+        return np.dot(first, second.T)/np.sqrt(np.outer(
+            np.sum(first**2, axis=1), np.sum(second**2, axis=1)))
+
+    def test_result(self):
+        dv = sm.velocity_change_estimate(
+            self.mat, self.tw, self.ref, self.strvec, sides='right',
+            return_sim_mat=True)
+        self.assertEqual(dv['sim_mat'].shape, (20, 11, 2))
+        for ii, ctw in enumerate(self.tw):
+            sim_mat = self.masked_sim_mat(ctw + 50)
+            np.testing.assert_allclose(dv['sim_mat'][..., ii], sim_mat)
+            np.testing.assert_allclose(dv['corr'][ii], sim_mat.max(axis=1))
+            np.testing.assert_array_equal(
+                dv['value'][ii], self.strvec[sim_mat.argmax(axis=1)])
+
+    def test_both_sides(self):
+        dv = sm.velocity_change_estimate(
+            self.mat, [np.arange(10)], self.ref, self.strvec,
+            return_sim_mat=True)
+        sim_mat = self.masked_sim_mat(np.arange(41, 60))
+        np.testing.assert_allclose(dv['sim_mat'], sim_mat)
+
+    def test_float32(self):
+        dv = sm.velocity_change_estimate(
+            self.mat, self.tw, self.ref, self.strvec, sides='single',
+            return_sim_mat=True, dtype=np.float32)
+        self.assertEqual(dv['sim_mat'].dtype, np.float32)
+        np.testing.assert_allclose(
+            dv['sim_mat'][..., 1], self.masked_sim_mat(self.tw[1]),
+            atol=1e-5)
+
+    def test_nan_rows(self):
+        mat = self.mat.copy()
+        mat[3] = 0
+        self.mat[3] = 0
+        dv = sm.velocity_change_estimate(
+            mat, self.tw, self.ref, self.strvec, sides='single')
+        self.assertTrue(np.all(np.isnan(dv['corr'][:, 3])))
+        self.assertTrue(np.all(np.isnan(dv['value'][:, 3])))
+
+    def test_wrong_sides(self):
+        with self.assertRaises(ValueError):
+            sm.velocity_change_estimate(
+                self.mat, self.tw, self.ref, self.strvec, sides='bla')
+
+    def test_tw_too_long(self):
+        with self.assertRaises(IndexError):
+            sm.velocity_change_estimate(
+                self.mat, [np.arange(200)], self.ref, self.strvec,
+                sides='single')
+
+
+class TestRefinedVelocityChangeEstimate(unittest.TestCase):
+    def setUp(self):
+        self.stats = CorrStats()
+        self.stats.start_lag = -50
+        self.stats.npts = 101
+        self.stats.delta = 1
+        self.ref = np.hstack((
+            np.zeros(15), np.sin(np.arange(71)*.3), np.zeros(15)))
+        self.stretches = np.linspace(-.02, .02, 9)
+        self.data = apply_stretch(
+            np.tile(self.ref, (9, 1)), self.stats, self.stretches)[0]
+        self.tw = [np.arange(30)]
+
+    def test_same_as_grid(self):
+        grid = sm.time_stretch_estimate(
+            self.data, self.ref, tw=self.tw, stretch_range=.05,
+            stretch_steps=1001)
+        dv = sm.time_stretch_estimate(
+            self.data, self.ref, tw=self.tw, stretch_range=.05,
+            stretch_steps=1001, search='refine', return_sim_mat=False)
+        self.assertNotIn('sim_mat', dv)
+        # within half a step of the grid search
+        np.testing.assert_allclose(dv['value'], grid['value'], atol=5e-5)
+        np.testing.assert_allclose(dv['corr'], grid['corr'], atol=1e-4)
+        np.testing.assert_allclose(dv['value'], self.stretches, atol=1e-3)
+
+    def test_subgrid(self):
+        # stretches between the grid points
+        stretches = self.stretches + .002
+        data = apply_stretch(
+            np.tile(self.ref, (9, 1)), self.stats, stretches)[0]
+        grid = sm.time_stretch_estimate(
+            data, self.ref, tw=self.tw, stretch_range=.05, stretch_steps=21)
+        dv = sm.time_stretch_estimate(
+            data, self.ref, tw=self.tw, stretch_range=.05, stretch_steps=21,
+            search='refine', coarse_steps=11)
+        err_grid = np.abs(grid['value'] - stretches).max()
+        err = np.abs(dv['value'] - stretches).max()
+        self.assertLess(err, err_grid/2)
+
+    def test_sim_mat(self):
+        grid = sm.time_stretch_estimate(
+            self.data, self.ref, tw=self.tw, stretch_range=.05,
+            stretch_steps=101)
+        dv = sm.time_stretch_estimate(
+            self.data, self.ref, tw=self.tw, stretch_range=.05,
+            stretch_steps=101, search='refine', coarse_steps=11)
+        self.assertEqual(dv['sim_mat'].shape, grid['sim_mat'].shape)
+        np.testing.assert_array_equal(
+            dv['second_axis'], grid['second_axis'])
+        # exact at the maximum
+        imax = grid['sim_mat'].argmax(axis=1)
+        np.testing.assert_allclose(
+            dv['sim_mat'][np.arange(9), imax],
+            grid['sim_mat'][np.arange(9), imax])
+        # interpolated values are still in the range of the similarity
+        self.assertTrue(np.all(np.abs(dv['sim_mat']) <= 1 + 1e-10))
+
+    def test_nan_rows(self):
+        self.data[3] = 0
+        dv = sm.time_stretch_estimate(
+            self.data, self.ref, tw=self.tw, stretch_range=.05,
+            stretch_steps=101, search='refine')
+        self.assertTrue(np.isnan(dv['value'][3]))
+        self.assertTrue(np.isnan(dv['corr'][3]))
+        self.assertFalse(np.any(np.isnan(np.delete(dv['value'], 3))))
+
+    def test_threads(self):
+        # rows are estimated independently, so blocks do not change results
+        tw = [np.arange(30), np.arange(10, 40)]
+        for search in ['grid', 'refine']:
+            dv = sm.time_stretch_estimate(
+                self.data, self.ref, tw=tw, stretch_range=.05,
+                stretch_steps=101, search=search)
+            dvt = sm.time_stretch_estimate(
+                self.data, self.ref, tw=tw, stretch_range=.05,
+                stretch_steps=101, search=search, threads=4)
+            for key in ['corr', 'value', 'sim_mat', 'second_axis']:
+                np.testing.assert_allclose(dvt[key], dv[key], atol=1e-12)
+
+    def test_coarse_steps_too_small(self):
+        with self.assertRaises(ValueError):
+            sm.time_stretch_estimate(
+                self.data, self.ref, tw=self.tw, search='refine',
+                coarse_steps=2)
+
+    def test_unknown_search(self):
+        with self.assertRaises(ValueError):
+            sm.time_stretch_estimate(self.data, self.ref, search='bla')
+
+
+class TestLogStretchEstimate(unittest.TestCase):
+    def setUp(self):
+        self.stats = CorrStats()
+        self.stats.start_lag = -100
+        self.stats.npts = 201
+        self.stats.delta = 1
+        t = np.arange(201) - 100.
+        self.ref = np.sin(t*.4)*np.exp(-np.abs(t)/50)
+        self.stretches = np.linspace(-.02, .02, 9)
+        self.data = apply_stretch(
+            np.tile(self.ref, (9, 1)), self.stats, self.stretches)[0]
+        self.tw = [np.arange(10, 90)]
+
+    def test_same_as_grid(self):
+        for sides, steps in zip(('both', 'right', 'left'), (401, 400, 101)):
+            grid = sm.time_stretch_estimate(
+                self.data, self.ref, tw=self.tw, stretch_range=.05,
+                stretch_steps=steps, sides=sides)
+            dv = sm.time_stretch_estimate(
+                self.data, self.ref, tw=self.tw, stretch_range=.05,
+                stretch_steps=steps, sides=sides, search='fft')
+            self.assertEqual(dv['sim_mat'].shape, grid['sim_mat'].shape)
+            np.testing.assert_allclose(
+                dv['sim_mat'], grid['sim_mat'], atol=.02)
+            np.testing.assert_allclose(
+                dv['value'], grid['value'], atol=.1/(steps - 1) + 1e-10)
+            np.testing.assert_allclose(dv['corr'], grid['corr'], atol=1e-3)
+
+    def test_single(self):
+        data = self.data[:, 100:]
+        dv = sm.log_stretch_estimate(
+            data, self.tw, self.ref[100:], np.linspace(-.05, .05, 101),
+            sides='single')
+        np.testing.assert_allclose(dv['value'], self.stretches, atol=1e-3)
+
+    def test_several_tw(self):
+        dv = sm.log_stretch_estimate(
+            self.data, [np.arange(10, 50), np.arange(50, 90)], self.ref,
+            np.linspace(-.05, .05, 101), return_sim_mat=True)
+        self.assertEqual(dv['sim_mat'].shape, (9, 101, 2))
+        self.assertEqual(dv['value'].shape, (2, 9))
+        for value in dv['value']:
+            np.testing.assert_allclose(value, self.stretches, atol=1e-3)
+
+    def test_nan_rows(self):
+        self.data[3] = np.nan
+        dv = sm.log_stretch_estimate(
+            self.data, self.tw, self.ref, np.linspace(-.05, .05, 101))
+        self.assertTrue(np.isnan(dv['value'][3]))
+        self.assertTrue(np.isnan(dv['corr'][3]))
+
+    def test_wrong_sides(self):
+        with self.assertRaises(ValueError):
+            sm.log_stretch_estimate(
+                self.data, self.tw, self.ref, self.stretches, sides='bla')
+
+    def test_tw_too_long(self):
+        with self.assertRaises(IndexError):
+            sm.log_stretch_estimate(
+                self.data, [np.arange(150)], self.ref, self.stretches)
+
+
+class TestMWCSEstimate(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.stats = CorrStats()
+        self.stats.start_lag = -50
+        self.stats.npts = 2001
+        self.stats.delta = .05
+        # band-limited noise with a decaying envelope
+        lags = self.stats.start_lag + np.arange(2001)*self.stats.delta
+        spec = np.fft.rfft(rng.standard_normal(2001))
+        f = np.fft.rfftfreq(2001, self.stats.delta)
+        spec[(f < 1) | (f > 3)] = 0
+        self.ref = np.fft.irfft(spec, 2001)*np.exp(-np.abs(lags)/20)
+        self.stretches = np.linspace(-.005, .005, 5)
+        self.data = apply_stretch(
+            np.tile(self.ref, (5, 1)), self.stats, self.stretches)[0]
+        self.args = (self.ref, .05, -50, 1, 3, 5, 2.5)
+
+    def test_result(self):
+        dv = sm.mwcs_estimate(self.data, *self.args, tw=(5, 40))
+        self.assertEqual(dv['method'], 'mwcs')
+        self.assertEqual(dv['value_type'], 'stretch')
+        self.assertEqual(dv['dt'].shape, (5, len(dv['second_axis'])))
+        # same sign convention as the stretching
+        np.testing.assert_allclose(dv['value'], self.stretches, atol=3e-4)
+        self.assertTrue(np.all(dv['corr'] > .9))
+        self.assertTrue(np.all(dv['value_err'] < 1e-4))
+        # windows are mirrored about zero lag time
+        np.testing.assert_allclose(
+            dv['second_axis'], -dv['second_axis'][::-1])
+
+    def test_sides(self):
+        for sides in ['left', 'right', 'single']:
+            dv = sm.mwcs_estimate(
+                self.data, *self.args, tw=(5, 40), sides=sides)
+            self.assertEqual(
+                np.all(dv['second_axis'] < 0), sides == 'left')
+            np.testing.assert_allclose(
+                dv['value'], self.stretches, atol=5e-4)
+
+    def test_threads(self):
+        dv = sm.mwcs_estimate(self.data, *self.args, tw=(5, 40))
+        dvt = sm.mwcs_estimate(self.data, *self.args, tw=(5, 40), threads=3)
+        for key in ['corr', 'value', 'dt', 'dt_err', 'coh']:
+            np.testing.assert_allclose(dvt[key], dv[key], atol=1e-12)
+
+    def test_nan_rows(self):
+        self.data[1] = np.nan
+        self.data[2] = 0
+        dv = sm.mwcs_estimate(self.data, *self.args, tw=(5, 40))
+        self.assertTrue(np.all(np.isnan(dv['value'][1:3])))
+        self.assertTrue(np.all(np.isnan(dv['corr'][1:3])))
+        self.assertFalse(np.any(np.isnan(dv['value'][[0, 3, 4]])))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            # band between two frequency bins
+            sm.mwcs_estimate(self.data, self.ref, .05, -50, 1, 1.01, 5, 2.5)
+        with self.assertRaises(ValueError):
+            sm.mwcs_estimate(
+                self.data, *self.args, tw=(5, 40), sides='bla')
+        with self.assertRaises(ValueError):
+            # window longer than the lapse time window
+            sm.mwcs_estimate(self.data, *self.args, tw=(5, 8))
+        with self.assertRaises(ValueError):
+            sm.mwcs_estimate(self.data, self.ref[:-1], *self.args[1:])
+
+
+class TestInterpolateRows(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.mat = rng.standard_normal((5, 60))
+        self.pos = np.linspace(-2, 62, 60)*np.ones((5, 1))
+
+    def test_cubic_matches_univariate_spline(self):
+        from scipy.interpolate import UnivariateSpline
+        out = sm._interpolate_rows(self.mat, self.pos)
+        x = np.arange(60)
+        for row, o, p in zip(self.mat, out, self.pos):
+            exp = UnivariateSpline(x, row, s=0)(p)
+            np.testing.assert_allclose(o, exp, atol=1e-8)
+
+    def test_linear_matches_interp1d(self):
+        from scipy.interpolate import interp1d
+        out = sm._interpolate_rows(self.mat, self.pos, kind='linear')
+        x = np.arange(60)
+        for row, o, p in zip(self.mat, out, self.pos):
+            exp = interp1d(x, row, fill_value='extrapolate')(p)
+            np.testing.assert_allclose(o, exp, atol=1e-10)
+
+    def test_fill_value(self):
+        out = sm._interpolate_rows(self.mat, self.pos, fill_value=0)
+        outside = (self.pos < 0) | (self.pos > 59)
+        self.assertTrue(outside.any())
+        np.testing.assert_array_equal(out[outside], 0)
+        self.assertTrue(np.all(np.isfinite(out)))
+
+    def test_nan_rows_and_dtype(self):
+        mat = self.mat.astype(np.float32)
+        mat[2, 10] = np.nan
+        out = sm._interpolate_rows(mat, self.pos)
+        self.assertEqual(out.dtype, np.float32)
+        self.assertTrue(np.all(np.isnan(out[2])))
+        self.assertTrue(np.all(np.isfinite(np.delete(out, 2, axis=0))))
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            sm._interpolate_rows(self.mat, self.pos, kind='quadratic')
+
+
 class TestTimeShiftApply(unittest.TestCase):
     def test_result(self):
         shift = (np.random.random()*10) - 5
@@ -165,6 +632,23 @@ class TestTimeShiftEstimate(unittest.TestCase):
         dv = sm.time_shift_estimate(corr, self.ref, shift_steps=21)
         np.testing.assert_array_equal(dv['value'], shift)
 
+    def test_result_fft(self):
+        shift = np.arange(-5, 5, 1)
+        corr = np.empty((len(shift), self.n))
+        for ii, s in enumerate(shift):
+            corr[ii] = np.roll(self.ref, s)
+        dv = sm.time_shift_estimate(
+            corr, self.ref, shift_steps=21, method='fft',
+            return_sim_mat=True)
+        np.testing.assert_allclose(dv['value'], shift, atol=.1)
+        self.assertEqual(dv['sim_mat'].shape, (len(shift), 21))
+        np.testing.assert_array_equal(
+            np.argmax(dv['sim_mat'], axis=1), shift + 10)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            sm.time_shift_estimate(self.ref, self.ref, method='bla')
+
     def test_no_stretch(self):
         corr = np.tile(self.ref, (4, 1))
         dv = sm.time_shift_estimate(corr, self.ref, shift_steps=101)
@@ -180,6 +664,60 @@ class TestTimeShiftEstimate(unittest.TestCase):
         np.testing.assert_array_equal(dv['value'], shift)
 
 
+class TestFFTShiftEstimate(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 401
+        self.times = np.linspace(-20, 20, n)
+        self.ref = np.convolve(
+            rng.standard_normal(n + 40), np.hanning(15), 'same')[20:-20]
+        self.stats = CorrStats({'start_lag': -20, 'delta': .1, 'npts': n})
+        self.true = rng.uniform(-8, 8, 20)
+        spl = UnivariateSpline(self.times, self.ref, s=0)
+        self.data = np.array([spl(self.times + t*.1) for t in self.true])
+        self.ind = np.arange(50, 350)
+        self.shifts = np.linspace(-10, 10, 81)
+
+    def test_same_sim_mat(self):
+        ref_mat = sm.create_shifted_ref_mat(
+            self.ref, self.stats, self.shifts*.1)
+        exp = sm.compare_with_modified_reference(
+            self.data, ref_mat, self.ind)
+        dt = sm.fft_shift_estimate(
+            self.data, self.ref, [self.ind], self.shifts, sides='single',
+            return_sim_mat=True)
+        np.testing.assert_allclose(dt['sim_mat'], exp, atol=1e-3)
+        np.testing.assert_array_equal(dt['second_axis'], self.shifts)
+
+    def test_sub_sample_shift(self):
+        dt = sm.fft_shift_estimate(
+            self.data, self.ref, [self.ind], self.shifts, sides='single')
+        np.testing.assert_allclose(dt['value'], self.true, atol=.05)
+        self.assertTrue(np.all(dt['corr'] > .99))
+
+    def test_nan_in_window(self):
+        data = self.data.copy()
+        data[1, 100] = np.nan
+        data[2, 10] = np.nan
+        dt = sm.fft_shift_estimate(
+            data, self.ref, [self.ind], self.shifts, sides='single',
+            remove_nans=False)
+        self.assertTrue(np.isnan(dt['value'][1]))
+        self.assertTrue(np.isnan(dt['corr'][1]))
+        self.assertAlmostEqual(dt['value'][2], self.true[2], places=1)
+
+    def test_value_in_shift_range(self):
+        dt = sm.fft_shift_estimate(
+            self.data, self.ref, [self.ind], np.linspace(-2, 2, 11),
+            sides='single')
+        self.assertTrue(np.all(np.abs(dt['value']) <= 2))
+
+    def test_wrong_ref_length(self):
+        with self.assertRaises(ValueError):
+            sm.fft_shift_estimate(
+                self.data, self.ref[:-1], [self.ind], self.shifts)
+
+
 class TestCreateShiftedRefMat(unittest.TestCase):
     def setUp(self):
         self.ref_trc = np.arange(101.)